@@ -0,0 +1,137 @@
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+
+#
+# A benchmark for the image worker pool, which measures how much snapshot image work slows down the rest of the plugin process.
+#
+# A tick thread stands in for the relay and the printer communication. Every millisecond it does a small amount of python work,
+# like handling a relayed message or a serial line, and records how late each tick ran. The snapshot jobs run at the same time,
+# like Gadget and notifications do, either on a thread in this process or in the image worker pool.
+# The tick latency percentiles are reported for no image work, in process image work, and pool image work.
+#
+# The jobs use the PIL path, a 1080p frame rotated and center cropped like a Gadget snapshot, and a 4K frame scaled to 1080 like a notification.
+#
+# Example:
+#   python3 developer/benchmark/imageworkerbench.py
+#   python3 developer/benchmark/imageworkerbench.py --jobs 40 --workers 2
+#
+
+c_BenchmarkDir = os.path.dirname(os.path.abspath(__file__))
+c_RepoRoot = os.path.dirname(os.path.dirname(c_BenchmarkDir))
+if c_RepoRoot not in sys.path:
+    sys.path.insert(0, c_RepoRoot)
+
+# pylint: disable=wrong-import-position
+from jpegtransformbench import MakeFrame
+
+from octoeverywhere.relaymetrics import RelayMetrics
+from octoeverywhere.imageworkerpool import ImageWorkerPool
+from octoeverywhere.snapshotresizeparams import SnapshotResizeParams
+from octoeverywhere.snapshotimageprocessor import SnapshotImageProcessor
+
+c_TickIntervalSec = 0.001
+
+
+# Does a small amount of python work each tick, and records how late the tick ran.
+class TickThread:
+
+    def __init__(self):
+        self.Running = True
+        self.LatenciesMs = []
+        self.Thread = threading.Thread(target=self._Run, daemon=True)
+
+
+    def Start(self):
+        self.Thread.start()
+
+
+    def Stop(self) -> list:
+        self.Running = False
+        self.Thread.join()
+        return self.LatenciesMs
+
+
+    def _Run(self):
+        nextSec = time.perf_counter() + c_TickIntervalSec
+        while self.Running:
+            sleepSec = nextSec - time.perf_counter()
+            if sleepSec > 0:
+                time.sleep(sleepSec)
+            self.LatenciesMs.append((time.perf_counter() - nextSec) * 1000.0)
+            # Something like parsing a message header and building a response.
+            total = 0
+            for i in range(200):
+                total += i * i
+            _ = str(total).encode()
+            nextSec += c_TickIntervalSec
+            # If we fell behind, don't try to catch up, just measure from now.
+            nextSec = max(nextSec, time.perf_counter())
+
+
+def _Percentile(values:list, p:float) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def _RunJobs(logger:logging.Logger, jobs:list, count:int, usePool:bool) -> float:
+    start = time.perf_counter()
+    for i in range(count):
+        frame, flipH, flipV, rotation, paramsFunc = jobs[i % len(jobs)]
+        if usePool:
+            out = ImageWorkerPool.Get().TryProcessSnapshot(frame, flipH, flipV, rotation, paramsFunc())
+        else:
+            out = SnapshotImageProcessor.ProcessSnapshot(logger, frame, flipH, flipV, rotation, paramsFunc())
+        if out is None or len(out) == 0:
+            raise Exception("The snapshot job failed.")
+    return (time.perf_counter() - start) / count
+
+
+def _Measure(name:str, logger:logging.Logger, jobs:list, count:int, mode:str):
+    tick = TickThread()
+    tick.Start()
+    jobSec = 0.0
+    if mode == "none":
+        time.sleep(2.0)
+    else:
+        jobSec = _RunJobs(logger, jobs, count, mode == "pool")
+    latencies = tick.Stop()
+    print(f"{name:<12}{jobSec * 1000.0:>10.1f}{_Percentile(latencies, 0.5):>10.2f}{_Percentile(latencies, 0.99):>10.2f}{_Percentile(latencies, 0.999):>10.2f}{max(latencies):>10.2f}{len(latencies):>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark for the image worker pool.")
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=1)
+    args = parser.parse_args()
+
+    logger = logging.getLogger("imageworkerbench")
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    logger.setLevel(logging.ERROR)
+    RelayMetrics.Init(logger)
+    ImageWorkerPool.Init(logger)
+    ImageWorkerPool.SetOptions(True, args.workers)
+
+    frame1080 = MakeFrame(1920, 1080, 85)
+    frame4k = MakeFrame(3840, 2160, 85)
+    jobs = [
+        (frame1080, True, False, 90, lambda: SnapshotResizeParams(512, False, False, True)),
+        (frame4k, False, False, 0, lambda: SnapshotResizeParams(1080, True, False, False)),
+    ]
+
+    # Start the worker processes before measuring, since they are kept running between jobs.
+    _RunJobs(logger, jobs, len(jobs), True)
+
+    print(f"{'image work':<12}{'job ms':>10}{'p50 ms':>10}{'p99 ms':>10}{'p99.9 ms':>10}{'max ms':>10}{'ticks':>9}")
+    _Measure("none", logger, jobs, args.jobs, "none")
+    _Measure("in process", logger, jobs, args.jobs, "inline")
+    _Measure("pool", logger, jobs, args.jobs, "pool")
+
+
+if __name__ == "__main__":
+    main()
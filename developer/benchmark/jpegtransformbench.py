@@ -0,0 +1,163 @@
+import io
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+
+#
+# A micro benchmark for the snapshot rotate and flip logic used by notifications and Gadget.
+#
+# It compares the PIL path (decode, transpose or rotate, and re-encode at quality 95) to the lossless jpegtran path from JpegTransform on 1080p webcam frames.
+# By default a frame is generated that's similar to a webcam frame, with gradients, edges, and sensor noise, encoded at a typical webcam quality.
+# A captured frame can also be used, e.g. from `curl -s http://<host>/webcam/?action=snapshot -o frame.jpg`
+#
+# For each transform the time, the output size, and the max pixel difference from a PIL transpose of the decoded source are reported.
+# The lossless path should have a difference of 0, other than any partial blocks on the edges that are trimmed.
+# If jpegtran isn't installed, only the PIL path is reported. It can be installed with `sudo apt-get install libjpeg-turbo-progs`
+#
+# Example:
+#   python3 developer/benchmark/jpegtransformbench.py
+#   python3 developer/benchmark/jpegtransformbench.py --image frame.jpg --rounds 20
+#
+
+c_BenchmarkDir = os.path.dirname(os.path.abspath(__file__))
+c_RepoRoot = os.path.dirname(os.path.dirname(c_BenchmarkDir))
+if c_RepoRoot not in sys.path:
+    sys.path.insert(0, c_RepoRoot)
+
+# pylint: disable=wrong-import-position
+from PIL import Image
+from PIL import ImageDraw
+from PIL import ImageChops
+
+from octoeverywhere.jpegtransform import JpegTransform
+
+# (name, flipH, flipV, rotation)
+c_Transforms = [
+    ("flipH", True, False, 0),
+    ("flipV", False, True, 0),
+    ("rotate90", False, False, 90),
+    ("rotate180", False, False, 180),
+    ("rotate270", False, False, 270),
+    ("flipH+rotate90", True, False, 90),
+]
+
+
+def MakeFrame(width:int, height:int, quality:int) -> bytes:
+    rand = random.Random(7)
+    img = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    draw = ImageDraw.Draw(img)
+    # Some hard edges, like a print bed and a printed part.
+    for _ in range(40):
+        x = rand.randint(0, width)
+        y = rand.randint(0, height)
+        draw.rectangle((x, y, x + rand.randint(20, 400), y + rand.randint(20, 300)), fill=(rand.randint(0, 255), rand.randint(0, 255), rand.randint(0, 255)))
+    # Sensor noise, which is what makes real webcam frames hard to compress.
+    noise = Image.effect_noise((width, height), 12).convert("RGB")
+    img = ImageChops.add(img, noise, 1.0, -128)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+# The PIL path from NotificationsHandler.GetNotificationSnapshot, used when jpegtran is not installed or a resize is needed.
+def _PilTransform(buf:bytes, flipH:bool, flipV:bool, rotation:int) -> bytes:
+    pilImage = Image.open(io.BytesIO(buf))
+    if flipH:
+        pilImage = pilImage.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    if flipV:
+        pilImage = pilImage.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+    if rotation == 90:
+        pilImage = pilImage.transpose(Image.Transpose.ROTATE_270)
+    elif rotation == 180:
+        pilImage = pilImage.transpose(Image.Transpose.ROTATE_180)
+    elif rotation == 270:
+        pilImage = pilImage.transpose(Image.Transpose.ROTATE_90)
+    buffer = io.BytesIO()
+    pilImage.save(buffer, format="JPEG", quality=95)
+    return buffer.getvalue()
+
+
+def _MaxDiff(source:bytes, out:bytes, flipH:bool, flipV:bool, rotation:int) -> int:
+    # Decode the source and transform the pixels, which is the exact result, and compare it to the output.
+    expected = Image.open(io.BytesIO(source)).convert("RGB")
+    if flipH:
+        expected = expected.transpose(Image.Transpose.FLIP_LEFT_RIGHT)
+    if flipV:
+        expected = expected.transpose(Image.Transpose.FLIP_TOP_BOTTOM)
+    if rotation == 90:
+        expected = expected.transpose(Image.Transpose.ROTATE_270)
+    elif rotation == 180:
+        expected = expected.transpose(Image.Transpose.ROTATE_180)
+    elif rotation == 270:
+        expected = expected.transpose(Image.Transpose.ROTATE_90)
+    got = Image.open(io.BytesIO(out)).convert("RGB")
+    if got.size == expected.size:
+        return max(e[1] for e in ImageChops.difference(expected, got).getextrema())
+    # If jpegtran trimmed the partial edge blocks, the transform decides which edges they were on, so compare against each corner and use the best.
+    best = None
+    for x in (0, expected.width - got.width):
+        for y in (0, expected.height - got.height):
+            crop = expected.crop((x, y, x + got.width, y + got.height))
+            diff = max(e[1] for e in ImageChops.difference(crop, got).getextrema())
+            best = diff if best is None else min(best, diff)
+    return best
+
+
+def _Time(func, rounds:int):
+    bestSec = None
+    out = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        out = func()
+        elapsedSec = time.perf_counter() - start
+        if bestSec is None or elapsedSec < bestSec:
+            bestSec = elapsedSec
+    return (bestSec, out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro benchmark for the snapshot rotate and flip logic.")
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--quality", type=int, default=85, help="The jpeg quality of the generated frame.")
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--image", default=None, help="An optional path to a captured jpeg frame to use instead of the generated frame.")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("jpegtransformbench")
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    logger.setLevel(logging.ERROR)
+
+    if args.image is not None:
+        with open(args.image, "rb") as f:
+            frame = f.read()
+    else:
+        frame = MakeFrame(args.width, args.height, args.quality)
+    size = JpegTransform.GetJpegSize(frame)
+    sizeSec, _ = _Time(lambda: JpegTransform.GetJpegSize(frame), args.rounds)
+    print(f"Frame: {size[0]}x{size[1]}, {len(frame) // 1024} KB, header size parse: {sizeSec * 1000000.0:.1f} us")
+
+    hasJpegTran = JpegTransform.GetJpegTranPath() is not None
+    if hasJpegTran is False:
+        print("jpegtran isn't installed, only the PIL path will be reported. Install it with `sudo apt-get install libjpeg-turbo-progs`")
+
+    print(f"{'transform':<18}{'path':<10}{'ms':>10}{'KB':>8}{'size':>12}{'maxdiff':>9}")
+    for name, flipH, flipV, rotation in c_Transforms:
+        paths = [("pil", lambda fh=flipH, fv=flipV, r=rotation: _PilTransform(frame, fh, fv, r))]
+        if hasJpegTran:
+            paths.append(("jpegtran", lambda fh=flipH, fv=flipV, r=rotation: JpegTransform.TryLosslessTransform(logger, frame, fh, fv, r)))
+        for pathName, func in paths:
+            elapsedSec, out = _Time(func, args.rounds)
+            if out is None:
+                print(f"{name:<18}{pathName:<10}{'failed':>10}")
+                continue
+            outSize = JpegTransform.GetJpegSize(out)
+            maxDiff = _MaxDiff(frame, out, flipH, flipV, rotation)
+            print(f"{name:<18}{pathName:<10}{elapsedSec * 1000.0:>10.2f}{len(out) // 1024:>8}{f'{outSize[0]}x{outSize[1]}':>12}{maxDiff:>9}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+import json
+import time
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from wsframing import BuildUpgradeResponse, WsServerConnection, c_OpCodeText, c_OpCodeBinary
+
+#
+# A local http origin that stands in for OctoPrint, Moonraker, or a webcam server.
+#
+# Endpoints:
+#   /static/<name>?size=N       - A static asset of N bytes, with a content type based on the extension.
+#   /api/json?items=N           - A small JSON api response.
+#   /download?size=N            - A large binary download with a content length.
+#   /webcam/?action=stream      - A multipart MJPEG stream, use fps=N and frameSize=N to tune it.
+#   /webcam/?action=snapshot    - A single jpeg, use frameSize=N to tune it.
+#   /websocket                  - A websocket that echoes every message it gets.
+#                                 Use ?pushCount=N&pushSize=N&pushIntervalMs=N to also push messages, like a chatty printer status socket.
+#
+class LocalOrigin:
+
+    c_MjpegBoundary = "oebenchboundary"
+
+    # How many mjpeg stream connections the origin has accepted, so the workloads can tell how many upstream connections the relay made.
+    MjpegConnections = 0
+    SnapshotRequests = 0
+
+    def __init__(self, port:int = 0):
+        self.Server = ThreadingHTTPServer(("127.0.0.1", port), LocalOriginRequestHandler)
+        self.Server.daemon_threads = True
+        self.Port = self.Server.server_address[1]
+        self.Thread = threading.Thread(target=self.Server.serve_forever, name="LocalOrigin", daemon=True)
+
+
+    def Start(self):
+        self.Thread.start()
+
+
+    def Stop(self):
+        self.Server.shutdown()
+        self.Server.server_close()
+
+
+# Returns a deterministic, somewhat compressible buffer of the given size.
+def BuildPayload(sizeBytes:int, seed:int = 0) -> bytes:
+    pattern = bytes(((i * 31 + seed) % 251) for i in range(4096))
+    repeats = sizeBytes // len(pattern) + 1
+    return (pattern * repeats)[:sizeBytes]
+
+
+# Returns a buffer that looks like a jpeg to the MJPEG parsers, it starts with the SOI marker and ends with the EOI marker.
+def BuildFakeJpeg(sizeBytes:int, frameNumber:int) -> bytes:
+    sizeBytes = max(sizeBytes, 8)
+    return b"\xff\xd8\xff\xe0" + BuildPayload(sizeBytes - 6, frameNumber).replace(b"\xff", b"\xfe") + b"\xff\xd9"
+
+
+class LocalOriginRequestHandler(BaseHTTPRequestHandler):
+
+    protocol_version = "HTTP/1.1"
+
+    # Cache the static payloads, so generating them doesn't show up in the benchmark.
+    PayloadCache = {}
+    PayloadCacheLock = threading.Lock()
+
+
+    # Don't log every request to stderr.
+    def log_message(self, format, *args): #pylint: disable=redefined-builtin
+        pass
+
+
+    def do_GET(self):
+        parsed = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(parsed.query)
+        path = parsed.path
+        try:
+            if self.headers.get("Upgrade", "").lower() == "websocket":
+                self._HandleWebsocket(query)
+            elif path.startswith("/static/"):
+                self._HandleStatic(path, query)
+            elif path == "/api/json":
+                self._HandleJson(query)
+            elif path == "/download":
+                self._HandleDownload(query)
+            elif path.startswith("/webcam"):
+                action = self._GetQueryStr(query, "action", "stream")
+                if action == "snapshot":
+                    self._HandleSnapshot(query)
+                else:
+                    self._HandleMjpeg(query)
+            else:
+                self._SendBody(404, "text/plain", b"Not Found")
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+
+    def do_POST(self):
+        # Read and discard the body, then respond like an api would.
+        length = int(self.headers.get("Content-Length", "0"))
+        remaining = length
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 65536))
+            if len(chunk) == 0:
+                break
+            remaining -= len(chunk)
+        self._SendBody(200, "application/json", json.dumps({"received": length}).encode("utf-8"))
+
+
+    def _HandleStatic(self, path:str, query:dict):
+        size = self._GetQueryInt(query, "size", 32 * 1024)
+        contentType = "application/octet-stream"
+        if path.endswith(".js"):
+            contentType = "application/javascript"
+        elif path.endswith(".css"):
+            contentType = "text/css"
+        elif path.endswith(".html"):
+            contentType = "text/html"
+        elif path.endswith(".png"):
+            contentType = "image/png"
+        self._SendBody(200, contentType, self._GetPayload(size))
+
+
+    def _HandleJson(self, query:dict):
+        items = self._GetQueryInt(query, "items", 10)
+        body = json.dumps({"result": [{"id": i, "name": f"item{i}", "value": i * 1.5} for i in range(items)]}).encode("utf-8")
+        self._SendBody(200, "application/json", body)
+
+
+    def _HandleDownload(self, query:dict):
+        size = self._GetQueryInt(query, "size", 50 * 1024 * 1024)
+        chunk = self._GetPayload(256 * 1024)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(size))
+        self.end_headers()
+        remaining = size
+        while remaining > 0:
+            thisSize = min(remaining, len(chunk))
+            self.wfile.write(chunk[:thisSize])
+            remaining -= thisSize
+
+
+    def _HandleSnapshot(self, query:dict):
+        LocalOrigin.SnapshotRequests += 1
+        frameSize = self._GetQueryInt(query, "frameSize", 60 * 1024)
+        self._SendBody(200, "image/jpeg", BuildFakeJpeg(frameSize, 0))
+
+
+    def _HandleMjpeg(self, query:dict):
+        fps = self._GetQueryInt(query, "fps", 30)
+        frameSize = self._GetQueryInt(query, "frameSize", 60 * 1024)
+        frameIntervalSec = 1.0 / max(fps, 1)
+        frames = [BuildFakeJpeg(frameSize, i) for i in range(8)]
+        LocalOrigin.MjpegConnections += 1
+        # Like mjpeg-streamer, this stream has no content length and runs until the client goes away.
+        self.send_response(200)
+        self.send_header("Content-Type", "multipart/x-mixed-replace;boundary=" + LocalOrigin.c_MjpegBoundary)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        frameNumber = 0
+        nextFrameSec = time.time()
+        while True:
+            frame = frames[frameNumber % len(frames)]
+            header = f"--{LocalOrigin.c_MjpegBoundary}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(frame)}\r\n\r\n".encode("ascii")
+            self.wfile.write(header + frame + b"\r\n")
+            self.wfile.flush()
+            frameNumber += 1
+            nextFrameSec += frameIntervalSec
+            sleepSec = nextFrameSec - time.time()
+            if sleepSec > 0:
+                time.sleep(sleepSec)
+            else:
+                nextFrameSec = time.time()
+
+
+    def _HandleWebsocket(self, query:dict):
+        key = self.headers.get("Sec-WebSocket-Key")
+        if key is None:
+            self._SendBody(400, "text/plain", b"Missing Sec-WebSocket-Key")
+            return
+        self.wfile.write(BuildUpgradeResponse(key))
+        self.wfile.flush()
+        # From now on this handler owns the socket, so make sure the http server doesn't try to reuse it.
+        self.close_connection = True
+        ws = WsServerConnection(self.connection)
+
+        # Optionally push messages, like a printer status websocket would.
+        pushCount = self._GetQueryInt(query, "pushCount", 0)
+        if pushCount > 0:
+            pushSize = self._GetQueryInt(query, "pushSize", 512)
+            pushIntervalSec = self._GetQueryInt(query, "pushIntervalMs", 10) / 1000.0
+            def pushThread():
+                payload = BuildPayload(pushSize)
+                try:
+                    for _ in range(pushCount):
+                        ws.SendFrame(c_OpCodeBinary, payload)
+                        time.sleep(pushIntervalSec)
+                except Exception:
+                    pass
+            threading.Thread(target=pushThread, daemon=True).start()
+
+        # Echo everything back.
+        while True:
+            opcode, payload = ws.ReadMessage()
+            if opcode is None:
+                return
+            try:
+                ws.SendFrame(opcode if opcode in (c_OpCodeText, c_OpCodeBinary) else c_OpCodeBinary, payload)
+            except Exception:
+                return
+
+
+    def _SendBody(self, status:int, contentType:str, body:bytes):
+        self.send_response(status)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+    def _GetPayload(self, size:int) -> bytes:
+        with LocalOriginRequestHandler.PayloadCacheLock:
+            payload = LocalOriginRequestHandler.PayloadCache.get(size, None)
+            if payload is None:
+                payload = BuildPayload(size)
+                LocalOriginRequestHandler.PayloadCache[size] = payload
+            return payload
+
+
+    def _GetQueryInt(self, query:dict, name:str, default:int) -> int:
+        values = query.get(name, None)
+        if values is None or len(values) == 0:
+            return default
+        return int(values[0])
+
+
+    def _GetQueryStr(self, query:dict, name:str, default:str) -> str:
+        values = query.get(name, None)
+        if values is None or len(values) == 0:
+            return default
+        return values[0]
@@ -0,0 +1,252 @@
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+
+#
+# A micro benchmark for the mjpeg stream parser used by the webcam relay.
+#
+# It compares the MjpegStreamParser to the old header read logic (120 byte reads, decoding and splitting the headers as strings) on a few stream captures.
+# By default the captures are generated to match the framing and headers each webcam server sends:
+#   - mjpg-streamer, which sends the boundary after each frame and a short set of headers.
+#   - camera-streamer, which sends the boundary before each frame.
+#   - ustreamer, which sends a long list of X-UStreamer-* headers with each frame.
+#   - A stream with no content-length headers, where the parser has to find the next boundary.
+# A recorded capture can also be used, which should be the raw http body of the stream, e.g. from `curl -s http://<host>/webcam/?action=stream --max-time 10 -o capture.bin`
+#
+# The read function blocks until the full size is read, like the urllib3 raw read does, and the reads and the time per frame are reported.
+# The parsed parts are also checked to make sure they add up to the exact stream that was read.
+#
+# Example:
+#   python3 developer/benchmark/mjpegparserbench.py
+#   python3 developer/benchmark/mjpegparserbench.py --capture capture.bin --boundary boundarydonotcross
+#
+
+c_BenchmarkDir = os.path.dirname(os.path.abspath(__file__))
+c_RepoRoot = os.path.dirname(os.path.dirname(c_BenchmarkDir))
+if c_RepoRoot not in sys.path:
+    sys.path.insert(0, c_RepoRoot)
+
+# pylint: disable=wrong-import-position
+from octoeverywhere.Webcam.mjpegstreamparser import MjpegStreamParser
+
+c_Boundary = "boundarydonotcross"
+
+
+# Mimics the raw response read, which blocks until the full size is read or the body is done.
+class CaptureReader:
+
+    def __init__(self, capture:bytes):
+        self.Capture = memoryview(capture)
+        self.Offset = 0
+        self.Reads = 0
+
+
+    def Read(self, size:int):
+        if self.Offset >= len(self.Capture):
+            return None
+        self.Reads += 1
+        data = bytes(self.Capture[self.Offset:self.Offset + size])
+        self.Offset += len(data)
+        return data
+
+
+def _Frame(rand:random.Random, frameSizeBytes:int) -> bytes:
+    # The content doesn't matter, but make sure it has some \r\n sequences in it, like real jpegs sometimes do.
+    body = bytearray(rand.randbytes(frameSizeBytes)) if hasattr(rand, "randbytes") else bytearray(os.urandom(frameSizeBytes))
+    body[0:2] = b"\xff\xd8"
+    body[-2:] = b"\xff\xd9"
+    body[frameSizeBytes // 2:frameSizeBytes // 2 + 4] = b"\r\n\r\n"
+    return bytes(body)
+
+
+def _MakeMjpgStreamerCapture(rand:random.Random, frames:int, frameSizeBytes:int) -> bytes:
+    # mjpg-streamer sends the first boundary with the http headers, and then the next boundary after each frame.
+    out = [f"--{c_Boundary}\r\n".encode()]
+    for i in range(frames):
+        frame = _Frame(rand, frameSizeBytes + rand.randint(-frameSizeBytes // 20, frameSizeBytes // 20))
+        out.append(f"Content-Type: image/jpeg\r\nContent-Length: {len(frame)}\r\nX-Timestamp: {1000 + i}.{rand.randint(0, 999999):06d}\r\n\r\n".encode())
+        out.append(frame)
+        out.append(f"\r\n--{c_Boundary}\r\n".encode())
+    return b"".join(out)
+
+
+def _MakeCameraStreamerCapture(rand:random.Random, frames:int, frameSizeBytes:int) -> bytes:
+    out = []
+    for _ in range(frames):
+        frame = _Frame(rand, frameSizeBytes + rand.randint(-frameSizeBytes // 20, frameSizeBytes // 20))
+        out.append(f"--{c_Boundary}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(frame)}\r\n\r\n".encode())
+        out.append(frame)
+        out.append(b"\r\n")
+    return b"".join(out)
+
+
+def _MakeUStreamerCapture(rand:random.Random, frames:int, frameSizeBytes:int) -> bytes:
+    out = []
+    for i in range(frames):
+        frame = _Frame(rand, frameSizeBytes + rand.randint(-frameSizeBytes // 20, frameSizeBytes // 20))
+        ts = 1000 + i / 30.0
+        headers = [
+            f"--{c_Boundary}",
+            "Content-Type: image/jpeg",
+            f"Content-Length: {len(frame)}",
+            f"X-Timestamp: {ts:.06f}",
+            "X-UStreamer-Online: true",
+            "X-UStreamer-Dropped: 0",
+            "X-UStreamer-Width: 1920",
+            "X-UStreamer-Height: 1080",
+            "X-UStreamer-Client-FPS: 30",
+            f"X-UStreamer-Grab-Time: {ts:.06f}",
+            f"X-UStreamer-Encode-Begin-Time: {ts + 0.001:.06f}",
+            f"X-UStreamer-Encode-End-Time: {ts + 0.009:.06f}",
+            f"X-UStreamer-Expose-Begin-Time: {ts + 0.010:.06f}",
+            f"X-UStreamer-Expose-Cmd-Time: {ts + 0.010:.06f}",
+            f"X-UStreamer-Expose-End-Time: {ts + 0.010:.06f}",
+            f"X-UStreamer-Send-Time: {ts + 0.011:.06f}",
+            "X-UStreamer-Latency: 0.011000",
+        ]
+        out.append(("\r\n".join(headers) + "\r\n\r\n").encode())
+        out.append(frame)
+        out.append(b"\r\n")
+    return b"".join(out)
+
+
+def _MakeNoContentLengthCapture(rand:random.Random, frames:int, frameSizeBytes:int) -> bytes:
+    out = []
+    for _ in range(frames):
+        frame = _Frame(rand, frameSizeBytes + rand.randint(-frameSizeBytes // 20, frameSizeBytes // 20))
+        out.append(f"--{c_Boundary}\r\nContent-Type: image/jpeg\r\n\r\n".encode())
+        out.append(frame)
+        out.append(b"\r\n")
+    return b"".join(out)
+
+
+# The old logic from OctoWebStreamHttpHelper.readStreamChunk, kept here so the two can be compared.
+class LegacyParser:
+
+    def __init__(self, boundaryStr:str, readFunc):
+        self.BoundaryStr = boundaryStr
+        self.ReadFunc = readFunc
+        self.Buffer = bytearray(10*1024)
+        self.HasFailed = False
+
+
+    def ReadPart(self):
+        frameSize = 0
+        headerSize = 0
+        foundContentLength = False
+        filled = 0
+        while foundContentLength is False and filled < 5 * 1024:
+            headerBuffer = self.ReadFunc(120)
+            if headerBuffer is None:
+                return bytes(self.Buffer[:filled]) if filled > 0 else None
+            self.Buffer[filled:filled+len(headerBuffer)] = headerBuffer
+            filled += len(headerBuffer)
+            headerStr = self.Buffer[:filled].decode(errors="ignore")
+            if headerStr.startswith("--"+self.BoundaryStr) is False and headerStr.startswith(self.BoundaryStr) is False and headerStr.startswith("\r\n--"+self.BoundaryStr) is False:
+                pass
+            headerSize = headerStr.find("\r\n\r\n")
+            if headerSize != -1:
+                headerSize += 4 + 2
+                for header in headerStr.split("\r\n"):
+                    if header.lower().startswith("content-length"):
+                        p = header.split(':')
+                        if len(p) == 2:
+                            frameSize = int(p[1].strip())
+                            foundContentLength = True
+                        break
+        if foundContentLength is False:
+            self.HasFailed = True
+            return bytes(self.Buffer[:filled])
+        toRead = (frameSize + headerSize) - filled
+        if toRead < 0:
+            self.HasFailed = True
+            return bytes(self.Buffer[:filled])
+        if toRead > 0:
+            data = self.ReadFunc(toRead)
+            if data is None:
+                return bytes(self.Buffer[:filled])
+            self.Buffer[filled:filled+len(data)] = data
+            filled += len(data)
+        return memoryview(self.Buffer)[0:filled]
+
+
+def _Run(name:str, capture:bytes, boundaryStr:str, createParser, rounds:int) -> dict:
+    bestSec = None
+    parts = 0
+    reads = 0
+    isExact = True
+    for _ in range(rounds):
+        reader = CaptureReader(capture)
+        parser = createParser(boundaryStr, reader.Read)
+        out = []
+        start = time.perf_counter()
+        parts = 0
+        while True:
+            part = parser.ReadPart()
+            if part is None:
+                break
+            out.append(bytes(part))
+            parts += 1
+            # Like the http helper, release the view when we are done with it.
+            if isinstance(part, memoryview):
+                part.release()
+            if parser.HasFailed:
+                # Like the http helper, once the parser fails the rest of the body is read directly.
+                while True:
+                    data = reader.Read(490 * 1024)
+                    if data is None:
+                        break
+                    out.append(data)
+                break
+        elapsedSec = time.perf_counter() - start
+        if bestSec is None or elapsedSec < bestSec:
+            bestSec = elapsedSec
+        reads = reader.Reads
+        isExact = b"".join(out) == capture
+    return {
+        "Name": name,
+        "Parts": parts,
+        "Reads": reads,
+        "ReadsPerPart": round(reads / max(1, parts), 2),
+        "UsPerPart": round(bestSec * 1000000.0 / max(1, parts), 2),
+        "Fallback": parser.HasFailed,
+        "ExactStream": isExact,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro benchmark for the mjpeg stream parser used by the webcam relay.")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--frameSize", type=int, default=60 * 1024)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--capture", default=None, help="An optional path to a recorded multipart stream body to use instead of the generated captures.")
+    parser.add_argument("--boundary", default=c_Boundary, help="The boundary string of the recorded capture.")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("mjpegparserbench")
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    logger.setLevel(logging.ERROR)
+
+    captures = []
+    if args.capture is not None:
+        with open(args.capture, "rb") as f:
+            captures.append((os.path.basename(args.capture), f.read(), args.boundary))
+    else:
+        rand = random.Random(7)
+        captures.append(("mjpg-streamer", _MakeMjpgStreamerCapture(rand, args.frames, args.frameSize), c_Boundary))
+        captures.append(("camera-streamer", _MakeCameraStreamerCapture(rand, args.frames, args.frameSize), c_Boundary))
+        captures.append(("ustreamer", _MakeUStreamerCapture(rand, args.frames, args.frameSize), c_Boundary))
+        captures.append(("no-content-length", _MakeNoContentLengthCapture(rand, args.frames, args.frameSize), c_Boundary))
+
+    print(f"{'capture':<20}{'parser':<10}{'parts':>8}{'reads/part':>12}{'us/part':>10}  fallback  exact")
+    for name, capture, boundaryStr in captures:
+        for parserName, create in (("legacy", LegacyParser), ("new", lambda b, r: MjpegStreamParser(logger, b, r))):
+            r = _Run(name, capture, boundaryStr, create, args.rounds)
+            print(f"{name:<20}{parserName:<10}{r['Parts']:>8}{r['ReadsPerPart']:>12}{r['UsPerPart']:>10}  {str(r['Fallback']):<8}  {r['ExactStream']}")
+
+
+if __name__ == "__main__":
+    main()
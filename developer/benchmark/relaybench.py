@@ -0,0 +1,355 @@
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+import multiprocessing
+
+#
+# An end to end loopback benchmark for the relay.
+#
+# The benchmark runs three things on the local machine:
+#   - A local origin, which stands in for OctoPrint, Moonraker, and the webcam server.
+#   - A stand-in OctoEverywhere server, which the plugin connects to like it would the real service.
+#   - The relay itself, running the real OctoServerCon and OctoSession code in a child process.
+#
+# The workloads open web streams from the stand-in server, like the service does when a user loads the portal,
+# and measure the latency, throughput, CPU time, and memory of the relay.
+#
+# Example:
+#   python3 developer/benchmark/relaybench.py --mode thread --workloads portal,download,webcam,wsecho,mixed
+#   python3 developer/benchmark/relaybench.py --mode asyncio --json asyncio.json
+#
+# The json output can be used to compare the results of two commits or execution modes.
+#
+
+c_BenchmarkDir = os.path.dirname(os.path.abspath(__file__))
+c_RepoRoot = os.path.dirname(os.path.dirname(c_BenchmarkDir))
+for p in (c_RepoRoot, c_BenchmarkDir):
+    if p not in sys.path:
+        sys.path.insert(0, p)
+
+# pylint: disable=wrong-import-position
+from localorigin import LocalOrigin
+from standinserver import StandInServer
+from relayprocess import RunRelayProcess
+
+from octoeverywhere.Proto.MessagePriority import MessagePriority
+
+c_AllWorkloads = ["portal", "download", "webcam", "webcamviewers", "wsecho", "mixed"]
+c_InternalStatsNames = ["SendQueue", "SendBudget", "SendWrites", "PriorityArbiter"]
+
+
+# Talks to the relay child process over a pipe.
+class RelayProcessClient:
+
+    def __init__(self, endpoint:str, originPort:int, mode:str, maxThreads:int, logLevel:str, pipelinedBodyRelay:bool, webcamLatestFrame:bool, webcamMaxFps:int, webcamFanOut:bool):
+        ctx = multiprocessing.get_context("spawn")
+        self.Conn, childConn = ctx.Pipe()
+        self.Lock = threading.Lock()
+        self.Process = ctx.Process(target=RunRelayProcess, args=(childConn, c_RepoRoot, endpoint, originPort, mode, maxThreads, logLevel, pipelinedBodyRelay, webcamLatestFrame, webcamMaxFps, webcamFanOut), daemon=True)
+
+
+    def Start(self):
+        self.Process.start()
+
+
+    def Stop(self):
+        try:
+            self._Call("stop")
+        except Exception:
+            pass
+        self.Process.join(5)
+        if self.Process.is_alive():
+            self.Process.kill()
+
+
+    # Called by the stand-in server when it gets the HandshakeSyn.
+    # The syn has already been sent, so the session exists, but give it a moment in case the process is slow.
+    def GetChallenge(self):
+        deadline = time.time() + 10
+        while time.time() < deadline:
+            challenge = self._Call("challenge")
+            if challenge is not None:
+                return challenge
+            time.sleep(0.01)
+        raise Exception("The relay process never created a session challenge.")
+
+
+    def GetStats(self) -> dict:
+        return self._Call("stats")
+
+
+    def _Call(self, command:str, arg = None):
+        with self.Lock:
+            self.Conn.send((command, arg))
+            return self.Conn.recv()
+
+
+def Percentile(values:list, percent:float):
+    if values is None or len(values) == 0:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round((percent / 100.0) * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def LatencySummary(valuesSec:list) -> dict:
+    return {
+        "Count": len(valuesSec),
+        "P50Ms": _ToMs(Percentile(valuesSec, 50)),
+        "P99Ms": _ToMs(Percentile(valuesSec, 99)),
+        "MaxMs": _ToMs(max(valuesSec) if len(valuesSec) > 0 else None),
+    }
+
+
+def _ToMs(valueSec):
+    if valueSec is None:
+        return None
+    return round(valueSec * 1000.0, 3)
+
+
+# Loads a page worth of static assets and api calls in parallel, like the portal does.
+def RunPortalWorkload(server:StandInServer, args, rounds:int = None) -> dict:
+    rounds = args.portalRounds if rounds is None else rounds
+    ttfb = []
+    total = []
+    roundTimes = []
+    failures = 0
+    for r in range(rounds):
+        roundStart = time.perf_counter()
+        streams = []
+        for i in range(args.portalAssets):
+            streams.append(server.OpenHttpStream(f"/static/asset{i}.js?size={args.portalAssetSize}&r={r}", priority=MessagePriority.Normal))
+        for i in range(args.portalApiCalls):
+            streams.append(server.OpenHttpStream(f"/api/json?items=20&r={r}&i={i}", priority=MessagePriority.High))
+        for s in streams:
+            if not s.Done.wait(args.requestTimeoutSec) or s.StatusCode != 200:
+                failures += 1
+                continue
+            ttfb.append(s.GetTimeToFirstByteSec())
+            total.append(s.GetTotalTimeSec())
+        roundTimes.append(time.perf_counter() - roundStart)
+    return {
+        "Requests": rounds * (args.portalAssets + args.portalApiCalls),
+        "Failures": failures,
+        "TimeToFirstByte": LatencySummary(ttfb),
+        "RequestTime": LatencySummary(total),
+        "PageLoadTime": LatencySummary(roundTimes),
+    }
+
+
+# Downloads one large file, like a gcode or timelapse download.
+def RunDownloadWorkload(server:StandInServer, args) -> dict:
+    stream = server.OpenHttpStream(f"/download?size={args.downloadSize}", priority=MessagePriority.Low)
+    if not stream.Done.wait(args.downloadTimeoutSec):
+        server.CloseStream(stream)
+        return {"Failures": 1, "BodyBytes": stream.BodyBytes}
+    totalSec = stream.GetTotalTimeSec()
+    return {
+        "Failures": 0 if stream.StatusCode == 200 and stream.BodyBytes == args.downloadSize else 1,
+        "BodyBytes": stream.BodyBytes,
+        "WireBytes": stream.WireBytes,
+        "Messages": stream.MessageCount,
+        "TotalTimeMs": _ToMs(totalSec),
+        "ThroughputMBps": round((stream.BodyBytes / (1024 * 1024)) / totalSec, 3) if totalSec else None,
+    }
+
+
+# Streams the webcam for a fixed amount of time.
+def RunWebcamWorkload(server:StandInServer, args) -> dict:
+    stream = server.OpenHttpStream(f"/webcam/?action=stream&fps={args.webcamFps}&frameSize={args.webcamFrameSize}", priority=MessagePriority.Normal)
+    time.sleep(args.webcamSec)
+    bodyBytes = stream.BodyBytes
+    server.CloseStream(stream)
+    expectedBytes = args.webcamFps * args.webcamFrameSize * args.webcamSec
+    return {
+        "Failures": 0 if stream.StatusCode == 200 else 1,
+        "BodyBytes": bodyBytes,
+        "Messages": stream.MessageCount,
+        "TimeToFirstByteMs": _ToMs(stream.GetTimeToFirstByteSec()),
+        "ThroughputMBps": round((bodyBytes / (1024 * 1024)) / args.webcamSec, 3),
+        # Roughly how many of the frames the origin produced made it through the relay.
+        "DeliveredRatio": round(bodyBytes / expectedBytes, 3) if expectedBytes > 0 else None,
+    }
+
+
+# Opens a few webcam streams at once, like several people watching the printer, using the same oracle request the service uses.
+# These go through the webcam helper, so with the fan out enabled they share one upstream connection.
+# While they are streaming, a few snapshots are taken at once, like Gadget and a notification would, which can be served from the streams.
+def RunWebcamViewersWorkload(server:StandInServer, args) -> dict:
+    connectionsBefore = LocalOrigin.MjpegConnections
+    streams = []
+    for _ in range(args.webcamViewers):
+        streams.append(server.OpenHttpStream("/webcam/?action=stream", priority=MessagePriority.Normal, headers={"oe-webcamstream": "1"}))
+    time.sleep(args.webcamSec / 2)
+    snapshotRequestsBefore = LocalOrigin.SnapshotRequests
+    snapshots = [server.OpenHttpStream("/webcam/?action=snapshot", priority=MessagePriority.Normal, headers={"oe-snapshot": "1"}) for _ in range(3)]
+    snapshotTimes = []
+    snapshotFailures = 0
+    for s in snapshots:
+        if not s.Done.wait(args.requestTimeoutSec) or s.StatusCode != 200:
+            snapshotFailures += 1
+            continue
+        snapshotTimes.append(s.GetTotalTimeSec())
+    snapshotRequests = LocalOrigin.SnapshotRequests - snapshotRequestsBefore
+    time.sleep(args.webcamSec / 2)
+    bodyBytes = [s.BodyBytes for s in streams]
+    for s in streams:
+        server.CloseStream(s)
+    return {
+        "Failures": sum(1 for s in streams if s.StatusCode != 200),
+        "UpstreamConnections": LocalOrigin.MjpegConnections - connectionsBefore,
+        "MinViewerMBps": round((min(bodyBytes) / (1024 * 1024)) / args.webcamSec, 3),
+        "MaxViewerMBps": round((max(bodyBytes) / (1024 * 1024)) / args.webcamSec, 3),
+        "SnapshotFailures": snapshotFailures,
+        "SnapshotOriginRequests": snapshotRequests,
+        "SnapshotTime": LatencySummary(snapshotTimes),
+    }
+
+
+# Sends small websocket messages one at a time and measures the round trip, like a chatty printer status socket.
+def RunWsEchoWorkload(server:StandInServer, args) -> dict:
+    gotMessage = threading.Event()
+    def onWsMessage(stream, data, now):
+        gotMessage.set()
+    stream = server.OpenWsStream("/websocket", priority=MessagePriority.High, onWsMessage=onWsMessage)
+    # Give the relay a moment to connect the local websocket.
+    time.sleep(0.5)
+    payload = b"x" * args.wsMessageSize
+    rtts = []
+    failures = 0
+    for _ in range(args.wsMessages):
+        gotMessage.clear()
+        start = time.perf_counter()
+        server.SendWsMessage(stream, payload)
+        if not gotMessage.wait(args.requestTimeoutSec):
+            failures += 1
+            continue
+        rtts.append(time.perf_counter() - start)
+    server.CloseStream(stream)
+    return {
+        "Failures": failures,
+        "RoundTrip": LatencySummary(rtts),
+    }
+
+
+# Runs a webcam stream and a large download in the background while loading the portal.
+# This shows how well the interactive requests hold up against the bulk streams.
+def RunMixedWorkload(server:StandInServer, args) -> dict:
+    webcam = server.OpenHttpStream(f"/webcam/?action=stream&fps={args.webcamFps}&frameSize={args.webcamFrameSize}", priority=MessagePriority.Normal)
+    download = server.OpenHttpStream(f"/download?size={args.downloadSize}", priority=MessagePriority.Low)
+    time.sleep(0.5)
+    portal = RunPortalWorkload(server, args)
+    server.CloseStream(webcam)
+    if not download.Done.is_set():
+        server.CloseStream(download)
+    return {
+        "Portal": portal,
+        "WebcamBodyBytes": webcam.BodyBytes,
+        "DownloadBodyBytes": download.BodyBytes,
+    }
+
+
+c_WorkloadFuncs = {
+    "portal": RunPortalWorkload,
+    "download": RunDownloadWorkload,
+    "webcam": RunWebcamWorkload,
+    "webcamviewers": RunWebcamViewersWorkload,
+    "wsecho": RunWsEchoWorkload,
+    "mixed": RunMixedWorkload,
+}
+
+
+def _StatsDelta(before:dict, after:dict) -> dict:
+    return {
+        "CpuSec": round((after["CpuUserSec"] + after["CpuSystemSec"]) - (before["CpuUserSec"] + before["CpuSystemSec"]), 3),
+        "WallSec": round(after["TimeSec"] - before["TimeSec"], 3),
+        "PeakRssMB": round(after["PeakRssBytes"] / (1024 * 1024), 2),
+        "RssMB": round(after["RssBytes"] / (1024 * 1024), 2),
+        "Threads": after["Threads"],
+    }
+
+
+def _PrintResult(name:str, result:dict, indent:int = 2):
+    print((" " * indent) + name + ":")
+    for key, value in result.items():
+        if isinstance(value, dict):
+            _PrintResult(key, value, indent + 2)
+        else:
+            print((" " * (indent + 2)) + f"{key}: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end loopback benchmark for the OctoEverywhere relay.")
+    parser.add_argument("--mode", default="thread", help="The relay execution mode: thread, worker_pool, or asyncio.")
+    parser.add_argument("--maxThreads", type=int, default=32, help="The max threads for the worker_pool and asyncio modes.")
+    parser.add_argument("--workloads", default=",".join(c_AllWorkloads), help="A comma separated list of workloads to run: " + ", ".join(c_AllWorkloads))
+    parser.add_argument("--portalRounds", type=int, default=10)
+    parser.add_argument("--portalAssets", type=int, default=30)
+    parser.add_argument("--portalAssetSize", type=int, default=48 * 1024)
+    parser.add_argument("--portalApiCalls", type=int, default=5)
+    parser.add_argument("--downloadSize", type=int, default=64 * 1024 * 1024)
+    parser.add_argument("--downloadTimeoutSec", type=float, default=120)
+    parser.add_argument("--webcamSec", type=int, default=10)
+    parser.add_argument("--webcamFps", type=int, default=30)
+    parser.add_argument("--webcamFrameSize", type=int, default=60 * 1024)
+    parser.add_argument("--webcamViewers", type=int, default=4)
+    parser.add_argument("--wsMessages", type=int, default=500)
+    parser.add_argument("--wsMessageSize", type=int, default=120, help="Keep this under 200 bytes so the messages aren't compressed.")
+    parser.add_argument("--requestTimeoutSec", type=float, default=30)
+    parser.add_argument("--webcamLatestFrame", action="store_true", help="Relay webcam streams in the latest frame mode, which skips old frames when the uplink is congested.")
+    parser.add_argument("--webcamMaxFps", type=int, default=0, help="The max fps for the latest frame mode, 0 means there's no limit.")
+    parser.add_argument("--webcamFanOut", action="store_true", help="Share one upstream connection between all of the webcam streams for the same url.")
+    parser.add_argument("--pipelinedBodyRelay", action="store_true", help="Relay large downloads with the body read, compression, and send running at the same time.")
+    parser.add_argument("--logLevel", default="warning", help="The log level of the relay process.")
+    parser.add_argument("--verbose", action="store_true", help="Print the relay's internal queue and arbiter stats for each workload.")
+    parser.add_argument("--json", default=None, help="An optional path to write the results as json.")
+    args = parser.parse_args()
+
+    workloads = [w.strip().lower() for w in args.workloads.split(",") if len(w.strip()) > 0]
+    for w in workloads:
+        if w not in c_WorkloadFuncs:
+            parser.error(f"Unknown workload '{w}'")
+
+    origin = LocalOrigin()
+    origin.Start()
+    relay:RelayProcessClient = None
+    server = StandInServer(lambda: relay.GetChallenge())
+    server.Start()
+    relay = RelayProcessClient(server.GetEndpoint(), origin.Port, args.mode, args.maxThreads, args.logLevel, args.pipelinedBodyRelay, args.webcamLatestFrame, args.webcamMaxFps, args.webcamFanOut)
+    relay.Start()
+
+    results = {"Mode": args.mode, "Workloads": {}}
+    try:
+        if not server.WaitForHandshake(30):
+            print("The relay never completed the handshake with the stand-in server.")
+            sys.exit(1)
+        results["Baseline"] = _StatsDelta(relay.GetStats(), relay.GetStats())
+        for name in workloads:
+            before = relay.GetStats()
+            result = c_WorkloadFuncs[name](server, args)
+            after = relay.GetStats()
+            result["Relay"] = _StatsDelta(before, after)
+            for statsName in c_InternalStatsNames:
+                if statsName in after:
+                    result[statsName] = after[statsName]
+            results["Workloads"][name] = result
+            if args.verbose:
+                _PrintResult(name, result)
+            else:
+                _PrintResult(name, {k: v for k, v in result.items() if k not in c_InternalStatsNames})
+    finally:
+        relay.Stop()
+        server.Stop()
+        origin.Stop()
+
+    if args.json is not None:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, default=str)
+        print("Results written to " + args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import os
+import sys
+import time
+import logging
+import resource
+import tempfile
+import threading
+
+#
+# The entry point for the relay child process.
+#
+# The relay runs in it's own process so the CPU time and peak memory we report are only the plugin's, not the
+# benchmark's stand-in server, local origin, or workload threads.
+#
+# The parent talks to this process over a multiprocessing pipe with simple (command, arg) tuples:
+#   ("challenge", None) - Returns the plain text RSA challenge of the current session, or None if there's no session yet.
+#   ("stats", None)     - Returns a dict of the process resource usage and the relay's internal queue stats.
+#   ("stop", None)      - Exits the process.
+#
+
+c_PrinterId = "BENCHMARKPRINTERID00000000000000000000000"
+c_PrivateKey = "benchmarkprivatekeybenchmarkprivatekeybenchmarkprivatekeybenchmarkprivatekeybenchmarkprivatekey"
+
+
+# A stand-in for the host that owns the OctoServerCon.
+class BenchmarkHostStub:
+
+    def __init__(self, logger:logging.Logger):
+        self.Logger = logger
+
+    def OnSummonRequest(self, summonConnectUrl, summonMethod):
+        self.Logger.info("Benchmark host ignoring summon request for "+str(summonConnectUrl))
+
+
+# A stand-in for the ui popup interface.
+class UiPopupInvokerStub:
+
+    def __init__(self, logger:logging.Logger):
+        self.Logger = logger
+
+    def ShowUiPopup(self, title:str, text:str, msgType:str, actionText:str, actionLink:str, showForSec:int, onlyShowIfLoadedViaOeBool:bool):
+        self.Logger.info("Benchmark popup: "+title+" - "+text)
+
+
+# A minimal webcam platform helper, the benchmark always uses the local origin's webcam endpoints.
+# The setting items are made by RunRelayProcess, since the repo modules are only imported in the relay process.
+class BenchmarkWebcamPlatformHelper:
+
+    def __init__(self, webcamSettingItems:list):
+        self.WebcamSettingItems = webcamSettingItems
+
+    def GetWebcamConfig(self):
+        return self.WebcamSettingItems
+
+    def ShouldQuickCamStreamKeepRunning(self) -> bool:
+        return True
+
+    def KickOffWebcamSettingsUpdate(self, forceUpdate = False):
+        pass
+
+
+def RunRelayProcess(conn, repoRoot:str, endpoint:str, originPort:int, executionMode:str, maxThreads:int, logLevel:str, pipelinedBodyRelay:bool, webcamLatestFrame:bool, webcamMaxFps:int, webcamFanOut:bool):
+    if repoRoot not in sys.path:
+        sys.path.insert(0, repoRoot)
+
+    # pylint: disable=import-outside-toplevel
+    from octoeverywhere.sentry import Sentry
+    from octoeverywhere.httpsessions import HttpSessions
+    from octoeverywhere.compression import Compression
+    from octoeverywhere.httpassetcache import HttpAssetCache
+    from octoeverywhere.httpassetdiskstore import HttpAssetDiskStore
+    from octoeverywhere.deviceid import DeviceId
+    from octoeverywhere.commandhandler import CommandHandler
+    from octoeverywhere.octohttprequest import OctoHttpRequest
+    from octoeverywhere.relayexecutionmode import RelayExecutionMode
+    from octoeverywhere.octoservercon import OctoServerCon
+    from octoeverywhere.Webcam.webcamhelper import WebcamHelper
+    from octoeverywhere.Webcam.webcamsettingitem import WebcamSettingItem
+    from octoeverywhere.Webcam.webcamstreamgovernor import WebcamStreamGovernor
+    from octoeverywhere.Webcam.mjpegfanout import MjpegFanOutManager
+    from octoeverywhere.Proto.ServerHost import ServerHost
+    from octoeverywhere.Proto.SummonMethods import SummonMethods
+
+    logger = logging.getLogger("relaybench")
+    logger.setLevel(getattr(logging, str(logLevel).upper(), logging.WARNING))
+    handler = logging.StreamHandler(sys.stderr)
+    handler.setFormatter(logging.Formatter("[relay] %(levelname)s %(message)s"))
+    logger.addHandler(handler)
+
+    storageDir = tempfile.mkdtemp(prefix="oe-relaybench-")
+
+    # Setup the singletons like the hosts do, but point everything at the local origin.
+    Sentry.SetLogger(logger)
+    HttpSessions.Init(logger)
+    Compression.Init(logger, storageDir)
+    HttpAssetDiskStore.Init(logger, storageDir, 64 * 1024 * 1024)
+    HttpAssetCache.Init(logger, 16 * 1024 * 1024)
+    DeviceId.Init(logger)
+    CommandHandler.Init(logger, None, None, None)
+    OctoHttpRequest.SetLocalHostAddress("127.0.0.1")
+    OctoHttpRequest.SetLocalOctoPrintPort(originPort)
+    OctoHttpRequest.SetLocalHttpProxyPort(originPort)
+    OctoHttpRequest.SetLocalHttpProxyIsHttps(False)
+    OctoHttpRequest.SetEnablePipelinedBodyRelay(pipelinedBodyRelay)
+    WebcamStreamGovernor.SetOptions(webcamLatestFrame, webcamMaxFps, WebcamStreamGovernor.c_DefaultTargetLatencyMs)
+    MjpegFanOutManager.SetEnabled(webcamFanOut)
+    webcamItem = WebcamSettingItem("Benchmark", "/webcam/?action=snapshot", "/webcam/?action=stream", False, False, 0)
+    WebcamHelper.Init(logger, BenchmarkWebcamPlatformHelper([webcamItem]), storageDir)
+    RelayExecutionMode.Setup(logger, executionMode, maxThreads)
+
+    # This isn't the primary connection, so it doesn't try to find the lowest latency server or start the ping pong logic.
+    serverCon = OctoServerCon(BenchmarkHostStub(logger), endpoint, False, False, c_PrinterId, c_PrivateKey, logger,
+                              UiPopupInvokerStub(logger), None, "0.0.0-benchmark", 60 * 60 * 24, SummonMethods.Unknown, ServerHost.OctoPrint, False)
+    threading.Thread(target=serverCon.RunBlocking, name="BenchmarkServerCon", daemon=True).start()
+
+    while True:
+        try:
+            command, _ = conn.recv()
+        except EOFError:
+            break
+        if command == "challenge":
+            conn.send(_GetChallenge(serverCon))
+        elif command == "stats":
+            conn.send(_GetStats(serverCon))
+        elif command == "stop":
+            conn.send(True)
+            break
+        else:
+            conn.send(None)
+    # Don't wait on the relay threads to wind down, they are all daemon threads.
+    # pylint: disable=protected-access
+    os._exit(0)
+
+
+def _GetChallenge(serverCon):
+    session = serverCon.OctoSession
+    if session is None or session.ServerAuth is None:
+        return None
+    return session.ServerAuth.Challenge
+
+
+def _GetStats(serverCon) -> dict:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    stats = {
+        "CpuUserSec": usage.ru_utime,
+        "CpuSystemSec": usage.ru_stime,
+        # On linux ru_maxrss is in KB.
+        "PeakRssBytes": usage.ru_maxrss * 1024,
+        "RssBytes": _GetCurrentRssBytes(),
+        "Threads": threading.active_count(),
+        "TimeSec": time.time(),
+    }
+    ws = serverCon.Ws
+    if ws is not None:
+        for name, func in (("SendQueue", "GetSendQueueStats"), ("SendBudget", "GetSendBudgetStats"), ("SendWrites", "GetSendWriteStats")):
+            try:
+                stats[name] = getattr(ws, func)()
+            except Exception as e:
+                stats[name] = {"Error": str(e)}
+    session = serverCon.OctoSession
+    if session is not None:
+        try:
+            stats["PriorityArbiter"] = session.PriorityArbiter.GetStats()
+        except Exception as e:
+            stats["PriorityArbiter"] = {"Error": str(e)}
+    return stats
+
+
+def _GetCurrentRssBytes() -> int:
+    try:
+        with open("/proc/self/statm", "r", encoding="utf-8") as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except Exception:
+        return 0
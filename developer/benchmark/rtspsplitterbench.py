@@ -0,0 +1,203 @@
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+
+#
+# A micro benchmark for the jpeg frame splitter used by QuickCam_RTSP to split the ffmpeg image2pipe output into frames.
+#
+# It compares the JpegFrameSplitter to the old QuickCam_RTSP logic, which appended each read to a growing buffer,
+# scanned it one byte at a time for the jpeg end, and reset the buffer if it grew past 50k.
+# The stream is read the way the pipe delivers it, in chunks up to the 64k linux pipe buffer, or in larger chunks when the reader is behind.
+# The frame sizes match 720p, 1080p, and 4K ffmpeg output at the default quality.
+#
+# For each case, the frames delivered, the total time, the time per delivered frame, and the peak buffered bytes are reported.
+#
+# Example:
+#   python3 developer/benchmark/rtspsplitterbench.py
+#   python3 developer/benchmark/rtspsplitterbench.py --frames 100 --chunk 262144
+#
+
+c_BenchmarkDir = os.path.dirname(os.path.abspath(__file__))
+c_RepoRoot = os.path.dirname(os.path.dirname(c_BenchmarkDir))
+if c_RepoRoot not in sys.path:
+    sys.path.insert(0, c_RepoRoot)
+
+# pylint: disable=wrong-import-position
+from octoeverywhere.Webcam.jpegframesplitter import JpegFrameSplitter
+
+
+# Mimics the non blocking pipe, which returns up to the chunk size per read.
+# If frame ends are given, a read never crosses one, like when the reader keeps up with ffmpeg and each frame is written and read on its own.
+class PipeReader:
+
+    def __init__(self, stream:bytes, chunkSize:int, frameEnds:list = None):
+        self.Stream = memoryview(stream)
+        self.Offset = 0
+        self.ChunkSize = chunkSize
+        self.FrameEnds = frameEnds
+        self.FrameIndex = 0
+
+
+    def _ReadSize(self, size:int) -> int:
+        size = min(size, self.ChunkSize, len(self.Stream) - self.Offset)
+        if self.FrameEnds is not None:
+            while self.FrameIndex < len(self.FrameEnds) and self.FrameEnds[self.FrameIndex] <= self.Offset:
+                self.FrameIndex += 1
+            if self.FrameIndex < len(self.FrameEnds):
+                size = min(size, self.FrameEnds[self.FrameIndex] - self.Offset)
+        return size
+
+
+    def read(self, size:int):
+        size = self._ReadSize(size)
+        data = bytes(self.Stream[self.Offset:self.Offset + size])
+        self.Offset += len(data)
+        return data
+
+
+    def readinto(self, buffer) -> int:
+        size = self._ReadSize(len(buffer))
+        buffer[:size] = self.Stream[self.Offset:self.Offset + size]
+        self.Offset += size
+        return size
+
+
+def _Frame(rand:random.Random, frameSizeBytes:int) -> bytes:
+    # Like ffmpeg's output, the frames start with the SOI and a comment marker, and the body never has an EOI in it.
+    body = bytearray(rand.randbytes(frameSizeBytes)) if hasattr(rand, "randbytes") else bytearray(os.urandom(frameSizeBytes))
+    body = body.replace(b"\xff", b"\xfe")
+    return b"\xff\xd8\xff\xfe\x00\x10" + bytes(body) + b"\xff\xd9"
+
+
+# The old logic from QuickCam_RTSP.GetImage, kept here so the two can be compared.
+class LegacySplitter:
+
+    def __init__(self, reader:PipeReader):
+        self.Reader = reader
+        self.Buffer = None
+        self.SearchedIndex = 0
+        self.JpegStartSequence = bytearray([0xff, 0xd8, 0xff, 0xfe, 0x00, 0x10])
+        self.JpegStartSequenceLen = len(self.JpegStartSequence)
+        self.JpegEndSequence = bytearray([0xff, 0xd9])
+        self.PeakBuffered = 0
+
+
+    def GetImage(self):
+        while True:
+            buffer = self.Reader.read(100000000)
+            if buffer is None or len(buffer) == 0:
+                return None
+            if self.Buffer is None:
+                if self._CheckIfFullJpeg(buffer):
+                    self._ResetLocalBuffer()
+                    return buffer
+            if self.Buffer is None:
+                self.Buffer = buffer
+            else:
+                self.Buffer += buffer
+            self.PeakBuffered = max(self.PeakBuffered, len(self.Buffer))
+            buffLen = len(self.Buffer)
+            if buffLen <= self.JpegStartSequenceLen:
+                continue
+            if self._CheckIfFullJpeg(self.Buffer):
+                img = self.Buffer
+                self._ResetLocalBuffer()
+                return img
+            newImageStart = -1
+            while self.SearchedIndex < buffLen - self.JpegStartSequenceLen:
+                if self.Buffer[self.SearchedIndex] == self.JpegEndSequence[0] and self.Buffer[self.SearchedIndex+1] == self.JpegEndSequence[1]:
+                    newImageStart = self.SearchedIndex + 2
+                    break
+                self.SearchedIndex += 1
+            if newImageStart != -1:
+                imgBuffer = self.Buffer[:newImageStart]
+                if self._CheckIfFullJpeg(imgBuffer) is False:
+                    self._ResetLocalBuffer()
+                    continue
+                self.Buffer = self.Buffer[newImageStart:]
+                self.SearchedIndex = 0
+                if self.Buffer is not None and len(self.Buffer) > 50000:
+                    self._ResetLocalBuffer()
+                return imgBuffer
+            if self.Buffer is not None and len(self.Buffer) > 50000:
+                self._ResetLocalBuffer()
+
+
+    def _ResetLocalBuffer(self):
+        self.SearchedIndex = 0
+        self.Buffer = None
+
+
+    def _CheckIfFullJpeg(self, buffer) -> bool:
+        if buffer is None or len(buffer) <= self.JpegStartSequenceLen:
+            return False
+        if buffer[:self.JpegStartSequenceLen] != self.JpegStartSequence:
+            return False
+        if buffer[-2:] != self.JpegEndSequence:
+            return False
+        return True
+
+
+def _RunLegacy(stream:bytes, chunkSize:int, frameEnds:list):
+    splitter = LegacySplitter(PipeReader(stream, chunkSize, frameEnds))
+    frames = 0
+    start = time.perf_counter()
+    while True:
+        img = splitter.GetImage()
+        if img is None:
+            break
+        frames += 1
+    return (frames, time.perf_counter() - start, splitter.PeakBuffered)
+
+
+def _RunSplitter(logger:logging.Logger, stream:bytes, chunkSize:int, frameEnds:list):
+    reader = PipeReader(stream, chunkSize, frameEnds)
+    splitter = JpegFrameSplitter(logger)
+    frames = 0
+    start = time.perf_counter()
+    while True:
+        read = splitter.ReadFrom(reader)
+        if read is None:
+            break
+        while True:
+            frame = splitter.GetFrame()
+            if frame is None:
+                break
+            # Like QuickCam_RTSP, the frame is copied once since it's held.
+            _ = bytes(frame)
+            frames += 1
+    return (frames, time.perf_counter() - start, len(splitter.Buffer))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro benchmark for the QuickCam RTSP jpeg frame splitter.")
+    parser.add_argument("--frames", type=int, default=60)
+    parser.add_argument("--chunk", type=int, default=64 * 1024, help="The max bytes returned by each pipe read.")
+    args = parser.parse_args()
+
+    logger = logging.getLogger("rtspsplitterbench")
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+    logger.setLevel(logging.ERROR)
+
+    rand = random.Random(7)
+    print(f"{'frames':<14}{'reads':<10}{'splitter':<10}{'delivered':>11}{'total ms':>10}{'us/frame':>12}{'peak buffer':>14}")
+    for name, frameSize in (("720p 40k", 40 * 1024), ("1080p 150k", 150 * 1024), ("4K 600k", 600 * 1024)):
+        frames = [_Frame(rand, frameSize + rand.randint(-frameSize // 10, frameSize // 10)) for _ in range(args.frames)]
+        stream = b"".join(frames)
+        frameEnds = []
+        offset = 0
+        for f in frames:
+            offset += len(f)
+            frameEnds.append(offset)
+        # Paced is when the reader keeps up, behind is when the reads span frames.
+        for readsName, ends in (("paced", frameEnds), ("behind", None)):
+            for splitterName, run in (("legacy", lambda s=stream, e=ends: _RunLegacy(s, args.chunk, e)), ("new", lambda s=stream, e=ends: _RunSplitter(logger, s, args.chunk, e))):
+                delivered, elapsedSec, peak = run()
+                print(f"{name:<14}{readsName:<10}{splitterName:<10}{f'{delivered}/{args.frames}':>11}{elapsedSec * 1000.0:>10.1f}{elapsedSec * 1000000.0 / max(1, delivered):>12.1f}{peak:>14}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import io
+import os
+import sys
+import time
+import argparse
+
+#
+# A micro benchmark for the reduced scale jpeg decode used when notification and Gadget snapshots are scaled down.
+#
+# It compares a full decode, resize, and encode to the same work with the jpeg decoder set to a reduced scale with PIL's draft(),
+# using the size JpegTransform.GetDraftSize picks. The frames are generated like jpegtransformbench, at 1080p, 4K, and 8K by default.
+# The targets match what the snapshot consumers ask for, the notification max height, Gadget max heights, and Gadget center crops.
+#
+# For each target the time, the decoded size (which is the peak image memory), and the difference between the two outputs are reported.
+# The 8K frame with no target shows the decode bound, since it's decoded at a reduced scale even with no resize.
+#
+# Example:
+#   python3 developer/benchmark/snapshotdecodebench.py
+#   python3 developer/benchmark/snapshotdecodebench.py --sizes 1920x1080 --rounds 20
+#
+
+c_BenchmarkDir = os.path.dirname(os.path.abspath(__file__))
+c_RepoRoot = os.path.dirname(os.path.dirname(c_BenchmarkDir))
+if c_RepoRoot not in sys.path:
+    sys.path.insert(0, c_RepoRoot)
+
+# pylint: disable=wrong-import-position
+from PIL import Image
+from PIL import ImageStat
+from PIL import ImageChops
+
+from jpegtransformbench import MakeFrame
+
+from octoeverywhere.jpegtransform import JpegTransform
+from octoeverywhere.snapshotresizeparams import SnapshotResizeParams
+
+# (name, SnapshotResizeParams or None)
+c_Targets = [
+    ("none", None),
+    ("maxHeight1080", SnapshotResizeParams(1080, True, False, False)),
+    ("maxHeight720", SnapshotResizeParams(720, True, False, False)),
+    ("maxHeight480", SnapshotResizeParams(480, True, False, False)),
+    ("crop512", SnapshotResizeParams(512, False, False, True)),
+    ("crop224", SnapshotResizeParams(224, False, False, True)),
+]
+
+
+# Does the same resize and crop as NotificationsHandler.GetNotificationSnapshot, returning the jpeg and the decoded size.
+def _Process(buf:bytes, snapshotResizeParams, useDraft:bool):
+    pilImage = Image.open(io.BytesIO(buf))
+    if useDraft:
+        draftSize = JpegTransform.GetDraftSize(pilImage.size, 0, snapshotResizeParams)
+        if draftSize is not None:
+            pilImage.draft(pilImage.mode, draftSize)
+    pilImage.load()
+    decodedSize = pilImage.size
+    scale = JpegTransform.GetResizeScale(pilImage.size, 0, snapshotResizeParams)
+    if scale is not None:
+        if snapshotResizeParams.CropSquareCenterNoPadding:
+            # Use the same integer math as the handler, scaling the smallest side to the size.
+            if pilImage.height < pilImage.width:
+                pilImage = pilImage.resize((int((float(snapshotResizeParams.Size) / float(pilImage.height)) * float(pilImage.width)), snapshotResizeParams.Size))
+                left = pilImage.width // 2 - snapshotResizeParams.Size // 2
+                pilImage = pilImage.crop((left, 0, left + snapshotResizeParams.Size, snapshotResizeParams.Size))
+            else:
+                pilImage = pilImage.resize((snapshotResizeParams.Size, int((float(snapshotResizeParams.Size) / float(pilImage.width)) * float(pilImage.height))))
+                upper = pilImage.height // 2 - snapshotResizeParams.Size // 2
+                pilImage = pilImage.crop((0, upper, snapshotResizeParams.Size, upper + snapshotResizeParams.Size))
+        elif snapshotResizeParams.ResizeToHeight:
+            pilImage = pilImage.resize((int((float(snapshotResizeParams.Size) / float(pilImage.height)) * float(pilImage.width)), snapshotResizeParams.Size))
+        else:
+            pilImage = pilImage.resize((snapshotResizeParams.Size, int((float(snapshotResizeParams.Size) / float(pilImage.width)) * float(pilImage.height))))
+    buffer = io.BytesIO()
+    pilImage.save(buffer, format="JPEG", quality=95)
+    return (buffer.getvalue(), decodedSize)
+
+
+def _Time(func, rounds:int):
+    bestSec = None
+    out = None
+    for _ in range(rounds):
+        start = time.perf_counter()
+        out = func()
+        elapsedSec = time.perf_counter() - start
+        if bestSec is None or elapsedSec < bestSec:
+            bestSec = elapsedSec
+    return (bestSec, out)
+
+
+def _Diff(a:bytes, b:bytes) -> str:
+    imgA = Image.open(io.BytesIO(a)).convert("RGB")
+    imgB = Image.open(io.BytesIO(b)).convert("RGB")
+    # If the decode bound changed the output size, there's nothing to compare.
+    if imgA.size != imgB.size:
+        return "-"
+    diff = ImageChops.difference(imgA, imgB)
+    mean = sum(ImageStat.Stat(diff).mean) / 3.0
+    return f"{mean:.2f}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro benchmark for the reduced scale jpeg decode used for snapshots.")
+    parser.add_argument("--sizes", default="1920x1080,3840x2160,7680x4320", help="A comma separated list of the frame sizes to generate.")
+    parser.add_argument("--quality", type=int, default=85, help="The jpeg quality of the generated frames.")
+    parser.add_argument("--rounds", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'frame':<11}{'target':<15}{'full ms':>9}{'draft ms':>10}{'speedup':>9}{'full decode':>13}{'draft decode':>14}{'decode MB':>15}{'mean diff':>11}")
+    for sizeStr in args.sizes.split(","):
+        width, height = (int(v) for v in sizeStr.split("x"))
+        frame = MakeFrame(width, height, args.quality)
+        for name, snapshotResizeParams in c_Targets:
+            fullSec, (fullOut, fullDecoded) = _Time(lambda f=frame, p=snapshotResizeParams: _Process(f, p, False), args.rounds)
+            draftSec, (draftOut, draftDecoded) = _Time(lambda f=frame, p=snapshotResizeParams: _Process(f, p, True), args.rounds)
+            fullMb = fullDecoded[0] * fullDecoded[1] * 3 / 1024.0 / 1024.0
+            draftMb = draftDecoded[0] * draftDecoded[1] * 3 / 1024.0 / 1024.0
+            print(f"{sizeStr:<11}{name:<15}{fullSec * 1000.0:>9.1f}{draftSec * 1000.0:>10.1f}{fullSec / draftSec:>8.1f}x"
+                  f"{f'{fullDecoded[0]}x{fullDecoded[1]}':>13}{f'{draftDecoded[0]}x{draftDecoded[1]}':>14}{f'{fullMb:.1f} -> {draftMb:.1f}':>15}{_Diff(fullOut, draftOut):>11}")
+
+
+if __name__ == "__main__":
+    main()
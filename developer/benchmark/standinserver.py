@@ -0,0 +1,312 @@
+import time
+import socket
+import threading
+
+from wsframing import ReadUpgradeRequest, BuildUpgradeResponse, WsServerConnection, c_OpCodeBinary
+
+from octoeverywhere.octostreammsgbuilder import OctoStreamMsgBuilder
+from octoeverywhere.Proto import OctoStreamMessage
+from octoeverywhere.Proto import MessageContext
+from octoeverywhere.Proto import HandshakeAck
+from octoeverywhere.Proto import HandshakeSyn
+from octoeverywhere.Proto import WebStreamMsg
+from octoeverywhere.Proto import HttpInitialContext
+from octoeverywhere.Proto import HttpHeader
+from octoeverywhere.Proto import MessagePriority
+from octoeverywhere.Proto.PathTypes import PathTypes
+from octoeverywhere.Proto.WebSocketDataTypes import WebSocketDataTypes
+from octoeverywhere.Proto.DataCompression import DataCompression
+
+c_OctoHost = "benchmark.octoeverywhere.local"
+
+#
+# A local stand-in for the OctoEverywhere server.
+#
+# It accepts the plugin's OctoStream websocket, speaks the HandshakeSyn/HandshakeAck and WebStreamMsg protocol,
+# and lets the benchmark workloads open web streams like the service would when a user loads the portal.
+#
+# The real server proves it's identity by decrypting the RSA challenge in the HandshakeSyn. The stand-in can't do that,
+# so the benchmark passes a function that returns the plain text challenge from the relay process.
+#
+class StandInServer:
+
+    def __init__(self, challengeProvider, port:int = 0):
+        self.ChallengeProvider = challengeProvider
+        self.ListenSock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.ListenSock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.ListenSock.bind(("127.0.0.1", port))
+        self.ListenSock.listen(8)
+        self.Port = self.ListenSock.getsockname()[1]
+        self.Connection:WsServerConnection = None
+        self.HandshakeComplete = threading.Event()
+        self.StreamsLock = threading.Lock()
+        self.Streams = {}
+        self.NextStreamId = 1
+        self.IsStopped = False
+        self.ReceivedMessages = 0
+        self.ReceivedBytes = 0
+
+
+    def GetEndpoint(self) -> str:
+        return f"ws://127.0.0.1:{self.Port}/octoclientws"
+
+
+    def Start(self):
+        threading.Thread(target=self._AcceptThread, name="StandInAccept", daemon=True).start()
+
+
+    def Stop(self):
+        self.IsStopped = True
+        try:
+            self.ListenSock.close()
+        except Exception:
+            pass
+        if self.Connection is not None:
+            self.Connection.Close()
+
+
+    def WaitForHandshake(self, timeoutSec:float) -> bool:
+        return self.HandshakeComplete.wait(timeoutSec)
+
+
+    # Opens a http web stream, like the service does for each browser request.
+    # Returns the StandInStream, which can be waited on for the response.
+    def OpenHttpStream(self, path:str, method:str = "GET", priority:int = MessagePriority.MessagePriority.Normal, headers:dict = None, body:bytes = None):
+        stream = self._CreateStream(path)
+        builder = OctoStreamMsgBuilder.CreateBuffer(1024 + (len(body) if body is not None else 0))
+        dataOffset = None
+        if body is not None and len(body) > 0:
+            dataOffset = builder.CreateByteVector(body)
+        contextOffset = self._BuildHttpInitialContext(builder, path, method, headers)
+        WebStreamMsg.Start(builder)
+        WebStreamMsg.AddStreamId(builder, stream.StreamId)
+        WebStreamMsg.AddIsOpenMsg(builder, True)
+        WebStreamMsg.AddIsControlFlagsOnly(builder, False)
+        WebStreamMsg.AddHttpInitialContext(builder, contextOffset)
+        WebStreamMsg.AddMsgPriority(builder, priority)
+        WebStreamMsg.AddIsDataTransmissionDone(builder, True)
+        if dataOffset is not None:
+            WebStreamMsg.AddData(builder, dataOffset)
+            WebStreamMsg.AddFullStreamDataSize(builder, len(body))
+        self._SendWebStreamMsg(builder, WebStreamMsg.End(builder))
+        return stream
+
+
+    # Opens a websocket web stream. Use SendWsMessage to send data and the stream's OnWsMessage callback to get data.
+    def OpenWsStream(self, path:str, priority:int = MessagePriority.MessagePriority.Normal, onWsMessage = None):
+        stream = self._CreateStream(path)
+        stream.OnWsMessage = onWsMessage
+        builder = OctoStreamMsgBuilder.CreateBuffer(1024)
+        contextOffset = self._BuildHttpInitialContext(builder, path, "GET", None)
+        WebStreamMsg.Start(builder)
+        WebStreamMsg.AddStreamId(builder, stream.StreamId)
+        WebStreamMsg.AddIsOpenMsg(builder, True)
+        # The open message has no data, so it must only be control flags, otherwise the ws helper will try to send it.
+        WebStreamMsg.AddIsControlFlagsOnly(builder, True)
+        WebStreamMsg.AddIsWebsocketStream(builder, True)
+        WebStreamMsg.AddHttpInitialContext(builder, contextOffset)
+        WebStreamMsg.AddMsgPriority(builder, priority)
+        self._SendWebStreamMsg(builder, WebStreamMsg.End(builder))
+        return stream
+
+
+    def SendWsMessage(self, stream, data:bytes, isText:bool = False):
+        builder = OctoStreamMsgBuilder.CreateBuffer(len(data) + 200)
+        dataOffset = builder.CreateByteVector(data)
+        WebStreamMsg.Start(builder)
+        WebStreamMsg.AddStreamId(builder, stream.StreamId)
+        WebStreamMsg.AddIsControlFlagsOnly(builder, False)
+        WebStreamMsg.AddWebsocketDataType(builder, WebSocketDataTypes.Text if isText else WebSocketDataTypes.Binary)
+        WebStreamMsg.AddData(builder, dataOffset)
+        self._SendWebStreamMsg(builder, WebStreamMsg.End(builder))
+
+
+    # Closes a stream from the server side, like when the browser goes away.
+    def CloseStream(self, stream):
+        builder = OctoStreamMsgBuilder.CreateBuffer(200)
+        WebStreamMsg.Start(builder)
+        WebStreamMsg.AddStreamId(builder, stream.StreamId)
+        WebStreamMsg.AddIsControlFlagsOnly(builder, True)
+        WebStreamMsg.AddIsCloseMsg(builder, True)
+        self._SendWebStreamMsg(builder, WebStreamMsg.End(builder))
+        stream.MarkDone()
+
+
+    def _CreateStream(self, path:str):
+        with self.StreamsLock:
+            streamId = self.NextStreamId
+            self.NextStreamId += 1
+            stream = StandInStream(streamId, path)
+            self.Streams[streamId] = stream
+            return stream
+
+
+    def _BuildHttpInitialContext(self, builder, path:str, method:str, headers:dict):
+        headerOffsets = []
+        if headers is not None:
+            for key, value in headers.items():
+                keyOffset = builder.CreateString(key)
+                valueOffset = builder.CreateString(value)
+                HttpHeader.Start(builder)
+                HttpHeader.AddKey(builder, keyOffset)
+                HttpHeader.AddValue(builder, valueOffset)
+                headerOffsets.append(HttpHeader.End(builder))
+        headersVectorOffset = None
+        if len(headerOffsets) > 0:
+            HttpInitialContext.StartHeadersVector(builder, len(headerOffsets))
+            for offset in reversed(headerOffsets):
+                builder.PrependUOffsetTRelative(offset)
+            headersVectorOffset = builder.EndVector()
+        pathOffset = builder.CreateString(path)
+        methodOffset = builder.CreateString(method)
+        # The service always sets the host the user used to reach the printer, the relay forwards it as X-Forwarded-Host.
+        octoHostOffset = builder.CreateString(c_OctoHost)
+        HttpInitialContext.Start(builder)
+        HttpInitialContext.AddPath(builder, pathOffset)
+        HttpInitialContext.AddPathType(builder, PathTypes.Relative)
+        HttpInitialContext.AddMethod(builder, methodOffset)
+        HttpInitialContext.AddOctoHost(builder, octoHostOffset)
+        if headersVectorOffset is not None:
+            HttpInitialContext.AddHeaders(builder, headersVectorOffset)
+        return HttpInitialContext.End(builder)
+
+
+    def _SendWebStreamMsg(self, builder, webStreamMsgOffset):
+        buffer, msgStartOffsetBytes, msgSizeBytes = OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalize(builder, MessageContext.MessageContext.WebStreamMsg, webStreamMsgOffset)
+        self._Send(memoryview(buffer)[msgStartOffsetBytes:msgStartOffsetBytes + msgSizeBytes])
+
+
+    def _Send(self, data):
+        connection = self.Connection
+        if connection is None:
+            raise Exception("The relay isn't connected to the stand-in server.")
+        connection.SendFrame(c_OpCodeBinary, data)
+
+
+    def _AcceptThread(self):
+        while self.IsStopped is False:
+            try:
+                sock, _ = self.ListenSock.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=self._ConnectionThread, args=(sock,), name="StandInConnection", daemon=True).start()
+
+
+    def _ConnectionThread(self, sock:socket.socket):
+        try:
+            _, headers = ReadUpgradeRequest(sock)
+            sock.sendall(BuildUpgradeResponse(headers["sec-websocket-key"]))
+            connection = WsServerConnection(sock)
+            # We only support one relay connection at a time, the newest one wins.
+            self.Connection = connection
+            self.HandshakeComplete.clear()
+            while True:
+                _, payload = connection.ReadMessage()
+                if payload is None:
+                    return
+                self._HandleMessage(payload)
+        except Exception as e:
+            if self.IsStopped is False:
+                print(f"Stand-in server connection error: {e}")
+
+
+    def _HandleMessage(self, payload:bytes):
+        self.ReceivedMessages += 1
+        self.ReceivedBytes += len(payload)
+        buf = bytearray(payload)
+        msg = OctoStreamMessage.OctoStreamMessage.GetRootAs(buf, 4)
+        contextType = msg.ContextType()
+        if contextType == MessageContext.MessageContext.HandshakeSyn:
+            self._HandleHandshakeSyn(msg)
+        elif contextType == MessageContext.MessageContext.WebStreamMsg:
+            webStreamMsg = WebStreamMsg.WebStreamMsg()
+            webStreamMsg.Init(msg.Context().Bytes, msg.Context().Pos)
+            self._HandleWebStreamMsg(webStreamMsg)
+
+
+    def _HandleHandshakeSyn(self, msg):
+        syn = HandshakeSyn.HandshakeSyn()
+        syn.Init(msg.Context().Bytes, msg.Context().Pos)
+        challenge = self.ChallengeProvider()
+        builder = OctoStreamMsgBuilder.CreateBuffer(500)
+        challengeOffset = builder.CreateString(challenge)
+        octoKeyOffset = builder.CreateString("benchmarkoctokey")
+        HandshakeAck.Start(builder)
+        HandshakeAck.AddAccepted(builder, True)
+        HandshakeAck.AddRsaChallengeResult(builder, challengeOffset)
+        HandshakeAck.AddOctokey(builder, octoKeyOffset)
+        ackOffset = HandshakeAck.End(builder)
+        buffer, msgStartOffsetBytes, msgSizeBytes = OctoStreamMsgBuilder.CreateOctoStreamMsgAndFinalize(builder, MessageContext.MessageContext.HandshakeAck, ackOffset)
+        self._Send(memoryview(buffer)[msgStartOffsetBytes:msgStartOffsetBytes + msgSizeBytes])
+        self.HandshakeComplete.set()
+
+
+    def _HandleWebStreamMsg(self, webStreamMsg:WebStreamMsg.WebStreamMsg):
+        with self.StreamsLock:
+            stream = self.Streams.get(webStreamMsg.StreamId(), None)
+        if stream is None:
+            return
+        stream.OnMessage(webStreamMsg)
+        if webStreamMsg.IsCloseMsg():
+            with self.StreamsLock:
+                self.Streams.pop(webStreamMsg.StreamId(), None)
+
+
+# Tracks the state and timing of one web stream from the server's point of view.
+class StandInStream:
+
+    def __init__(self, streamId:int, path:str):
+        self.StreamId = streamId
+        self.Path = path
+        self.OpenTimeSec = time.perf_counter()
+        self.FirstByteTimeSec = None
+        self.DoneTimeSec = None
+        self.StatusCode = None
+        self.MessageCount = 0
+        # The body size before compression, which is what the user gets.
+        self.BodyBytes = 0
+        # The size of the body data on the wire.
+        self.WireBytes = 0
+        self.OnWsMessage = None
+        self.Done = threading.Event()
+
+
+    def OnMessage(self, webStreamMsg:WebStreamMsg.WebStreamMsg):
+        now = time.perf_counter()
+        self.MessageCount += 1
+        if self.FirstByteTimeSec is None:
+            self.FirstByteTimeSec = now
+        if webStreamMsg.StatusCode() != 0 and self.StatusCode is None:
+            self.StatusCode = webStreamMsg.StatusCode()
+        dataLength = webStreamMsg.DataLength()
+        if dataLength > 0:
+            self.WireBytes += dataLength
+            if webStreamMsg.DataCompression() != DataCompression.None_:
+                self.BodyBytes += webStreamMsg.OriginalDataSize()
+            else:
+                self.BodyBytes += dataLength
+            if self.OnWsMessage is not None:
+                self.OnWsMessage(self, bytes(webStreamMsg.DataAsByteArray()), now)
+        if webStreamMsg.IsCloseMsg():
+            self.MarkDone(now)
+
+
+    def MarkDone(self, now:float = None):
+        if self.DoneTimeSec is None:
+            self.DoneTimeSec = now if now is not None else time.perf_counter()
+        self.Done.set()
+
+
+    # The time from open to the first response message.
+    def GetTimeToFirstByteSec(self) -> float:
+        if self.FirstByteTimeSec is None:
+            return None
+        return self.FirstByteTimeSec - self.OpenTimeSec
+
+
+    # The time from open to the close message.
+    def GetTotalTimeSec(self) -> float:
+        if self.DoneTimeSec is None:
+            return None
+        return self.DoneTimeSec - self.OpenTimeSec
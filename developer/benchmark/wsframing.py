@@ -0,0 +1,172 @@
+import base64
+import hashlib
+import socket
+import struct
+import threading
+
+#
+# A tiny blocking websocket server side implementation used by the benchmark stand-in server and local origin.
+# It only needs to support what our clients send, so it's far from a full RFC6455 implementation.
+#
+
+c_OpCodeCont = 0x0
+c_OpCodeText = 0x1
+c_OpCodeBinary = 0x2
+c_OpCodeClose = 0x8
+c_OpCodePing = 0x9
+c_OpCodePong = 0xA
+
+c_WebsocketAcceptGuid = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+
+# Builds the 101 response for the websocket upgrade request key.
+def BuildUpgradeResponse(secWebsocketKey:str) -> bytes:
+    accept = base64.b64encode(hashlib.sha1(secWebsocketKey.strip().encode("ascii") + c_WebsocketAcceptGuid).digest()).decode("ascii")
+    return ("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: " + accept + "\r\n\r\n").encode("ascii")
+
+
+# Reads the http upgrade request from a raw socket and returns the path and the headers dict, with lower case keys.
+def ReadUpgradeRequest(sock:socket.socket):
+    data = b""
+    while b"\r\n\r\n" not in data:
+        chunk = sock.recv(4096)
+        if len(chunk) == 0:
+            raise Exception("Socket closed during the websocket upgrade.")
+        data += chunk
+        if len(data) > 64 * 1024:
+            raise Exception("Websocket upgrade request too large.")
+    lines = data.split(b"\r\n\r\n")[0].decode("latin-1").split("\r\n")
+    path = lines[0].split(" ")[1]
+    headers = {}
+    for line in lines[1:]:
+        if ":" in line:
+            key, value = line.split(":", 1)
+            headers[key.strip().lower()] = value.strip()
+    return path, headers
+
+
+# A server side websocket connection over an already upgraded socket.
+class WsServerConnection:
+
+    def __init__(self, sock:socket.socket):
+        self.Sock = sock
+        # Small messages should go out right away, otherwise Nagle's algorithm adds latency that isn't the relay's.
+        try:
+            self.Sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except Exception:
+            pass
+        self.SendLock = threading.Lock()
+        self.RecvBuffer = bytearray()
+        self.IsClosed = False
+
+
+    # Reads the next full message, reassembling fragments and answering pings.
+    # Returns (opcode, payload) or (None, None) when the socket closes.
+    def ReadMessage(self):
+        messageOpcode = None
+        messageParts = []
+        while True:
+            frame = self._ReadFrame()
+            if frame is None:
+                return None, None
+            isFinal, opcode, payload = frame
+            if opcode == c_OpCodePing:
+                self.SendFrame(c_OpCodePong, payload)
+                continue
+            if opcode == c_OpCodePong:
+                continue
+            if opcode == c_OpCodeClose:
+                self.Close()
+                return None, None
+            if opcode != c_OpCodeCont:
+                messageOpcode = opcode
+            messageParts.append(payload)
+            if isFinal:
+                if len(messageParts) == 1:
+                    return messageOpcode, messageParts[0]
+                return messageOpcode, b"".join(messageParts)
+
+
+    # Sends one unmasked frame. The payload can be any buffer, including a memoryview.
+    def SendFrame(self, opcode:int, payload) -> None:
+        length = len(payload)
+        firstByte = 0x80 | opcode
+        if length < 126:
+            header = struct.pack("!BB", firstByte, length)
+        elif length < 65536:
+            header = struct.pack("!BBH", firstByte, 126, length)
+        else:
+            header = struct.pack("!BBQ", firstByte, 127, length)
+        with self.SendLock:
+            if self.IsClosed:
+                raise Exception("Websocket is closed.")
+            self.Sock.sendall(header)
+            if length > 0:
+                self.Sock.sendall(payload)
+
+
+    def Close(self) -> None:
+        if self.IsClosed:
+            return
+        try:
+            with self.SendLock:
+                self.Sock.sendall(struct.pack("!BB", 0x80 | c_OpCodeClose, 0))
+        except Exception:
+            pass
+        self.IsClosed = True
+        try:
+            self.Sock.shutdown(socket.SHUT_RDWR)
+        except Exception:
+            pass
+        try:
+            self.Sock.close()
+        except Exception:
+            pass
+
+
+    def _ReadExactly(self, size:int):
+        while len(self.RecvBuffer) < size:
+            try:
+                chunk = self.Sock.recv(max(65536, size - len(self.RecvBuffer)))
+            except OSError:
+                return None
+            if len(chunk) == 0:
+                return None
+            self.RecvBuffer += chunk
+        result = bytes(self.RecvBuffer[:size])
+        del self.RecvBuffer[:size]
+        return result
+
+
+    def _ReadFrame(self):
+        header = self._ReadExactly(2)
+        if header is None:
+            return None
+        isFinal = (header[0] & 0x80) != 0
+        opcode = header[0] & 0x0F
+        isMasked = (header[1] & 0x80) != 0
+        length = header[1] & 0x7F
+        if length == 126:
+            ext = self._ReadExactly(2)
+            if ext is None:
+                return None
+            length = struct.unpack("!H", ext)[0]
+        elif length == 127:
+            ext = self._ReadExactly(8)
+            if ext is None:
+                return None
+            length = struct.unpack("!Q", ext)[0]
+        mask = None
+        if isMasked:
+            mask = self._ReadExactly(4)
+            if mask is None:
+                return None
+        payload = b""
+        if length > 0:
+            payload = self._ReadExactly(length)
+            if payload is None:
+                return None
+        if mask is not None and length > 0:
+            fullMask = (mask * (length // 4 + 1))[:length]
+            payload = (int.from_bytes(payload, "little") ^ int.from_bytes(fullMask, "little")).to_bytes(length, "little")
+        return isFinal, opcode, payload
@@ -31,6 +31,27 @@ class Config:
     RelaySection = "relay"
     RelayFrontEndPortKey = "frontend_port"            # This field is shared with the installer, the installer can write this value. It the name can't change!
     RelayFrontEndTypeHintKey = "frontend_type_hint"   # This field is shared with the installer, the installer can write this value. It the name can't change!
+    # The relay options are read and applied by octoeverywhere/relayoptions.py, these are only used for the config file comments.
+    RelayWebStreamExecutionModeKey = "web_stream_execution_mode"
+    RelayWorkerPoolMaxThreadsKey = "worker_pool_max_threads"
+    RelayOriginUrlRacingKey = "origin_url_racing"
+    RelayHttpRouteCacheKey = "http_route_cache"
+    RelayAssetCacheMaxMbKey = "asset_cache_max_mb"
+    RelayAssetDiskStoreMaxMbKey = "asset_disk_store_max_mb"
+    RelayLocalHttpMaxConnectionsPerHostKey = "local_http_max_connections_per_host"
+    RelayLocalHttpPoolBlockingKey = "local_http_pool_blocking"
+    RelayStreamingUploadsKey = "streaming_uploads"
+    RelayPipelinedBodyRelayKey = "pipelined_body_relay"
+    RelayWebcamLatestFrameModeKey = "webcam_latest_frame_mode"
+    RelayWebcamMaxFpsKey = "webcam_max_fps"
+    RelayWebcamTargetLatencyMsKey = "webcam_target_latency_ms"
+    RelayWebcamStreamFanOutKey = "webcam_stream_fan_out"
+    RelayWebcamSnapshotFreshnessMsKey = "webcam_snapshot_freshness_ms"
+    RelayWebcamStreamFrameMaxAgeMsKey = "webcam_stream_frame_max_age_ms"
+    RelayImageWorkerPoolKey = "image_worker_pool"
+    RelayImageWorkerCountKey = "image_worker_count"
+    RelayQuickCamAdaptiveCaptureKey = "quickcam_adaptive_capture"
+    RelayQuickCamSnapshotFpsKey = "quickcam_snapshot_fps"
 
 
     #
@@ -76,6 +97,26 @@ class Config:
     c_ConfigComments = [
         { "Target": RelayFrontEndPortKey,  "Comment": "The port used for http relay. If your desired frontend runs on a different port, change this value. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
         { "Target": RelayFrontEndTypeHintKey,  "Comment": "A string only used by the UI to hint at what web interface this port is."},
+        { "Target": RelayWebStreamExecutionModeKey,  "Comment": "How relay web streams are executed. 'thread' gives each web stream it's own thread, 'worker_pool' runs web streams on a bounded pool of worker threads, which uses less memory on low end devices. 'asyncio' runs the relay on a single event loop, which uses the least CPU and memory on low end devices. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayWorkerPoolMaxThreadsKey,  "Comment": "The max number of worker threads used when the web stream execution mode is 'worker_pool', or the max number of blocking threads when the mode is 'asyncio'."},
+        { "Target": RelayOriginUrlRacingKey,  "Comment": "If true, GET requests will start the next local url in the fallback chain in parallel when the current one is slow to respond, rather than waiting for it to time out. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayHttpRouteCacheKey,  "Comment": "If true, when a local request only works after falling back to another local url, the url that worked is remembered so later requests for the same path go right to it. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayAssetCacheMaxMbKey,  "Comment": "The max size in MB of the web interface files, like the js and css, that are kept in memory so they can be served without asking the local web server. 0 disables this. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayAssetDiskStoreMaxMbKey,  "Comment": "The max size in MB of the web interface files, like the js and css, that are stored on disk so they can be served right away after a restart. 0 disables this. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayLocalHttpMaxConnectionsPerHostKey,  "Comment": "The max number of connections kept open to each local http server. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayLocalHttpPoolBlockingKey,  "Comment": "If true, when all of the connections to a local http server are in use, requests will wait a few seconds for one to be freed rather than opening an extra connection. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayStreamingUploadsKey,  "Comment": "If true, large uploads are streamed to the local http server as they arrive, rather than being held in memory until the upload is done. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayPipelinedBodyRelayKey,  "Comment": "If true, large downloads are relayed with the local http read, compression, and send to the service running at the same time, rather than one after another. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayWebcamLatestFrameModeKey,  "Comment": "If true, when the connection to OctoEverywhere is slower than the webcam, old webcam frames are skipped so the newest frame is always sent, rather than the stream falling further and further behind. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayWebcamMaxFpsKey,  "Comment": "When the webcam latest frame mode is enabled, the max frames per second sent for each webcam stream. 0 means there's no limit. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayWebcamTargetLatencyMsKey,  "Comment": "When the webcam latest frame mode is enabled, how long in milliseconds a webcam frame can wait to be sent before frames are skipped. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayWebcamStreamFanOutKey,  "Comment": "If true, all of the webcam streams and snapshots for the same http mjpeg stream url share one connection to the webcam server, rather than each opening their own. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayWebcamSnapshotFreshnessMsKey,  "Comment": "How long in milliseconds a webcam snapshot can be reused for other snapshot requests. 0 means only requests made at the same time share a snapshot. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayWebcamStreamFrameMaxAgeMsKey,  "Comment": "When a webcam is being streamed, snapshots will use the newest frame of the stream if it's newer than this many milliseconds, rather than making a new request. 0 disables this. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayImageWorkerPoolKey,  "Comment": "If true, the image work for notification and Gadget snapshots, like rotating and resizing, is done in separate worker processes, so it doesn't slow down the rest of the plugin. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayImageWorkerCountKey,  "Comment": "When the image worker pool is enabled, how many worker processes can be used. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayQuickCamAdaptiveCaptureKey,  "Comment": "If true, RTSP webcam captures run at a low frame rate when they are only used for snapshots, switch to the full frame rate when someone is watching the stream, and scale the frames down when the connection to OctoEverywhere can't keep up. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
+        { "Target": RelayQuickCamSnapshotFpsKey,  "Comment": "When the RTSP webcam adaptive capture is enabled, the frames per second captured when no one is watching the stream. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
         { "Target": LogLevelKey,  "Comment": "The active logging level. Valid values include: DEBUG, INFO, WARNING, or ERROR."},
         { "Target": CompanionKeyIpOrHostname,  "Comment": "The IP or hostname this companion plugin will use to connect to Moonraker. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
         { "Target": CompanionKeyPort,  "Comment": "The port this companion plugin will use to connect to Moonraker. The OctoEverywhere plugin service needs to be restarted before changes will take effect."},
@@ -9,6 +9,7 @@ from octoeverywhere.hostcommon import HostCommon
 from octoeverywhere.compression import Compression
 from octoeverywhere.octopingpong import OctoPingPong
 from octoeverywhere.httpsessions import HttpSessions
+from octoeverywhere.relaymetrics import RelayMetrics
 from octoeverywhere.Webcam.webcamhelper import WebcamHelper
 from octoeverywhere.printinfo import PrintInfoManager
 from octoeverywhere.commandhandler import CommandHandler
@@ -17,6 +18,7 @@ from octoeverywhere.octohttprequest import OctoHttpRequest
 from octoeverywhere.Proto.ServerHost import ServerHost
 from octoeverywhere.localip import LocalIpHelper
 from octoeverywhere.compat import Compat
+from octoeverywhere.relayoptions import RelayOptions
 
 from linux_host.config import Config
 from linux_host.secrets import Secrets
@@ -90,6 +92,8 @@ class MoonrakerHost:
 
             # Setup the HttpSession cache early, so it can be used whenever
             HttpSessions.Init(self.Logger)
+            # Setup the relay metrics early as well, so all of the hot paths can record to it.
+            RelayMetrics.Init(self.Logger)
 
             # As soon as we have the plugin version, setup Sentry
             # Enabling profiling and no filtering, since we are the only PY in this process.
@@ -156,6 +160,9 @@ class MoonrakerHost:
             OctoHttpRequest.SetLocalHttpProxyIsHttps(False)
             OctoHttpRequest.SetLocalOctoPrintPort(frontendPort)
 
+            # Setup the relay options, like the web stream execution mode and the local http and webcam options.
+            RelayOptions.LoadFromConfig(self.Config, Config.RelaySection).Apply(self.Logger, localStorageDir)
+
             # If we are in companion mode, we need to update the local address to be the other local remote.
             if isCompanionMode:
                 ipOrHostnameStr = self.Config.GetStr(Config.SectionCompanion, Config.CompanionKeyIpOrHostname, None)
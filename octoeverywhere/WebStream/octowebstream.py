@@ -4,11 +4,14 @@ import threading
 import traceback
 import time
 import queue
+import asyncio
 
 from ..sentry import Sentry
 from ..octostreammsgbuilder import OctoStreamMsgBuilder
 from .octowebstreamhttphelper import OctoWebStreamHttpHelper
 from .octowebstreamwshelper import OctoWebStreamWsHelper
+from .octowebstreamworkerpool import OctoWebStreamWorkerPool
+from ..asyncrelayengine import AsyncRelayEngine
 from ..Proto import WebStreamMsg
 from ..Proto import MessageContext
 from ..Proto import MessagePriority
@@ -19,6 +22,13 @@ from ..debugprofiler import DebugProfiler, DebugProfilerFeatures
 #
 class OctoWebStream(threading.Thread):
 
+    # How long a producer will wait for uplink byte budget before the stream sheds load by closing.
+    # If the uplink is this slow, the user isn't getting anything useful from the stream anyways.
+    c_UplinkBudgetMaxWaitSec = 30.0
+
+    # The budget wait is done in slices, so we notice if the stream was closed while waiting.
+    c_UplinkBudgetWaitSliceSec = 1.0
+
     # Created when an open message is sent for a new web stream from the server.
     def __init__(self, group=None, target=None, name=None, args=(), kwargs=None, verbose=None):
         threading.Thread.__init__(self, group=group, target=target, name=name)
@@ -35,12 +45,22 @@ class OctoWebStream(threading.Thread):
         self.IsHelperClosed = False
         self.OpenedTime = time.time()
         self.ClosedDueToRequestConnectionError = False
+        # The priority of this stream, which is set from the open message. This is used by the send scheduler.
+        self.MsgPriority = MessagePriority.MessagePriority.Normal
+
+        # If the worker pool execution mode is enabled, this stream doesn't get it's own thread.
+        # Instead, it's scheduled on the pool when there are messages in the queue.
+        self.WorkerPool = OctoWebStreamWorkerPool.Get()
+        self.WorkerScheduleLock = threading.Lock()
+        self.IsScheduledOnWorker = False
+
+        # If the asyncio relay engine is enabled, this stream doesn't get it's own thread.
+        # Instead, it runs as a task on the engine's loop. The event is created on the loop, since it must be bound to it.
+        self.AsyncEngine = AsyncRelayEngine.Get()
+        self.AsyncMsgEvent:asyncio.Event = None
 
-        # Vars for high pri streams
+        # Set if this stream is high pri, which makes the low pri streams in the session defer to it.
         self.IsHighPriStream = False
-        self.HighPriLock = threading.Lock()
-        self.ActiveHighPriStreamCount = 0
-        self.ActiveHighPriStreamStart = time.time()
 
 
     # Called for all messages for this stream id.
@@ -66,6 +86,12 @@ class OctoWebStream(threading.Thread):
         else:
             # Otherwise, put the message into the queue, so the thread will pick it up.
             self.MsgQueue.put(webStreamMsg)
+            # If we are using the worker pool, make sure we are scheduled to process the message.
+            if self.WorkerPool is not None:
+                self.scheduleOnWorkerPoolIfNeeded()
+            # If we are using the asyncio engine, wake the task.
+            if self.AsyncEngine is not None:
+                self.wakeAsyncTask()
 
 
     # Closes the web stream and all related elements.
@@ -100,13 +126,15 @@ class OctoWebStream(threading.Thread):
 
         # Put an empty message on the queue to wake it up to exit.
         self.MsgQueue.put(None)
+        if self.AsyncEngine is not None:
+            self.wakeAsyncTask()
 
         # Ensure we have sent the close message
         self.ensureCloseMessageSent()
 
-        # If this was high pri, clear the state
+        # If this was high pri, tell the session's arbiter it's done.
         if self.IsHighPriStream:
-            self.highPriStreamEnded()
+            self.OctoSession.PriorityArbiter.HighPriStreamEnded(self.Id)
 
         # If we got a ref to the helper, we need to call close on it.
         try:
@@ -122,6 +150,18 @@ class OctoWebStream(threading.Thread):
         self.ClosedDueToRequestConnectionError = True
 
 
+    # Called by the session when the stream is created to start processing messages.
+    def StartProcessing(self):
+        # In the worker pool mode, there's nothing to start. We will be scheduled when messages are queued.
+        if self.WorkerPool is not None:
+            return
+        # In the asyncio mode, the stream runs as a task on the loop.
+        if self.AsyncEngine is not None:
+            self.AsyncEngine.RunCoroutine(self.runOnAsyncEngine())
+            return
+        self.start()
+
+
     # This is our main thread, where we will process all incoming messages.
     def run(self):
         # Enable the profiler if needed- it will do nothing if not enabled.
@@ -157,40 +197,172 @@ class OctoWebStream(threading.Thread):
             if webStreamMsg is None:
                 continue
 
-            # Handle the message.
-            if webStreamMsg.IsOpenMsg():
-                self.initFromOpenMessage(webStreamMsg)
+            # Handle the message, if this returns true, we are done.
+            if self.processMessage(webStreamMsg):
+                return
 
-            # Ensure we have an open message.
-            if self.OpenWebStreamMsg is None:
-                # Throw so we reset the connection.
-                raise Exception("Web stream ["+str(self.Id)+"] got a non open message before it's open message.")
 
-            # Don't pass it to the helper if there's nothing more.
-            if webStreamMsg.IsControlFlagsOnly():
-                continue
+    # Used in the worker pool execution mode, this is called on a worker thread to process all of the queued messages.
+    def runOnWorkerPool(self):
+        # Enable the profiler if needed- it will do nothing if not enabled.
+        with DebugProfiler(self.Logger, DebugProfilerFeatures.WebStream):
+            try:
+                while True:
+                    # Check that we aren't closed
+                    if self.IsClosed is True:
+                        return
+
+                    # Get the next message, if there are none, we are done until more are queued.
+                    webStreamMsg:WebStreamMsg.WebStreamMsg = None
+                    try:
+                        webStreamMsg = self.MsgQueue.get_nowait()
+                    except queue.Empty:
+                        # Under lock, check again, so we don't miss a message that was queued after we looked but before we clear the flag.
+                        with self.WorkerScheduleLock:
+                            if self.MsgQueue.empty():
+                                self.IsScheduledOnWorker = False
+                                return
+                        continue
+
+                    # None is put into the queue on close.
+                    if webStreamMsg is None:
+                        continue
+
+                    # Handle the message, if this returns true, we are done.
+                    if self.processMessage(webStreamMsg):
+                        return
+            except Exception as e:
+                Sentry.Exception("Exception in web stream ["+str(self.Id)+"] worker pool task.", e)
+                traceback.print_exc()
+                self.OctoSession.OnSessionError(0)
 
-            # Allow the helper to process the message
-            # We should only ever have one, but just for safety, check both.
-            returnValue = True
-            if self.HttpHelper is not None:
-                returnValue = self.HttpHelper.IncomingServerMessage(webStreamMsg)
-            if self.WsHelper is not None:
-                returnValue = self.WsHelper.IncomingServerMessage(webStreamMsg)
-
-            # If process server message returns true, we should close the stream.
-            if returnValue is True:
-                self.Close()
-                return
 
-            # When the http helper sends messages, it can indicate that the close flag has been set.
-            # In such a case, self.HasSentCloseMessage will be true. We don't want to rely on the client
-            # returning the correct returnValue, so if we see that we will call close to make sure things
-            # are going down. Since Close() is guarded against multiple entries, this is totally fine.
-            if self.HasSentCloseMessage is True and self.IsClosed is False:
-                self.Logger.warn("Web stream "+str(self.Id)+" processed a message and has sent a close message, but didn't call close on the web stream. Closing now.")
-                self.Close()
+    # Ensures this stream is scheduled on the worker pool, but only once at a time, so messages are processed in order.
+    def scheduleOnWorkerPoolIfNeeded(self):
+        with self.WorkerScheduleLock:
+            if self.IsScheduledOnWorker:
                 return
+            self.IsScheduledOnWorker = True
+        self.WorkerPool.Schedule(self.runOnWorkerPool)
+
+
+    # Used in the asyncio execution mode, this is the task that processes all of the messages for this stream on the loop.
+    async def runOnAsyncEngine(self):
+        try:
+            self.AsyncMsgEvent = asyncio.Event()
+            while self.IsClosed is False:
+                # Get the next message, if there are none, wait until more are queued.
+                # Anything that's queued will set the event after it's queued, so there's no race in clearing it here.
+                webStreamMsg:WebStreamMsg.WebStreamMsg = None
+                try:
+                    webStreamMsg = self.MsgQueue.get_nowait()
+                except queue.Empty:
+                    self.AsyncMsgEvent.clear()
+                    if self.MsgQueue.empty():
+                        # Timeout after 60 seconds just to check that we aren't closed.
+                        try:
+                            await asyncio.wait_for(self.AsyncMsgEvent.wait(), 60)
+                        except asyncio.TimeoutError:
+                            pass
+                    continue
+
+                # Check that we aren't closed
+                if self.IsClosed is True:
+                    return
+
+                # None is put into the queue on close.
+                if webStreamMsg is None:
+                    continue
+
+                # Handle the message, if this returns true, we are done.
+                if await self.processMessageAsync(webStreamMsg):
+                    return
+        except Exception as e:
+            Sentry.Exception("Exception in web stream ["+str(self.Id)+"] asyncio task.", e)
+            traceback.print_exc()
+            self.OctoSession.OnSessionError(0)
+
+
+    # Wakes the asyncio task, this can be called from any thread.
+    def wakeAsyncTask(self):
+        if self.AsyncEngine.IsLoopThread():
+            self._setAsyncMsgEvent()
+        else:
+            self.AsyncEngine.CallSoon(self._setAsyncMsgEvent)
+
+
+    def _setAsyncMsgEvent(self):
+        if self.AsyncMsgEvent is not None:
+            self.AsyncMsgEvent.set()
+
+
+    # Handles a single message from the server.
+    # Returns true if the stream is done and no more messages should be processed.
+    def processMessage(self, webStreamMsg:WebStreamMsg.WebStreamMsg) -> bool:
+        if webStreamMsg.IsOpenMsg():
+            self.initFromOpenMessage(webStreamMsg)
+        if self.shouldPassMessageToHelper(webStreamMsg) is False:
+            return False
+
+        # Allow the helper to process the message
+        # We should only ever have one, but just for safety, check both.
+        returnValue = True
+        if self.HttpHelper is not None:
+            returnValue = self.HttpHelper.IncomingServerMessage(webStreamMsg)
+        if self.WsHelper is not None:
+            returnValue = self.WsHelper.IncomingServerMessage(webStreamMsg)
+        return self.handleHelperReturnValue(returnValue)
+
+
+    # The asyncio version of processMessage, this runs on the loop.
+    async def processMessageAsync(self, webStreamMsg:WebStreamMsg.WebStreamMsg) -> bool:
+        if webStreamMsg.IsOpenMsg():
+            # Creating the websocket helper can do blocking work, like a mDNS lookup, so it's done on a blocking thread.
+            if webStreamMsg.IsWebsocketStream():
+                await self.AsyncEngine.RunBlocking(self.initFromOpenMessage, webStreamMsg)
+            else:
+                self.initFromOpenMessage(webStreamMsg)
+        if self.shouldPassMessageToHelper(webStreamMsg) is False:
+            return False
+
+        returnValue = True
+        if self.HttpHelper is not None:
+            returnValue = await self.HttpHelper.IncomingServerMessageAsync(webStreamMsg, self.AsyncEngine)
+        if self.WsHelper is not None:
+            returnValue = await self.WsHelper.IncomingServerMessageAsync(webStreamMsg)
+        return self.handleHelperReturnValue(returnValue)
+
+
+    # Validates the stream state and returns true if the message has data the helper needs to process.
+    def shouldPassMessageToHelper(self, webStreamMsg:WebStreamMsg.WebStreamMsg) -> bool:
+        # Ensure we have an open message.
+        if self.OpenWebStreamMsg is None:
+            # Throw so we reset the connection.
+            raise Exception("Web stream ["+str(self.Id)+"] got a non open message before it's open message.")
+
+        # Don't pass it to the helper if there's nothing more.
+        if webStreamMsg.IsControlFlagsOnly():
+            return False
+        return True
+
+
+    # Handles the value returned from the helper after it processed a message.
+    # Returns true if the stream is done and no more messages should be processed.
+    def handleHelperReturnValue(self, returnValue:bool) -> bool:
+        # If process server message returns true, we should close the stream.
+        if returnValue is True:
+            self.Close()
+            return True
+
+        # When the http helper sends messages, it can indicate that the close flag has been set.
+        # In such a case, self.HasSentCloseMessage will be true. We don't want to rely on the client
+        # returning the correct returnValue, so if we see that we will call close to make sure things
+        # are going down. Since Close() is guarded against multiple entries, this is totally fine.
+        if self.HasSentCloseMessage is True and self.IsClosed is False:
+            self.Logger.warn("Web stream "+str(self.Id)+" processed a message and has sent a close message, but didn't call close on the web stream. Closing now.")
+            self.Close()
+            return True
+        return False
 
 
     def initFromOpenMessage(self, webStreamMsg:WebStreamMsg.WebStreamMsg):
@@ -201,11 +373,15 @@ class OctoWebStream(threading.Thread):
 
         # Set the message.
         self.OpenWebStreamMsg = webStreamMsg
+        self.MsgPriority = self.OpenWebStreamMsg.MsgPriority()
 
-        # Check if this is high pri, if so, tell them system a high pri is active
-        if self.OpenWebStreamMsg.MsgPriority() < MessagePriority.MessagePriority.Normal:
+        # Check if this is high pri, if so, tell the session's arbiter a high pri stream is active.
+        # Note the stream might have already been closed, but ending it is keyed by the stream id, so it's safe to start now.
+        if self.IsHighPriMsgPriority(self.MsgPriority):
             self.IsHighPriStream = True
-            self.highPriStreamStarted()
+            self.OctoSession.PriorityArbiter.HighPriStreamStarted(self.Id)
+            if self.IsClosed:
+                self.OctoSession.PriorityArbiter.HighPriStreamEnded(self.Id)
 
         # At this point we know what kind of stream we are, http or ws.
         # Create the helper out of lock and then set it.
@@ -263,7 +439,7 @@ class OctoWebStream(threading.Thread):
 
         # Send now
         try:
-            self.OctoSession.Send(buffer, msgStartOffsetBytes, msgSize)
+            self.OctoSession.Send(buffer, msgStartOffsetBytes, msgSize, self.Id, self.MsgPriority)
         except Exception as e:
             Sentry.Exception("Web stream "+str(self.Id)+ " failed to send a message to the OctoStream.", e)
 
@@ -277,6 +453,42 @@ class OctoWebStream(threading.Thread):
             # Return since things are going down.
             return
 
+    # Called by the helpers before they read more data from the local source to send.
+    # If this stream or the entire uplink has too much data queued, this blocks until the queued data is sent.
+    # Returns false if the wait timed out, in which case the helper should shed load by closing the stream.
+    def WaitForUplinkBudget(self) -> bool:
+        # The asyncio relay engine loop must never block, so producers that run on it must use WaitForUplinkBudgetAsync.
+        # If one calls this from the loop anyways, don't block the loop, since that would stall every stream.
+        if self.AsyncEngine is not None and self.AsyncEngine.IsLoopThread():
+            return True
+        start = time.time()
+        while self.IsClosed is False:
+            if self.OctoSession.WaitForUplinkBudget(self.Id, OctoWebStream.c_UplinkBudgetWaitSliceSec):
+                return True
+            if time.time() - start > OctoWebStream.c_UplinkBudgetMaxWaitSec:
+                self.Logger.warn(f"Web stream {self.Id} waited more than {OctoWebStream.c_UplinkBudgetMaxWaitSec}s for uplink budget, shedding load by closing the stream.")
+                return False
+        return True
+
+
+    # The same as WaitForUplinkBudget, but for producers that run on the asyncio relay engine loop.
+    # The loop isn't blocked while waiting, the caller is resumed when the uplink has sent enough of the queued data.
+    async def WaitForUplinkBudgetAsync(self) -> bool:
+        start = time.time()
+        while self.IsClosed is False:
+            if await self.OctoSession.WaitForUplinkBudgetAsync(self.Id, OctoWebStream.c_UplinkBudgetWaitSliceSec):
+                return True
+            if time.time() - start > OctoWebStream.c_UplinkBudgetMaxWaitSec:
+                self.Logger.warn(f"Web stream {self.Id} waited more than {OctoWebStream.c_UplinkBudgetMaxWaitSec}s for uplink budget, shedding load by closing the stream.")
+                return False
+        return True
+
+
+    # Returns the bytes this stream has queued to send and how long the oldest of them has been waiting.
+    def GetUplinkQueueState(self):
+        return self.OctoSession.GetUplinkQueueState(self.Id)
+
+
     # Ensures the close message is always sent, but only once.
     # The only way the close message doesn't need to be sent is if
     # the other side started the close with a close message.
@@ -299,33 +511,7 @@ class OctoWebStream(threading.Thread):
             Sentry.Exception("Exception thrown while trying to send close message for web stream "+str(self.Id), e)
             self.OctoSession.OnSessionError(0)
 
-    # Called by the OctoStreamHttpHelper if the request is normal pri.
-    # If a high pri request is active, this should block until it's complete or for a little while.
-    def BlockIfHighPriStreamActive(self):
-        # Check the counter, don't worry about taking the lock, worst case
-        # this logic would allow one request through or not block one.
-
-        # If there are no high pri requests, don't block.
-        if self.ActiveHighPriStreamCount == 0:
-            return
-        # As a sanity check, if the high pri request started more than 5 seconds ago
-        # don't block.
-        timeSinceStartSec = time.time() - self.ActiveHighPriStreamStart
-        if timeSinceStartSec > 5.0:
-            return
-
-        # We should block this request
-        # TODO - this would be better if we blocked on a event or something, but for now this is fine.
-        # Note that the http will call this function before the request and on each response read loop, so the delays add up.
-        time.sleep(0.1)
-
-    # Called when a high pri stream is started
-    def highPriStreamStarted(self):
-        with self.HighPriLock:
-            self.ActiveHighPriStreamCount += 1
-            self.ActiveHighPriStreamStart = time.time()
-
-    # Called when a high pri stream is ended.
-    def highPriStreamEnded(self):
-        with self.HighPriLock:
-            self.ActiveHighPriStreamCount -= 1
+    # Returns true if streams with this priority should make lower pri streams defer to them.
+    @staticmethod
+    def IsHighPriMsgPriority(msgPriority:int) -> bool:
+        return msgPriority < MessagePriority.MessagePriority.Normal
@@ -0,0 +1,178 @@
+import time
+import queue
+import logging
+import threading
+
+from ..sentry import Sentry
+from ..relaymetrics import RelayMetrics
+
+#
+# A three stage pipeline used to relay large http response bodies with a known length.
+#
+# Normally the http helper reads a chunk from the origin, compresses it, builds the message, and sends it, all in sequence on one thread.
+# That means the origin socket is idle while we compress and send, and the compressor is idle while we wait on the sockets.
+# With the pipeline, the body read and the compression each run on their own thread, connected to the send loop by small bounded queues.
+# The read runs ahead of the compression, which runs ahead of the send, but only by a few chunks, so the memory use is bounded and if the
+# uplink is slow the backpressure pushes all the way back to the origin read.
+#
+# Each stage is a single thread, so the chunks stay in order, which the streaming compression context requires.
+#
+# Each stage tracks how long it was busy and how long it waited on the stage before it, so we can tell which stage limits the download.
+#
+class OctoWebStreamBodyPipeline:
+
+    # How many chunks can be waiting between each stage.
+    c_MaxQueuedChunks = 3
+
+    # Queue waits are done in slices, so the stages notice when the stream is closed.
+    c_QueueWaitSliceSec = 0.5
+
+    # How long we wait for the stage threads to exit when the pipeline is stopped.
+    c_StopJoinTimeoutSec = 5.0
+
+
+    def __init__(self, logger:logging.Logger, httpHelper, octoHttpResult, contentLength:int, shouldCompress:bool, readSizeBytes:int):
+        self.Logger = logger
+        self.HttpHelper = httpHelper
+        self.OctoHttpResult = octoHttpResult
+        self.ContentLength = contentLength
+        self.ShouldCompress = shouldCompress
+        self.ReadSizeBytes = readSizeBytes
+        self.IsStopped = False
+        self.ReadQueue = queue.Queue(maxsize=OctoWebStreamBodyPipeline.c_MaxQueuedChunks)
+        self.SendQueue = queue.Queue(maxsize=OctoWebStreamBodyPipeline.c_MaxQueuedChunks)
+        self.ReadThread:threading.Thread = None
+        self.CompressThread:threading.Thread = None
+        self.StartSec = 0.0
+
+        # Stage timing. Busy is time spent doing the stage's work, wait is time spent waiting on the stage before it.
+        self.ReadBusySec = 0.0
+        self.CompressBusySec = 0.0
+        self.CompressWaitSec = 0.0
+        self.SendWaitSec = 0.0
+
+
+    def Start(self) -> None:
+        self.StartSec = time.time()
+        self.ReadThread = threading.Thread(target=self._ReadThread, name="BodyPipelineRead")
+        self.CompressThread = threading.Thread(target=self._CompressThread, name="BodyPipelineCompress")
+        self.ReadThread.start()
+        self.CompressThread.start()
+
+
+    # Called by the send loop to get the next chunk.
+    # Returns (originalSize, buffer, isCompressed), the buffer is None when the body is done.
+    def TakeChunk(self):
+        waitStartSec = time.time()
+        item = self._Get(self.SendQueue)
+        self.SendWaitSec += time.time() - waitStartSec
+        if item is None:
+            return (0, None, False)
+        # If the compress stage failed, throw on the send loop, which will take down the stream.
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+
+    # Stops the pipeline and records the stage timing. This is safe to call more than once.
+    def Stop(self) -> None:
+        if self.IsStopped:
+            return
+        self.IsStopped = True
+        for t in [self.ReadThread, self.CompressThread]:
+            if t is not None:
+                t.join(OctoWebStreamBodyPipeline.c_StopJoinTimeoutSec)
+
+        # The send stage was busy any time it wasn't waiting on the compress stage.
+        totalSec = time.time() - self.StartSec
+        sendBusySec = max(0.0, totalSec - self.SendWaitSec)
+        metrics = RelayMetrics.Get()
+        metrics.RecordLatency("Http.Pipeline.ReadStage", self.ReadBusySec)
+        metrics.RecordLatency("Http.Pipeline.CompressStage", self.CompressBusySec)
+        metrics.RecordLatency("Http.Pipeline.SendStage", sendBusySec)
+        # The stage that was busy the longest is the one limiting the download.
+        stages = {"Read": self.ReadBusySec, "Compress": self.CompressBusySec, "Send": sendBusySec}
+        bottleneck = max(stages, key=stages.get)
+        metrics.IncrementCounter("Http.Pipeline.Bottleneck." + bottleneck)
+        if self.Logger.isEnabledFor(logging.DEBUG):
+            self.Logger.debug(f"{self.HttpHelper.getLogMsgPrefix()}Body pipeline done in {totalSec:.3f}s; read:{self.ReadBusySec:.3f}s; compress:{self.CompressBusySec:.3f}s (waited {self.CompressWaitSec:.3f}s); send:{sendBusySec:.3f}s (waited {self.SendWaitSec:.3f}s); bottleneck:{bottleneck}")
+
+
+    # Reads the body from the origin, until we have the full content length or the body ends.
+    def _ReadThread(self):
+        try:
+            readBytes = 0
+            while self._IsRunning() and readBytes < self.ContentLength:
+                readStartSec = time.time()
+                data = self.HttpHelper.doBodyRead(self.OctoHttpResult, min(self.ReadSizeBytes, self.ContentLength - readBytes))
+                thisReadSec = time.time() - readStartSec
+                self.ReadBusySec += thisReadSec
+                self.HttpHelper.recordBodyReadTime(thisReadSec)
+                if data is None:
+                    break
+                readBytes += len(data)
+                if self._Put(self.ReadQueue, data) is False:
+                    return
+        except Exception as e:
+            Sentry.Exception(self.HttpHelper.getLogMsgPrefix()+" body pipeline read stage failed.", e)
+        finally:
+            # Always tell the next stage the body is done.
+            self._Put(self.ReadQueue, None)
+
+
+    # Compresses each chunk, if needed, and passes it to the send loop.
+    def _CompressThread(self):
+        compressedBytes = 0
+        originalBytes = 0
+        shouldCompress = self.ShouldCompress
+        try:
+            while self._IsRunning():
+                waitStartSec = time.time()
+                data = self._Get(self.ReadQueue)
+                self.CompressWaitSec += time.time() - waitStartSec
+                if data is None:
+                    break
+
+                # If the compression isn't making the body smaller, turn it off, see the send loop in the http helper for details.
+                if shouldCompress and compressedBytes != 0 and originalBytes != 0 and compressedBytes > originalBytes * 0.9:
+                    shouldCompress = False
+                    self.Logger.info(f"We detected that the compression being applied to this stream was inefficient, so we are disabling compression. Compression: {float(compressedBytes)/float(originalBytes)} URL: {self.OctoHttpResult.Url}")
+
+                originalSize = len(data)
+                if shouldCompress:
+                    compressStartSec = time.time()
+                    data = self.HttpHelper.compressBodyChunk(data)
+                    self.CompressBusySec += time.time() - compressStartSec
+                originalBytes += originalSize
+                compressedBytes += len(data)
+                if self._Put(self.SendQueue, (originalSize, data, shouldCompress)) is False:
+                    return
+            self._Put(self.SendQueue, None)
+        except Exception as e:
+            # Pass the exception to the send loop, so the stream is taken down like it would be without the pipeline.
+            self._Put(self.SendQueue, e)
+
+
+    def _IsRunning(self) -> bool:
+        return self.IsStopped is False and self.HttpHelper.IsClosed is False
+
+
+    # Puts the item in the queue, returns false if the pipeline was stopped while waiting.
+    def _Put(self, q:queue.Queue, item) -> bool:
+        while self._IsRunning():
+            try:
+                q.put(item, timeout=OctoWebStreamBodyPipeline.c_QueueWaitSliceSec)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+
+    # Gets the next item from the queue, returns None if the pipeline was stopped while waiting.
+    def _Get(self, q:queue.Queue):
+        while True:
+            try:
+                return q.get(timeout=OctoWebStreamBodyPipeline.c_QueueWaitSliceSec)
+            except queue.Empty:
+                if self._IsRunning() is False:
+                    return None
@@ -1,4 +1,5 @@
 import time
+import asyncio
 import logging
 import threading
 
@@ -11,16 +12,24 @@ from .octoheaderimpl import BaseProtocol
 from ..octohttprequest import OctoHttpRequest
 from ..octostreammsgbuilder import OctoStreamMsgBuilder
 from ..Webcam.webcamhelper import WebcamHelper
+from ..Webcam.mjpegstreamparser import MjpegStreamParser
+from ..Webcam.webcamstreamgovernor import WebcamStreamGovernor, LatestFrameReader
+from ..Webcam.webcamframeregistry import WebcamFrameRegistry
 from ..commandhandler import CommandHandler
 from ..compression import Compression, CompressionContext
 from ..sentry import Sentry
 from ..compat import Compat
+from ..relaymetrics import RelayMetrics
+from ..httpassetcache import HttpAssetCache
+from ..httpuploadpipe import HttpUploadPipe
+from .octowebstreambodypipeline import OctoWebStreamBodyPipeline
 from ..Proto import HttpHeader
 from ..Proto import WebStreamMsg
 from ..Proto import MessageContext
 from ..Proto import HttpInitialContext
 from ..Proto import DataCompression
 from ..Proto import OeAuthAllowed
+from ..Proto import MessagePriority
 from ..Proto.PathTypes import PathTypes
 
 # A wrapper that allows us to pass around a ref to the per message builder object.
@@ -47,6 +56,13 @@ class MsgBuilderContext:
 #
 class OctoWebStreamHttpHelper:
 
+    # When streaming uploads are enabled, uploads with a known size smaller than this are still collected in memory, since there's no gain.
+    c_MinStreamingUploadSizeBytes = 1024 * 1024
+
+    # When the pipelined body relay is enabled, bodies with a known length at least this large are pipelined.
+    # Smaller bodies are only a few reads, so there's nothing to overlap.
+    c_MinPipelinedBodySizeBytes = 2 * 1024 * 1024
+
     # Called by the main socket thread so this should be quick!
     def __init__(self, streamId, logger:logging.Logger, webStream, webStreamOpenMsg:WebStreamMsg.WebStreamMsg, openedTime):
         self.Id = streamId
@@ -58,11 +74,15 @@ class OctoWebStreamHttpHelper:
         self.CompressionContext = CompressionContext(self.Logger)
 
         # Vars for response reading
-        self.BodyReadTempBuffer:bytearray = None
+        self.MjpegParser:MjpegStreamParser = None
+        # If the latest frame webcam mode is enabled, these are used for multipart streams.
+        self.WebcamGovernor:WebcamStreamGovernor = None
+        self.LatestFrameReader:LatestFrameReader = None
+        # For multipart streams, the key the frames are published to the frame registry with, so snapshots can be taken from the stream.
+        self.WebcamFrameKey:str = None
         self.ChunkedBodyHasNoContentLengthHeaders = False
         self.CompressionType:DataCompression.DataCompression = None
         self.CompressionTimeSec = -1
-        self.MissingBoundaryWarningCounter = 0
         self.IsUsingFullBodyBuffer = False
         self.IsUsingCustomBodyStreamCallbacks = False
 
@@ -71,6 +91,14 @@ class OctoWebStreamHttpHelper:
         self.UploadBytesReceivedSoFar = 0
         self.UploadBuffer = None
 
+        # If the upload is streamed to the local http server as it arrives, this is the pipe the body is written into.
+        # The http call is made on a thread (or task for asyncio) when the stream opens, and the result is processed when the upload is done.
+        self.UploadPipe:HttpUploadPipe = None
+        self.StreamingUploadRequest = None
+        self.StreamingUploadThread:threading.Thread = None
+        self.StreamingUploadTask:asyncio.Task = None
+        self.StreamingUploadResult:OctoHttpRequest.Result = None
+
         # Unknown body size chunk reader
         # If this is not None, we are doing the unknown body read. Then the rest of the body reads must use this same system.
         self.UnknownBodyChunkReadContext:UnknownBodyChunkReadContext = None
@@ -80,6 +108,8 @@ class OctoWebStreamHttpHelper:
         self.ServiceUploadTimeSec = 0.0
         self.BodyReadTimeHighWaterMarkSec = 0.0
         self.ServiceUploadTimeHighWaterMarkSec = 0.0
+        # The time this stream was deferred for high pri streams, if it's low pri.
+        self.HighPriDeferredTimeSec = 0.0
 
         # Used to keep track of multipart read rates, aka webcam streaming fps.
         # A value of 0 means there's no current read rate.
@@ -110,6 +140,14 @@ class OctoWebStreamHttpHelper:
             with self.UnknownBodyChunkReadContext.BufferLock:
                 self.UnknownBodyChunkReadContext.BufferDataReadyEvent.set()
 
+        # If we are streaming an upload, abort the pipe so the http call and any blocked writes stop.
+        if self.UploadPipe is not None:
+            self.UploadPipe.Abort()
+
+        # If there's a latest frame reader, stop it. It's thread will exit when the http response is closed.
+        if self.LatestFrameReader is not None:
+            self.LatestFrameReader.Stop()
+
 
     # Called when a new message has arrived for this stream from the server.
     # This function should throw on critical errors, that will reset the connection.
@@ -122,12 +160,27 @@ class OctoWebStreamHttpHelper:
         # This http call might have data sent to us in multiple messages.
         # If this message has data, put it into our buffer.
         if webStreamMsg.DataLength() > 0:
-            # Copy this upload data from the message.
-            self.copyUploadDataFromMsg(webStreamMsg)
+            # If this is a large upload, start the http request now and stream the body to it as it arrives.
+            if self.shouldStartStreamingUpload(webStreamMsg) and self.tryStartStreamingUpload():
+                self.StreamingUploadThread = threading.Thread(target=self.streamingUploadHttpCallThread)
+                self.StreamingUploadThread.start()
+
+            if self.UploadPipe is not None:
+                # This will block if the local http server is slower than the upload.
+                self.UploadPipe.Write(self.getUploadDataForPipe(webStreamMsg))
+            else:
+                # Copy this upload data from the message.
+                self.copyUploadDataFromMsg(webStreamMsg)
 
         # If the data is done flag is set, that indicates that
         # the full upload buffer has been transmitted.
         if webStreamMsg.IsDataTransmissionDone():
+            # If this is a streaming upload, the request is already running, so we wait for it and send the response.
+            if self.UploadPipe is not None:
+                with self.CompressionContext:
+                    self.finishStreamingUpload()
+                return True
+
             # If we didn't know the upload size, we need to finalize it now
             self.finalizeUnknownUploadSizeIfNeeded()
 
@@ -143,6 +196,32 @@ class OctoWebStreamHttpHelper:
         return False
 
 
+    # Used by the asyncio relay engine, this is the same as IncomingServerMessage but runs on the loop.
+    async def IncomingServerMessageAsync(self, webStreamMsg:WebStreamMsg.WebStreamMsg, engine):
+        if webStreamMsg.DataLength() > 0:
+            if self.shouldStartStreamingUpload(webStreamMsg) and self.tryStartStreamingUpload():
+                self.StreamingUploadTask = asyncio.ensure_future(self.streamingUploadHttpCallAsync(engine))
+            if self.UploadPipe is not None:
+                # The loop can't block, so if the pipe is full the write waits on a blocking thread.
+                buffer = self.getUploadDataForPipe(webStreamMsg)
+                if self.UploadPipe.CanWriteWithoutBlocking():
+                    self.UploadPipe.Write(buffer)
+                else:
+                    await engine.RunBlocking(self.UploadPipe.Write, buffer)
+            else:
+                self.copyUploadDataFromMsg(webStreamMsg)
+        if webStreamMsg.IsDataTransmissionDone():
+            if self.UploadPipe is not None:
+                with self.CompressionContext:
+                    await self.finishStreamingUploadAsync(engine)
+                return True
+            self.finalizeUnknownUploadSizeIfNeeded()
+            with self.CompressionContext:
+                await self.executeHttpRequestAsync(engine)
+            return True
+        return False
+
+
     # This function either needs to throw (which will restart the entire connection)
     # or return a WebStreamMsg, or close the web stream. Otherwise the server will be waiting for it
     # for until it hits a timeout.
@@ -153,13 +232,100 @@ class OctoWebStreamHttpHelper:
     def executeHttpRequest(self):
         requestExecutionStart = time.time()
 
+        # Validate and gather what we need to make the request.
+        httpInitialContext, method, sendHeaders = self.prepareHttpRequest()
+
+        # Before we make the request, make sure we shouldn't defer for a high pri request
+        self.checkForDelayIfNotHighPri()
+
+        # Check for some special case requests before we handle the request as normal.
+        if self.isSpecialCaseRequest(httpInitialContext, sendHeaders):
+            self.executeSpecialCaseRequest(httpInitialContext, method, sendHeaders, requestExecutionStart)
+            return
+
+        # This is a normal web request, first ensure they are allowed.
+        if self.closeIfHttpRelayIsDisabled(httpInitialContext):
+            return
+
+        # For all web requests, check our in memory read-to-go cache.
+        # If available, this will return the object. On a miss it will return None
+        octoHttpResult = self.getSlipstreamCachedResult(httpInitialContext)
+        # If Slipstream doesn't have it, check the static asset cache.
+        assetCacheKey = None
+        if octoHttpResult is None:
+            assetCacheKey = self.getAssetCacheKey(httpInitialContext, method, sendHeaders)
+            octoHttpResult = self.getAssetCachedResult(assetCacheKey)
+        isFromCache = octoHttpResult is not None
+        if octoHttpResult is None:
+            # If we don't have a valid result yet, do the normal http path.
+            octoHttpResult = OctoHttpRequest.MakeHttpCallOctoStreamHelper(self.Logger, httpInitialContext, method, self.getAssetCacheFillHeaders(assetCacheKey, sendHeaders), self.UploadBuffer)
+            # If the result is a cacheable asset, this will store it and return the cached result.
+            octoHttpResult = self.storeInAssetCacheIfPossible(assetCacheKey, octoHttpResult)
+
+        # Process the result and send the response.
+        self.processHttpResult(octoHttpResult, httpInitialContext, method, sendHeaders, requestExecutionStart, isFromCache)
+
+
+    # Used by the asyncio relay engine, this is the same as executeHttpRequest but runs on the loop.
+    # The http call is made with the async http client. If the response body was fully read, the response is processed on the loop, otherwise
+    # it's processed on a blocking thread, since the body reads would block the loop.
+    async def executeHttpRequestAsync(self, engine):
+        requestExecutionStart = time.time()
+
+        # Validate and gather what we need to make the request.
+        httpInitialContext, method, sendHeaders = self.prepareHttpRequest()
+
+        # Before we make the request, make sure we shouldn't defer for a high pri request
+        await self.checkForDelayIfNotHighPriAsync()
+
+        # The special case requests are all blocking, so they run on a blocking thread.
+        if self.isSpecialCaseRequest(httpInitialContext, sendHeaders):
+            await engine.RunBlocking(self.executeSpecialCaseRequest, httpInitialContext, method, sendHeaders, requestExecutionStart)
+            return
+
+        # This is a normal web request, first ensure they are allowed.
+        if self.closeIfHttpRelayIsDisabled(httpInitialContext):
+            return
+
+        # Check the Slipstream and static asset caches, if we get a hit, it's a full body buffer so it can be processed here.
+        octoHttpResult = self.getSlipstreamCachedResult(httpInitialContext)
+        assetCacheKey = None
+        if octoHttpResult is None:
+            assetCacheKey = self.getAssetCacheKey(httpInitialContext, method, sendHeaders)
+            octoHttpResult = self.getAssetCachedResult(assetCacheKey)
+        isFromCache = octoHttpResult is not None
+        if octoHttpResult is None:
+            octoHttpResult = await OctoHttpRequest.MakeHttpCallOctoStreamHelperAsync(self.Logger, engine, httpInitialContext, method, self.getAssetCacheFillHeaders(assetCacheKey, sendHeaders), self.UploadBuffer)
+            # Storing might read the body and compress it, so it's done on a blocking thread.
+            if assetCacheKey is not None and octoHttpResult is not None:
+                octoHttpResult = await engine.RunBlocking(self.storeInAssetCacheIfPossible, assetCacheKey, octoHttpResult)
+
+        await self.processHttpResultAsync(engine, octoHttpResult, httpInitialContext, method, sendHeaders, requestExecutionStart, isFromCache)
+
+
+    # The asyncio version of processHttpResult, this must be called on the loop.
+    async def processHttpResultAsync(self, engine, octoHttpResult:OctoHttpRequest.Result, httpInitialContext, method:str, sendHeaders, requestExecutionStart:float, isFromCache:bool):
+        # If there's no body to stream, we can process the result on the loop.
+        if octoHttpResult is None or octoHttpResult.ResponseForBodyRead is None or octoHttpResult.FullBodyBuffer is not None or octoHttpResult.StatusCode == 304 or octoHttpResult.StatusCode == 204:
+            # The whole response is sent at once, so wait for the uplink budget first, without blocking the loop.
+            if await self.WebStream.WaitForUplinkBudgetAsync() is False:
+                self.WebStream.Close()
+                return
+            self.processHttpResult(octoHttpResult, httpInitialContext, method, sendHeaders, requestExecutionStart, isFromCache)
+        else:
+            await engine.RunBlocking(self.processHttpResult, octoHttpResult, httpInitialContext, method, sendHeaders, requestExecutionStart, isFromCache)
+
+
+    # Validates the request and gathers the values needed to make it.
+    # Returns httpInitialContext, method, sendHeaders
+    # For streaming uploads, this is called before the upload data has arrived, so the upload size isn't checked.
+    def prepareHttpRequest(self, checkUploadSize:bool = True):
         # Validate
         if self.WebStreamOpenMsg is None:
             raise Exception("ExecuteHttpRequest but there is no open message")
         # Make sure if there was a defined upload size, we have all of the data.
-        if self.KnownFullStreamUploadSizeBytes is not None:
-            if self.UploadBytesReceivedSoFar != self.KnownFullStreamUploadSizeBytes:
-                raise Exception("Http request tried to execute, but we haven't gotten all of the upload payload. Total:"+str(self.KnownFullStreamUploadSizeBytes)+"; rec so far:"+str(self.UploadBytesReceivedSoFar))
+        if checkUploadSize:
+            self.checkUploadSizeIsComplete()
 
         # Get the initial context
         httpInitialContext = self.WebStreamOpenMsg.HttpInitialContext()
@@ -181,45 +347,204 @@ class OctoWebStreamHttpHelper:
         if method is None:
             self.Logger.error(self.getLogMsgPrefix()+" request had a None method type.")
             raise Exception("Http request had a None method type")
+        return httpInitialContext, method, sendHeaders
 
-        # Before we make the request, make sure we shouldn't defer for a high pri request
-        self.checkForDelayIfNotHighPri()
 
-        # Check for some special case requests before we handle the request as normal.
-        #
-        # 1) An oracle snapshot or webcam stream request. In this case the WebCamHelper class will handle the request.
-        # 2) If the request is a OctoStreamCommand, the CommandHandler will handle the request.
-        # 3) Finally, check if the request is cached in Slipstream.
+    # Throws if there was a defined upload size and we didn't get all of the data.
+    def checkUploadSizeIsComplete(self):
+        if self.KnownFullStreamUploadSizeBytes is not None:
+            if self.UploadBytesReceivedSoFar != self.KnownFullStreamUploadSizeBytes:
+                raise Exception("Http request tried to execute, but we haven't gotten all of the upload payload. Total:"+str(self.KnownFullStreamUploadSizeBytes)+"; rec so far:"+str(self.UploadBytesReceivedSoFar))
+
+
+    # Returns true if the upload should be streamed to the local http server as it arrives.
+    # This is decided on the first message with data, and only if there's more data coming.
+    def shouldStartStreamingUpload(self, webStreamMsg:WebStreamMsg.WebStreamMsg) -> bool:
+        if OctoHttpRequest.GetEnableStreamingUploads() is False or self.UploadPipe is not None or self.UploadBuffer is not None or webStreamMsg.IsDataTransmissionDone():
+            return False
+        # If the size isn't known, we know it's more than one message, so it's streamed.
+        if self.KnownFullStreamUploadSizeBytes is not None and self.KnownFullStreamUploadSizeBytes < OctoWebStreamHttpHelper.c_MinStreamingUploadSizeBytes:
+            return False
+        return True
+
+
+    # Sets up the upload pipe and gathers what the http call needs. Returns false if this request can't be streamed,
+    # the special case requests and requests that are blocked by a disabled http relay use the normal path.
+    def tryStartStreamingUpload(self) -> bool:
+        requestExecutionStart = time.time()
+        httpInitialContext, method, sendHeaders = self.prepareHttpRequest(False)
+        if self.isSpecialCaseRequest(httpInitialContext, sendHeaders):
+            return False
+        if OctoHttpRequest.GetDisableHttpRelay() and httpInitialContext.PathType() != PathTypes.Absolute:
+            return False
+        self.StreamingUploadRequest = (httpInitialContext, method, sendHeaders, requestExecutionStart)
+        self.UploadPipe = HttpUploadPipe(self.KnownFullStreamUploadSizeBytes)
+        RelayMetrics.Get().IncrementCounter("Http.StreamingUploads")
+        return True
+
+
+    # Returns the message's upload data, decompressed, and checks we didn't get more than expected.
+    def getUploadDataForPipe(self, webStreamMsg:WebStreamMsg.WebStreamMsg):
+        buf = self.decompressBufferIfNeeded(webStreamMsg)
+        if self.KnownFullStreamUploadSizeBytes is not None and len(buf) + self.UploadBytesReceivedSoFar > self.KnownFullStreamUploadSizeBytes:
+            self.Logger.warn(self.getLogMsgPrefix() + " received more bytes than it was expecting for the upload. thisMsg:"+str(len(buf))+"; so far:"+str(self.UploadBytesReceivedSoFar) + "; expected:"+str(self.KnownFullStreamUploadSizeBytes))
+            raise Exception("Too many bytes received for http upload pipe")
+        self.UploadBytesReceivedSoFar += len(buf)
+        return buf
+
+
+    # Runs on it's own thread for streaming uploads, this makes the http call which reads the body from the upload pipe.
+    def streamingUploadHttpCallThread(self):
+        try:
+            httpInitialContext, method, sendHeaders, _ = self.StreamingUploadRequest
+            self.checkForDelayIfNotHighPri()
+            self.StreamingUploadResult = self.closeResultIfStreamClosed(OctoHttpRequest.MakeHttpCallOctoStreamHelper(self.Logger, httpInitialContext, method, sendHeaders, self.UploadPipe))
+        except Exception as e:
+            if self.IsClosed is False:
+                Sentry.Exception(self.getLogMsgPrefix()+" streaming upload http call failed.", e)
+        finally:
+            # Any data that's still coming is dropped, since the request is done.
+            self.UploadPipe.FinishRead()
+            self.recordUploadPipeMetrics()
+
+
+    # The asyncio version of streamingUploadHttpCallThread, this runs as a task on the loop and returns the result.
+    async def streamingUploadHttpCallAsync(self, engine):
+        try:
+            httpInitialContext, method, sendHeaders, _ = self.StreamingUploadRequest
+            await self.checkForDelayIfNotHighPriAsync()
+            return self.closeResultIfStreamClosed(await OctoHttpRequest.MakeHttpCallOctoStreamHelperAsync(self.Logger, engine, httpInitialContext, method, sendHeaders, self.UploadPipe))
+        except Exception as e:
+            if self.IsClosed is False:
+                Sentry.Exception(self.getLogMsgPrefix()+" streaming upload http call failed.", e)
+            return None
+        finally:
+            self.UploadPipe.FinishRead()
+            self.recordUploadPipeMetrics()
+
+
+    # Adds the upload pipe's stats to the relay metrics, so slow local servers show up as write waits in the metrics command.
+    def recordUploadPipeMetrics(self):
+        stats = self.UploadPipe.GetStats()
+        metrics = RelayMetrics.Get()
+        metrics.IncrementCounter("Http.StreamingUploads.Bytes", stats["TotalWrittenBytes"])
+        metrics.IncrementCounter("Http.StreamingUploads.WriteWaits", stats["WriteWaits"])
+        if stats["CanReplay"] is False:
+            metrics.IncrementCounter("Http.StreamingUploads.NotReplayable")
+
+
+    # If the stream was closed while the streaming upload was running, no one will use the result, so it's closed.
+    def closeResultIfStreamClosed(self, octoHttpResult:OctoHttpRequest.Result) -> OctoHttpRequest.Result:
+        if self.IsClosed and octoHttpResult is not None:
+            with octoHttpResult:
+                pass
+            return None
+        return octoHttpResult
+
+
+    # Called when all of the streaming upload data has been written to the pipe. This waits for the http call and sends the response.
+    def finishStreamingUpload(self):
+        self.UploadPipe.FinishWrite()
+        try:
+            self.checkUploadSizeIsComplete()
+        except Exception:
+            self.UploadPipe.Abort()
+            raise
+        self.StreamingUploadThread.join()
+        httpInitialContext, method, sendHeaders, requestExecutionStart = self.StreamingUploadRequest
+        self.processHttpResult(self.StreamingUploadResult, httpInitialContext, method, sendHeaders, requestExecutionStart, False)
+
+
+    # The asyncio version of finishStreamingUpload, this must be called on the loop.
+    async def finishStreamingUploadAsync(self, engine):
+        self.UploadPipe.FinishWrite()
+        try:
+            self.checkUploadSizeIsComplete()
+        except Exception:
+            self.UploadPipe.Abort()
+            raise
+        octoHttpResult = await self.StreamingUploadTask
+        httpInitialContext, method, sendHeaders, requestExecutionStart = self.StreamingUploadRequest
+        await self.processHttpResultAsync(engine, octoHttpResult, httpInitialContext, method, sendHeaders, requestExecutionStart, False)
+
+
+    # Returns true if the request is one of the special case requests that aren't relayed as a normal web request.
+    #
+    # 1) An oracle snapshot or webcam stream request. In this case the WebCamHelper class will handle the request.
+    # 2) If the request is a OctoStreamCommand, the CommandHandler will handle the request.
+    def isSpecialCaseRequest(self, httpInitialContext, sendHeaders) -> bool:
+        return WebcamHelper.Get().IsSnapshotOrWebcamStreamOracleRequest(sendHeaders) or CommandHandler.Get().IsCommandRequest(httpInitialContext)
+
+
+    # Handles the special case requests, see isSpecialCaseRequest.
+    def executeSpecialCaseRequest(self, httpInitialContext, method, sendHeaders, requestExecutionStart):
         octoHttpResult = None
-        isFromCache = False
         if WebcamHelper.Get().IsSnapshotOrWebcamStreamOracleRequest(sendHeaders):
             octoHttpResult = WebcamHelper.Get().MakeSnapshotOrWebcamStreamRequest(httpInitialContext, method, sendHeaders, self.UploadBuffer)
         # If this is a special command for OctoEverywhere, we handle it differently.
         elif CommandHandler.Get().IsCommandRequest(httpInitialContext):
             # This HandleCommand wil return a mock  OctoHttpResult, including a full mock response object.
             octoHttpResult = CommandHandler.Get().HandleCommand(httpInitialContext, self.UploadBuffer)
-        else:
-            # This is a normal web request, first ensure they are allowed.
-            # Note we must always allow absolute paths, since these can be services like Spoolman or OctoFarm.
-            if OctoHttpRequest.GetDisableHttpRelay() and httpInitialContext.PathType() != PathTypes.Absolute:
-                self.Logger.warn("OctoWebStreamHttpHelper got a request but the http relay is disabled.")
-                self.WebStream.SetClosedDueToFailedRequestConnection()
-                self.WebStream.Close()
-                return
+        self.processHttpResult(octoHttpResult, httpInitialContext, method, sendHeaders, requestExecutionStart, False)
 
-            # For all web requests, check our in memory read-to-go cache.
-            # If available, this will return the object. On a miss it will return None
-            if Compat.HasSlipstream():
-                octoHttpResult = Compat.GetSlipstream().GetCachedOctoHttpResult(httpInitialContext)
 
-            # Check if we got a cache hit.
-            if octoHttpResult is not None:
-                isFromCache = True
-            else:
-                # If we don't have a valid result yet, do the normal http path.
-                octoHttpResult = OctoHttpRequest.MakeHttpCallOctoStreamHelper(self.Logger, httpInitialContext, method, sendHeaders, self.UploadBuffer)
+    # If the http relay is disabled, this closes the stream and returns true.
+    def closeIfHttpRelayIsDisabled(self, httpInitialContext) -> bool:
+        # Note we must always allow absolute paths, since these can be services like Spoolman or OctoFarm.
+        if OctoHttpRequest.GetDisableHttpRelay() and httpInitialContext.PathType() != PathTypes.Absolute:
+            self.Logger.warn("OctoWebStreamHttpHelper got a request but the http relay is disabled.")
+            self.WebStream.SetClosedDueToFailedRequestConnection()
+            self.WebStream.Close()
+            return True
+        return False
+
+
+    # Checks our in memory read-to-go cache. On a miss or if there's no cache, this returns None.
+    def getSlipstreamCachedResult(self, httpInitialContext):
+        if Compat.HasSlipstream():
+            result = Compat.GetSlipstream().GetCachedOctoHttpResult(httpInitialContext)
+            RelayMetrics.Get().IncrementCounter(RelayMetrics.SlipstreamCacheMisses if result is None else RelayMetrics.SlipstreamCacheHits)
+            return result
+        return None
+
+
+    # Returns the static asset cache key for this request, or None if it can't be cached or the cache is disabled.
+    # With no key, the lookup, fill headers, and store below all do nothing, so the request is made like normal.
+    def getAssetCacheKey(self, httpInitialContext, method:str, sendHeaders) -> str:
+        cache = HttpAssetCache.Get()
+        if cache is None:
+            return None
+        return cache.GetCacheKey(OctoStreamMsgBuilder.BytesToString(httpInitialContext.Path()), httpInitialContext.PathType(), method, sendHeaders)
+
+
+    # Checks the static asset cache. On a miss or if there's no key, this returns None.
+    def getAssetCachedResult(self, assetCacheKey:str):
+        if assetCacheKey is None:
+            return None
+        return HttpAssetCache.Get().GetCachedResult(assetCacheKey)
+
+
+    # Returns the headers that should be used for the http call. If the request might fill the asset cache, the conditional
+    # headers are removed so we get the full body, but the original headers are still used to convert the response to a 304.
+    def getAssetCacheFillHeaders(self, assetCacheKey:str, sendHeaders):
+        if assetCacheKey is None:
+            return sendHeaders
+        return HttpAssetCache.Get().GetFillRequestHeaders(sendHeaders)
 
 
+    # If the result can be cached, this stores it and returns the cached result. Otherwise the result is returned as is.
+    # This can block to read the body.
+    def storeInAssetCacheIfPossible(self, assetCacheKey:str, octoHttpResult:OctoHttpRequest.Result):
+        if assetCacheKey is None or octoHttpResult is None:
+            return octoHttpResult
+        contentType = octoHttpResult.Headers.get("content-type", None)
+        shouldCompress = contentType is not None and self.isCompressibleContentType(contentType.lower())
+        return HttpAssetCache.Get().TryStore(assetCacheKey, octoHttpResult, shouldCompress)
+
+
+    # Processes the result of the http request and sends the response back to the server.
+    # This will block until the entire response is sent.
+    def processHttpResult(self, octoHttpResult:OctoHttpRequest.Result, httpInitialContext, method:str, sendHeaders, requestExecutionStart:float, isFromCache:bool):
         # If None is returned, it failed.
         # Since the request failed, we want to just close the stream, since it's not a protocol failure.
         if octoHttpResult is None:
@@ -232,6 +557,9 @@ class OctoWebStreamHttpHelper:
         # On success, unpack the result.
         uri = octoHttpResult.Url
         requestExecutionEnd = time.time()
+        metrics = RelayMetrics.Get()
+        metrics.IncrementCounter(RelayMetrics.HttpRequests)
+        metrics.RecordLatency(RelayMetrics.HttpRequestExecution, requestExecutionEnd - requestExecutionStart)
 
         # Now that we have a valid response, use a with block to ensure no matter what it gets closed when we leave.
         # This is important since we use the stream flag, otherwise close() will not get called and the connection will remain open.
@@ -332,6 +660,20 @@ class OctoWebStreamHttpHelper:
             if Compat.HasWebRequestResponseHandler():
                 responseHandlerContext = Compat.GetWebRequestResponseHandler().CheckIfResponseNeedsToBeHandled(uri)
 
+            # For large bodies with a known length, the body read and compression run on their own threads, so they overlap with the send.
+            bodyPipeline = None
+            if self.shouldPipelineBody(octoHttpResult, method, contentLength, boundaryStr, responseHandlerContext):
+                bodyPipeline = OctoWebStreamBodyPipeline(self.Logger, self, octoHttpResult, contentLength, compressBody, self.getDefaultBodyReadSizeBytes(compressBody, contentLength))
+                bodyPipeline.Start()
+
+            # For multipart streams, like webcam streams, if the latest frame mode is enabled setup the governor, which will skip old frames if the uplink can't keep up.
+            if WebcamStreamGovernor.IsEnabled() and boundaryStr is not None and len(boundaryStr) != 0 and responseHandlerContext is None:
+                self.WebcamGovernor = WebcamStreamGovernor(self.Logger, self.WebStream, self.getLogMsgPrefix())
+
+            # For multipart streams, publish the frames to the frame registry, so snapshots can use them rather than making a new request.
+            if WebcamFrameRegistry.IsEnabled() and boundaryStr is not None and len(boundaryStr) != 0 and responseHandlerContext is None:
+                self.WebcamFrameKey = self.getWebcamFrameKey(httpInitialContext, sendHeaders)
+
             # Setup a loop to read the stream and push it out in multiple messages.
             contentReadBytes = 0
             nonCompressedContentReadSizeBytes = 0
@@ -345,12 +687,23 @@ class OctoWebStreamHttpHelper:
                 # Before we process the response, make sure we shouldn't defer for a high pri request
                 self.checkForDelayIfNotHighPri()
 
+                # Before we read more of the body, make sure the uplink isn't backed up. If it's too slow for too long, shed load by closing the stream.
+                if self.WebStream.WaitForUplinkBudget() is False:
+                    self.WebStream.Close()
+                    break
+
+                # For webcam streams, wait until the next frame should be sent. While we wait, the frame source keeps only the newest frame.
+                # If the stream couldn't be parsed into frames, it's read in fixed size chunks, which can't be skipped, so the governor isn't used.
+                if self.WebcamGovernor is not None and self.ChunkedBodyHasNoContentLengthHeaders is False:
+                    self.WebcamGovernor.WaitForFrameSlot(lambda: self.IsClosed)
+
                 # This is an interesting check. If we are spinning to deliver a http body, and we detect that what we are compressing
                 # is larger than the OG body, we will disable compression for all future messages. We do this because any files that's already
                 # compressed (video, audio, images, or files) will be the same after compression but with overhead added.
                 # We take a big time hit applying the compression, which is usually offset by the size reduction, but if that's not the case, disable it.
                 # If the compressed stream size (contentReadBytes) is larger than  90% of the original stream size(nonCompressedContentReadSizeBytes), stop compression.
-                if compressBody and contentReadBytes != 0 and nonCompressedContentReadSizeBytes != 0 and contentReadBytes > nonCompressedContentReadSizeBytes * 0.9:
+                # When the body is pipelined, the compress stage does this check, since it's ahead of the send.
+                if bodyPipeline is None and compressBody and contentReadBytes != 0 and nonCompressedContentReadSizeBytes != 0 and contentReadBytes > nonCompressedContentReadSizeBytes * 0.9:
                     compressBody = False
                     self.Logger.info(f"We detected that the compression being applied to this stream was inefficient, so we are disabling compression. Compression: {float(contentReadBytes)/float(nonCompressedContentReadSizeBytes)} URL: {uri}")
 
@@ -368,6 +721,9 @@ class OctoWebStreamHttpHelper:
                     lastBodyReadLength = 0
                     dataOffset = None
                     # Note that compressBody will be set to false in the special case below.
+                elif bodyPipeline is not None:
+                    # The chunk was already read and compressed by the pipeline, the compress stage also tells us if this chunk is compressed.
+                    nonCompressedBodyReadSize, lastBodyReadLength, dataOffset, compressBody = self.takePipelinedChunkAndMakeDataVector(builderContext, bodyPipeline)
                 else:
                     # Start by reading data from the response.
                     # This function will return a read length of 0 and a null data offset if there's nothing to read.
@@ -490,9 +846,12 @@ class OctoWebStreamHttpHelper:
                 serviceSendStartSec = time.time()
                 self.WebStream.SendToOctoStream(buffer, msgStartOffsetBytes, msgSizeBytes, isLastMessage, True)
                 thisServiceSendTimeSec = time.time() - serviceSendStartSec
+                metrics.RecordLatency(RelayMetrics.HttpUplinkSend, thisServiceSendTimeSec)
                 self.ServiceUploadTimeSec += thisServiceSendTimeSec
                 if thisServiceSendTimeSec > self.ServiceUploadTimeHighWaterMarkSec:
                     self.ServiceUploadTimeHighWaterMarkSec = thisServiceSendTimeSec
+                if self.WebcamGovernor is not None:
+                    self.WebcamGovernor.OnFrameSent(msgSizeBytes, thisServiceSendTimeSec)
 
                 # Do a debug check to see if our pre-allocated flatbuffer size was too small.
                 # If this fires often, we should increase the c_MsgStreamOverheadSize size.
@@ -505,10 +864,38 @@ class OctoWebStreamHttpHelper:
                 isFirstResponse = False
                 messageCount += 1
 
+            # If the body was pipelined, make sure the stage threads are done and record the stage timing.
+            if bodyPipeline is not None:
+                bodyPipeline.Stop()
+
+            # If the webcam stream was governed, stop the frame reader and add the stats to the relay metrics.
+            if self.LatestFrameReader is not None:
+                self.LatestFrameReader.Stop()
+            if self.WebcamGovernor is not None:
+                droppedFrames = 0 if self.LatestFrameReader is None else self.LatestFrameReader.FramesDropped
+                governorStats = self.WebcamGovernor.GetStats()
+                metrics.IncrementCounter("Webcam.Governor.Streams")
+                metrics.IncrementCounter("Webcam.Governor.FramesSent", governorStats["FramesSent"])
+                metrics.IncrementCounter("Webcam.Governor.FramesDropped", droppedFrames)
+                metrics.IncrementCounter("Webcam.Governor.CongestedWaits", governorStats["CongestedWaits"])
+                metrics.IncrementCounter("Webcam.Governor.FpsLimitedWaits", governorStats["FpsLimitedWaits"])
+                metrics.IncrementCounter("Webcam.Governor.CongestedTimeMs", int(governorStats["CongestedTimeSec"] * 1000))
+                if self.Logger.isEnabledFor(logging.DEBUG):
+                    self.Logger.debug(f"{self.getLogMsgPrefix()}Webcam stream governor stats: {governorStats}, dropped frames: {droppedFrames}")
+
+            # If the body was parsed as a multipart stream, add the parser stats to the relay metrics.
+            if self.MjpegParser is not None:
+                parserStats = self.MjpegParser.GetStats()
+                metrics.IncrementCounter("Webcam.MjpegParser.Streams")
+                metrics.IncrementCounter("Webcam.MjpegParser.Parts", parserStats["Parts"])
+                metrics.IncrementCounter("Webcam.MjpegParser.Reads", parserStats["Reads"])
+                metrics.IncrementCounter("Webcam.MjpegParser.ReadBytes", parserStats["ReadBytes"])
+
             # Log about it - only if debug is enabled. Otherwise, we don't want to waste time making the log string.
             responseWriteDone = time.time()
+            metrics.RecordLatency(RelayMetrics.HttpResponseSend, responseWriteDone - requestExecutionEnd)
             if self.Logger.isEnabledFor(logging.DEBUG):
-                self.Logger.debug(self.getLogMsgPrefix() + method+" [upload:"+str(format(requestExecutionStart - self.OpenedTime, '.3f'))+"s; request_exe:"+str(format(requestExecutionEnd - requestExecutionStart, '.3f'))+"s; send:"+str(format(responseWriteDone - requestExecutionEnd, '.3f'))+"s; body_read:"+str(format(self.BodyReadTimeSec, '.3f'))+"s; compress:"+str(format(self.CompressionTimeSec, '.3f'))+"s; octo_stream_upload:"+str(format(self.ServiceUploadTimeSec, '.3f'))+"s] size:("+str(nonCompressedContentReadSizeBytes)+"->"+str(contentReadBytes)+") compressed:"+str(compressBody)+" msgcount:"+str(messageCount)+" microreads:"+str(self.UnknownBodyChunkReadContext is not None)+" type:"+str(contentTypeLower)+" status:"+str(octoHttpResult.StatusCode)+" cached:"+str(isFromCache)+" for " + uri)
+                self.Logger.debug(self.getLogMsgPrefix() + method+" [upload:"+str(format(requestExecutionStart - self.OpenedTime, '.3f'))+"s; request_exe:"+str(format(requestExecutionEnd - requestExecutionStart, '.3f'))+"s; send:"+str(format(responseWriteDone - requestExecutionEnd, '.3f'))+"s; body_read:"+str(format(self.BodyReadTimeSec, '.3f'))+"s; compress:"+str(format(self.CompressionTimeSec, '.3f'))+"s; octo_stream_upload:"+str(format(self.ServiceUploadTimeSec, '.3f'))+"s; high_pri_deferred:"+str(format(self.HighPriDeferredTimeSec, '.3f'))+"s] size:("+str(nonCompressedContentReadSizeBytes)+"->"+str(contentReadBytes)+") compressed:"+str(compressBody)+" msgcount:"+str(messageCount)+" microreads:"+str(self.UnknownBodyChunkReadContext is not None)+" type:"+str(contentTypeLower)+" status:"+str(octoHttpResult.StatusCode)+" cached:"+str(isFromCache)+" for " + uri)
 
 
     def buildHeaderVector(self, builder, octoHttpResult:OctoHttpRequest.Result):
@@ -695,6 +1082,7 @@ class OctoWebStreamHttpHelper:
 
     def updateResponseFor304(self, octoHttpResult:OctoHttpRequest.Result):
         self.Logger.info(f"Converting request for {octoHttpResult.Url} {octoHttpResult.StatusCode} to a 304.")
+        RelayMetrics.Get().IncrementCounter(RelayMetrics.NotModifiedConversions)
         # First of all, update the status code.
         octoHttpResult.StatusCode = 304
         # Next, if this was a cached result or a result that has a full body buffer, we need to clear it.
@@ -739,7 +1127,11 @@ class OctoWebStreamHttpHelper:
         # so we don't want to waste time on it.
         if contentTypeLower is None:
             return False
+        return self.isCompressibleContentType(contentTypeLower)
+
 
+    # Returns true if the content type is one we would compress.
+    def isCompressibleContentType(self, contentTypeLower:str) -> bool:
         # We will compress...
         #   - Any thing that has text/ in it
         #   - Anything that says it's javascript
@@ -756,28 +1148,7 @@ class OctoWebStreamHttpHelper:
     # If the body has been fully read, this should return ogLen == 0, len = 0, and offset == None
     # The read style depends on the presence of the boundary string existing.
     def readContentFromBodyAndMakeDataVector(self, builderContext:MsgBuilderContext, octoHttpResult:OctoHttpRequest.Result, boundaryStr_opt, shouldCompress, contentTypeLower_NoneIfNotKnown:str, contentLength_NoneIfNotKnown:int, responseHandlerContext):
-        # This is the max size each body read will be. Since we are making local calls, most of the time we will always get this full amount as long as theres more body to read.
-        # This size is a little under the max read buffer on the server, allowing the server to handle the buffers with no copies.
-        #
-        # 3/24/24 - We did a lot of direct download testing to tweak this buffer size and the server read size, these were the best values able to hit about 223mbps.
-        # With the current values, the majority of the time is spent sending the data on the websocket.
-        #
-        # But NOTE! This size is the actual size that will be allocated for the read buffer (in the stream class) and then the buffer is sliced by how much
-        # is read. So we can't make this value too large, or we will be allocating big buffers.
-        # This is 490kb
-        defaultBodyReadSizeBytes = 490 * 1024
-
-        # If we are going to compress this read, use a much higher number. Since most of what we compress is text,
-        # and that text usually compresses down to 25% of the og size, we will use a x4 multiplier.
-        # We do want to make sure this value isn't too big, because we dont want to allocate a huge buffer on low memory systems.
-        if shouldCompress:
-            defaultBodyReadSizeBytes = defaultBodyReadSizeBytes * 4
-
-        # Finally check if we know the content length of the request. If we do, we will set the buffer to be exactly that value.
-        # This is a lot more efficient, because we only allocate a buffer the exact size we need for the request.
-        # But we want to limit the max size of the buffer, so we don't allocate a huge buffer for a large request.
-        if contentLength_NoneIfNotKnown is not None and contentLength_NoneIfNotKnown < defaultBodyReadSizeBytes:
-            defaultBodyReadSizeBytes = contentLength_NoneIfNotKnown
+        defaultBodyReadSizeBytes = self.getDefaultBodyReadSizeBytes(shouldCompress, contentLength_NoneIfNotKnown)
 
         # Some requests like snapshot requests will already have a fully read body. In this case we use the existing body buffer instead of reading from the body.
         finalDataBuffer = None
@@ -797,14 +1168,10 @@ class OctoWebStreamHttpHelper:
                 # and failed to find any content length headers. In that case, we will just read fixed sized chunks.
                 if self.ChunkedBodyHasNoContentLengthHeaders is False and boundaryStr_opt is not None and len(boundaryStr_opt) != 0:
                     # Try to read a single boundary chunk
-                    readLength = self.readStreamChunk(octoHttpResult, boundaryStr_opt)
-                    # If we get a length, we have a buffer to use.
-                    if readLength != 0:
-                        # We create a memory view from the buffer, which is a zero copy operation and zero copy slicing.
-                        # This allows us to pass the buffer around without copying it, but we do have to be sure to release the
-                        # memory views when we are done.
-                        finalDataBufferMv_CanBeNone = memoryview(self.BodyReadTempBuffer)
-                        finalDataBuffer = finalDataBufferMv_CanBeNone[0:readLength]
+                    # This returns a memory view into the parser's buffer, which is a zero copy operation. This allows us to pass the buffer around
+                    # without copying it, but we do have to be sure to release the memory view when we are done.
+                    finalDataBufferMv_CanBeNone = self.readStreamChunk(octoHttpResult, boundaryStr_opt)
+                    finalDataBuffer = finalDataBufferMv_CanBeNone
                 else:
                     if self.UnknownBodyChunkReadContext is not None or (responseHandlerContext is None and self.shouldDoUnknownBodyChunkRead(contentTypeLower_NoneIfNotKnown, contentLength_NoneIfNotKnown)):
                         # According to the HTTP 1.1 spec, if there's no content length and no boundary string, then the body is chunk based transfer encoding.
@@ -827,10 +1194,7 @@ class OctoWebStreamHttpHelper:
                         finalDataBuffer = self.doBodyRead(octoHttpResult, defaultBodyReadSizeBytes)
 
             # Keep track of read times.
-            thisBodyReadTimeSec = time.time() - bodyReadStartSec
-            self.BodyReadTimeSec += thisBodyReadTimeSec
-            if thisBodyReadTimeSec > self.BodyReadTimeHighWaterMarkSec:
-                self.BodyReadTimeHighWaterMarkSec = thisBodyReadTimeSec
+            self.recordBodyReadTime(time.time() - bodyReadStartSec)
 
             # If the final data buffer has been set to None, it means the body is not empty
             if finalDataBuffer is None:
@@ -865,17 +1229,7 @@ class OctoWebStreamHttpHelper:
 
             # Otherwise, check if we should compress
             elif shouldCompress:
-                compressionResult = Compression.Get().Compress(self.CompressionContext, finalDataBuffer)
-                finalDataBuffer = compressionResult.Bytes
-                # Init and update the total compression time if needed.
-                if self.CompressionTimeSec < 0:
-                    self.CompressionTimeSec = 0
-                self.CompressionTimeSec += compressionResult.CompressionTimeSec
-                # Set the compression type, this should only be set once and can't change.
-                if self.CompressionType is None:
-                    self.CompressionType = compressionResult.CompressionType
-                elif self.CompressionType != compressionResult.CompressionType:
-                    raise Exception(f"The data compression has changed mid stream! It was {self.CompressionType} and now tried to be {compressionResult.CompressionType}")
+                finalDataBuffer = self.compressBodyChunk(finalDataBuffer)
 
             # We have a data buffer and we know how large it will be.
             # Since this buffer is the majority of the flatbuffer message, we use it to create the initial size of the flatbuffer.
@@ -887,139 +1241,123 @@ class OctoWebStreamHttpHelper:
             return (originalBufferSize, len(finalDataBuffer), builderContext.Builder.CreateByteVector(finalDataBuffer))
         finally:
             # If we used a memory view, release it.
-            # This also means that the finalDataBuffer is a memory view.
             if finalDataBufferMv_CanBeNone is not None:
-                finalDataBuffer.release()
                 finalDataBufferMv_CanBeNone.release()
 
 
-    # Reads a single chunk from the http response.
-    # This function uses the BodyReadTempBuffer to store the data.
-    # Returns the read size, 0 if the body read is complete.
-    def readStreamChunk(self, octoHttpResult:OctoHttpRequest.Result, boundaryStr):
-        frameSize = 0
-        headerSize = 0
-        foundContentLength = False
+    # Updates the body read time stats for a single body read.
+    def recordBodyReadTime(self, thisBodyReadTimeSec:float):
+        RelayMetrics.Get().RecordLatency(RelayMetrics.HttpBodyRead, thisBodyReadTimeSec)
+        self.BodyReadTimeSec += thisBodyReadTimeSec
+        if thisBodyReadTimeSec > self.BodyReadTimeHighWaterMarkSec:
+            self.BodyReadTimeHighWaterMarkSec = thisBodyReadTimeSec
+
+
+    # Compresses a single body chunk with the stream's compression context and returns the compressed bytes.
+    # The compression context isn't thread safe, so this must only be called from one thread at a time, in body order.
+    def compressBodyChunk(self, buffer):
+        compressionResult = Compression.Get().Compress(self.CompressionContext, buffer)
+        # Init and update the total compression time if needed.
+        if self.CompressionTimeSec < 0:
+            self.CompressionTimeSec = 0
+        self.CompressionTimeSec += compressionResult.CompressionTimeSec
+        RelayMetrics.Get().RecordLatency(RelayMetrics.HttpCompression, compressionResult.CompressionTimeSec)
+        # Set the compression type, this should only be set once and can't change.
+        if self.CompressionType is None:
+            self.CompressionType = compressionResult.CompressionType
+        elif self.CompressionType != compressionResult.CompressionType:
+            raise Exception(f"The data compression has changed mid stream! It was {self.CompressionType} and now tried to be {compressionResult.CompressionType}")
+        return compressionResult.Bytes
+
+
+    # Returns true if the body should be relayed with the read, compress, and send stages running at the same time.
+    # This is only done for large bodies with a known length that are read directly from the http response, since those are the
+    # downloads where the stages overlapping makes a difference.
+    def shouldPipelineBody(self, octoHttpResult:OctoHttpRequest.Result, method:str, contentLength_NoneIfNotKnown:int, boundaryStr_opt:str, responseHandlerContext) -> bool:
+        if OctoHttpRequest.GetEnablePipelinedBodyRelay() is False:
+            return False
+        if contentLength_NoneIfNotKnown is None or contentLength_NoneIfNotKnown < OctoWebStreamHttpHelper.c_MinPipelinedBodySizeBytes:
+            return False
+        if self.IsUsingFullBodyBuffer or self.IsUsingCustomBodyStreamCallbacks or responseHandlerContext is not None:
+            return False
+        if boundaryStr_opt is not None and len(boundaryStr_opt) != 0:
+            return False
+        if octoHttpResult.StatusCode == 304 or octoHttpResult.StatusCode == 204 or method.lower() == "head":
+            return False
+        return octoHttpResult.ResponseForBodyRead is not None
+
+
+    # Takes the next chunk from the body pipeline and builds the data vector for it.
+    # Returns the same values as readContentFromBodyAndMakeDataVector, plus if the chunk was compressed, since the pipeline can turn compression off mid stream.
+    def takePipelinedChunkAndMakeDataVector(self, builderContext:MsgBuilderContext, bodyPipeline:OctoWebStreamBodyPipeline):
+        originalBufferSize, finalDataBuffer, isCompressed = bodyPipeline.TakeChunk()
+        if finalDataBuffer is None:
+            return (0, 0, None, False)
+        builderContext.CreateBuilder(len(finalDataBuffer))
+        return (originalBufferSize, len(finalDataBuffer), builderContext.Builder.CreateByteVector(finalDataBuffer), isCompressed)
+
+
+    # Returns the size of each body read.
+    def getDefaultBodyReadSizeBytes(self, shouldCompress:bool, contentLength_NoneIfNotKnown:int) -> int:
+        # This is the max size each body read will be. Since we are making local calls, most of the time we will always get this full amount as long as theres more body to read.
+        # This size is a little under the max read buffer on the server, allowing the server to handle the buffers with no copies.
+        #
+        # 3/24/24 - We did a lot of direct download testing to tweak this buffer size and the server read size, these were the best values able to hit about 223mbps.
+        # With the current values, the majority of the time is spent sending the data on the websocket.
+        #
+        # But NOTE! This size is the actual size that will be allocated for the read buffer (in the stream class) and then the buffer is sliced by how much
+        # is read. So we can't make this value too large, or we will be allocating big buffers.
+        # This is 490kb
+        defaultBodyReadSizeBytes = 490 * 1024
 
-        # If the temp array isn't setup, do it now.
-        if self.BodyReadTempBuffer is None:
-            self.BodyReadTempBuffer = bytearray(10*1024)
+        # If we are going to compress this read, use a much higher number. Since most of what we compress is text,
+        # and that text usually compresses down to 25% of the og size, we will use a x4 multiplier.
+        # We do want to make sure this value isn't too big, because we dont want to allocate a huge buffer on low memory systems.
+        if shouldCompress:
+            defaultBodyReadSizeBytes = defaultBodyReadSizeBytes * 4
+
+        # Finally check if we know the content length of the request. If we do, we will set the buffer to be exactly that value.
+        # This is a lot more efficient, because we only allocate a buffer the exact size we need for the request.
+        # But we want to limit the max size of the buffer, so we don't allocate a huge buffer for a large request.
+        if contentLength_NoneIfNotKnown is not None and contentLength_NoneIfNotKnown < defaultBodyReadSizeBytes:
+            defaultBodyReadSizeBytes = contentLength_NoneIfNotKnown
+        return defaultBodyReadSizeBytes
+
+
+    # Reads a single boundary chunk from the http response.
+    # Returns a memory view of the chunk, which is only valid until the next call, or None if the body read is complete.
+    def readStreamChunk(self, octoHttpResult:OctoHttpRequest.Result, boundaryStr) -> memoryview:
+        # If the parser isn't setup, do it now.
+        if self.MjpegParser is None:
+            self.MjpegParser = MjpegStreamParser(self.Logger, boundaryStr, lambda readSize: self.doBodyRead(octoHttpResult, readSize), self.getLogMsgPrefix())
+            # If the stream is governed, the parts are read on a thread that only keeps the newest one.
+            if self.WebcamGovernor is not None:
+                self.LatestFrameReader = LatestFrameReader(self.Logger, self.MjpegParser, self.getLogMsgPrefix())
+                self.LatestFrameReader.Start()
 
         # Note. OctoPrint webcam streams have content-length headers in each chunk. However, the standard
-        # says it's not required. So if we can find them use them, but if not we will set the
-        # ChunkedBodyHasNoContentLengthHeaders so that future body reads don't attempt to find the headers again.
-
-        # First, we need to see if we can find the content length header.
-        # We will keep grabbing more and more data in loop until we find the header
-        # If we can't find it after our max size, we declare it's not there (which is fine)
-        # and will use a different read method going forward.
-        c_maxHeaderSearchSizeBytes = 5 * 1024
-        tempBufferFilledSize = 0
+        # says it's not required. If they aren't there the parser will look for the next boundary instead.
+        # If the parser can't find the headers or the boundary at all, it will return what it has read and we
+        # will set the ChunkedBodyHasNoContentLengthHeaders so that future body reads don't attempt to parse the stream again.
         try:
-            # Loop until found or we have hit the search limit.
-            while foundContentLength is False and tempBufferFilledSize < c_maxHeaderSearchSizeBytes:
-                # Read a small chunk to try to read the header
-                # We want to read enough that hopefully we get all of the headers, but not so much that
-                # we accidentally read two boundary messages at once.
-                # 3/24/24 - After a lot of testing, it seems most times we get the full headers in 120 chars.
-                # So we will target that much, hoping we can do one read and get them.
-                headerBuffer = self.doBodyRead(octoHttpResult, 120)
-
-                # If this returns 0, the body read is complete
-                if headerBuffer is None:
-                    # We should return the length of the buffer we have read so far.
-                    return tempBufferFilledSize
-
-                # Add the header buffer to the temp output
-                self.BodyReadTempBuffer[tempBufferFilledSize:tempBufferFilledSize+len(headerBuffer)] = headerBuffer
-                tempBufferFilledSize += len(headerBuffer)
-
-                # Convert the entire buffer read so far into a string for parsing.
-                # We must use the decode function here, not just str(), because in py3 str() will make a "ToString" the object,
-                # and not actually return us the contents of the buffer as a string.
-                headerStr = self.BodyReadTempBuffer[:tempBufferFilledSize].decode(errors="ignore")
-
-                # Validate the headers starts with what we expect.
-                # According the the RFC, the boundary should start with the boundary string or '--' + boundary string.
-                # However, we have also seen \r\n--<str> and also no boundary string for the first frame as well. So this might fire once or twice, and that's fine.
-                # These are in order of how common they are, for perf.
-                if headerStr.startswith("--"+boundaryStr) is False and headerStr.startswith(boundaryStr) is False and headerStr.startswith("\r\n--"+boundaryStr) is False:
-                    # Always report the first time we find this, otherwise, report only occasionally.
-                    if self.MissingBoundaryWarningCounter % 120 == 0:
-                        # Trim the string to print it.
-                        outputStr = headerStr
-                        if len(outputStr) > 40:
-                            outputStr = outputStr[:40]
-                        self.Logger.warn("We read a web stream body frame, but it didn't start with the expected boundary header. expected:'"+boundaryStr+"' got:^^"+outputStr+"^^")
-                    self.MissingBoundaryWarningCounter += 1
-
-                # Find out how long the headers are. The \r\n\r\n sequence ends the headers.
-                endOfAllHeadersMatch = "\r\n\r\n"
-                endOfHeaderMatch = "\r\n"
-
-                # Try to find headers
-                # This logic checks for errors, and if found, don't stop the logic because of them
-                # This will cause us to loop again and read more. The reason for this is since we read random
-                # chunks, we could read a chunk that splits the content-length header in half, which would cause errors.
-                # So we just allow the system to keep reading until we hit the limit, because the next read would then have the full
-                # header we are looking for.
-                headerSize = headerStr.find(endOfAllHeadersMatch)
-                if headerSize != -1:
-                    # We found at least some headers!
-
-                    # Add 4 bytes for the \r\n\r\n end of header sequence. Also add two bytes for the \r\n at the end of this boundary chunk.
-                    headerSize += 4 + 2
-
-                    # Split out the headers
-                    headers = headerStr.split(endOfHeaderMatch)
-                    for header in headers:
-                        if header.lower().startswith("content-length"):
-                            # We found the content-length header!
-                            p = header.split(':')
-                            if len(p) == 2:
-                                frameSize = int(p[1].strip())
-                                foundContentLength = True
-                            break
-
+            if self.LatestFrameReader is not None:
+                chunk = self.LatestFrameReader.TakeFrame(lambda: self.IsClosed)
+                hasFailed = self.LatestFrameReader.HasFailed
+            else:
+                chunk = self.MjpegParser.ReadPart()
+                hasFailed = self.MjpegParser.HasFailed
         except Exception as e:
             Sentry.Exception(self.getLogMsgPrefix()+ " exception thrown in http stream chunk reader", e)
-            return 0
+            return None
 
-        # Check if we found a content length header
-        if foundContentLength is False:
-            # It ok if we didn't find it, since it's not required for boundary chunks
-            # In this case, we will set the flag so future reads don't try again.
-            self.ChunkedBodyHasNoContentLengthHeaders = True
-            # And return the length of whatever we read
-            return tempBufferFilledSize
-
-        # We have a content-length!
-        # Compute how much more we need to read.
-        toRead = (frameSize + headerSize) - tempBufferFilledSize
-        if toRead < 0:
-            # Oops. This means we read into the next chunk.
-            # TODO - we could update this logic to correct itself by appending this chunk data
-            # on the next chunk, but as it stands it won't work.
-            # So just put the stream into the no content-length mode and return what we read.
-            self.Logger.error(self.getLogMsgPrefix()+ " http stream to read size is less than 0. FrameSize:"+str(frameSize) + " HeaderSize:"+str(headerSize) + " Read:"+str(tempBufferFilledSize))
+        if hasFailed:
+            self.Logger.info(self.getLogMsgPrefix()+" the http stream chunks couldn't be parsed, so we will read the body in fixed size chunks.")
             self.ChunkedBodyHasNoContentLengthHeaders = True
-            return tempBufferFilledSize
-
-        # Read the remainder of the chunk.
-        if toRead > 0:
-            data = self.doBodyRead(octoHttpResult, toRead)
+            return chunk
 
-            # If we hit the end of the body, return how much we read already.
-            if data is None:
-                return tempBufferFilledSize
-
-            # Warn if twe didn't read it all
-            if len(data) != toRead:
-                self.Logger.warn(self.getLogMsgPrefix()+" while reading a boundary chunk, doBodyRead didn't return the full size we requested.")
-
-            # Copy this data into the temp buffer
-            self.BodyReadTempBuffer[tempBufferFilledSize:tempBufferFilledSize+len(data)] = data
-            tempBufferFilledSize += len(data)
+        # If the body is done, there's nothing to count.
+        if chunk is None:
+            return None
 
         # Update our read rate. This is a metric we send along in the stream if the it's a multipart stream, to know how fast we are reading it.
         # Basically for webcams streamed via http, it's the frame rate.
@@ -1037,15 +1375,27 @@ class OctoWebStreamHttpHelper:
             # Note if this spins multiple times, it will be zeroed out. That would mean there's a more than 1s gap in reading.
             if isFirstIncrement is False and self.MultipartReadsPerSecond == 0:
                 self.Logger.warn("Multipart read per second stats hit a period where 0 reads happened for more than second.")
-            self.MultipartReadsPerSecond = self.MissingBoundaryWarningCounter
-            self.MissingBoundaryWarningCounter = 0
+            self.MultipartReadsPerSecond = self.MultipartReadsPerSecondCounter
+            self.MultipartReadsPerSecondCounter = 0
             isFirstIncrement = False
 
         # Now increment our counter, to account for the frame we just processed.
-        self.MissingBoundaryWarningCounter += 1
+        self.MultipartReadsPerSecondCounter += 1
+
+        # Publish the frame, the copy is only made if the registry is going to take it.
+        if self.WebcamFrameKey is not None:
+            WebcamFrameRegistry.Get().PublishFrame(self.WebcamFrameKey, lambda: bytes(MjpegStreamParser.GetPartBody(chunk)))
+
+        # Finally, return the chunk.
+        return chunk
+
 
-        # Finally, return how much we put into the temp buffer!
-        return tempBufferFilledSize
+    # Returns the key the frames of this stream are published to the frame registry with.
+    # For oracle webcam stream requests it's the webcam's stream url, otherwise it's the path that was requested, which is what the webcam settings use.
+    def getWebcamFrameKey(self, httpInitialContext, sendHeaders) -> str:
+        if WebcamHelper.Get().IsWebcamStreamOracleRequest(sendHeaders):
+            return WebcamHelper.Get().GetWebcamStreamUrl(WebcamHelper.Get().GetOracleRequestCameraIndex(sendHeaders))
+        return OctoStreamMsgBuilder.BytesToString(httpInitialContext.Path())
 
 
     def doBodyRead(self, octoHttpResult:OctoHttpRequest.Result, readSize:int):
@@ -1292,15 +1642,26 @@ class OctoWebStreamHttpHelper:
 
 
     # To speed up page load, we will defer lower pri requests while higher priority requests
-    # are executing.
+    # are executing. This is called before the request is made and before each body read, so the origin reads and sends are paused.
     def checkForDelayIfNotHighPri(self):
-        # This isn't used at all right now.
-        pass
         # Allow anything above Normal priority to always execute
-        # if self.WebStreamOpenMsg.MsgPriority() < MessagePriority.MessagePriority.Normal:
-        #     return
-        # # Otherwise, we want to block for a bit if there's a high pri stream processing.
-        # self.WebStream.BlockIfHighPriStreamActive()
+        if self.WebStreamOpenMsg.MsgPriority() < MessagePriority.MessagePriority.Normal:
+            return
+        # When the body is fully read on the asyncio relay engine loop, the response is processed on the loop, which must never block.
+        # The request was already deferred before it was made, so it's fine to skip.
+        engine = self.WebStream.AsyncEngine
+        if engine is not None and engine.IsLoopThread():
+            return
+        # Otherwise, we want to block for a bit if there's a high pri stream processing.
+        self.HighPriDeferredTimeSec += self.WebStream.OctoSession.PriorityArbiter.WaitIfHighPriStreamActive()
+
+
+    # The same as checkForDelayIfNotHighPri, but for the asyncio relay engine loop.
+    async def checkForDelayIfNotHighPriAsync(self):
+        if self.WebStreamOpenMsg.MsgPriority() < MessagePriority.MessagePriority.Normal:
+            return
+        self.HighPriDeferredTimeSec += await self.WebStream.OctoSession.PriorityArbiter.WaitIfHighPriStreamActiveAsync()
+
 
     # Formatting helper.
     def _FormatFloat(self, value:float) -> str:
@@ -0,0 +1,141 @@
+# namespace: WebStream
+
+import time
+import asyncio
+import logging
+import threading
+
+#
+# The priority arbiter is owned by the OctoSession and is shared by all of the web streams in the session.
+#
+# When a high pri stream is in flight, like the requests for the first portal page load, the low pri http streams
+# will pause their origin reads and sends for a bit, so the high pri requests get the bandwidth and CPU.
+#
+# All waits are bounded, so low pri work is only ever deferred, never stopped.
+#   - Each wait is limited to c_MaxWaitPerCallSec.
+#   - High pri streams that have been active longer than c_MaxHighPriHoldSec are ignored, so a long lived high pri stream
+#     like a websocket or a large download can't starve everything else.
+#
+class OctoWebStreamPriorityArbiter:
+
+    # The max time a single call will wait for the high pri streams to finish.
+    c_MaxWaitPerCallSec = 1.0
+
+    # High pri streams that have been active for longer than this don't cause low pri streams to wait.
+    c_MaxHighPriHoldSec = 5.0
+
+    # How often the async wait checks the state, since it can't block on the condition.
+    c_AsyncPollIntervalSec = 0.05
+
+
+    def __init__(self, logger:logging.Logger):
+        self.Logger = logger
+        self.Lock = threading.Lock()
+        self.HighPriStreamsEnded = threading.Condition(self.Lock)
+        # A map of the active high pri stream id to the time it started.
+        self.ActiveHighPriStreams = {}
+
+        # Stats
+        self.HighPriStreamsStarted = 0
+        self.DeferredCalls = 0
+        self.DeferredCallsTimedOut = 0
+        self.DeferredTimeTotalSec = 0.0
+        self.DeferredTimeHighWaterMarkSec = 0.0
+
+
+    # Called by the web stream when a high pri stream starts.
+    def HighPriStreamStarted(self, streamId:int):
+        with self.Lock:
+            self.ActiveHighPriStreams[streamId] = time.time()
+            self.HighPriStreamsStarted += 1
+
+
+    # Called by the web stream when a high pri stream ends.
+    def HighPriStreamEnded(self, streamId:int):
+        with self.Lock:
+            self.ActiveHighPriStreams.pop(streamId, None)
+            if len(self.ActiveHighPriStreams) == 0:
+                self.HighPriStreamsEnded.notify_all()
+
+
+    # Called by low pri streams before they make a request or read the next body chunk.
+    # If a high pri stream is in flight, this blocks until they are done or the bounded wait expires.
+    # Returns the number of seconds this call was deferred.
+    # This must not be called from the asyncio relay engine loop thread, use WaitIfHighPriStreamActiveAsync instead.
+    def WaitIfHighPriStreamActive(self) -> float:
+        # As a quick check, don't take the lock if there's nothing active.
+        # Worst case this allows one read through without waiting.
+        if len(self.ActiveHighPriStreams) == 0:
+            return 0.0
+        start = time.time()
+        timedOut = False
+        didWait = False
+        with self.Lock:
+            while True:
+                holdRemainingSec = self._GetHighPriHoldRemainingSecUnderLock()
+                if holdRemainingSec <= 0:
+                    break
+                waitRemainingSec = OctoWebStreamPriorityArbiter.c_MaxWaitPerCallSec - (time.time() - start)
+                if waitRemainingSec <= 0:
+                    timedOut = True
+                    break
+                didWait = True
+                self.HighPriStreamsEnded.wait(min(holdRemainingSec, waitRemainingSec))
+        if didWait is False:
+            return 0.0
+        return self._RecordDeferral(start, timedOut)
+
+
+    # The same as WaitIfHighPriStreamActive, but for the asyncio relay engine loop.
+    async def WaitIfHighPriStreamActiveAsync(self) -> float:
+        if len(self.ActiveHighPriStreams) == 0:
+            return 0.0
+        start = time.time()
+        timedOut = False
+        didWait = False
+        while True:
+            with self.Lock:
+                holdRemainingSec = self._GetHighPriHoldRemainingSecUnderLock()
+            if holdRemainingSec <= 0:
+                break
+            waitRemainingSec = OctoWebStreamPriorityArbiter.c_MaxWaitPerCallSec - (time.time() - start)
+            if waitRemainingSec <= 0:
+                timedOut = True
+                break
+            didWait = True
+            await asyncio.sleep(min(holdRemainingSec, waitRemainingSec, OctoWebStreamPriorityArbiter.c_AsyncPollIntervalSec))
+        if didWait is False:
+            return 0.0
+        return self._RecordDeferral(start, timedOut)
+
+
+    # Returns a dict of the high pri and deferral stats.
+    def GetStats(self) -> dict:
+        with self.Lock:
+            return {
+                "ActiveHighPriStreams": len(self.ActiveHighPriStreams),
+                "HighPriStreamsStarted": self.HighPriStreamsStarted,
+                "DeferredCalls": self.DeferredCalls,
+                "DeferredCallsTimedOut": self.DeferredCallsTimedOut,
+                "DeferredTimeTotalSec": round(self.DeferredTimeTotalSec, 3),
+                "DeferredTimeHighWaterMarkSec": round(self.DeferredTimeHighWaterMarkSec, 3),
+            }
+
+
+    # Returns how long the newest high pri stream will still hold low pri streams, or 0 if nothing should wait.
+    def _GetHighPriHoldRemainingSecUnderLock(self) -> float:
+        if len(self.ActiveHighPriStreams) == 0:
+            return 0.0
+        newestStartSec = max(self.ActiveHighPriStreams.values())
+        return OctoWebStreamPriorityArbiter.c_MaxHighPriHoldSec - (time.time() - newestStartSec)
+
+
+    def _RecordDeferral(self, start:float, timedOut:bool) -> float:
+        deferredSec = time.time() - start
+        with self.Lock:
+            self.DeferredCalls += 1
+            if timedOut:
+                self.DeferredCallsTimedOut += 1
+            self.DeferredTimeTotalSec += deferredSec
+            self.DeferredTimeHighWaterMarkSec = max(self.DeferredTimeHighWaterMarkSec, deferredSec)
+        return deferredSec
@@ -0,0 +1,196 @@
+# namespace: WebStream
+
+import time
+import logging
+import threading
+import collections
+
+from ..sentry import Sentry
+from ..repeattimer import RepeatTimer
+from ..relaymetrics import RelayMetrics
+
+#
+# A bounded pool of worker threads web streams can be scheduled on.
+#
+# By default, every web stream gets it's own OS thread. When a portal loads, the server opens a lot of web streams at once, which
+# on low end devices (like the Pi Zero 2 or the K1) means we pay the thread creation cost and stack memory for hundreds of threads.
+# When this pool is enabled, web streams don't get their own thread. Instead, the web stream keeps it's own message queue and when
+# messages arrive it's scheduled as a task on this pool. Only one worker will ever process a given web stream at a time, so the
+# message order is kept.
+#
+class OctoWebStreamWorkerPool:
+
+    # The default and bounds for the max number of worker threads.
+    c_DefaultMaxWorkerThreads = 16
+    c_MinWorkerThreads = 2
+    c_MaxWorkerThreads = 256
+
+    # How long an idle worker will wait for more work before it exits. We keep the workers around for a bit so bursts of
+    # web streams reuse them, but we don't want to hold the stack memory forever.
+    c_WorkerIdleTimeoutSec = 60.0
+
+    # Some web streams, like webcam streams or event streams, will hold a worker for as long as they are open.
+    # If all of the workers are busy and a task has been waiting this long, we will start an overflow worker so new web streams
+    # can't get stuck behind long running streams forever. Overflow workers exit as soon as there's no more queued work.
+    c_OverflowAfterQueueWaitSec = 2.0
+    c_OverflowCheckIntervalSec = 1.0
+
+    _Instance = None
+
+
+    # Only call Init if the worker pool execution mode should be used.
+    @staticmethod
+    def Init(logger:logging.Logger, maxWorkerThreads:int = c_DefaultMaxWorkerThreads):
+        OctoWebStreamWorkerPool._Instance = OctoWebStreamWorkerPool(logger, maxWorkerThreads)
+
+
+    # Returns None if the worker pool execution mode isn't enabled.
+    @staticmethod
+    def Get():
+        return OctoWebStreamWorkerPool._Instance
+
+
+    def __init__(self, logger:logging.Logger, maxWorkerThreads:int):
+        self.Logger = logger
+        self.MaxWorkerThreads = max(OctoWebStreamWorkerPool.c_MinWorkerThreads, min(OctoWebStreamWorkerPool.c_MaxWorkerThreads, maxWorkerThreads))
+
+        # All of the pool state is protected by this lock, the condition is used to wake idle workers.
+        self.Lock = threading.Lock()
+        self.WorkAvailable = threading.Condition(self.Lock)
+        # A queue of tuples, (callback, queuedTimeSec)
+        self.TaskQueue = collections.deque()
+        self.WorkerThreadCount = 0
+        self.IdleWorkerThreadCount = 0
+        self.BusyWorkerThreadCount = 0
+
+        # Stats
+        self.StatTasksScheduled = 0
+        self.StatSaturatedSchedules = 0
+        self.StatWorkerThreadsCreated = 0
+        self.StatOverflowWorkerThreadsCreated = 0
+        self.StatPeakBusyWorkerThreads = 0
+        self.StatPeakQueuedTasks = 0
+        self.StatQueueWaitTimeTotalSec = 0.0
+        self.StatQueueWaitTimeHighWaterMarkSec = 0.0
+
+        self.Logger.info(f"Web stream worker pool enabled with {self.MaxWorkerThreads} max worker threads.")
+
+        # Make the pool saturation and queue wait stats readable with the metrics command.
+        RelayMetrics.Get().RegisterStatsProvider("WebStreamWorkerPool", self.GetStats)
+
+        # Start the overflow watchdog.
+        self.OverflowTimer = RepeatTimer(self.Logger, OctoWebStreamWorkerPool.c_OverflowCheckIntervalSec, self._OverflowCheck)
+        self.OverflowTimer.daemon = True
+        self.OverflowTimer.start()
+
+
+    # Schedules the callback to run on a worker thread.
+    def Schedule(self, callback):
+        with self.Lock:
+            self.TaskQueue.append((callback, time.time()))
+            self.StatTasksScheduled += 1
+            queuedTasks = len(self.TaskQueue)
+            self.StatPeakQueuedTasks = max(self.StatPeakQueuedTasks, queuedTasks)
+
+            # If there are enough idle workers to pick up all of the queued tasks, just wake one.
+            if self.IdleWorkerThreadCount >= queuedTasks:
+                self.WorkAvailable.notify()
+                return
+
+            # If we aren't at the max, start a new worker.
+            if self.WorkerThreadCount < self.MaxWorkerThreads:
+                self._StartWorker_UnderLock(False)
+                return
+
+            # Otherwise the pool is saturated and the task must wait for a worker to free up.
+            self.StatSaturatedSchedules += 1
+
+        if self.Logger.isEnabledFor(logging.DEBUG):
+            self.Logger.debug(f"Web stream worker pool is saturated, {queuedTasks} tasks are waiting for a worker.")
+
+
+    # Returns a dict of the current pool stats.
+    def GetStats(self) -> dict:
+        with self.Lock:
+            avgQueueWaitMs = 0.0
+            if self.StatTasksScheduled > 0:
+                avgQueueWaitMs = (self.StatQueueWaitTimeTotalSec / self.StatTasksScheduled) * 1000.0
+            return {
+                "MaxWorkerThreads": self.MaxWorkerThreads,
+                "WorkerThreads": self.WorkerThreadCount,
+                "IdleWorkerThreads": self.IdleWorkerThreadCount,
+                "BusyWorkerThreads": self.BusyWorkerThreadCount,
+                "PeakBusyWorkerThreads": self.StatPeakBusyWorkerThreads,
+                "QueuedTasks": len(self.TaskQueue),
+                "PeakQueuedTasks": self.StatPeakQueuedTasks,
+                "TasksScheduled": self.StatTasksScheduled,
+                "SaturatedSchedules": self.StatSaturatedSchedules,
+                "WorkerThreadsCreated": self.StatWorkerThreadsCreated,
+                "OverflowWorkerThreadsCreated": self.StatOverflowWorkerThreadsCreated,
+                "AvgQueueWaitMs": round(avgQueueWaitMs, 2),
+                "QueueWaitHighWaterMarkMs": round(self.StatQueueWaitTimeHighWaterMarkSec * 1000.0, 2),
+            }
+
+
+    # Must be called under lock!
+    def _StartWorker_UnderLock(self, isOverflow:bool):
+        self.WorkerThreadCount += 1
+        self.StatWorkerThreadsCreated += 1
+        if isOverflow:
+            self.StatOverflowWorkerThreadsCreated += 1
+        t = threading.Thread(target=self._WorkerThread, args=(isOverflow,), name="WebStreamWorker")
+        t.daemon = True
+        t.start()
+
+
+    def _WorkerThread(self, isOverflow:bool):
+        try:
+            while True:
+                callback = None
+                with self.Lock:
+                    # Wait for work, or exit if we have been idle for too long.
+                    # Overflow workers exit as soon as there's no more work.
+                    self.IdleWorkerThreadCount += 1
+                    idleStartSec = time.time()
+                    while len(self.TaskQueue) == 0:
+                        remainingSec = OctoWebStreamWorkerPool.c_WorkerIdleTimeoutSec - (time.time() - idleStartSec)
+                        if isOverflow or remainingSec <= 0:
+                            self.IdleWorkerThreadCount -= 1
+                            self.WorkerThreadCount -= 1
+                            return
+                        self.WorkAvailable.wait(remainingSec)
+                    self.IdleWorkerThreadCount -= 1
+
+                    # Take the task and update the stats.
+                    callback, queuedTimeSec = self.TaskQueue.popleft()
+                    queueWaitSec = time.time() - queuedTimeSec
+                    self.StatQueueWaitTimeTotalSec += queueWaitSec
+                    self.StatQueueWaitTimeHighWaterMarkSec = max(self.StatQueueWaitTimeHighWaterMarkSec, queueWaitSec)
+                    self.BusyWorkerThreadCount += 1
+                    self.StatPeakBusyWorkerThreads = max(self.StatPeakBusyWorkerThreads, self.BusyWorkerThreadCount)
+
+                # Run the task outside of the lock.
+                try:
+                    callback()
+                except Exception as e:
+                    Sentry.Exception("Web stream worker pool task threw an exception.", e)
+                finally:
+                    with self.Lock:
+                        self.BusyWorkerThreadCount -= 1
+        except Exception as e:
+            Sentry.Exception("Web stream worker pool thread exception.", e)
+            with self.Lock:
+                self.WorkerThreadCount -= 1
+
+
+    # Called on a timer to make sure queued tasks aren't stuck behind long running web streams.
+    def _OverflowCheck(self):
+        with self.Lock:
+            queuedTasks = len(self.TaskQueue)
+            if queuedTasks == 0 or self.IdleWorkerThreadCount >= queuedTasks:
+                return
+            oldestWaitSec = time.time() - self.TaskQueue[0][1]
+            if oldestWaitSec < OctoWebStreamWorkerPool.c_OverflowAfterQueueWaitSec:
+                return
+            self._StartWorker_UnderLock(True)
+        self.Logger.warning(f"Web stream worker pool started an overflow worker, a task waited {round(oldestWaitSec, 2)}s and {queuedTasks} tasks are queued.")
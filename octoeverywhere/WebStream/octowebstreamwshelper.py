@@ -1,6 +1,7 @@
 # namespace: WebStream
 
 import time
+import asyncio
 import threading
 
 import octowebsocket
@@ -9,6 +10,8 @@ from ..mdns import MDns
 from ..sentry import Sentry
 from ..compat import Compat
 from ..websocketimpl import Client
+from ..asyncwebsocketimpl import AsyncClient
+from ..asyncrelayengine import AsyncRelayEngine
 from ..localip import LocalIpHelper
 from ..compression import Compression, CompressionContext
 from .octoheaderimpl import HeaderHelper
@@ -193,7 +196,12 @@ class OctoWebStreamWsHelper:
 
         # Make the websocket object and start it running.
         self.Logger.debug(self.getLogMsgPrefix()+"opening websocket to "+str(uri) + " attempt "+ str(self.ConnectionAttempt))
-        ws = Client(uri, self.onWsOpened, None, self.onWsData, self.onWsClosed, self.onWsError, subProtocolList=self.SubProtocolList)
+        # If the asyncio relay engine is enabled, the websocket runs on the engine's loop instead of it's own threads.
+        if AsyncRelayEngine.Get() is not None:
+            # onWsData runs on the loop and can't block for the uplink budget, so the local websocket isn't read until there's budget.
+            ws = AsyncClient(uri, self.onWsOpened, None, self.onWsData, self.onWsClosed, self.onWsError, subProtocolList=self.SubProtocolList, receiveGate=self.waitForUplinkBudgetAsync)
+        else:
+            ws = Client(uri, self.onWsOpened, None, self.onWsData, self.onWsClosed, self.onWsError, subProtocolList=self.SubProtocolList)
 
         # To ensure we never leak a websocket, we need to use this lock.
         # We need to check the is closed flag and then only set the ws if it's not closed.
@@ -268,6 +276,22 @@ class OctoWebStreamWsHelper:
             # Sleep for 5ms.
             time.sleep(0.005)
 
+        return self.sendMessageToLocalWs(webStreamMsg)
+
+
+    # Used by the asyncio relay engine, this is the same as IncomingServerMessage but runs on the loop.
+    async def IncomingServerMessageAsync(self, webStreamMsg:WebStreamMsg.WebStreamMsg):
+        # Wait for the socket to open, without blocking the loop.
+        while self.IsWsObjOpened is False:
+            if self.IsWsObjClosed is True or self.IsClosed:
+                return True
+            await asyncio.sleep(0.005)
+        return self.sendMessageToLocalWs(webStreamMsg)
+
+
+    # Sends the message from the server to the local websocket, the websocket must be opened.
+    # Returns true if the web stream should close.
+    def sendMessageToLocalWs(self, webStreamMsg:WebStreamMsg.WebStreamMsg):
         # Note it's ok for this to be empty. Since DataAsByteArray returns 0 if it doesn't
         # exist, we need to check for it.
         buffer = webStreamMsg.DataAsByteArray()
@@ -311,12 +335,27 @@ class OctoWebStreamWsHelper:
         return False
 
 
+    # Awaited by the AsyncClient before it reads each frame from the local websocket.
+    # Not reading pushes back on the local server, and if the uplink is too slow for too long, the stream sheds load by closing.
+    async def waitForUplinkBudgetAsync(self) -> bool:
+        if await self.WebStream.WaitForUplinkBudgetAsync() is False:
+            self.WebStream.Close()
+            return False
+        return True
+
+
     def onWsData(self, ws, buffer:bytes, msgType):
         # Only handle callbacks for the current websocket.
         if self.Ws is not None and self.Ws != ws:
             return
 
         try:
+            # Before we send more data, make sure the uplink isn't backed up. This holds the local websocket receive,
+            # which pushes back on the local server. If it's too slow for too long, shed load by closing the stream.
+            if self.WebStream.WaitForUplinkBudget() is False:
+                self.WebStream.Close()
+                return
+
             # Figure out the data type
             # TODO - we should support the OPCODE_CONT type at some point. But it's not needed right now.
             sendType = WebSocketDataTypes.WebSocketDataTypes.None_
@@ -0,0 +1,162 @@
+import logging
+
+
+# Splits a stream of back to back jpegs, like the ffmpeg image2pipe output, into frames.
+#
+# The stream is read into one preallocated buffer with readinto, so there are no per read allocations or concatenations.
+# The search for the end of the frame resumes where the last search stopped, so each byte is only scanned once.
+# Frames are handed out as memoryviews into the buffer, so there's no copy until the caller decides to keep the frame.
+#
+# The buffer works like a ring, but instead of wrapping, the remaining partial frame is moved to the front of the buffer when the end is reached.
+# That keeps every frame contiguous, so it can be handed out as a single memoryview. Since the frames are much smaller than the buffer, the moves are rare and small.
+#
+# Frames larger than the max frame size are treated as a corrupt stream, and are dropped until the next jpeg start.
+class JpegFrameSplitter:
+
+    # The default max frame size. A 4K frame from ffmpeg is well under this.
+    c_DefaultMaxFrameSizeBytes = 8 * 1024 * 1024
+
+    # The initial buffer size, which will grow as needed, up to the max frame size.
+    c_InitialBufferSizeBytes = 512 * 1024
+
+    # The min amount of free space we want for each read. The linux pipe buffer is 64k, so this allows us to read all of it at once.
+    c_MinReadSizeBytes = 64 * 1024
+
+    c_JpegStart = b"\xff\xd8"
+    c_JpegEnd = b"\xff\xd9"
+
+
+    def __init__(self, logger:logging.Logger, maxFrameSizeBytes:int = c_DefaultMaxFrameSizeBytes):
+        self.Logger = logger
+        self.MaxFrameSizeBytes = maxFrameSizeBytes
+        self.Buffer = bytearray(min(JpegFrameSplitter.c_InitialBufferSizeBytes, maxFrameSizeBytes + JpegFrameSplitter.c_MinReadSizeBytes))
+        self.BufferView = memoryview(self.Buffer)
+        # The unconsumed data is from the start to the end offset.
+        self.Start = 0
+        self.End = 0
+        # Where the search for the end of the current frame will resume.
+        self.ScanIndex = 0
+        # Stats
+        self.FramesDropped = 0
+        self.CorruptResyncs = 0
+
+
+    # Reads the available data from the file object into the buffer.
+    # The file object must support readinto, and can be non blocking.
+    # Any memoryviews returned by GetFrame before this call are no longer valid after it.
+    # Returns the number of bytes read, 0 if there was no data, or None if the stream has ended.
+    def ReadFrom(self, fileObj) -> int:
+        self._EnsureReadSpace()
+        read = fileObj.readinto(self.BufferView[self.End:])
+        # For non blocking streams, None means there's no data right now.
+        if read is None:
+            return 0
+        if read == 0:
+            return None
+        self.End += read
+        return read
+
+
+    # Returns the next complete frame as a memoryview into the buffer, or None if there isn't a complete frame yet.
+    # The memoryview is only valid until the next ReadFrom call, so the caller must copy it if it's going to keep it.
+    def GetFrame(self) -> memoryview:
+        while self.End - self.Start >= 2:
+            # The data must always start with a jpeg start, if it doesn't, the stream is corrupt or we lost our place.
+            if self.Buffer[self.Start] != 0xFF or self.Buffer[self.Start + 1] != 0xD8:
+                self._Resync(self.Start + 1)
+                continue
+
+            # Look for the end of this frame, from where we last stopped looking.
+            endIndex = self.Buffer.find(JpegFrameSplitter.c_JpegEnd, max(self.ScanIndex, self.Start + 2), self.End)
+            if endIndex != -1:
+                frameEnd = endIndex + 2
+                if frameEnd - self.Start > self.MaxFrameSizeBytes:
+                    # We can't hand out a frame this large, skip it.
+                    self.Logger.warn(f"JpegFrameSplitter dropped a frame larger than the max frame size. {frameEnd - self.Start} bytes")
+                    self.FramesDropped += 1
+                    self.Start = frameEnd
+                    self.ScanIndex = self.Start
+                    continue
+                frame = self.BufferView[self.Start:frameEnd]
+                self.Start = frameEnd
+                self.ScanIndex = self.Start
+                return frame
+
+            # No end yet. The last byte might be the first half of the end marker, so the next search starts on it.
+            self.ScanIndex = max(self.Start + 2, self.End - 1)
+            if self.End - self.Start > self.MaxFrameSizeBytes:
+                # The frame never ended, so the stream is corrupt. Drop it and look for the next jpeg start.
+                self.Logger.warn(f"JpegFrameSplitter didn't find the end of a frame within the max frame size, the stream is corrupt. {self.End - self.Start} bytes")
+                self._Resync(self.Start + 2)
+                continue
+            return None
+        return None
+
+
+    # Returns the newest complete frame, dropping any older complete frames, or None if there isn't a complete frame.
+    # This is used when the reader is behind, so it always shows the newest frame rather than falling further behind.
+    def GetLatestFrame(self) -> memoryview:
+        latest = None
+        while True:
+            frame = self.GetFrame()
+            if frame is None:
+                return latest
+            if latest is not None:
+                self.FramesDropped += 1
+            latest = frame
+
+
+    # Drops data until the next jpeg start, searching from the given offset.
+    def _Resync(self, fromIndex:int):
+        self.CorruptResyncs += 1
+        startIndex = self.Buffer.find(JpegFrameSplitter.c_JpegStart, fromIndex, self.End)
+        if startIndex == -1:
+            # Keep the last byte, since it might be the first half of the start marker.
+            startIndex = max(self.Start, self.End - 1)
+        self.Start = startIndex
+        self.ScanIndex = self.Start
+
+
+    # Makes sure there's room for a read at the end of the buffer, by moving the remaining data to the front or growing the buffer.
+    def _EnsureReadSpace(self):
+        # If everything has been consumed, start at the front again, which is the common case.
+        if self.Start == self.End:
+            self.Start = 0
+            self.End = 0
+            self.ScanIndex = 0
+            return
+        if len(self.Buffer) - self.End >= JpegFrameSplitter.c_MinReadSizeBytes:
+            return
+
+        # Move the partial frame to the front. This doesn't change the buffer size, so it's allowed even if there are memoryviews of it.
+        pending = self.End - self.Start
+        if self.Start > 0:
+            # The slice copy doesn't handle overlapping ranges, so if they overlap, copy the pending data out first.
+            if self.Start < pending:
+                self.Buffer[0:pending] = bytes(self.BufferView[self.Start:self.End])
+            else:
+                self.Buffer[0:pending] = self.BufferView[self.Start:self.End]
+            self.ScanIndex -= self.Start
+            self.Start = 0
+            self.End = pending
+        if len(self.Buffer) - self.End >= JpegFrameSplitter.c_MinReadSizeBytes:
+            return
+
+        # If there's still not enough room, grow the buffer, up to the max frame size and one read.
+        # We make a new buffer, since the old one might still have memoryviews.
+        maxBufferSize = self.MaxFrameSizeBytes + JpegFrameSplitter.c_MinReadSizeBytes
+        newSize = min(len(self.Buffer) * 2, maxBufferSize)
+        if newSize <= len(self.Buffer):
+            # This can't happen, since GetFrame drops any partial frame larger than the max frame size, but make sure we don't get stuck.
+            self.Logger.warn("JpegFrameSplitter buffer is full, dropping the buffered data.")
+            self.CorruptResyncs += 1
+            self.Start = 0
+            self.End = 0
+            self.ScanIndex = 0
+            return
+        newBuffer = bytearray(newSize)
+        newBuffer[0:pending] = self.BufferView[0:pending]
+        self.Buffer = newBuffer
+        self.BufferView = memoryview(self.Buffer)
+        if self.Logger.isEnabledFor(logging.DEBUG):
+            self.Logger.debug(f"JpegFrameSplitter buffer grew to {newSize} bytes.")
@@ -0,0 +1,397 @@
+import time
+import logging
+import threading
+
+from ..sentry import Sentry
+from ..relaymetrics import RelayMetrics
+from ..octohttprequest import OctoHttpRequest
+from .mjpegstreamparser import MjpegStreamParser
+from .webcamframeregistry import WebcamFrameRegistry
+
+
+# This is a helper class that manages the active http mjpeg stream fan outs, so all requests for the same stream URL share one upstream connection.
+#
+# Without this, each remote viewer and each snapshot taken from the stream opens its own connection to the webcam server, so N viewers cost
+# N upstream connections, reads, and parses. With the fan out, there's one upstream connection per URL, and each part is given to all of the subscribed streams.
+class MjpegFanOutManager:
+
+    # If the fan out is enabled, which is set by the host.
+    Enabled = False
+
+    _Instance = None
+
+    @staticmethod
+    def Init(logger:logging.Logger):
+        MjpegFanOutManager._Instance = MjpegFanOutManager(logger)
+
+
+    @staticmethod
+    def Get():
+        return MjpegFanOutManager._Instance
+
+
+    @staticmethod
+    def SetEnabled(enabled:bool):
+        MjpegFanOutManager.Enabled = enabled
+
+
+    @staticmethod
+    def IsEnabled() -> bool:
+        return MjpegFanOutManager.Enabled
+
+
+    def __init__(self, logger:logging.Logger) -> None:
+        self.Logger = logger
+        self.FanOutMap = {}
+        self.FanOutMapLock = threading.Lock()
+        # The stats of the fan outs that have been removed, so the totals don't go backwards when a fan out is removed.
+        self.RemovedStats = {
+            "UpstreamConnects": 0,
+            "PartsRead": 0,
+            "DroppedParts": 0,
+        }
+        RelayMetrics.Get().RegisterStatsProvider("MjpegFanOut", self.GetStats)
+
+
+    # Tries to start a web stream that's fed from the shared upstream for this stream URL.
+    # On success, this returns an OctoHttpRequest object with a custom body read stream.
+    # On failure, this returns None, and the caller should connect to the stream directly.
+    def TryGetStream(self, url:str) -> OctoHttpRequest.Result:
+        if url is None or len(url) == 0:
+            return None
+        # We must create a new instance of this class per stream to ensure all of the vars stay in it's context and the streams are cleaned up properly.
+        sm = MjpegFanOutStreamInstance(self.Logger, self._GetOrCreate(url))
+        return sm.StartWebRequest()
+
+
+    # Tries to get a snapshot from the shared upstream for this stream URL.
+    # On success, this returns a complete OctoHttpResult object, otherwise None and the caller should connect to the stream directly.
+    def TryToGetSnapshot(self, url:str) -> OctoHttpRequest.Result:
+        if url is None or len(url) == 0:
+            return None
+        img = self._GetOrCreate(url).GetCurrentImage()
+        if img is None:
+            return None
+        headers = {
+            "content-type": "image/jpeg",
+            # It's very important this size matches the body buffer, or the logic in the http loop will fail because it will keep trying to read more.
+            "content-length": str(len(img))
+        }
+        return OctoHttpRequest.Result(200, headers, url, False, fullBodyBuffer=img)
+
+
+    # Returns the combined stats of all of the fan outs. The urls aren't included, since they can have the webcam credentials in them.
+    def GetStats(self) -> dict:
+        with self.FanOutMapLock:
+            fanOuts = list(self.FanOutMap.values())
+            stats = dict(self.RemovedStats)
+        stats["FanOuts"] = len(fanOuts)
+        stats["Streams"] = 0
+        for fo in fanOuts:
+            for name, value in fo.GetStats().items():
+                stats[name] += value
+        return stats
+
+
+    def _GetOrCreate(self, url:str):
+        with self.FanOutMapLock:
+            fo = self.FanOutMap.get(url, None)
+            if fo is not None:
+                return fo
+            fo = MjpegFanOut(self.Logger, url, self._OnUpstreamExit)
+            self.FanOutMap[url] = fo
+            return fo
+
+
+    # Called by the fan out when its upstream thread exits. If nothing is using it anymore, it's removed, so the map doesn't grow forever.
+    # If it's being used again, it's left, since it has already started a new upstream or has streams attached.
+    def _OnUpstreamExit(self, fo) -> None:
+        with self.FanOutMapLock:
+            if self.FanOutMap.get(fo.Url, None) is fo and fo.IsUnused():
+                del self.FanOutMap[fo.Url]
+                for name, value in fo.GetStats().items():
+                    if name in self.RemovedStats:
+                        self.RemovedStats[name] += value
+
+
+# Reads one http mjpeg stream and gives each part to all of the attached stream callbacks.
+#
+# The parts are passed on exactly as the webcam server sent them, including the boundary and part headers, so the shared streams
+# are the same as a direct connection to the webcam server would be.
+# The attached callbacks are the reference count. The upstream is closed once there are no streams attached and no snapshots have been taken for the idle timeout.
+class MjpegFanOut:
+
+    # How long the upstream stays connected after the last stream is detached or the last snapshot was taken.
+    # This is short, since unlike the QuickCam sources, keeping a http stream open costs the webcam server a client.
+    c_IdleTimeoutSec = 20
+
+    # How long we wait for the first part when the upstream isn't connected.
+    c_FirstPartTimeoutSec = 5
+
+    # If the stream URL isn't a multipart stream we can parse, how long we wait before trying it again.
+    c_NotSupportedRetrySec = 60
+
+
+    # The upstream exit callback is called with this fan out each time the upstream thread exits.
+    def __init__(self, logger:logging.Logger, url:str, onUpstreamExit) -> None:
+        self.Logger = logger
+        self.Url = url
+        self.OnUpstreamExit = onUpstreamExit
+        self.LogPrefix = "MjpegFanOut "
+        self.Lock = threading.Lock()
+        self.PartCondition = threading.Condition(self.Lock)
+        self.IsUpstreamRunning = False
+        self.ContentType:str = None
+        self.CurrentPart:bytes = None
+        self.LastRequestTimeSec:float = 0.0
+        self.NotSupportedUntilSec:float = 0.0
+        self.PartStreamCallbacks = []
+
+        # Stats
+        self.UpstreamConnects = 0
+        self.PartsRead = 0
+        # The parts dropped by the attached streams, since they were held back by a slow uplink.
+        self.DroppedParts = 0
+
+
+    # Returns the newest part and the upstream content type, starting the upstream if needed.
+    # This will return (None, None) if it fails.
+    def GetCurrentPart(self):
+        with self.Lock:
+            self.LastRequestTimeSec = time.time()
+            if self.CurrentPart is None:
+                if time.time() < self.NotSupportedUntilSec:
+                    return (None, None)
+                self._EnsureUpstreamRunning()
+                # Wait for the first part, or for the upstream to fail.
+                self.PartCondition.wait_for(lambda: self.CurrentPart is not None or self.IsUpstreamRunning is False, MjpegFanOut.c_FirstPartTimeoutSec)
+                if self.CurrentPart is None:
+                    return (None, None)
+            return (self.CurrentPart, self.ContentType)
+
+
+    # Returns the newest frame as a raw jpeg, starting the upstream if needed.
+    # This will return None if it fails.
+    def GetCurrentImage(self) -> bytes:
+        part, _ = self.GetCurrentPart()
+        if part is None:
+            return None
+        img = bytes(MjpegStreamParser.GetPartBody(memoryview(part)))
+        if len(img) == 0:
+            return None
+        return img
+
+
+    # Used to attach a new stream handler to receive callbacks when a part is ready.
+    # The callback is called with None if the upstream ends.
+    # Note a call to detach must be called as well!
+    def AttachPartStreamCallback(self, callback):
+        with self.Lock:
+            self.PartStreamCallbacks.append(callback)
+            if self.IsUpstreamRunning:
+                RelayMetrics.Get().IncrementCounter("Webcam.FanOut.SharedAttaches")
+            self._EnsureUpstreamRunning()
+
+
+    # Used to detach a stream handler. The upstream will close once there are no streams attached and the idle timeout has passed.
+    def DetachPartStreamCallback(self, callback):
+        with self.Lock:
+            self.PartStreamCallbacks.remove(callback)
+            # Start the idle timeout from the time the last stream left.
+            self.LastRequestTimeSec = time.time()
+
+
+    def GetStats(self) -> dict:
+        with self.Lock:
+            return {
+                "Streams": len(self.PartStreamCallbacks),
+                "UpstreamConnects": self.UpstreamConnects,
+                "PartsRead": self.PartsRead,
+                "DroppedParts": self.DroppedParts,
+            }
+
+
+    # Returns true if the upstream isn't running and nothing is using the fan out.
+    # If the stream url isn't supported, it's still in use, since it remembers not to try the url again until the retry time.
+    def IsUnused(self) -> bool:
+        with self.Lock:
+            return self.IsUpstreamRunning is False and len(self.PartStreamCallbacks) == 0 and time.time() >= self.NotSupportedUntilSec
+
+
+    # Must be called under the lock.
+    def _EnsureUpstreamRunning(self) -> None:
+        if self.IsUpstreamRunning:
+            return
+        self.IsUpstreamRunning = True
+        self.UpstreamConnects += 1
+        RelayMetrics.Get().IncrementCounter("Webcam.FanOut.UpstreamConnects")
+        t = threading.Thread(target=self._UpstreamThread, name="MjpegFanOut")
+        t.daemon = True
+        t.start()
+
+
+    # Returns true if the upstream should close, and if so, clears the upstream state.
+    # This is done under the lock, so a stream can't attach between the check and the upstream closing.
+    def _ShouldStopUpstream(self) -> bool:
+        with self.Lock:
+            if len(self.PartStreamCallbacks) > 0 or time.time() - self.LastRequestTimeSec < MjpegFanOut.c_IdleTimeoutSec:
+                return False
+            self.IsUpstreamRunning = False
+            self.CurrentPart = None
+            return True
+
+
+    # Called when there's a new part from the upstream.
+    def _SetNewPart(self, part:bytes) -> None:
+        with self.Lock:
+            self.CurrentPart = part
+            self.PartsRead += 1
+            self.PartCondition.notify_all()
+            for callback in self.PartStreamCallbacks:
+                callback(part)
+        # Publish the frame, so snapshots of any webcam using this url can use it.
+        WebcamFrameRegistry.Get().PublishFrame(self.Url, lambda: bytes(MjpegStreamParser.GetPartBody(memoryview(part))))
+
+
+    def _UpstreamThread(self):
+        isIdleStop = False
+        try:
+            self.Logger.debug(f"{self.LogPrefix}upstream starting for {self.Url}")
+            octoHttpResult = OctoHttpRequest.MakeHttpCall(self.Logger, self.Url, OctoHttpRequest.GetPathType(self.Url), "GET", {}, allowRedirects=True)
+            if octoHttpResult is None:
+                self.Logger.info(f"{self.LogPrefix}failed to make the upstream web request.")
+                return
+            if octoHttpResult.StatusCode != 200:
+                self.Logger.info(f"{self.LogPrefix}upstream failed due to the http call having a bad status: {octoHttpResult.StatusCode}")
+                return
+
+            # Hold the entire response in a with block, so it's cleaned up when we leave.
+            with octoHttpResult:
+                contentType, boundaryStr = MjpegFanOut._GetContentTypeAndBoundaryStr(octoHttpResult.Headers)
+                responseForBodyRead = octoHttpResult.ResponseForBodyRead
+                if boundaryStr is None or responseForBodyRead is None:
+                    self.Logger.info(f"{self.LogPrefix}the stream url isn't a multipart stream, so it can't be shared. {self.Url}")
+                    self._SetNotSupported()
+                    return
+                with self.Lock:
+                    self.ContentType = contentType
+
+                parser = MjpegStreamParser(self.Logger, boundaryStr, responseForBodyRead.raw.read, self.LogPrefix)
+                while True:
+                    if self._ShouldStopUpstream():
+                        isIdleStop = True
+                        return
+                    part = parser.ReadPart()
+                    if part is None:
+                        self.Logger.debug(f"{self.LogPrefix}upstream body ended.")
+                        return
+                    if parser.HasFailed:
+                        self.Logger.info(f"{self.LogPrefix}the stream couldn't be parsed, so it can't be shared. {self.Url}")
+                        self._SetNotSupported()
+                        return
+                    # The part is a view into the parser's buffer, which is reused on the next read, so it must be copied.
+                    partBytes = bytes(part)
+                    part.release()
+                    self._SetNewPart(partBytes)
+        except Exception as e:
+            Sentry.Exception(self.LogPrefix+"exception in the upstream thread.", e)
+        finally:
+            # If we stopped because we were idle, the state was already cleared, and a new upstream might already be running.
+            # Otherwise, the current part is cleared so clients don't get a stale frame, and any attached streams are told the upstream ended, so they close like a direct stream would.
+            if isIdleStop is False:
+                with self.Lock:
+                    self.IsUpstreamRunning = False
+                    self.CurrentPart = None
+                    self.PartCondition.notify_all()
+                    for callback in self.PartStreamCallbacks:
+                        callback(None)
+            self.Logger.debug(f"{self.LogPrefix}upstream exit. {self.Url}")
+            self.OnUpstreamExit(self)
+
+
+    def _SetNotSupported(self) -> None:
+        with self.Lock:
+            self.NotSupportedUntilSec = time.time() + MjpegFanOut.c_NotSupportedRetrySec
+
+
+    # Returns the content type and the boundary string from the headers, or (None, None) if this isn't a multipart stream.
+    @staticmethod
+    def _GetContentTypeAndBoundaryStr(headers:dict):
+        for name in headers:
+            if name.lower() == "content-type":
+                value = headers[name]
+                valueLower = value.lower()
+                if valueLower.startswith("multipart/") is False:
+                    return (None, None)
+                i = valueLower.find("boundary=")
+                if i == -1:
+                    return (None, None)
+                boundaryStr = value[i + len("boundary="):].strip()
+                if len(boundaryStr) == 0:
+                    return (None, None)
+                return (value, boundaryStr)
+        return (None, None)
+
+
+# Created per web stream to stream the parts from a shared MjpegFanOut into the http stream.
+# Like the QuickCam stream instance, only the newest part is kept, so if this stream is held back by a slow uplink, the older parts are dropped.
+class MjpegFanOutStreamInstance:
+
+    def __init__(self, logger:logging.Logger, fanOut:MjpegFanOut) -> None:
+        self.Logger = logger
+        self.FanOut = fanOut
+        self.PartReadyEvent = threading.Event()
+        self.AwaitingPart:bytes = None
+        self.IsUpstreamDone = False
+        self.DroppedParts = 0
+
+
+    # This will attempt to start a stream from the shared upstream.
+    # On success, it will return an OctoHttpRequest.Result object with a data callback setup.
+    # On failure, it will return None.
+    def StartWebRequest(self) -> OctoHttpRequest.Result:
+        # First, get the current part. This will determine if we are able to get a stream or not, and it starts the stream right away.
+        self.AwaitingPart, contentType = self.FanOut.GetCurrentPart()
+        if self.AwaitingPart is None:
+            return None
+
+        # Note! We must be sure to call DetachPartStreamCallback to remove this stream callback!
+        self.FanOut.AttachPartStreamCallback(self._NewPartCallback)
+
+        # Use the upstream content type, since the parts use the upstream boundary.
+        headers = {
+            "content-type": contentType,
+        }
+        return OctoHttpRequest.Result(200, headers, self.FanOut.Url, False, customBodyStreamCallback=self._CustomBodyStreamRead, customBodyStreamClosedCallback=self._CustomBodyStreamClosed)
+
+
+    def _NewPartCallback(self, part:bytes):
+        if part is None:
+            self.IsUpstreamDone = True
+            self.PartReadyEvent.set()
+            return
+        if self.AwaitingPart is not None:
+            self.DroppedParts += 1
+            # This is called under the fan out's lock, so it's safe to update its stats.
+            self.FanOut.DroppedParts += 1
+            RelayMetrics.Get().IncrementCounter("Webcam.LatestFrame.Dropped")
+        self.AwaitingPart = part
+        self.PartReadyEvent.set()
+
+
+    # Called by the http body reading system when it needs data. Returning None ends the stream.
+    def _CustomBodyStreamRead(self) -> bytes:
+        while True:
+            capturedPart = self.AwaitingPart
+            if capturedPart is not None:
+                self.AwaitingPart = None
+                self.PartReadyEvent.clear()
+                return capturedPart
+            if self.IsUpstreamDone:
+                return None
+            self.PartReadyEvent.wait()
+
+
+    def _CustomBodyStreamClosed(self) -> None:
+        # It's important this is called so the stream will be detached!
+        self.FanOut.DetachPartStreamCallback(self._NewPartCallback)
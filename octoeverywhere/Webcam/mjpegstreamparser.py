@@ -0,0 +1,272 @@
+import logging
+
+#
+# A buffered parser that splits a multipart (mjpeg) http body into its parts.
+#
+# The parts are returned exactly as they were read, including the boundary and part headers, so the stream can be relayed as is.
+# Data is read in as few reads as possible into one reusable buffer, and the boundaries and content-length headers are found with byte searches
+# on the buffer, so there's no string decoding or splitting per frame. Any data read past the end of a part is kept for the next part,
+# so a single read can contain any number of full or partial parts.
+#
+# Note the body read function blocks until it has read the full size requested, so the read sizes are picked to never read much further
+# than the current part. If we did, we would block waiting on the next frame from the camera, which would add a frame of latency.
+#
+class MjpegStreamParser:
+
+    # The initial size of the read buffer. It will grow if a part is larger.
+    c_InitialBufferSizeBytes = 64 * 1024
+
+    # The first header read size. Webcam frames are always much larger than this, so it's safe to read this much before we know the frame size.
+    # After the first part, we use the size of the last part's headers, since the servers send the same headers for every frame.
+    c_InitialHeaderReadSizeBytes = 512
+    c_MinHeaderReadSizeBytes = 120
+    c_MaxHeaderReadSizeBytes = 4 * 1024
+    # This is added to the last header size, since some header values change length, like the content-length and timestamps.
+    c_HeaderReadSlackBytes = 32
+
+    # If we can't find the end of the headers in this much data, we assume the stream isn't the format we expect.
+    c_MaxHeaderSearchSizeBytes = 5 * 1024
+
+    # When a part has no content-length header, we read this much at a time while looking for the next boundary.
+    c_NoContentLengthReadSizeBytes = 16 * 1024
+
+    # If a part without a content-length header is larger than this, we stop looking for the boundary.
+    c_MaxNoContentLengthPartSizeBytes = 10 * 1024 * 1024
+
+    c_EndOfHeaders = b"\r\n\r\n"
+    c_EndOfHeadersLen = len(c_EndOfHeaders)
+    c_Crlf = b"\r\n"
+    c_CrlfLen = len(c_Crlf)
+
+
+    # The read function must take a size and return up to that many bytes, or None when the body is done.
+    def __init__(self, logger:logging.Logger, boundaryStr:str, readFunc, logPrefix:str = ""):
+        self.Logger = logger
+        self.ReadFunc = readFunc
+        self.LogPrefix = logPrefix
+        boundary = boundaryStr.encode("utf-8")
+        # According the the RFC, the boundary should start with '--' + boundary string, but we have also seen \r\n--<str> and just the boundary string.
+        # These are in order of how common they are, for perf.
+        self.BoundaryPrefixes = [b"--" + boundary, boundary, b"\r\n--" + boundary]
+        self.Delimiter = b"\r\n--" + boundary
+
+        # The buffer and the range of unparsed data in it.
+        self.Buffer = bytearray(MjpegStreamParser.c_InitialBufferSizeBytes)
+        self.DataStart = 0
+        self.DataEnd = 0
+        # The last part we returned, which is a view into the buffer.
+        self.LastPart:memoryview = None
+
+        self.HeaderReadSizeBytes = MjpegStreamParser.c_InitialHeaderReadSizeBytes
+        self.IsBodyDone = False
+        # Set when the stream isn't a format we can parse, after which all of the buffered data has been returned and the caller should read the body directly.
+        self.HasFailed = False
+        self.MissingBoundaryWarningCounter = 0
+
+        # Stats
+        self.Parts = 0
+        self.Reads = 0
+        self.ReadBytes = 0
+
+
+    # Returns the next full part, as a memoryview into the parser's buffer, or None if the body is done.
+    # The view is only valid until the next call, the caller can release it when it's done, but doesn't need to.
+    #
+    # If the body ends in the middle of a part, or the stream can't be parsed, whatever was buffered is returned as the last part.
+    # In the can't be parsed case, HasFailed is set and no more data will be returned.
+    def ReadPart(self) -> memoryview:
+        self._ReleaseLastPart()
+        if self.HasFailed:
+            return None
+
+        # Find the end of the part headers.
+        # Note that all offsets are kept relative to DataStart, since a fill can move the data in the buffer.
+        headersEnd = self._Find(MjpegStreamParser.c_EndOfHeaders, 0)
+        while headersEnd == -1:
+            if self.DataEnd - self.DataStart >= MjpegStreamParser.c_MaxHeaderSearchSizeBytes:
+                return self._Fail()
+            # Only search the new data, but back up a few bytes in case the sequence was split between reads.
+            searchStart = max(0, self.DataEnd - self.DataStart - MjpegStreamParser.c_EndOfHeadersLen + 1)
+            if self._Fill(self.HeaderReadSizeBytes) is False:
+                return self._TakeRemaining()
+            headersEnd = self._Find(MjpegStreamParser.c_EndOfHeaders, searchStart)
+        headersEnd += MjpegStreamParser.c_EndOfHeadersLen
+
+        self._CheckBoundary()
+
+        # Use the size of these headers for the next header read.
+        self.HeaderReadSizeBytes = min(MjpegStreamParser.c_MaxHeaderReadSizeBytes, max(MjpegStreamParser.c_MinHeaderReadSizeBytes, headersEnd + MjpegStreamParser.c_HeaderReadSlackBytes))
+
+        contentLength = self._FindContentLength(self.DataStart, self.DataStart + headersEnd)
+        if contentLength is not None:
+            # The part is the headers, the frame, and then a \r\n.
+            partEnd = headersEnd + contentLength + MjpegStreamParser.c_CrlfLen
+            while self.DataEnd - self.DataStart < partEnd:
+                if self._Fill(partEnd - (self.DataEnd - self.DataStart)) is False:
+                    return self._TakeRemaining()
+            # If the \r\n is missing, then the stream puts the \r\n before the next boundary rather than after the frame, so leave the bytes for the next part.
+            if self.Buffer.startswith(MjpegStreamParser.c_Crlf, self.DataStart + partEnd - MjpegStreamParser.c_CrlfLen) is False:
+                partEnd -= MjpegStreamParser.c_CrlfLen
+        else:
+            # Without a content-length, the part ends at the next boundary.
+            partEnd = self._FindNextDelimiter(headersEnd)
+            if partEnd is None:
+                if self.IsBodyDone:
+                    return self._TakeRemaining()
+                return self._Fail()
+
+        return self._TakePart(partEnd)
+
+
+    # Given a part returned by ReadPart, returns the frame in it, without the boundary, the part headers, or the trailing \r\n.
+    @staticmethod
+    def GetPartBody(part:memoryview) -> memoryview:
+        headersEnd = bytes(part[:MjpegStreamParser.c_MaxHeaderSearchSizeBytes]).find(MjpegStreamParser.c_EndOfHeaders)
+        if headersEnd == -1:
+            return part[0:0]
+        body = part[headersEnd + MjpegStreamParser.c_EndOfHeadersLen:]
+        if len(body) >= MjpegStreamParser.c_CrlfLen and body[-MjpegStreamParser.c_CrlfLen:] == MjpegStreamParser.c_Crlf:
+            body = body[:-MjpegStreamParser.c_CrlfLen]
+        return body
+
+
+    def GetStats(self) -> dict:
+        return {
+            "Parts": self.Parts,
+            "Reads": self.Reads,
+            "ReadBytes": self.ReadBytes,
+            "BufferSizeBytes": len(self.Buffer),
+        }
+
+
+    # Returns the content-length value in the header range, or None if there isn't one.
+    def _FindContentLength(self, start:int, end:int) -> int:
+        # Most servers use one of these, so search for them directly before doing a case insensitive search on a copy of the headers.
+        for name in (b"Content-Length:", b"content-length:", b"Content-length:"):
+            i = self.Buffer.find(name, start, end)
+            if i != -1:
+                return self._ParseHeaderInt(i + len(name), end)
+        headers = bytes(self.Buffer[start:end]).lower()
+        i = headers.find(b"content-length:")
+        if i == -1:
+            return None
+        return self._ParseHeaderInt(start + i + len(b"content-length:"), end)
+
+
+    def _ParseHeaderInt(self, valueStart:int, headersEnd:int) -> int:
+        valueEnd = self.Buffer.find(MjpegStreamParser.c_Crlf, valueStart, headersEnd)
+        if valueEnd == -1:
+            valueEnd = headersEnd
+        try:
+            value = int(self.Buffer[valueStart:valueEnd])
+            if value < 0:
+                return None
+            return value
+        except ValueError:
+            return None
+
+
+    # Looks for the next boundary after the start offset, reading more as needed.
+    # Returns the end of the current part, which includes the \r\n before the boundary, or None if it wasn't found.
+    def _FindNextDelimiter(self, start:int) -> int:
+        searchStart = start
+        while True:
+            i = self._Find(self.Delimiter, searchStart)
+            if i != -1:
+                return i + MjpegStreamParser.c_CrlfLen
+            if self.DataEnd - self.DataStart >= MjpegStreamParser.c_MaxNoContentLengthPartSizeBytes:
+                return None
+            # Back up in case the delimiter was split between reads.
+            searchStart = max(start, self.DataEnd - self.DataStart - len(self.Delimiter) + 1)
+            if self._Fill(MjpegStreamParser.c_NoContentLengthReadSizeBytes) is False:
+                return None
+
+
+    # Finds the value in the unparsed data, the offsets are relative to DataStart.
+    def _Find(self, value:bytes, start:int) -> int:
+        i = self.Buffer.find(value, self.DataStart + start, self.DataEnd)
+        if i == -1:
+            return -1
+        return i - self.DataStart
+
+
+    # Warns if the part didn't start with the boundary.
+    def _CheckBoundary(self) -> None:
+        for prefix in self.BoundaryPrefixes:
+            if self.Buffer.startswith(prefix, self.DataStart):
+                return
+        # Always report the first time we find this, otherwise, report only occasionally.
+        # This might fire once or twice on the first frame, since some servers don't send a boundary for it, and that's fine.
+        if self.MissingBoundaryWarningCounter % 120 == 0:
+            outputStr = bytes(self.Buffer[self.DataStart:min(self.DataEnd, self.DataStart + 40)]).decode(errors="ignore")
+            self.Logger.warn(f"{self.LogPrefix}We read a web stream body frame, but it didn't start with the expected boundary header. expected:'{self.BoundaryPrefixes[0].decode(errors='ignore')}' got:^^{outputStr}^^")
+        self.MissingBoundaryWarningCounter += 1
+
+
+    # Reads up to the requested size into the end of the buffer. Returns false if the body is done.
+    # Note this can move the unparsed data to the front of the buffer, so any offsets must be re-based on DataStart.
+    def _Fill(self, size:int) -> bool:
+        if self.IsBodyDone:
+            return False
+        data = self.ReadFunc(size)
+        if data is None or len(data) == 0:
+            self.IsBodyDone = True
+            return False
+        self.Reads += 1
+        self.ReadBytes += len(data)
+        self._EnsureSpace(len(data))
+        # This assignment is the same size, so the buffer isn't resized.
+        self.Buffer[self.DataEnd:self.DataEnd+len(data)] = data
+        self.DataEnd += len(data)
+        return True
+
+
+    # Makes sure there's room for the size at the end of the buffer.
+    # The buffer is never resized in place, since a caller might still hold a view of it, which would make the resize throw.
+    def _EnsureSpace(self, size:int) -> None:
+        if self.DataEnd + size <= len(self.Buffer):
+            return
+        unparsed = self.DataEnd - self.DataStart
+        if unparsed + size <= len(self.Buffer):
+            # Move the unparsed data to the front.
+            self.Buffer[0:unparsed] = self.Buffer[self.DataStart:self.DataEnd]
+        else:
+            newBuffer = bytearray(max(len(self.Buffer) * 2, unparsed + size))
+            newBuffer[0:unparsed] = self.Buffer[self.DataStart:self.DataEnd]
+            self.Buffer = newBuffer
+        self.DataStart = 0
+        self.DataEnd = unparsed
+
+
+    # Takes the part, the end is relative to DataStart.
+    def _TakePart(self, partEnd:int) -> memoryview:
+        part = memoryview(self.Buffer)[self.DataStart:self.DataStart + partEnd]
+        self.DataStart += partEnd
+        if self.DataStart == self.DataEnd:
+            # Everything has been parsed, so the next fill can start at the front.
+            self.DataStart = 0
+            self.DataEnd = 0
+        self.LastPart = part
+        self.Parts += 1
+        return part
+
+
+    # Returns whatever is buffered as the last part, or None if nothing is.
+    def _TakeRemaining(self) -> memoryview:
+        if self.DataEnd == self.DataStart:
+            return None
+        return self._TakePart(self.DataEnd - self.DataStart)
+
+
+    # Called when the stream can't be parsed. All of the buffered data is returned, so the caller can read the rest of the body directly.
+    def _Fail(self) -> memoryview:
+        self.HasFailed = True
+        if self.DataEnd == self.DataStart:
+            return None
+        return self._TakePart(self.DataEnd - self.DataStart)
+
+
+    def _ReleaseLastPart(self) -> None:
+        if self.LastPart is not None:
+            self.LastPart.release()
+            self.LastPart = None
@@ -12,8 +12,12 @@ import signal
 from octoeverywhere.sentry import Sentry
 
 from ..octohttprequest import OctoHttpRequest
+from ..relaymetrics import RelayMetrics
 from .webcamsettingitem import WebcamSettingItem
 from .webcamstreaminstance import WebcamStreamInstance
+from .webcamframeregistry import WebcamFrameRegistry
+from .jpegframesplitter import JpegFrameSplitter
+from .quickcamcapturegovernor import QuickCamCaptureGovernor, QuickCamCaptureProfile
 
 
 # Indicates the stream type for the QuickCam class.
@@ -133,6 +137,8 @@ class QuickCam:
         self.LastImageRequestTimeSec:float = 0.0
         self.ImageStreamCallbacks = []
         self.ImageStreamCallbackLock = threading.Lock()
+        # Picks the ffmpeg capture profile for RTSP captures.
+        self.CaptureGovernor = QuickCamCaptureGovernor(logger, url)
 
 
     # Given a URL, this function returns the quick cam type that will be used and if it's supported.
@@ -197,17 +203,26 @@ class QuickCam:
             self.ImageStreamCallbacks.remove(callback)
 
 
+    # Called by the stream handlers when they drop a frame, because the last frame they were given hasn't been sent yet.
+    # This is how we know if the uplink can keep up with the capture.
+    def ReportDroppedStreamFrame(self):
+        self.CaptureGovernor.OnStreamFrameDropped()
+
+
     # Called when there's a new image from the capture thread.
     def _SetNewImage(self, img:bytearray) -> None:
         # Set the new image.
         self.CurrentImage = img
         # Release anyone waiting on it.
         self.ImageReady.set()
+        # Publish it, so snapshots of any webcam using this url can use it.
+        WebcamFrameRegistry.Get().PublishFrame(self.Url, lambda: img)
         # Fire the callbacks, if there are any.
         with self.ImageStreamCallbackLock:
             if len(self.ImageStreamCallbacks) > 0:
                 # Update the last image request time to ensure the stream keeps going.
                 self.LastImageRequestTimeSec = time.time()
+                self.CaptureGovernor.OnStreamFrame(len(self.ImageStreamCallbacks))
                 for callback in self.ImageStreamCallbacks:
                     callback(self.CurrentImage)
 
@@ -234,9 +249,12 @@ class QuickCam:
 
                 # Create the camera implementation we need for this device.
                 camImpl = None
+                captureProfile = None
                 if self.Type == QuickCamStreamTypes.RTSP:
-                    self.Logger.debug(f"QuickCam capture thread started for RTSP. {self.Url}")
-                    camImpl = QuickCam_RTSP(self.Logger)
+                    # For RTSP, the ffmpeg settings depend on who is using the capture.
+                    captureProfile = self.CaptureGovernor.GetProfile(len(self.ImageStreamCallbacks))
+                    self.Logger.debug(f"QuickCam capture thread started for RTSP. Profile: {captureProfile} {self.Url}")
+                    camImpl = QuickCam_RTSP(self.Logger, captureProfile)
                 elif self.Type == QuickCamStreamTypes.WebSocket:
                     self.Logger.debug(f"QuickCam capture thread started for Websocket. {self.Url}")
                     camImpl = QuickCam_WebSocket(self.Logger)
@@ -245,6 +263,7 @@ class QuickCam:
                     return
 
                 # Wrap the usage into a with, so the connection is always cleaned up
+                isProfileChange = False
                 with camImpl:
                     try:
                         # Connect to the server.
@@ -269,11 +288,25 @@ class QuickCam:
                             if img is not None:
                                 self._SetNewImage(img)
 
+                            # If the demand has changed, restart the capture with the new profile.
+                            # We keep the current image, so snapshots and streams still have something while ffmpeg restarts.
+                            if captureProfile is not None:
+                                newProfile = self.CaptureGovernor.GetProfile(len(self.ImageStreamCallbacks))
+                                if newProfile != captureProfile:
+                                    self.Logger.info(f"QuickCam capture profile changing from {captureProfile} to {newProfile}.")
+                                    RelayMetrics.Get().IncrementCounter(f"QuickCam.Capture.ProfileChange.{newProfile.Name}")
+                                    isProfileChange = True
+                                    break
+
                     except Exception as e:
                         # We have seen times where random errors are returned, like on boot or if the stream is opened too soon after closing.
                         # This exception block is designed to eat any connection or buffer parsing errors, eat them, and try again.
                         self.Logger.warn("Exception in QuickCam capture thread. "+str(e))
                         time.sleep(2)
+
+                # A profile change isn't a failed attempt.
+                if isProfileChange:
+                    attempts -= 1
         except Exception as e:
             Sentry.Exception("Exception in QuickCam capture thread. ", e)
         finally:
@@ -454,16 +487,13 @@ class QuickCam_RTSP:
     c_DebugLogging = False
 
 
-    def __init__(self, logger:logging.Logger):
+    def __init__(self, logger:logging.Logger, captureProfile:QuickCamCaptureProfile):
         self.Logger = logger
+        self.CaptureProfile = captureProfile
         self.Process:subprocess.Popen = None
 
         # Image getting stuff
-        self.Buffer = bytearray()
-        self.SearchedIndex = 0
-        self.JpegStartSequence = bytearray([0xff, 0xd8, 0xff, 0xfe, 0x00, 0x10])
-        self.JpegStartSequenceLen = len(self.JpegStartSequence)
-        self.JpegEndSequence = bytearray([0xff, 0xd9])
+        self.FrameSplitter = JpegFrameSplitter(logger)
         self.PipeSelect = selectors.DefaultSelector()
         self.TimeSinceLastImg = time.time()
 
@@ -483,18 +513,14 @@ class QuickCam_RTSP:
         # we can capture them on timeouts.
         logLevel = "trace" if self.Logger.isEnabledFor(logging.DEBUG) else "warning"
 
-        # For FPS, we have found that we can stream and transcode the X1 rtsp stream at a smooth 15 fps on a Pi 4.
-        # But for other RTSP streams like Wzye bridge cams, it's more intensive and we need to drop to 10 fps.
-        # If we don't drop the FPS, the stream will fall behind.
-        fps = 10
-        if url.find("bblp:") != -1:
-            fps = 15
+        # The FPS and size come from the capture profile, which depends on the camera and who is using the capture.
+        # See QuickCamCaptureGovernor for the details.
 
         # For auth, if there's a username and password it will already be in the URL in the http:// basic auth style,
         # So there's nothing else we need to do.
 
         # Notes
-        #   We use the default jpeg image quality, for the same FPS reasons above.
+        #   We use the default jpeg image quality, for the same FPS reasons as QuickCamCaptureGovernor.GetViewerFps.
         # pylint: disable=consider-using-with # We handle this on our own.
         self.Process = subprocess.Popen(["ffmpeg",
                     "-hide_banner",
@@ -503,7 +529,7 @@ class QuickCam_RTSP:
                     "-rtsp_transport", "0", # Use a value of 0, so both TCP and UDP can be used.
                     "-use_wallclock_as_timestamps", "1",
                     "-i", url,
-                    "-filter:v", f"fps={fps}",
+                    "-filter:v", self.CaptureProfile.GetVideoFilter(),
                     "-movflags", "+faststart",
                     "-f", "image2pipe", "-"
                     ],
@@ -531,99 +557,39 @@ class QuickCam_RTSP:
             # We timeout after 5 seconds, which is plenty of time for the stream to be ready.
             self.PipeSelect.select(QuickCam_RTSP.c_ReadTimeoutSec)
 
-            # Read all of the data we can.
-            buffer = self.Process.stdout.read(100000000)
+            # Read all of the data we can into the frame splitter's buffer.
+            read = self.FrameSplitter.ReadFrom(self.Process.stdout)
 
             # Check for a timeout. This can happen because the select timeout, or it's been too long since we got an image parsed.
             # This usually means that ffmpeg has died or is not running correctly.
-            if self.Process.returncode is not None or (time.time() - self.TimeSinceLastImg) > QuickCam_RTSP.c_ReadTimeoutSec:
+            if read is None or self.Process.returncode is not None or (time.time() - self.TimeSinceLastImg) > QuickCam_RTSP.c_ReadTimeoutSec:
                 if self.StdErrBuffer is None or len(self.StdErrBuffer) == 0:
                     self.StdErrBuffer = "<None>"
+                if read is None:
+                    raise Exception(f"Ffmpeg closed the image pipe. ffmpeg output:\n{self.StdErrBuffer}")
                 raise Exception(f"Ffmpeg read timeout. ffmpeg output:\n{self.StdErrBuffer}")
 
-            # If we get an empty buffer, we just need to wait for more.
-            if buffer is None or len(buffer) == 0:
+            # If we didn't get any data, we just need to wait for more.
+            if read == 0:
                 if QuickCam_RTSP.c_DebugLogging:
                     self.Logger.debug("RTSP read empty buffer from stdin.")
                 continue
 
-            # If there's no pending buffered data do a quick exit if we were able to read the entire buffer in our first read.
-            # If the full buffer is only one jpeg images, we don't need to do any scanning and can just return it.
-            if self.Buffer is None:
-                if self._CheckIfFullJpeg(buffer):
-                    self._ResetLocalBuffer(True)
-                    if QuickCam_RTSP.c_DebugLogging:
-                        self.Logger.debug("RTSP fast path image received.")
-                    return buffer
-
-            # Append this buffer to the current pending buffer.
-            if self.Buffer is None:
-                self.Buffer = buffer
-            else:
-                self.Buffer += buffer
-
-            # Ensure the buffer is long enough to check.
-            buffLen = len(self.Buffer)
-            if buffLen <= self.JpegStartSequenceLen:
-                continue
-
-            # Check if the buffer is a full image now
-            if self._CheckIfFullJpeg(self.Buffer):
-                img = self.Buffer
-                self._ResetLocalBuffer(True)
-                if QuickCam_RTSP.c_DebugLogging:
-                    self.Logger.debug("RTSP second quick path image received.")
-                return img
-
-            # Scan the buffer for the jpeg end sequence.
-            newImageStart = -1
-            while self.SearchedIndex < buffLen - self.JpegStartSequenceLen:
-                if self.Buffer[self.SearchedIndex] == self.JpegEndSequence[0] and self.Buffer[self.SearchedIndex+1] == self.JpegEndSequence[1]:
-                    newImageStart = self.SearchedIndex + 2
-                    break
-                self.SearchedIndex += 1
-
-            # See if we found a complete image.
-            if newImageStart != -1:
-                # Get the image and check it's a full image.
-                imgBuffer = self.Buffer[:newImageStart]
-                if self._CheckIfFullJpeg(imgBuffer) is False:
-                    # If we don't have a correct buffer, we got off in out counting.
-                    # So reset the buffer and continue. Note after we reset the buffer, we might
-                    # hit this, since we could have a partial image in the Buffer
-                    self._ResetLocalBuffer()
-                    if QuickCam_RTSP.c_DebugLogging:
-                        self.Logger.debug("RTSP we found a jpeg end sequence, but the buffer didn't start with a jpeg start sequence.")
-                    continue
-                # Take the image off the buffer.
-                self.Buffer = self.Buffer[newImageStart:]
-                self.SearchedIndex = 0
-                self.TimeSinceLastImg = time.time()
-                # Ensure the buffer isn't too long.
-                self._ResetLocalBufferIfOverLimit()
+            # Get the newest complete frame. If we are running behind, the older frames are skipped, so we don't fall further behind.
+            frame = self.FrameSplitter.GetLatestFrame()
+            if frame is None:
                 if QuickCam_RTSP.c_DebugLogging:
-                    self.Logger.debug("RTSP slow path image received.")
-                return imgBuffer
-
-            # If we didn't find anything, check the limit.
-            if QuickCam_RTSP.c_DebugLogging:
-                self.Logger.debug("We got a new buffer with no image match.")
-            self._ResetLocalBufferIfOverLimit()
-
-
-    def _ResetLocalBufferIfOverLimit(self):
-        # A normal image is around 37,000, so if the buffer is too long, reset it so
-        # we can try to recover the buffer.
-        if self.Buffer is not None and len(self.Buffer) > 50000:
-            self.Logger.info("Quick cam rtsp buffer reset. This means we are running behind.")
-            self._ResetLocalBuffer()
-
+                    self.Logger.debug("We got a new buffer with no image match.")
+                continue
 
-    def _ResetLocalBuffer(self, hasNewImage:bool = False):
-        self.SearchedIndex = 0
-        self.Buffer = None
-        if hasNewImage:
+            # The frame is a view into the splitter's buffer, which is reused by the next read.
+            # The image is held after that, so this is the one copy of it.
+            img = bytes(frame)
+            frame.release()
             self.TimeSinceLastImg = time.time()
+            if QuickCam_RTSP.c_DebugLogging:
+                self.Logger.debug(f"RTSP image received. Size: {len(img)}, Frames dropped: {self.FrameSplitter.FramesDropped}")
+            return img
 
 
     # Reads the error stream from ffmpeg.
@@ -656,17 +622,6 @@ class QuickCam_RTSP:
                 Sentry.Exception("RTSP error reader thread failed.", e)
 
 
-    # Checks if the buffer is only one image, from start to end.
-    def _CheckIfFullJpeg(self, buffer:bytearray) -> bool:
-        if buffer is None or len(buffer) <= self.JpegStartSequenceLen:
-            return False
-        if buffer[:self.JpegStartSequenceLen] != self.JpegStartSequence:
-            return False
-        if buffer[-2:] != self.JpegEndSequence:
-            return False
-        return True
-
-
     # Allows us to using the with: scope.
     def __enter__(self):
         return self
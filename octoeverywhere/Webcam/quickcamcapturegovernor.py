@@ -0,0 +1,202 @@
+import time
+import logging
+import threading
+
+from ..relaymetrics import RelayMetrics
+
+
+# The ffmpeg capture settings used for a QuickCam RTSP capture.
+class QuickCamCaptureProfile:
+
+    # The profile names, which are used for logging and metrics.
+    Snapshot = "Snapshot"
+    Viewer = "Viewer"
+    Congested = "Congested"
+
+
+    def __init__(self, name:str, fps:int, maxHeight:int = 0):
+        self.Name = name
+        self.Fps = fps
+        # If not 0, frames taller than this are scaled down to it, keeping the aspect ratio.
+        self.MaxHeight = maxHeight
+
+
+    # Returns the ffmpeg video filter for this profile.
+    def GetVideoFilter(self) -> str:
+        videoFilter = f"fps={self.Fps}"
+        if self.MaxHeight > 0:
+            # Only scale down, and keep the width even, which the jpeg encoder needs for the yuv420 frames.
+            videoFilter += f",scale=-2:'min({self.MaxHeight},ih)'"
+        return videoFilter
+
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, QuickCamCaptureProfile) is False:
+            return False
+        return self.Name == other.Name and self.Fps == other.Fps and self.MaxHeight == other.MaxHeight
+
+
+    def __str__(self) -> str:
+        return f"{self.Name} {self.Fps}fps" + (f" max height {self.MaxHeight}" if self.MaxHeight > 0 else "")
+
+
+# Picks the ffmpeg capture profile for a QuickCam RTSP capture, based on who is using it.
+#
+# Most of the time a QuickCam capture is only kept running for snapshots, like Gadget and notifications during a print,
+# which only need a fresh frame every so often. Capturing at the full stream frame rate for hours with nobody watching
+# costs a lot of CPU for the jpeg encode and the frame handling. So when adaptive capture is enabled:
+#   - With no stream viewers, the capture runs at a low frame rate.
+#   - When a stream viewer attaches, the capture is switched to the full frame rate right away.
+#   - If the viewers are dropping most of the frames, because the uplink can't keep up, the frames are scaled down.
+#
+# ffmpeg can't change these settings while it's running, so each change restarts ffmpeg, which takes a few seconds.
+# To keep that from happening often, the changes back to a cheaper profile are only made after the demand has been
+# low for a while, and the changes in and out of the congested profile are rate limited.
+class QuickCamCaptureGovernor:
+
+    # The snapshot frame rate limits.
+    c_DefaultSnapshotFps = 2
+    c_MinSnapshotFps = 1
+    c_MaxSnapshotFps = 10
+
+    # How long there must be no stream viewers before the capture drops to the snapshot profile.
+    # This is long enough that a page reload or a quick switch between webcams doesn't restart ffmpeg.
+    c_ViewerHoldSec = 30.0
+
+    # The congested profile scales the frames down to this height.
+    c_CongestedMaxHeight = 720
+
+    # The dropped frames are checked over windows of this length.
+    c_CongestionWindowSec = 10.0
+    # A window needs at least this many frames sent to the viewers to be checked.
+    c_CongestionMinWindowFrames = 20
+    # If at least this much of the frames in a window are dropped, the uplink is congested.
+    c_CongestionEnterDropRatio = 0.5
+    # And the uplink is clear once the dropped frames stay under this ratio for the clear hold time.
+    c_CongestionExitDropRatio = 0.1
+    c_CongestionClearHoldSec = 60.0
+    # If the uplink becomes congested again soon after it was clear, the clear hold time is doubled, up to the max.
+    # This keeps a link that's only fast enough for the scaled down frames from flipping between the profiles.
+    c_CongestionReenterWindowSec = 300.0
+    c_CongestionMaxClearHoldSec = 600.0
+
+    # The options, which are set by the host.
+    Enabled = False
+    SnapshotFps = c_DefaultSnapshotFps
+
+
+    @staticmethod
+    def SetOptions(enabled:bool, snapshotFps:int):
+        QuickCamCaptureGovernor.Enabled = enabled
+        QuickCamCaptureGovernor.SnapshotFps = min(max(snapshotFps, QuickCamCaptureGovernor.c_MinSnapshotFps), QuickCamCaptureGovernor.c_MaxSnapshotFps)
+
+
+    # Returns the full frame rate for the url.
+    @staticmethod
+    def GetViewerFps(url:str) -> int:
+        # For FPS, we have found that we can stream and transcode the X1 rtsp stream at a smooth 15 fps on a Pi 4.
+        # But for other RTSP streams like Wzye bridge cams, it's more intensive and we need to drop to 10 fps.
+        # If we don't drop the FPS, the stream will fall behind.
+        if url.find("bblp:") != -1:
+            return 15
+        return 10
+
+
+    def __init__(self, logger:logging.Logger, url:str):
+        self.Logger = logger
+        self.Lock = threading.Lock()
+        viewerFps = QuickCamCaptureGovernor.GetViewerFps(url)
+        self.ViewerProfile = QuickCamCaptureProfile(QuickCamCaptureProfile.Viewer, viewerFps)
+        self.SnapshotProfile = QuickCamCaptureProfile(QuickCamCaptureProfile.Snapshot, min(QuickCamCaptureGovernor.SnapshotFps, viewerFps))
+        self.CongestedProfile = QuickCamCaptureProfile(QuickCamCaptureProfile.Congested, viewerFps, QuickCamCaptureGovernor.c_CongestedMaxHeight)
+        # The last time there was a stream viewer.
+        self.LastViewerSec = 0.0
+        # The congestion state.
+        self.IsCongested = False
+        self.CongestionClearSinceSec = None
+        self.CongestionClearHoldSec = QuickCamCaptureGovernor.c_CongestionClearHoldSec
+        self.LastCongestionExitSec = 0.0
+        # The current window of frames sent to the viewers.
+        self.WindowStartSec = time.time()
+        self.WindowFrames = 0
+        self.WindowDroppedFrames = 0
+
+
+    # Called for each frame given to a stream viewer.
+    def OnStreamFrame(self, viewerCount:int):
+        with self.Lock:
+            self.WindowFrames += viewerCount
+
+
+    # Called by the stream viewers when they drop a frame, because the last one hasn't been sent yet.
+    def OnStreamFrameDropped(self):
+        with self.Lock:
+            self.WindowDroppedFrames += 1
+
+
+    # Returns the profile the capture should be using now, given the number of stream viewers.
+    def GetProfile(self, viewerCount:int) -> QuickCamCaptureProfile:
+        if QuickCamCaptureGovernor.Enabled is False:
+            return self.ViewerProfile
+        nowSec = time.time()
+        with self.Lock:
+            if viewerCount > 0:
+                self.LastViewerSec = nowSec
+            elif nowSec - self.LastViewerSec > QuickCamCaptureGovernor.c_ViewerHoldSec:
+                # No one has been watching for a while, so the congestion state doesn't matter anymore.
+                self._ResetCongestion(nowSec)
+                return self.SnapshotProfile
+            self._UpdateCongestion(nowSec, viewerCount)
+            return self.CongestedProfile if self.IsCongested else self.ViewerProfile
+
+
+    # Checks the dropped frames when the current window is done. Must be called under the lock.
+    def _UpdateCongestion(self, nowSec:float, viewerCount:int):
+        if nowSec - self.WindowStartSec < QuickCamCaptureGovernor.c_CongestionWindowSec:
+            return
+        frames = self.WindowFrames
+        dropped = self.WindowDroppedFrames
+        self.WindowStartSec = nowSec
+        self.WindowFrames = 0
+        self.WindowDroppedFrames = 0
+        # If there weren't enough frames sent, like when there are no viewers or ffmpeg is restarting, there's nothing to go on.
+        if viewerCount == 0 or frames < QuickCamCaptureGovernor.c_CongestionMinWindowFrames:
+            return
+        dropRatio = min(1.0, dropped / frames)
+        if self.Logger.isEnabledFor(logging.DEBUG):
+            self.Logger.debug(f"QuickCam capture governor window: {frames} frames, {dropped} dropped, congested: {self.IsCongested}")
+
+        if self.IsCongested is False:
+            if dropRatio >= QuickCamCaptureGovernor.c_CongestionEnterDropRatio:
+                # If we just left the congested profile, wait longer before trying to leave it again.
+                if nowSec - self.LastCongestionExitSec < QuickCamCaptureGovernor.c_CongestionReenterWindowSec:
+                    self.CongestionClearHoldSec = min(self.CongestionClearHoldSec * 2, QuickCamCaptureGovernor.c_CongestionMaxClearHoldSec)
+                else:
+                    self.CongestionClearHoldSec = QuickCamCaptureGovernor.c_CongestionClearHoldSec
+                self.IsCongested = True
+                self.CongestionClearSinceSec = None
+                RelayMetrics.Get().IncrementCounter("QuickCam.Capture.Congested")
+                self.Logger.info(f"QuickCam viewers dropped {int(dropRatio * 100)}% of the frames, the capture will be scaled down.")
+            return
+
+        if dropRatio >= QuickCamCaptureGovernor.c_CongestionExitDropRatio:
+            self.CongestionClearSinceSec = None
+            return
+        if self.CongestionClearSinceSec is None:
+            # The clear time starts at the start of this window.
+            self.CongestionClearSinceSec = nowSec - QuickCamCaptureGovernor.c_CongestionWindowSec
+        if nowSec - self.CongestionClearSinceSec >= self.CongestionClearHoldSec:
+            self.IsCongested = False
+            self.CongestionClearSinceSec = None
+            self.LastCongestionExitSec = nowSec
+            self.Logger.info("QuickCam viewers are keeping up with the scaled down capture, the capture will go back to full size.")
+
+
+    # Must be called under the lock.
+    def _ResetCongestion(self, nowSec:float):
+        self.IsCongested = False
+        self.CongestionClearSinceSec = None
+        self.CongestionClearHoldSec = QuickCamCaptureGovernor.c_CongestionClearHoldSec
+        self.WindowStartSec = nowSec
+        self.WindowFrames = 0
+        self.WindowDroppedFrames = 0
@@ -0,0 +1,94 @@
+import time
+import logging
+import threading
+
+from ..relaymetrics import RelayMetrics
+
+
+# Holds the newest frame of each live webcam stream, so snapshots can be taken from a stream that's already running.
+#
+# While someone is watching a webcam, or a QuickCam capture is running, the newest full jpeg is already in memory.
+# Without this, a snapshot request would still make a new http snapshot request, or even open a new stream connection.
+# The live stream paths publish their frames here, keyed by the url or path they stream from, and the snapshot logic
+# uses a frame if it's fresh enough, otherwise it falls back to the normal snapshot logic.
+class WebcamFrameRegistry:
+
+    # The max frame age limits. 0 disables the registry, which is the default, so snapshots are only taken from a stream if the host enables it.
+    c_DefaultMaxFrameAgeMs = 0
+    c_MinMaxFrameAgeMs = 0
+    c_MaxMaxFrameAgeMs = 10000
+
+    # Streams can run at a high frame rate, so we only take a frame this often, which keeps the copies cheap.
+    c_MinPublishIntervalSec = 0.2
+
+    # How old a frame can be and still be used for a snapshot, which is set by the host.
+    MaxFrameAgeSec = c_DefaultMaxFrameAgeMs / 1000.0
+
+    _Instance = None
+
+
+    @staticmethod
+    def Init(logger:logging.Logger):
+        WebcamFrameRegistry._Instance = WebcamFrameRegistry(logger)
+
+
+    @staticmethod
+    def Get():
+        return WebcamFrameRegistry._Instance
+
+
+    @staticmethod
+    def SetMaxFrameAgeMs(maxFrameAgeMs:int):
+        maxFrameAgeMs = min(max(maxFrameAgeMs, WebcamFrameRegistry.c_MinMaxFrameAgeMs), WebcamFrameRegistry.c_MaxMaxFrameAgeMs)
+        WebcamFrameRegistry.MaxFrameAgeSec = maxFrameAgeMs / 1000.0
+
+
+    @staticmethod
+    def IsEnabled() -> bool:
+        return WebcamFrameRegistry.MaxFrameAgeSec > 0
+
+
+    def __init__(self, logger:logging.Logger):
+        self.Logger = logger
+        self.Lock = threading.Lock()
+        # Maps the stream key to a tuple of (publish time, jpeg buffer)
+        self.Frames = {}
+
+
+    # Called by the live stream paths with each frame.
+    # The frame function is only called if the frame will be used, so the caller can avoid copying the frame when it won't be.
+    # It must return the raw jpeg as bytes that won't change, since the buffer is shared with the snapshot callers.
+    def PublishFrame(self, key:str, frameFunc) -> None:
+        if key is None or WebcamFrameRegistry.IsEnabled() is False:
+            return
+        nowSec = time.time()
+        with self.Lock:
+            current = self.Frames.get(key, None)
+            if current is not None and nowSec - current[0] < WebcamFrameRegistry.c_MinPublishIntervalSec:
+                return
+            buf = frameFunc()
+            # Only keep jpegs, which must start with FF D8, so other multipart streams are never used as snapshots.
+            if buf is None or len(buf) < 2 or buf[0] != 0xFF or buf[1] != 0xD8:
+                return
+            self.Frames[key] = (nowSec, buf)
+
+
+    # Returns the newest fresh frame for any of the keys, or None if there isn't one.
+    def GetFrame(self, keys) -> bytes:
+        if WebcamFrameRegistry.IsEnabled() is False:
+            return None
+        nowSec = time.time()
+        with self.Lock:
+            for key in keys:
+                if key is None:
+                    continue
+                current = self.Frames.get(key, None)
+                if current is None:
+                    continue
+                if nowSec - current[0] <= WebcamFrameRegistry.MaxFrameAgeSec:
+                    RelayMetrics.Get().IncrementCounter("Webcam.FrameRegistry.Hits")
+                    return current[1]
+                # The stream has stopped, so don't hold the frame anymore.
+                del self.Frames[key]
+        RelayMetrics.Get().IncrementCounter("Webcam.FrameRegistry.Misses")
+        return None
@@ -6,9 +6,13 @@ from typing import List
 import urllib3
 
 from ..sentry import Sentry
+from ..relaymetrics import RelayMetrics
 from ..octohttprequest import OctoHttpRequest
 from .webcamsettingitem import WebcamSettingItem
 from .quickcam import QuickCamManager
+from .mjpegfanout import MjpegFanOutManager
+from .webcamsnapshotcache import WebcamSnapshotCache
+from .webcamframeregistry import WebcamFrameRegistry
 
 # The point of this class is to abstract the logic that needs to be done to reliably get a webcam snapshot and stream from many types of
 # printer setups. The main entry point is GetSnapshot() which will try a number of ways to get a snapshot from whatever camera system is
@@ -30,6 +34,10 @@ class WebcamHelper:
     def Init(logger:logging.Logger, webcamPlatformHelperInterface, pluginDataFolderPath):
         WebcamHelper._Instance = WebcamHelper(logger, webcamPlatformHelperInterface, pluginDataFolderPath)
         QuickCamManager.Init(logger, webcamPlatformHelperInterface)
+        MjpegFanOutManager.Init(logger)
+        WebcamFrameRegistry.Init(logger)
+        # Expose the per camera snapshot stats through the metrics command.
+        RelayMetrics.Get().RegisterStatsProvider("WebcamSnapshots", WebcamHelper._Instance.GetSnapshotStats)
 
 
     @staticmethod
@@ -40,6 +48,7 @@ class WebcamHelper:
     def __init__(self, logger:logging.Logger, webcamPlatformHelperInterface, pluginDataFolderPath:str):
         self.Logger = logger
         self.WebcamPlatformHelperInterface = webcamPlatformHelperInterface
+        self.SnapshotCache = WebcamSnapshotCache(logger)
 
         # Init local webcam settings stuffs.
         self.SettingsFilePath = os.path.join(pluginDataFolderPath, "webcam-settings.json")
@@ -48,6 +57,14 @@ class WebcamHelper:
         self._LoadPluginWebcamSettings()
 
 
+    # Returns the stream url from the settings, or None if there isn't one.
+    def GetWebcamStreamUrl(self, cameraIndex:int = None) -> str:
+        obj = self._GetWebcamSettingObj(cameraIndex)
+        if obj is None:
+            return None
+        return obj.StreamUrl
+
+
     # Returns if flip H is set in the settings.
     def GetWebcamFlipH(self, cameraIndex:int = None):
         obj = self._GetWebcamSettingObj(cameraIndex)
@@ -130,6 +147,13 @@ class WebcamHelper:
         # Try to get the URL from the settings.
         webcamStreamUrl = webcamSettingsObj.StreamUrl
         if webcamStreamUrl is not None:
+            # If enabled, try to share one upstream connection between all of the streams for this URL.
+            # If the URL isn't a mjpeg stream, this will fail and we will connect to it directly.
+            if MjpegFanOutManager.IsEnabled():
+                result = MjpegFanOutManager.Get().TryGetStream(webcamStreamUrl)
+                if result is not None:
+                    return result
+
             # Try to make a standard http call with this stream url
             # Use use this HTTP call helper system because it might be somewhat tricky to know
             # Where to actually make the webcam request in terms of IP and port.
@@ -149,8 +173,14 @@ class WebcamHelper:
     # On success, this will return a valid OctoHttpRequest that's fully filled out. The stream will always already be fully read, and will be FullBodyBuffer var.
     def GetSnapshot(self, cameraIndex:int = None) -> OctoHttpRequest.Result:
         # Wrap the entire result in the _EnsureJpegHeaderInfo function, so ensure the returned snapshot can be used by all image processing libs.
+        # The snapshot cache makes sure concurrent requests for the same camera share one fetch, and returns a recent snapshot if the freshness window is set.
         # Wrap the entire result in the add transform function, so on success the header gets added.
-        return self._AddOeWebcamTransformHeader(self._EnsureJpegHeaderInfo(self._GetSnapshotInternal(cameraIndex)), cameraIndex)
+        return self._AddOeWebcamTransformHeader(self.SnapshotCache.GetSnapshot(cameraIndex, lambda: self._EnsureJpegHeaderInfo(self._GetSnapshotInternal(cameraIndex))), cameraIndex)
+
+
+    # Returns the snapshot request stats for each camera index.
+    def GetSnapshotStats(self) -> dict:
+        return self.SnapshotCache.GetStats()
 
 
     def _GetSnapshotInternal(self, cameraIndex:int = None) -> OctoHttpRequest.Result:
@@ -160,7 +190,16 @@ class WebcamHelper:
         if webcamSettingsObj is None:
             return None
 
-        # First, check if this webcam URL needs to be handled by the QuickCam system.
+        # First, if any live stream of this webcam has a recent frame, use it rather than making a new request.
+        img = WebcamFrameRegistry.Get().GetFrame([webcamSettingsObj.StreamUrl, webcamSettingsObj.SnapshotUrl])
+        if img is not None:
+            headers = {
+                "content-type": "image/jpeg",
+                "content-length": str(len(img))
+            }
+            return OctoHttpRequest.Result(200, headers, webcamSettingsObj.StreamUrl, False, fullBodyBuffer=img)
+
+        # Next, check if this webcam URL needs to be handled by the QuickCam system.
         result = QuickCamManager.Get().TryToGetSnapshot(webcamSettingsObj)
         if result is not None:
             return result
@@ -188,6 +227,12 @@ class WebcamHelper:
 
 
     def _GetSnapshotFromStream(self, url) -> OctoHttpRequest.Result:
+        # If enabled, try to get the newest frame from the shared upstream for this URL, which is already connected if anyone is streaming.
+        if MjpegFanOutManager.IsEnabled():
+            result = MjpegFanOutManager.Get().TryToGetSnapshot(url)
+            if result is not None:
+                return result
+
         try:
             # Try to connect the the mjpeg stream using the http helper class.
             # This is required because knowing the port to connect to might be tricky.
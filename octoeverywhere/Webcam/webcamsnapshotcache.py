@@ -0,0 +1,174 @@
+import time
+import logging
+import threading
+
+from ..sentry import Sentry
+from ..relaymetrics import RelayMetrics
+from ..octohttprequest import OctoHttpRequest
+
+
+# Coalesces snapshot requests for the same camera, and optionally caches the last snapshot for a short freshness window.
+#
+# Snapshots are requested by many systems on their own schedules, like Gadget, the final snap, notifications, and the service.
+# Without this, each request does its own fetch from the webcam server, even when they happen within the same few hundred milliseconds.
+# With this, if a fetch for a camera is already in flight, the other requests wait for it and share the result. If the freshness window
+# is set, a snapshot that's younger than the window is returned without a fetch.
+#
+# Each caller gets its own result object, since the results are modified by the callers, but the image buffer is shared.
+class WebcamSnapshotCache:
+
+    # The freshness window limits. 0 means only concurrent requests share a snapshot.
+    c_DefaultFreshnessWindowMs = 0
+    c_MinFreshnessWindowMs = 0
+    c_MaxFreshnessWindowMs = 10000
+
+    # How long a coalesced request will wait for the in flight fetch. The fetch can take a while, since it might fall back to the stream.
+    c_MaxCoalescedWaitSec = 60
+
+    # The freshness window, which is set by the host.
+    FreshnessWindowSec = 0.0
+
+
+    @staticmethod
+    def SetFreshnessWindowMs(freshnessWindowMs:int):
+        freshnessWindowMs = min(max(freshnessWindowMs, WebcamSnapshotCache.c_MinFreshnessWindowMs), WebcamSnapshotCache.c_MaxFreshnessWindowMs)
+        WebcamSnapshotCache.FreshnessWindowSec = freshnessWindowMs / 1000.0
+
+
+    def __init__(self, logger:logging.Logger):
+        self.Logger = logger
+        self.Lock = threading.Lock()
+        # Maps the camera key to the last good snapshot, the in flight fetch, and the stats.
+        self.Snapshots = {}
+        self.InFlight = {}
+        self.Stats = {}
+
+
+    # Returns a snapshot for the camera key, either from the cache, from an in flight fetch, or by calling the fetch function.
+    # The fetch function must return a fully buffered OctoHttpRequest.Result or None.
+    def GetSnapshot(self, cameraKey, fetchFunc) -> OctoHttpRequest.Result:
+        isFetcher = False
+        with self.Lock:
+            stats = self._GetStats(cameraKey)
+            stats.Requests += 1
+
+            # Check if there's a snapshot that's still fresh.
+            snapshot = self.Snapshots.get(cameraKey, None)
+            if snapshot is not None and WebcamSnapshotCache.FreshnessWindowSec > 0 and time.time() - snapshot.TimeSec <= WebcamSnapshotCache.FreshnessWindowSec:
+                stats.CacheHits += 1
+                RelayMetrics.Get().IncrementCounter("Webcam.Snapshot.CacheHits")
+                return snapshot.CreateResult()
+
+            # If there's no fetch in flight, this request does it.
+            flight = self.InFlight.get(cameraKey, None)
+            if flight is None:
+                flight = SnapshotFlight()
+                self.InFlight[cameraKey] = flight
+                isFetcher = True
+            else:
+                stats.Coalesced += 1
+                RelayMetrics.Get().IncrementCounter("Webcam.Snapshot.Coalesced")
+
+        if isFetcher:
+            return self._Fetch(cameraKey, flight, fetchFunc)
+
+        # Wait for the in flight fetch.
+        if flight.Done.wait(WebcamSnapshotCache.c_MaxCoalescedWaitSec) is False:
+            self.Logger.warn(f"WebcamSnapshotCache timed out waiting for an in flight snapshot for camera {cameraKey}")
+            return None
+        if flight.Snapshot is None:
+            return None
+        return flight.Snapshot.CreateResult()
+
+
+    # Returns the stats for each camera key.
+    def GetStats(self) -> dict:
+        with self.Lock:
+            return {str(k): v.ToDict() for k, v in self.Stats.items()}
+
+
+    def _Fetch(self, cameraKey, flight, fetchFunc) -> OctoHttpRequest.Result:
+        result = None
+        snapshot = None
+        startSec = time.time()
+        try:
+            result = fetchFunc()
+            if result is not None and result.StatusCode == 200 and result.FullBodyBuffer is not None:
+                snapshot = CachedSnapshot(result)
+        except Exception as e:
+            Sentry.Exception("WebcamSnapshotCache snapshot fetch failed.", e)
+        finally:
+            fetchSec = time.time() - startSec
+            RelayMetrics.Get().RecordLatency("Webcam.Snapshot.Fetch", fetchSec)
+            with self.Lock:
+                stats = self._GetStats(cameraKey)
+                stats.Fetches += 1
+                stats.LastFetchMs = int(fetchSec * 1000)
+                if snapshot is None:
+                    stats.Failures += 1
+                else:
+                    self.Snapshots[cameraKey] = snapshot
+                flight.Snapshot = snapshot
+                del self.InFlight[cameraKey]
+            # Release the coalesced requests.
+            flight.Done.set()
+        if self.Logger.isEnabledFor(logging.DEBUG):
+            self.Logger.debug(f"WebcamSnapshotCache fetched a snapshot for camera {cameraKey} in {fetchSec:.3f}s. Stats: {stats.ToDict()}")
+        # The fetcher can use its own result, since the cache keeps a copy of the headers.
+        return result
+
+
+    # Must be called under the lock.
+    def _GetStats(self, cameraKey):
+        stats = self.Stats.get(cameraKey, None)
+        if stats is None:
+            stats = SnapshotStats()
+            self.Stats[cameraKey] = stats
+        return stats
+
+
+# An in flight snapshot fetch that other requests can wait on.
+class SnapshotFlight:
+
+    def __init__(self):
+        self.Done = threading.Event()
+        self.Snapshot:CachedSnapshot = None
+
+
+# A snapshot that's been fetched, which can create new results for each caller.
+class CachedSnapshot:
+
+    def __init__(self, result:OctoHttpRequest.Result):
+        self.TimeSec = time.time()
+        self.StatusCode = result.StatusCode
+        # Copy the headers, since the callers add to them.
+        self.Headers = dict(result.Headers)
+        self.Url = result.Url
+        self.DidFallback = result.DidFallback
+        self.Buffer = result.FullBodyBuffer
+
+
+    def CreateResult(self) -> OctoHttpRequest.Result:
+        return OctoHttpRequest.Result(self.StatusCode, dict(self.Headers), self.Url, self.DidFallback, fullBodyBuffer=self.Buffer)
+
+
+class SnapshotStats:
+
+    def __init__(self):
+        self.Requests = 0
+        self.Fetches = 0
+        self.Coalesced = 0
+        self.CacheHits = 0
+        self.Failures = 0
+        self.LastFetchMs = 0
+
+
+    def ToDict(self) -> dict:
+        return {
+            "Requests": self.Requests,
+            "Fetches": self.Fetches,
+            "Coalesced": self.Coalesced,
+            "CacheHits": self.CacheHits,
+            "Failures": self.Failures,
+            "LastFetchMs": self.LastFetchMs,
+        }
@@ -0,0 +1,219 @@
+import time
+import logging
+import threading
+
+from ..sentry import Sentry
+from ..relaymetrics import RelayMetrics
+
+#
+# Paces the frames of a relayed webcam stream, so that when the uplink is slower than the camera the viewer gets the newest frame
+# rather than a growing backlog of old ones.
+#
+# Without this, every frame is queued to send. If the uplink can't keep up, the frames pile up in the send queue, and the latency
+# of the stream grows until the uplink budget holds the stream back, which can be seconds of old frames.
+#
+# With the governor, before each frame is read the stream waits until:
+#   - The max fps interval has passed since the last frame, if there's a max fps.
+#   - The uplink isn't congested, which is when the oldest message this stream has queued is older than the latency target,
+#     there's more than a couple of frames queued, or the last send took longer than the latency target.
+# While the stream waits, the frame source keeps only the newest frame, so the next frame sent is always the newest.
+# For QuickCam streams, the stream instance already only keeps the newest image. For proxied http streams, see LatestFrameReader.
+#
+class WebcamStreamGovernor:
+
+    # The option limits and defaults. A max fps of 0 means there's no limit.
+    c_DefaultMaxFps = 0
+    c_MinMaxFps = 0
+    c_MaxMaxFps = 60
+    c_DefaultTargetLatencyMs = 500
+    c_MinTargetLatencyMs = 50
+    c_MaxTargetLatencyMs = 10000
+
+    # The options, which are set by the host.
+    Enabled = False
+    MaxFps = c_DefaultMaxFps
+    TargetLatencySec = c_DefaultTargetLatencyMs / 1000.0
+
+    # How often we check if the uplink is still congested.
+    c_CongestionCheckIntervalSec = 0.010
+
+    # The uplink is congested if more than this many frames are queued.
+    c_MaxQueuedFrames = 2
+
+
+    # Sets the webcam relay options. A max fps of 0 means there's no limit.
+    @staticmethod
+    def SetOptions(enabled:bool, maxFps:int, targetLatencyMs:int):
+        WebcamStreamGovernor.Enabled = enabled
+        WebcamStreamGovernor.MaxFps = min(max(maxFps, WebcamStreamGovernor.c_MinMaxFps), WebcamStreamGovernor.c_MaxMaxFps)
+        WebcamStreamGovernor.TargetLatencySec = min(max(targetLatencyMs, WebcamStreamGovernor.c_MinTargetLatencyMs), WebcamStreamGovernor.c_MaxTargetLatencyMs) / 1000.0
+
+
+    @staticmethod
+    def IsEnabled() -> bool:
+        return WebcamStreamGovernor.Enabled
+
+
+    def __init__(self, logger:logging.Logger, webStream, logPrefix:str = ""):
+        self.Logger = logger
+        self.WebStream = webStream
+        self.LogPrefix = logPrefix
+        self.MinFrameIntervalSec = 0.0
+        if WebcamStreamGovernor.MaxFps > 0:
+            self.MinFrameIntervalSec = 1.0 / WebcamStreamGovernor.MaxFps
+        self.TargetLatencySec = WebcamStreamGovernor.TargetLatencySec
+        self.LastFrameSentSec = 0.0
+        self.LastFrameSizeBytes = 0
+        self.LastSendTimeSec = 0.0
+
+        # Stats
+        self.FramesSent = 0
+        self.CongestedWaits = 0
+        self.CongestedTimeSec = 0.0
+        self.FpsLimitedWaits = 0
+
+
+    # Blocks until the next frame should be read and sent.
+    # The is closed function is checked while waiting, so the wait ends if the stream closes.
+    def WaitForFrameSlot(self, isClosedFunc) -> None:
+        # First, respect the max fps.
+        if self.MinFrameIntervalSec > 0 and self.LastFrameSentSec > 0:
+            waitSec = (self.LastFrameSentSec + self.MinFrameIntervalSec) - time.time()
+            if waitSec > 0:
+                self.FpsLimitedWaits += 1
+                time.sleep(waitSec)
+
+        # Then wait until the uplink has caught up.
+        if self.IsCongested() is False:
+            return
+        self.CongestedWaits += 1
+        RelayMetrics.Get().IncrementCounter("Webcam.Governor.CongestedWaits")
+        startSec = time.time()
+        while isClosedFunc() is False and self.IsCongested():
+            time.sleep(WebcamStreamGovernor.c_CongestionCheckIntervalSec)
+        self.CongestedTimeSec += time.time() - startSec
+
+
+    # Called after each frame is sent, with the message size and how long the send took.
+    def OnFrameSent(self, sizeBytes:int, sendTimeSec:float) -> None:
+        self.LastFrameSentSec = time.time()
+        self.LastFrameSizeBytes = sizeBytes
+        self.LastSendTimeSec = sendTimeSec
+        self.FramesSent += 1
+
+
+    def IsCongested(self) -> bool:
+        # If the send itself is slow, the uplink is backed up.
+        if self.LastSendTimeSec > self.TargetLatencySec:
+            # Only use the last send time once, otherwise we would never get out of the congested state, since we aren't sending.
+            self.LastSendTimeSec = 0.0
+            return True
+        queuedBytes, oldestAgeSec = self.WebStream.GetUplinkQueueState()
+        if queuedBytes == 0:
+            return False
+        if oldestAgeSec > self.TargetLatencySec:
+            return True
+        return self.LastFrameSizeBytes > 0 and queuedBytes > self.LastFrameSizeBytes * WebcamStreamGovernor.c_MaxQueuedFrames
+
+
+    def GetStats(self) -> dict:
+        return {
+            "FramesSent": self.FramesSent,
+            "CongestedWaits": self.CongestedWaits,
+            "CongestedTimeSec": round(self.CongestedTimeSec, 3),
+            "FpsLimitedWaits": self.FpsLimitedWaits,
+        }
+
+
+#
+# Reads the parts of a proxied multipart webcam stream on it's own thread, and only keeps the newest one.
+#
+# This is used with the WebcamStreamGovernor. While the governor holds the stream back, this keeps reading the frames from the webcam server,
+# so they don't queue up in the socket buffers, and drops all but the newest one. Whole parts are always dropped, so the stream is still valid.
+#
+class LatestFrameReader:
+
+    # How long each wait for a new frame is, so we notice when the stream closes.
+    c_WaitSliceSec = 0.5
+
+
+    # The parser must be a MjpegStreamParser.
+    def __init__(self, logger:logging.Logger, parser, logPrefix:str = ""):
+        self.Logger = logger
+        self.Parser = parser
+        self.LogPrefix = logPrefix
+        self.Lock = threading.Lock()
+        self.FrameReadyEvent = threading.Event()
+        self.Thread:threading.Thread = None
+        self.IsStopped = False
+
+        # The newest frame and if it was the parser's last part before it failed.
+        self.Frame:bytes = None
+        self.FrameIsFailedPart = False
+        self.IsReadDone = False
+        # Set once the part the parser failed on has been taken. After this, the caller must read the body directly.
+        self.HasFailed = False
+
+        # Stats
+        self.FramesRead = 0
+        self.FramesDropped = 0
+
+
+    def Start(self) -> None:
+        self.Thread = threading.Thread(target=self._ReadThread, name="LatestFrameReader")
+        self.Thread.daemon = True
+        self.Thread.start()
+
+
+    # Stops the read thread. The thread will exit when it's current read returns, which happens when the http response is closed.
+    def Stop(self) -> None:
+        self.IsStopped = True
+        self.FrameReadyEvent.set()
+
+
+    # Blocks until there's a frame newer than the last one taken, and returns it as a memoryview.
+    # Returns None if the body is done or the stream closed.
+    def TakeFrame(self, isClosedFunc) -> memoryview:
+        while True:
+            with self.Lock:
+                if self.Frame is not None:
+                    frame = self.Frame
+                    self.Frame = None
+                    self.HasFailed = self.FrameIsFailedPart
+                    self.FrameReadyEvent.clear()
+                    return memoryview(frame)
+                if self.IsReadDone or self.IsStopped:
+                    return None
+            if isClosedFunc():
+                return None
+            self.FrameReadyEvent.wait(LatestFrameReader.c_WaitSliceSec)
+
+
+    def _ReadThread(self) -> None:
+        try:
+            while self.IsStopped is False:
+                part = self.Parser.ReadPart()
+                if part is None:
+                    break
+                # The part is a view into the parser's buffer, which will be reused on the next read, so it must be copied.
+                frame = bytes(part)
+                part.release()
+                isFailedPart = self.Parser.HasFailed
+                with self.Lock:
+                    self.FramesRead += 1
+                    # If the last frame wasn't taken yet, drop it. It's always a full part, since we stop after the part the parser failed on.
+                    if self.Frame is not None:
+                        self.FramesDropped += 1
+                        RelayMetrics.Get().IncrementCounter("Webcam.LatestFrame.Dropped")
+                    self.Frame = frame
+                    self.FrameIsFailedPart = isFailedPart
+                    self.FrameReadyEvent.set()
+                # Once the parser fails, the rest of the body is read by the caller, so we are done.
+                if isFailedPart:
+                    break
+        except Exception as e:
+            Sentry.Exception(self.LogPrefix+" exception thrown in the latest frame reader.", e)
+        finally:
+            with self.Lock:
+                self.IsReadDone = True
+                self.FrameReadyEvent.set()
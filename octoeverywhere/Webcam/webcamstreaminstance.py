@@ -3,6 +3,7 @@ import logging
 import threading
 
 from ..octohttprequest import OctoHttpRequest
+from ..relaymetrics import RelayMetrics
 
 # Stream Instance is a class that is created per web stream to handle streaming QuickCam images into the http stream.
 class WebcamStreamInstance:
@@ -18,22 +19,27 @@ class WebcamStreamInstance:
         self.StreamOpenTimeSec = time.time()
         self.ImageReadyEvent = threading.Event()
         self.AwaitingImage:bytearray = None
+        self.DroppedFrames = 0
 
 
     # This will attempt to start a stream of the webcam.
     # On success, it will return an OctoHttpRequest.Result object with a data callback setup.
     # On failure, it will return None.
     def StartWebRequest(self) -> OctoHttpRequest.Result:
-        # First, try to get a snapshot. This will determine if we are able to get a stream or not.
-        # If we can't start the stream, then we don't return success.
-        # We will also use this first image to start the stream, to get it going ASAP.
-        self.AwaitingImage = self.QuickCam.GetCurrentImage()
-        if self.AwaitingImage is None:
-            return None
-
+        # Attach the stream callback first, so if this starts the capture, it will start with the stream capture profile.
         # Note! We must be sure to call DetachImageStreamCallback to remove this stream callback!
         self.QuickCam.AttachImageStreamCallback(self._NewImageCallback)
 
+        # Next, try to get a snapshot. This will determine if we are able to get a stream or not.
+        # If we can't start the stream, then we don't return success.
+        # We will also use this first image to start the stream, to get it going ASAP, unless the callback already gave us a newer one.
+        image = self.QuickCam.GetCurrentImage()
+        if image is None:
+            self.QuickCam.DetachImageStreamCallback(self._NewImageCallback)
+            return None
+        if self.AwaitingImage is None:
+            self.AwaitingImage = image
+
         # We must set the content type so that the web browser knows what kind of stream to expect.
         headers = {
             "content-type": f"multipart/x-mixed-replace; boundary={WebcamStreamInstance.c_OeStreamBoundaryString}",
@@ -44,7 +50,12 @@ class WebcamStreamInstance:
 
 
     # Define the callback we will get from QuickCam when there's a new image ready for us to send.
+    # Only the newest image is kept, so if the stream is held back by a slow uplink, the older images are dropped and the newest is sent next.
     def _NewImageCallback(self, imgBuffer:bytearray):
+        if self.AwaitingImage is not None:
+            self.DroppedFrames += 1
+            RelayMetrics.Get().IncrementCounter("Webcam.LatestFrame.Dropped")
+            self.QuickCam.ReportDroppedStreamFrame()
         self.AwaitingImage = imgBuffer
         self.ImageReadyEvent.set()
 
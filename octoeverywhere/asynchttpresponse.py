@@ -0,0 +1,116 @@
+import logging
+
+from requests.structures import CaseInsensitiveDict
+
+#
+# When the asyncio relay engine is used, local http calls are made with an async http client on the engine's loop.
+# This class wraps the async response so it looks like the parts of the requests lib Response object that OctoHttpRequest.Result users depend on.
+#
+# If the body was fully read on the loop, the Result will have a full body buffer and the body is never read through this object.
+# Otherwise, the body read functions are called from a blocking thread, and they marshal each read onto the loop.
+#
+class AsyncHttpResponse:
+
+    def __init__(self, logger:logging.Logger, engine, response):
+        self.Logger = logger
+        self.Engine = engine
+        self.Response = response
+        self.status_code = response.status_code
+        # Like the requests lib, duplicate headers are joined into one value.
+        self.headers = CaseInsensitiveDict(response.headers.items())
+        # The body is always streamed, so like a requests stream response, there's never any lingering content.
+        self.content = b""
+        self.raw = AsyncHttpResponseRawReader(self)
+        self.IsClosed = False
+        self.RawIterator = None
+        self.PendingBuffer = None
+
+
+    # Called on the loop, returns the next raw chunk or None if the body is done.
+    async def ReadNextChunkAsync(self):
+        if self.IsClosed:
+            return None
+        if self.PendingBuffer is not None:
+            buffer = self.PendingBuffer
+            self.PendingBuffer = None
+            return buffer
+        if self.RawIterator is None:
+            self.RawIterator = self.Response.aiter_raw()
+        try:
+            # The anext builtin is only in PY 3.10+, so the dunder is called directly.
+            return await self.RawIterator.__anext__() #pylint: disable=unnecessary-dunder-call
+        except StopAsyncIteration:
+            return None
+        except Exception as e:
+            # Like the requests body reads, any read failure just means the body is done.
+            if self.IsClosed is False:
+                self.Logger.info(f"AsyncHttpResponse body read ended due to an exception. {e}")
+            return None
+
+
+    # Called on the loop, reads until the requested size is filled or the body is done.
+    async def ReadAsync(self, amt:int):
+        bufferList = []
+        readSize = 0
+        while amt is None or readSize < amt:
+            chunk = await self.ReadNextChunkAsync()
+            if chunk is None:
+                break
+            # If we read too much, keep the remainder for the next read.
+            if amt is not None and readSize + len(chunk) > amt:
+                remaining = amt - readSize
+                self.PendingBuffer = chunk[remaining:]
+                chunk = chunk[:remaining]
+            bufferList.append(chunk)
+            readSize += len(chunk)
+        if len(bufferList) == 1:
+            return bufferList[0]
+        return b"".join(bufferList)
+
+
+    async def CloseAsync(self):
+        self.IsClosed = True
+        try:
+            await self.Response.aclose()
+        except Exception as e:
+            self.Logger.debug(f"AsyncHttpResponse close exception. {e}")
+
+
+    def close(self):
+        if self.IsClosed:
+            return
+        self.IsClosed = True
+        # This can be called from the loop or a blocking thread, so always schedule it.
+        self.Engine.RunCoroutine(self.CloseAsync())
+
+
+    # Support using with, like the requests lib Response.
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, t, v, tb):
+        self.close()
+
+
+# Mirrors the parts of the urllib3 raw response we use in the body read paths.
+# These must be called from a blocking thread, not the loop.
+class AsyncHttpResponseRawReader:
+
+    def __init__(self, response:AsyncHttpResponse):
+        self.AsyncResponse = response
+
+
+    def read(self, amt:int = None):
+        return self.AsyncResponse.Engine.RunCoroutineBlocking(self.AsyncResponse.ReadAsync(amt))
+
+
+    def stream(self, amt:int = None):
+        while True:
+            if amt is None:
+                chunk = self.AsyncResponse.Engine.RunCoroutineBlocking(self.AsyncResponse.ReadNextChunkAsync())
+            else:
+                chunk = self.read(amt)
+            if chunk is None or len(chunk) == 0:
+                return
+            yield chunk
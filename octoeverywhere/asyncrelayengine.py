@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import threading
+import concurrent.futures
+
+from .sentry import Sentry
+
+#
+# An opt-in relay engine that runs the OctoStream server websocket, the local websockets, and the local http calls
+# on a single asyncio event loop, instead of using a few blocking threads per connection and web stream.
+#
+# On low core count devices the context switching and per thread stack memory dominates the CPU and RSS usage when the portal is busy.
+# With this engine the server websocket and the local websockets are multiplexed on the loop, each web stream is a task on the loop,
+# and local http calls are made with an async http client.
+#
+# Some work is still blocking, like the webcam oracle requests, commands, and long running body streams. That work is handed off
+# to a small bounded thread pool, so it never blocks the loop.
+#
+class AsyncRelayEngine:
+
+    # The default number of threads used for work that must block.
+    c_DefaultMaxBlockingThreads = 16
+
+    # The max number of http connections the async http client will keep open.
+    c_MaxHttpConnections = 100
+    c_MaxHttpKeepAliveConnections = 20
+
+    _Instance = None
+
+
+    # Only call Init if the asyncio engine should be used.
+    @staticmethod
+    def Init(logger:logging.Logger, maxBlockingThreads:int = c_DefaultMaxBlockingThreads):
+        AsyncRelayEngine._Instance = AsyncRelayEngine(logger, maxBlockingThreads)
+
+
+    # Returns None if the asyncio engine isn't enabled.
+    @staticmethod
+    def Get():
+        return AsyncRelayEngine._Instance
+
+
+    def __init__(self, logger:logging.Logger, maxBlockingThreads:int):
+        self.Logger = logger
+        self.HttpClient = None
+        self.LoopThreadId = None
+        self.Loop = asyncio.new_event_loop()
+        self.BlockingExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=maxBlockingThreads, thread_name_prefix="AsyncRelayBlocking")
+
+        # Start the loop and wait for it to be running, so anything that's scheduled right after init is safe.
+        loopStarted = threading.Event()
+        self.LoopThread = threading.Thread(target=self._LoopThread, args=(loopStarted,), name="AsyncRelayEngine")
+        self.LoopThread.daemon = True
+        self.LoopThread.start()
+        loopStarted.wait()
+        self.Logger.info(f"Asyncio relay engine started with {maxBlockingThreads} max blocking threads.")
+
+
+    def _LoopThread(self, loopStarted:threading.Event):
+        try:
+            asyncio.set_event_loop(self.Loop)
+            self.Loop.set_default_executor(self.BlockingExecutor)
+            self.LoopThreadId = threading.get_ident()
+            self.Loop.call_soon(loopStarted.set)
+            self.Loop.run_forever()
+        except Exception as e:
+            Sentry.Exception("Asyncio relay engine loop thread exception.", e)
+        finally:
+            loopStarted.set()
+            self.Logger.error("Asyncio relay engine loop thread exited.")
+
+
+    # Returns true if the caller is running on the event loop thread.
+    def IsLoopThread(self) -> bool:
+        return threading.get_ident() == self.LoopThreadId
+
+
+    # Schedules a coroutine on the loop, this is safe to call from any thread.
+    # Returns a concurrent.futures.Future.
+    def RunCoroutine(self, coro) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(coro, self.Loop)
+
+
+    # Runs a coroutine on the loop and blocks until it's complete, returning the result.
+    # This must never be called from the loop thread, or it will deadlock.
+    def RunCoroutineBlocking(self, coro):
+        if self.IsLoopThread():
+            coro.close()
+            raise Exception("RunCoroutineBlocking was called from the asyncio relay engine loop thread.")
+        return self.RunCoroutine(coro).result()
+
+
+    # Calls the callback on the loop, this is safe to call from any thread.
+    # Callbacks are always called in the order they are scheduled.
+    def CallSoon(self, callback, *args):
+        self.Loop.call_soon_threadsafe(callback, *args)
+
+
+    # Used from the loop, this runs a blocking function on the blocking thread pool and awaits the result.
+    async def RunBlocking(self, func, *args):
+        return await self.Loop.run_in_executor(self.BlockingExecutor, func, *args)
+
+
+    # Returns the shared async http client. This must be called from the loop.
+    def GetHttpClient(self):
+        if self.HttpClient is None:
+            # Only import the lib if the engine is in use, so we don't pay the memory cost otherwise.
+            import httpx #pylint: disable=import-outside-toplevel
+            # Like our requests sessions, we don't want any env proxy lookups and we don't verify certs, since most local servers use self-signed certs.
+            # We use a long timeout because some api calls can hang for a while, see MakeHttpCallAttempt.
+            self.HttpClient = httpx.AsyncClient(
+                verify=False,
+                trust_env=False,
+                timeout=httpx.Timeout(1800.0),
+                limits=httpx.Limits(max_connections=AsyncRelayEngine.c_MaxHttpConnections, max_keepalive_connections=AsyncRelayEngine.c_MaxHttpKeepAliveConnections)
+            )
+        return self.HttpClient
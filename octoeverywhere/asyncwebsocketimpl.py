@@ -0,0 +1,672 @@
+import os
+import ssl
+import time
+import base64
+import struct
+import hashlib
+import asyncio
+import threading
+import collections
+import urllib.parse
+
+import certifi
+import octowebsocket
+
+from .sentry import Sentry
+from .relaymetrics import RelayMetrics
+from .asyncrelayengine import AsyncRelayEngine
+from .sendscheduler import SendScheduler
+from .websocketimpl import Client, SendQueueContext, SendWriteStats
+
+# A websocket client that runs on the asyncio relay engine loop.
+#
+# This class has the same interface and callback semantics as websocketimpl.Client, so it can be swapped in when the
+# asyncio relay engine is enabled. The big difference is it doesn't use any threads, the connection, receive loop, and send queue
+# are all tasks on the engine's loop. The octowebsocket lib is blocking only, so the websocket protocol is implemented here on top of asyncio streams.
+#
+# By default, the onWsMsg, onWsData, and onWsClose callbacks are fired on the loop, so they must never block, since that would stall every stream.
+# Callbacks that run longer than c_SlowLoopCallbackSec are logged and counted, so a handler that blocks is easy to find.
+# If dispatchOffLoop is set, the callbacks are instead fired in order on a blocking thread, like the Client's receive thread.
+# While the callbacks are behind, the socket isn't read, which pushes back on the sender.
+# If receiveGate is set, it's an async function that's awaited before each frame is read, so the owner can also pause the reads
+# without blocking the loop, like while the uplink is backed up. If it returns false, the socket is closed.
+class AsyncClient:
+
+    # Like the Client, we send a ping every 10 minutes, and the pong must come back within 20 seconds.
+    c_PingIntervalSec = 600
+    c_PongTimeoutSec = 20
+
+    # Like the default socket timeout set in Client, this is the max time we will wait for the connection and handshake.
+    c_ConnectTimeoutSec = 10 * 60
+
+    # The max size of the http handshake response.
+    c_MaxHandshakeResponseSizeBytes = 64 * 1024
+
+    # The GUID defined in RFC6455 for the accept key.
+    c_WebsocketAcceptGuid = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+    # The max size of a single frame and of a full message, after the fragments are joined.
+    # The frame length comes from the other side, so without these limits one bad frame header could make us allocate without bound.
+    # If either is exceeded, the socket is closed with the message too big status.
+    c_MaxFrameSizeBytes = 16 * 1024 * 1024
+    c_MaxMessageSizeBytes = 32 * 1024 * 1024
+
+    # When dispatchOffLoop is set, the max bytes of messages waiting for the callbacks before we stop reading the socket.
+    c_MaxDispatchQueuedBytes = 4 * 1024 * 1024
+
+    # Callbacks on the loop that take longer than this are logged, since they stall every stream on the loop.
+    c_SlowLoopCallbackSec = 0.1
+
+    # See Client for details on coalesceWrites.
+    # If dispatchOffLoop is set, the callbacks are fired on a blocking thread rather than the loop, see the class comment.
+    def __init__(self, url, onWsOpen = None, onWsMsg = None, onWsData = None, onWsClose = None, onWsError = None, headers:dict = None, subProtocolList:list = None, coalesceWrites:bool = False, dispatchOffLoop:bool = False, receiveGate = None):
+        self.Engine = AsyncRelayEngine.Get()
+        if self.Engine is None:
+            raise Exception("The AsyncClient was created but the asyncio relay engine isn't running.")
+
+        self.Url = url
+        self.Headers = headers
+        self.SubProtocolList = subProtocolList
+        self.OnWsOpen = onWsOpen
+        self.OnWsMsg = onWsMsg
+        self.OnWsData = onWsData
+        self.OnWsClose = onWsClose
+
+        # Since we also fire onWsError if there is a send error, we need to capture
+        # the callback and have some vars to ensure it only gets fired once.
+        self.clientWsErrorCallback = onWsError
+        self.wsErrorCallbackLock = threading.Lock()
+        self.hasFiredWsErrorCallback = False
+
+        # The send queue can be added to from any thread, but it's only read from the loop.
+        # The event is created on the loop, since it must be bound to it.
+        self.SendQueue = SendScheduler()
+        self.SendEvent:asyncio.Event = None
+        self.CoalesceWrites = coalesceWrites
+        self.WriteStats = SendWriteStats()
+
+        # The callbacks waiting to be fired on the blocking thread when dispatchOffLoop is set.
+        # The queue is a deque of (callback, args, sizeBytes), the space event is created on the loop.
+        self.DispatchOffLoop = dispatchOffLoop
+        self.DispatchLock = threading.Lock()
+        self.DispatchQueue = collections.deque()
+        self.DispatchQueuedBytes = 0
+        self.IsDispatchRunning = False
+        self.DispatchFuture:asyncio.Future = None
+        self.DispatchSpaceEvent:asyncio.Event = None
+        self.HasLoggedSlowLoopCallback = False
+        self.ReceiveGate = receiveGate
+
+        # These are only used on the loop.
+        self.Reader:asyncio.StreamReader = None
+        self.Writer:asyncio.StreamWriter = None
+        self.RunTask:asyncio.Task = None
+        self.HasSentCloseFrame = False
+        self.LastPongTimeSec = 0.0
+
+        # Used to indicate if the client has started to close this WS. If so, we won't fire
+        # any errors.
+        self.hasClientRequestedClose = False
+
+        # This is used to keep track of this object has been closed.
+        # If this flag is true, this object should not be running and will never run again.
+        self.isClosed = False
+        self.isClosedLock = threading.Lock()
+
+
+    # Runs the websocket blocking until it closes.
+    # This must not be called from the loop.
+    def RunUntilClosed(self):
+        # Since some clients use RunAsync, check that we didn't close before the async action started.
+        with self.isClosedLock:
+            if self.isClosed:
+                return
+        try:
+            self.Engine.RunCoroutineBlocking(self._Run())
+        except Exception as e:
+            self.handleWsError(e)
+
+
+    # Runs the websocket async.
+    def RunAsync(self):
+        with self.isClosedLock:
+            if self.isClosed:
+                return
+        self.Engine.RunCoroutine(self._Run())
+
+
+    # Closes the websocket.
+    def Close(self):
+        self.hasClientRequestedClose = True
+        # Always try to call close, even if we have already done it.
+        self._Close()
+
+
+    # Internally used to close and cleanup.
+    def _Close(self):
+        # Set that we are now closed.
+        with self.isClosedLock:
+            self.isClosed = True
+        self.SendQueue.Close()
+        # The socket can only be touched from the loop.
+        try:
+            self.Engine.CallSoon(self._CloseOnLoop)
+        except Exception as e:
+            Sentry.Exception("AsyncClient failed to schedule the close on the loop.", e)
+
+
+    def _CloseOnLoop(self):
+        # Try to send the close frame and shutdown the socket, since it most likely is already closing, ignore any exceptions.
+        try:
+            if self.Writer is not None and self.Writer.is_closing() is False:
+                self._WriteCloseFrame()
+                self.Writer.close()
+        except Exception:
+            pass
+        # Cancel the run task, which will cleanup and fire the close callback.
+        if self.RunTask is not None and self.RunTask.done() is False:
+            self.RunTask.cancel()
+
+
+    # This can be called from our logic internally in this class or from any thread.
+    def handleWsError(self, exception):
+        # If the client is trying to close this websocket and has made the close call to do so,
+        # we won't fire any more errors out of it.
+        if self.hasClientRequestedClose:
+            return
+
+        # Since this callback can be fired from many sources, we want to ensure it only
+        # gets fired once.
+        with self.wsErrorCallbackLock:
+            if self.hasFiredWsErrorCallback:
+                return
+            self.hasFiredWsErrorCallback = True
+
+        # Like the Client, spin off a thread to fire the callback. This is even more important here, since the callbacks
+        # are allowed to block (for example, the ws helper will try to connect again) and this is usually called from the loop.
+        callbackThread = threading.Thread(target=self.fireWsErrorCallbackThread, args=(exception, ))
+        callbackThread.start()
+
+
+    def fireWsErrorCallbackThread(self, exception):
+        try:
+            # Fire the error callback.
+            if self.clientWsErrorCallback:
+                self.clientWsErrorCallback(self, exception)
+        except Exception as e :
+            Sentry.Exception("AsyncClient exception in fireWsErrorCallbackThread", e)
+
+        # Be sure we always close the WS
+        self._Close()
+
+
+    def Send(self, buffer:bytearray, msgStartOffsetBytes:int = None, msgSize:int = None, isData:bool = True, streamId:int = SendScheduler.c_NonStreamId, priority:int = None):
+        if isData:
+            self.SendWithOptCode(buffer, msgStartOffsetBytes, msgSize, octowebsocket.ABNF.OPCODE_BINARY, streamId, priority)
+        else:
+            self.SendWithOptCode(buffer, msgStartOffsetBytes, msgSize, octowebsocket.ABNF.OPCODE_TEXT, streamId, priority)
+
+
+    # Sends a buffer, with an optional message start offset and size.
+    # This can be called from any thread, the buffer is queued and written on the loop.
+    def SendWithOptCode(self, buffer:bytearray, msgStartOffsetBytes:int = None, msgSize:int = None, optCode = octowebsocket.ABNF.OPCODE_BINARY, streamId:int = SendScheduler.c_NonStreamId, priority:int = None):
+        try:
+            # Make sure we have a buffer, this is invalid and it will also shutdown our send loop.
+            if buffer is None:
+                raise Exception("We tired to send a message to the websocket with a None buffer.")
+            self.SendQueue.Put(SendQueueContext(buffer, msgStartOffsetBytes, msgSize, optCode, streamId, priority))
+            # Wake the send loop. If we are already on the loop, we can do it directly.
+            if self.Engine.IsLoopThread():
+                self._WakeSendLoop()
+            else:
+                self.Engine.CallSoon(self._WakeSendLoop)
+        except Exception as e:
+            # If any exception happens during sending, we want to report the error
+            # and shutdown the entire websocket.
+            self.handleWsError(e)
+
+
+    def _WakeSendLoop(self):
+        if self.SendEvent is not None:
+            self.SendEvent.set()
+
+
+    # The main task for the websocket, this connects, runs the receive loop, and then always cleans up.
+    async def _Run(self):
+        # Check that we didn't close before the task started.
+        if self.isClosed:
+            return
+        self.RunTask = asyncio.current_task()
+        self.SendEvent = asyncio.Event()
+        self.DispatchSpaceEvent = asyncio.Event()
+        sendTask = None
+        pingTask = None
+        try:
+            await self._Connect()
+
+            # If we were closed while connecting, we are done.
+            if self.isClosed:
+                return
+
+            # Fire the open callback. This is done on the blocking thread pool, since some callbacks do work like the handshake RSA challenge.
+            # We don't start the receive loop until it's done, so just like the Client, open will always fire before any messages.
+            if self.OnWsOpen:
+                await self.Engine.RunBlocking(self.OnWsOpen, self)
+
+            # Start the send and ping loops and then run the receive loop until the socket closes.
+            self.LastPongTimeSec = time.time()
+            sendTask = asyncio.ensure_future(self._SendLoop())
+            pingTask = asyncio.ensure_future(self._PingLoop())
+            await self._ReceiveLoop()
+        except asyncio.CancelledError:
+            # This is how the socket is closed from our side.
+            pass
+        except Exception as e:
+            self.handleWsError(e)
+        finally:
+            with self.isClosedLock:
+                self.isClosed = True
+            if sendTask is not None:
+                sendTask.cancel()
+            if pingTask is not None:
+                pingTask.cancel()
+            try:
+                if self.Writer is not None:
+                    self.Writer.close()
+            except Exception:
+                pass
+            # Like the Client, always fire the close callback when the socket is done.
+            # When dispatching off the loop, it's queued behind any messages that haven't been fired yet, so it's always last.
+            if self.OnWsClose:
+                self._Dispatch(self.OnWsClose, (self,), 0)
+            # Like the Client, don't return until the callbacks are done, so the close callback has fired when RunUntilClosed returns.
+            if self.DispatchFuture is not None:
+                try:
+                    await self.DispatchFuture
+                except Exception as e:
+                    Sentry.Exception("AsyncClient exception waiting for the callbacks to finish.", e)
+
+
+    async def _Connect(self):
+        # Parse the URL
+        parsedUrl = urllib.parse.urlsplit(self.Url)
+        isSecure = parsedUrl.scheme.lower() in ("wss", "https")
+        host = parsedUrl.hostname
+        if host is None:
+            raise octowebsocket.WebSocketAddressException("Invalid websocket url, no hostname. "+str(self.Url))
+        port = parsedUrl.port
+        if port is None:
+            port = 443 if isSecure else 80
+        resource = parsedUrl.path if len(parsedUrl.path) > 0 else "/"
+        if len(parsedUrl.query) > 0:
+            resource += "?" + parsedUrl.query
+
+        # Like the Client, we use certifi's root CA store for secure connections.
+        sslContext = None
+        if isSecure:
+            sslContext = ssl.create_default_context(cafile=certifi.where())
+
+        self.Reader, self.Writer = await asyncio.wait_for(asyncio.open_connection(host, port, ssl=sslContext, limit=AsyncClient.c_MaxHandshakeResponseSizeBytes), AsyncClient.c_ConnectTimeoutSec)
+        await asyncio.wait_for(self._Handshake(host, port, isSecure, resource), AsyncClient.c_ConnectTimeoutSec)
+
+
+    async def _Handshake(self, host:str, port:int, isSecure:bool, resource:str):
+        # Build the host header, only include the port if it's not the default.
+        hostHeader = f"[{host}]" if ":" in host else host
+        if (isSecure and port != 443) or (isSecure is False and port != 80):
+            hostHeader += f":{port}"
+
+        key = base64.b64encode(os.urandom(16)).decode("utf-8")
+        lines = [
+            f"GET {resource} HTTP/1.1",
+            f"Host: {hostHeader}",
+            "Upgrade: websocket",
+            "Connection: Upgrade",
+            f"Sec-WebSocket-Key: {key}",
+            "Sec-WebSocket-Version: 13",
+        ]
+
+        # Add the custom headers, skipping any that we must control for the handshake.
+        hasOriginHeader = False
+        if self.Headers is not None:
+            for name, value in self.Headers.items():
+                nameLower = name.lower()
+                if nameLower in ("host", "upgrade", "connection", "sec-websocket-key", "sec-websocket-version", "sec-websocket-protocol"):
+                    continue
+                if nameLower == "origin":
+                    hasOriginHeader = True
+                lines.append(f"{name}: {value}")
+        # Like the websocket lib, add an origin header if there isn't one.
+        if hasOriginHeader is False:
+            lines.append(f"Origin: {'https' if isSecure else 'http'}://{hostHeader}")
+        if self.SubProtocolList is not None and len(self.SubProtocolList) > 0:
+            lines.append(f"Sec-WebSocket-Protocol: {','.join(self.SubProtocolList)}")
+        self.Writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("utf-8"))
+        await self.Writer.drain()
+
+        # Read and validate the response.
+        try:
+            response = await self.Reader.readuntil(b"\r\n\r\n")
+        except asyncio.IncompleteReadError as e:
+            raise octowebsocket.WebSocketConnectionClosedException("Connection to remote host was lost.") from e
+        responseLines = response.decode("utf-8", errors="replace").split("\r\n")
+        statusParts = responseLines[0].split(" ", 2)
+        if len(statusParts) < 2 or statusParts[1] != "101":
+            raise octowebsocket.WebSocketException(f"Handshake status {responseLines[0]}")
+        acceptValue = None
+        for line in responseLines[1:]:
+            index = line.find(":")
+            if index != -1 and line[:index].strip().lower() == "sec-websocket-accept":
+                acceptValue = line[index+1:].strip()
+        expectedAccept = base64.b64encode(hashlib.sha1((key + AsyncClient.c_WebsocketAcceptGuid).encode("utf-8")).digest()).decode("utf-8")
+        if acceptValue != expectedAccept:
+            raise octowebsocket.WebSocketException("Invalid websocket handshake accept value.")
+
+
+    async def _ReceiveLoop(self):
+        fragmentList = None
+        fragmentOpcode = None
+        fragmentSizeBytes = 0
+        while True:
+            # If the callbacks are behind, wait for them before reading more.
+            if self.DispatchOffLoop:
+                await self._WaitForDispatchSpace()
+            if self.ReceiveGate is not None and await self.ReceiveGate() is False:
+                self.hasClientRequestedClose = True
+                self._WriteCloseFrame()
+                return
+            isFinal, opcode, payload = await self._ReadFrame()
+            if opcode == octowebsocket.ABNF.OPCODE_TEXT or opcode == octowebsocket.ABNF.OPCODE_BINARY:
+                if isFinal:
+                    self._FireMessage(payload, opcode)
+                else:
+                    fragmentList = [payload]
+                    fragmentOpcode = opcode
+                    fragmentSizeBytes = len(payload)
+            elif opcode == octowebsocket.ABNF.OPCODE_CONT:
+                if fragmentList is None:
+                    raise octowebsocket.WebSocketProtocolException("Got a continuation frame without a starting frame.")
+                fragmentSizeBytes += len(payload)
+                if fragmentSizeBytes > AsyncClient.c_MaxMessageSizeBytes:
+                    self._CloseMessageTooBig(f"Websocket message is larger than the max message size. {fragmentSizeBytes} bytes")
+                fragmentList.append(payload)
+                if isFinal:
+                    data = b"".join(fragmentList)
+                    fragmentList = None
+                    fragmentSizeBytes = 0
+                    self._FireMessage(data, fragmentOpcode)
+            elif opcode == octowebsocket.ABNF.OPCODE_PING:
+                self._WriteFrame(payload, octowebsocket.ABNF.OPCODE_PONG)
+            elif opcode == octowebsocket.ABNF.OPCODE_PONG:
+                self.LastPongTimeSec = time.time()
+            elif opcode == octowebsocket.ABNF.OPCODE_CLOSE:
+                # Respond with a close and we are done.
+                self._WriteCloseFrame()
+                return
+            else:
+                raise octowebsocket.WebSocketProtocolException(f"Got an unknown websocket opcode {opcode}")
+
+
+    def _FireMessage(self, payload:bytes, opcode):
+        # Text also comes as a byte buffer, just like the Client.
+        if self.OnWsMsg:
+            self._Dispatch(self.OnWsMsg, (self, payload), len(payload))
+        if self.OnWsData:
+            self._Dispatch(self.OnWsData, (self, payload, opcode), len(payload))
+
+
+    # Fires the callback, either on the loop or queued for the dispatch thread. This must be called on the loop.
+    def _Dispatch(self, callback, args, sizeBytes:int):
+        if self.DispatchOffLoop is False:
+            start = time.time()
+            self._FireCallback(callback, args)
+            elapsedSec = time.time() - start
+            if elapsedSec > AsyncClient.c_SlowLoopCallbackSec:
+                RelayMetrics.Get().IncrementCounter("AsyncWebsocket.SlowLoopCallbacks")
+                # Only log once per socket, the counter shows how often it happens.
+                if self.HasLoggedSlowLoopCallback is False:
+                    self.HasLoggedSlowLoopCallback = True
+                    self.Engine.Logger.warn(f"AsyncClient callback {getattr(callback, '__qualname__', str(callback))} blocked the loop for {round(elapsedSec, 3)}s. Callbacks on the loop must never block.")
+            return
+        with self.DispatchLock:
+            self.DispatchQueue.append((callback, args, sizeBytes))
+            self.DispatchQueuedBytes += sizeBytes
+            if self.IsDispatchRunning:
+                return
+            self.IsDispatchRunning = True
+        self.DispatchFuture = asyncio.ensure_future(self.Engine.RunBlocking(self._DispatchThread))
+
+
+    # Runs on a blocking thread, firing the queued callbacks in order until the queue is empty.
+    def _DispatchThread(self):
+        while True:
+            with self.DispatchLock:
+                if len(self.DispatchQueue) == 0:
+                    self.IsDispatchRunning = False
+                    return
+                callback, args, sizeBytes = self.DispatchQueue.popleft()
+            self._FireCallback(callback, args)
+            with self.DispatchLock:
+                wasFull = self.DispatchQueuedBytes >= AsyncClient.c_MaxDispatchQueuedBytes
+                self.DispatchQueuedBytes -= sizeBytes
+            # If the receive loop might be waiting for space, wake it.
+            if wasFull:
+                self.Engine.CallSoon(self._SetDispatchSpaceEvent)
+
+
+    def _FireCallback(self, callback, args):
+        try:
+            callback(*args)
+        except Exception as e:
+            Sentry.Exception(f"AsyncClient exception in the {getattr(callback, '__qualname__', str(callback))} callback.", e)
+
+
+    def _SetDispatchSpaceEvent(self):
+        if self.DispatchSpaceEvent is not None:
+            self.DispatchSpaceEvent.set()
+
+
+    async def _WaitForDispatchSpace(self):
+        # The event is only set from the loop, after the dispatch thread frees space, so there's no race in clearing it here.
+        while self.DispatchQueuedBytes >= AsyncClient.c_MaxDispatchQueuedBytes:
+            self.DispatchSpaceEvent.clear()
+            await self.DispatchSpaceEvent.wait()
+
+
+    # Sends the message too big close frame and raises, which ends the receive loop.
+    def _CloseMessageTooBig(self, msg:str):
+        RelayMetrics.Get().IncrementCounter("AsyncWebsocket.MessageTooBig")
+        try:
+            self._WriteCloseFrame(octowebsocket.STATUS_MESSAGE_TOO_BIG)
+        except Exception:
+            pass
+        raise octowebsocket.WebSocketPayloadException(msg)
+
+
+    async def _ReadFrame(self):
+        try:
+            header = await self.Reader.readexactly(2)
+            isFinal = (header[0] & 0x80) != 0
+            opcode = header[0] & 0x0F
+            isMasked = (header[1] & 0x80) != 0
+            length = header[1] & 0x7F
+            if length == 126:
+                length = struct.unpack("!H", await self.Reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack("!Q", await self.Reader.readexactly(8))[0]
+            # Check the length before we read the payload, so we never allocate for it.
+            if length > AsyncClient.c_MaxFrameSizeBytes:
+                self._CloseMessageTooBig(f"Websocket frame is larger than the max frame size. {length} bytes")
+            mask = None
+            if isMasked:
+                mask = await self.Reader.readexactly(4)
+            payload = b""
+            if length > 0:
+                payload = await self.Reader.readexactly(length)
+            # Servers shouldn't mask frames, but handle it if they do.
+            if mask is not None and length > 0:
+                fullMask = (mask * (length // 4 + 1))[:length]
+                payload = (int.from_bytes(payload, "little") ^ int.from_bytes(fullMask, "little")).to_bytes(length, "little")
+            return isFinal, opcode, payload
+        except asyncio.IncompleteReadError as e:
+            raise octowebsocket.WebSocketConnectionClosedException("Connection to remote host was lost.") from e
+
+
+    # Writes a frame to the socket, this must be called on the loop.
+    def _WriteFrame(self, buffer, opcode, msgStartOffsetBytes:int = None, msgSize:int = None):
+        if msgStartOffsetBytes is None:
+            msgStartOffsetBytes = 0
+        if msgSize is None:
+            msgSize = len(buffer) - msgStartOffsetBytes
+        # Important! Like the Client, we don't use the frame mask because it adds about 30% CPU usage on low end devices.
+        # Our server, OctoPrint, and Moonraker all accept unmasked frames, so its safe to do this for all WS.
+        self.Writer.write(self._BuildFrameHeader(opcode, msgSize))
+        if msgSize > 0:
+            self.Writer.write(memoryview(buffer)[msgStartOffsetBytes:msgStartOffsetBytes+msgSize])
+
+
+    # Writes the context and anything else that's queued as back to back frames with one transport write.
+    # For plain sockets, the transport can send the list as one scatter write, for TLS it's written as one buffer.
+    def _WriteCoalesced(self, context):
+        chunks = []
+        frames = 0
+        sizeBytes = 0
+        while context is not None:
+            # Only ever send one close frame, the receive loop will end when the other side responds.
+            if context.OptCode == octowebsocket.ABNF.OPCODE_CLOSE:
+                if self.HasSentCloseFrame:
+                    context = self.SendQueue.TryGet()
+                    continue
+                self.HasSentCloseFrame = True
+            msgStartOffsetBytes = context.MsgStartOffsetBytes if context.MsgStartOffsetBytes is not None else 0
+            msgSize = context.GetSendSizeBytes()
+            chunks.append(self._BuildFrameHeader(context.OptCode, msgSize))
+            if msgSize > 0:
+                chunks.append(memoryview(context.Buffer)[msgStartOffsetBytes:msgStartOffsetBytes+msgSize])
+            frames += 1
+            sizeBytes += msgSize
+            # Stop gathering once the write is large, so the drain applies backpressure.
+            if sizeBytes >= Client.c_CoalesceMaxWriteBytes:
+                break
+            context = self.SendQueue.TryGet()
+        if frames == 0:
+            return
+        self.Writer.writelines(chunks)
+        self.WriteStats.OnWrite(frames, sizeBytes)
+
+
+    def _BuildFrameHeader(self, opcode, msgSize:int) -> bytes:
+        firstByte = 0x80 | opcode
+        if msgSize < 126:
+            return struct.pack("!BB", firstByte, msgSize)
+        if msgSize < 65536:
+            return struct.pack("!BBH", firstByte, 126, msgSize)
+        return struct.pack("!BBQ", firstByte, 127, msgSize)
+
+
+    def _WriteCloseFrame(self, status:int = octowebsocket.STATUS_NORMAL):
+        if self.HasSentCloseFrame:
+            return
+        self.HasSentCloseFrame = True
+        self._WriteFrame(struct.pack("!H", status), octowebsocket.ABNF.OPCODE_CLOSE)
+
+
+    async def _SendLoop(self):
+        try:
+            while True:
+                # Wait on something to send.
+                # Anything added to the queue will set the event after it's added, so there's no race in clearing it here.
+                context = self.SendQueue.TryGet()
+                if context is None:
+                    if self.isClosed:
+                        return
+                    self.SendEvent.clear()
+                    await self.SendEvent.wait()
+                    continue
+                if self.CoalesceWrites:
+                    self._WriteCoalesced(context)
+                    await self.Writer.drain()
+                    continue
+                # Only ever send one close frame, the receive loop will end when the other side responds.
+                if context.OptCode == octowebsocket.ABNF.OPCODE_CLOSE:
+                    if self.HasSentCloseFrame:
+                        continue
+                    self.HasSentCloseFrame = True
+                self._WriteFrame(context.Buffer, context.OptCode, context.MsgStartOffsetBytes, context.MsgSize)
+                self.WriteStats.OnWrite(1, context.GetSendSizeBytes())
+                await self.Writer.drain()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # If any exception happens during sending, we want to report the error
+            # and shutdown the entire websocket.
+            self.handleWsError(e)
+            self._CloseOnLoop()
+
+
+    async def _PingLoop(self):
+        try:
+            while True:
+                await asyncio.sleep(AsyncClient.c_PingIntervalSec)
+                pingSentSec = time.time()
+                self._WriteFrame(b"", octowebsocket.ABNF.OPCODE_PING)
+                await asyncio.sleep(AsyncClient.c_PongTimeoutSec)
+                if self.LastPongTimeSec < pingSentSec:
+                    self.handleWsError(octowebsocket.WebSocketTimeoutException("ping/pong timed out"))
+                    self._CloseOnLoop()
+                    return
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            self.handleWsError(e)
+            self._CloseOnLoop()
+
+
+    # Returns the frames per write stats. The asyncio transport does the syscalls, so there are no per syscall stats.
+    def GetSendWriteStats(self) -> dict:
+        return self.WriteStats.GetStats()
+
+
+    # Returns the per priority class send queue stats.
+    def GetSendQueueStats(self) -> dict:
+        return self.SendQueue.GetStats()
+
+
+    # Blocks until the stream is within the send queue byte budget, see SendScheduler.WaitForBudget.
+    # This must not be called from the asyncio relay engine loop thread, since it blocks.
+    def WaitForSendBudget(self, streamId:int, timeoutSec:float) -> bool:
+        return self.SendQueue.WaitForBudget(streamId, timeoutSec)
+
+
+    # Waits without blocking until the stream is within the send queue byte budget, see SendScheduler.WaitForBudgetAsync.
+    # This is used by producers that run on the asyncio relay engine loop.
+    async def WaitForSendBudgetAsync(self, streamId:int, timeoutSec:float) -> bool:
+        return await self.SendQueue.WaitForBudgetAsync(streamId, timeoutSec)
+
+
+    # Returns the send queue byte budget stats.
+    def GetSendBudgetStats(self) -> dict:
+        return self.SendQueue.GetBudgetStats()
+
+
+    # Returns the bytes queued for the stream and the age of it's oldest queued message, see SendScheduler.GetStreamQueueState.
+    def GetStreamSendQueueState(self, streamId:int):
+        return self.SendQueue.GetStreamQueueState(streamId)
+
+
+    # Support using with:
+    def __enter__(self):
+        return self
+
+
+    # Support using with;
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.Close()
+
+
+    # A helper for dealing with common websocket connection exceptions.
+    @staticmethod
+    def IsCommonConnectionException(e:Exception):
+        if isinstance(e, (asyncio.TimeoutError, asyncio.IncompleteReadError)):
+            return True
+        return Client.IsCommonConnectionException(e)
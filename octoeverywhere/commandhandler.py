@@ -6,6 +6,7 @@ from .octohttprequest import PathTypes
 from .Webcam.webcamhelper import WebcamHelper
 from .Webcam.webcamsettingitem import WebcamSettingItem
 from .sentry import Sentry
+from .relaymetrics import RelayMetrics
 
 #
 # Platform Command Handler Interface
@@ -316,6 +317,23 @@ class CommandHandler:
             return CommandResponse.Error(400, "Failed to process rekey command.")
 
 
+    # Must return a CommandResponse
+    # Returns the relay metrics. If the optional "Reset" arg is true, the metrics are cleared after they are read.
+    def GetMetrics(self, jsonObjData_CanBeNone):
+        reset = False
+        if jsonObjData_CanBeNone is not None:
+            try:
+                reset = jsonObjData_CanBeNone.get("Reset", False) is True
+            except Exception as e:
+                Sentry.Exception("Failed to GetMetrics, bad args.", e)
+                return CommandResponse.Error(400, "Failed to parse args")
+        metrics = RelayMetrics.Get()
+        responseObj = metrics.GetSnapshot()
+        if reset:
+            metrics.Reset()
+        return CommandResponse.Success(responseObj)
+
+
     #
     # Common Handler Core Logic
     #
@@ -422,6 +440,8 @@ class CommandHandler:
             return self.Cancel()
         elif commandPathLower.startswith("rekey"):
             return self.Rekey()
+        elif commandPathLower.startswith("metrics"):
+            return self.GetMetrics(jsonObj_CanBeNone)
         return CommandResponse.Error(CommandHandler.c_CommandError_UnknownCommand, "The command path didn't match any known commands.")
 
 
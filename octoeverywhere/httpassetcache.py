@@ -0,0 +1,514 @@
+import re
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from requests.structures import CaseInsensitiveDict
+
+from .sentry import Sentry
+from .relaymetrics import RelayMetrics
+from .httpassetdiskstore import HttpAssetDiskStore
+from .octohttprequest import OctoHttpRequest
+from .compression import Compression, CompressionContext
+from .Proto.PathTypes import PathTypes
+from .Proto.DataCompression import DataCompression
+from .WebStream.octoheaderimpl import HeaderHelper, BaseProtocol
+
+#
+# A platform agnostic in memory cache for static web assets, like the js, css, and fonts the web frontends load.
+#
+# Slipstream does this for OctoPrint's index and packed files, but the other frontends (Mainsail, Fluidd, Creality, etc) get no caching.
+# Their assets are usually hashed file names that never change, or at least have an ETag, so once we have them, we can serve them
+# right from memory without making the local http call or compressing the body again.
+#
+# Entries are stored pre-compressed, in the same format the relay would send them, and the cache is bounded by the total stored bytes.
+# When it's full, the least recently used entries are removed first.
+#
+# Entries that aren't known to be immutable are revalidated in the background with a conditional request after they are fresh for a bit,
+# while the cached copy is still served. If they go too long without being revalidated, they are dropped and the next request fills them again.
+#
+# If the host inits the HttpAssetDiskStore, entries are also written to it, so they can be served right away after a restart.
+#
+# The cache is optional, it's only setup if the host's relay options give it a size. When it's not setup, every request goes to the local server.
+#
+class HttpAssetCache:
+
+    # The max size of the (compressed) bodies we will keep in memory, in MB. 0 means the cache is disabled.
+    c_DefaultMaxMemoryMb = 0
+    c_MinMaxMemoryMb = 0
+    c_MaxMaxMemoryMb = 256
+
+    # The max body size of a single entry, before compression.
+    c_MaxEntrySizeBytes = 4 * 1024 * 1024
+
+    # How long an entry is served without being revalidated.
+    c_FreshSec = 30.0
+    # How long an immutable entry is served without being revalidated.
+    c_ImmutableFreshSec = 6 * 60.0 * 60.0
+    # After it's no longer fresh, how long an entry can be served while it's being revalidated. After this, it's dropped.
+    c_MaxStaleSec = 10 * 60.0
+
+    # If a response has a max-age of at least this, it's treated as immutable.
+    c_ImmutableMinMaxAgeSec = 7 * 24 * 60 * 60
+
+    # Only paths with these extensions are considered. These are the static assets the frontends load, we don't want to cache
+    # api calls, index pages, or any printer files.
+    c_CacheableExtensions = (".js", ".mjs", ".css", ".woff", ".woff2", ".ttf", ".otf", ".eot", ".svg", ".png", ".jpg", ".jpeg", ".gif", ".webp", ".ico", ".map", ".wasm")
+
+    # Paths that are never cached, even if they have a cacheable extension.
+    # These are file and thumbnail download paths, which can be protected or change without the file name changing.
+    c_ExcludedPathPrefixes = ("/downloads/", "/server/files/", "/api/", "/access/", "/printer/", "/machine/", "/webcam")
+
+    # Request headers that mean the response is for a specific user or a partial body.
+    c_NonCacheableRequestHeadersLower = ("authorization", "x-api-key", "range")
+
+    # Matches the hashed file names most bundlers generate, like "index-CqP8s2kB.js" or "app.3f9a1b2c.css".
+    # Those files never change, since any change makes a new name.
+    c_HashedFileNameRegex = re.compile(r"[.\-_](?=[A-Za-z]*[0-9])[A-Za-z0-9]{8,}\.[a-z0-9]+$")
+
+    # The header we add to cached responses, like Slipstream does.
+    c_CacheHeaderName = "x-oe-asset-cache"
+
+    _Instance = None
+
+
+    # If the max size is 0, the cache is disabled and nothing is cached.
+    @staticmethod
+    def Init(logger:logging.Logger, maxMemoryBytes:int):
+        if maxMemoryBytes <= 0:
+            HttpAssetCache._Instance = None
+            return
+        HttpAssetCache._Instance = HttpAssetCache(logger, maxMemoryBytes)
+
+
+    # Note this will be None if the host didn't init it or it's disabled, in which case nothing is cached.
+    @staticmethod
+    def Get():
+        return HttpAssetCache._Instance
+
+
+    def __init__(self, logger:logging.Logger, maxMemoryBytes:int):
+        self.Logger = logger
+        self.MaxMemoryBytes = maxMemoryBytes
+        self.Lock = threading.Lock()
+        # Ordered from least to most recently used.
+        self.Entries = OrderedDict()
+        self.TotalBytes = 0
+        self.RevalidatingKeys = set()
+
+        # Stats
+        self.Hits = 0
+        self.Misses = 0
+        self.Stores = 0
+        self.Evictions = 0
+        self.Expirations = 0
+        self.DiskLoads = 0
+        self.Revalidations = 0
+        self.RevalidationsNotModified = 0
+        self.RevalidationsChanged = 0
+        self.RevalidationsFailed = 0
+
+        RelayMetrics.Get().RegisterStatsProvider("HttpAssetCache", self.GetStats)
+
+
+    # Returns the cache key for the request, or None if the request can't be cached.
+    # This only looks at the request, the response decides if it's actually stored.
+    def GetCacheKey(self, path:str, pathType:int, method:str, headers:dict) -> str:
+        if path is None or pathType != PathTypes.Relative or method is None or method.upper() != "GET":
+            return None
+        # Remove any anchors, they are never sent to the server anyways.
+        posOfHashtag = path.find('#')
+        if posOfHashtag != -1:
+            path = path[:posOfHashtag]
+        # Only the path part decides if it's an asset, but the query string is part of the key, since it's commonly used as a version.
+        posOfQuestionMark = path.find('?')
+        pathOnlyLower = (path if posOfQuestionMark == -1 else path[:posOfQuestionMark]).lower()
+        if pathOnlyLower.endswith(HttpAssetCache.c_CacheableExtensions) is False:
+            return None
+        if pathOnlyLower.startswith(HttpAssetCache.c_ExcludedPathPrefixes):
+            return None
+        for key in headers:
+            if key.lower() in HttpAssetCache.c_NonCacheableRequestHeadersLower:
+                return None
+        return path
+
+
+    # If there's a valid entry for the key, this returns a new ready to go OctoHttpResult for it. Otherwise returns None.
+    # Each call returns a new result object, so the caller is free to update it, like converting it to a 304.
+    def GetCachedResult(self, key:str) -> OctoHttpRequest.Result:
+        nowSec = time.time()
+        with self.Lock:
+            entry = self.Entries.get(key, None)
+            if entry is not None:
+                if nowSec - entry.ValidatedSec > entry.FreshSec + HttpAssetCache.c_MaxStaleSec:
+                    # It's been too long since the entry was validated, drop it so the request fills it again.
+                    self._RemoveEntry(key)
+                    self.Expirations += 1
+                    entry = None
+                else:
+                    self.Entries.move_to_end(key)
+        # If it's not in memory, it might be in the disk store from before we restarted.
+        if entry is None:
+            entry = self._LoadFromDiskStore(key, nowSec)
+        with self.Lock:
+            if entry is None:
+                self.Misses += 1
+            else:
+                self.Hits += 1
+        if entry is None:
+            RelayMetrics.Get().IncrementCounter("Cache.Asset.Misses")
+            return None
+        RelayMetrics.Get().IncrementCounter("Cache.Asset.Hits")
+        if nowSec - entry.ValidatedSec > entry.FreshSec:
+            self._StartRevalidation(key, entry)
+        return entry.CreateResult()
+
+
+    # If the disk store has an entry that's still valid enough to be served, it's added to memory and returned.
+    def _LoadFromDiskStore(self, key:str, nowSec:float):
+        store = HttpAssetDiskStore.Get()
+        if store is None:
+            return None
+        diskEntry = store.GetEntry(key)
+        if diskEntry is None:
+            return None
+        # Like the memory entries, if it's been too long since it was validated, it's not served. But we leave it on disk, since
+        # if the validator still matches when the cache is filled, the stored body will be used.
+        if nowSec - diskEntry.ValidatedSec > diskEntry.FreshSec + HttpAssetCache.c_MaxStaleSec:
+            return None
+        entry = HttpAssetCacheEntry.FromDiskEntry(diskEntry)
+        self._AddEntry(key, entry, False)
+        with self.Lock:
+            self.DiskLoads += 1
+        return entry
+
+
+    # Returns a copy of the request headers that should be used when making the http call to fill the cache.
+    # The conditional headers are removed, so we get the full body back rather than a 304. If the client's
+    # copy is still valid, the cached result will be converted to a 304 for them.
+    def GetFillRequestHeaders(self, headers:dict) -> dict:
+        fillHeaders = {}
+        for key, value in headers.items():
+            keyLower = key.lower()
+            if keyLower == "if-none-match" or keyLower == "if-modified-since":
+                continue
+            fillHeaders[key] = value
+        return fillHeaders
+
+
+    # Given the result of a request for a cache key, this will try to store it.
+    # If the result is stored, the body is fully read and the original result is closed, and a new result for the cache entry is returned.
+    # If not, the original result is returned as is.
+    # Note this blocks to read the body, so it must not be called on the asyncio loop.
+    def TryStore(self, key:str, octoHttpResult:OctoHttpRequest.Result, shouldCompress:bool) -> OctoHttpRequest.Result:
+        if key is None or octoHttpResult is None:
+            return octoHttpResult
+        try:
+            freshSec = self._GetFreshSecIfCacheable(key, octoHttpResult)
+            if freshSec is None:
+                return octoHttpResult
+            # If the disk store has the body for this validator, we can use it and skip the body read and compression.
+            entry = self._GetMatchingDiskEntry(key, octoHttpResult, freshSec)
+            if entry is None:
+                entry = self._CreateEntry(key, octoHttpResult, shouldCompress, freshSec)
+                if entry is None:
+                    return octoHttpResult
+                self._PersistEntry(key, entry)
+            self._AddEntry(key, entry, True)
+            HttpAssetCache._CloseResult(octoHttpResult)
+            return entry.CreateResult()
+        except Exception as e:
+            Sentry.Exception("HttpAssetCache failed to store a result.", e)
+        return octoHttpResult
+
+
+    # If the disk store has the body for the response's validator, this returns a new entry for it, otherwise None.
+    def _GetMatchingDiskEntry(self, key:str, octoHttpResult:OctoHttpRequest.Result, freshSec:float):
+        store = HttpAssetDiskStore.Get()
+        if store is None:
+            return None
+        validator = HttpAssetDiskStore.GetValidator(octoHttpResult.Headers)
+        if validator is None:
+            return None
+        diskEntry = store.GetEntry(key, validator)
+        if diskEntry is None or str(diskEntry.OriginalSize) != octoHttpResult.Headers.get("content-length", None):
+            return None
+        # The response validated the stored body, so update it.
+        nowSec = time.time()
+        store.SetValidated(key, nowSec)
+        entry = HttpAssetCacheEntry.FromDiskEntry(diskEntry)
+        entry.FreshSec = freshSec
+        entry.ValidatedSec = nowSec
+        with self.Lock:
+            self.DiskLoads += 1
+        return entry
+
+
+    # Writes the entry to the disk store, if there is one. On success, the entry's body is swapped to the memory mapped one.
+    def _PersistEntry(self, key:str, entry) -> None:
+        store = HttpAssetDiskStore.Get()
+        if store is None:
+            return
+        mappedBuffer = store.Put(key, entry.Url, entry.Headers, entry.Buffer, entry.CompressionType, entry.OriginalSize, entry.FreshSec, entry.ValidatedSec)
+        if mappedBuffer is not None:
+            entry.Buffer = mappedBuffer
+
+
+    # Returns how long the response can be served without revalidation, or None if it can't be cached.
+    def _GetFreshSecIfCacheable(self, key:str, octoHttpResult:OctoHttpRequest.Result) -> float:
+        if octoHttpResult.StatusCode != 200 or octoHttpResult.GetCustomBodyStreamCallback is not None:
+            return None
+        # If the body was already read and compressed, it's not a normal response.
+        if octoHttpResult.BodyBufferCompressionType != DataCompression.None_:
+            return None
+        headers = octoHttpResult.Headers
+        contentLength = None
+        hasValidator = False
+        cacheControlLower = ""
+        for name, value in headers.items():
+            nameLower = name.lower()
+            if nameLower == "content-length":
+                try:
+                    contentLength = int(value)
+                except Exception:
+                    return None
+            elif nameLower == "set-cookie":
+                # Never cache anything that sets a session.
+                return None
+            elif nameLower == "vary":
+                # We only cache one version of each path, and we always request identity encoding.
+                if value.strip().lower() not in ("accept-encoding", ""):
+                    return None
+            elif nameLower == "cache-control":
+                cacheControlLower = value.lower()
+            elif nameLower == "etag" or nameLower == "last-modified":
+                hasValidator = True
+            elif nameLower == "content-type":
+                if value.lower().startswith("multipart"):
+                    return None
+        if contentLength is None or contentLength <= 0 or contentLength > HttpAssetCache.c_MaxEntrySizeBytes:
+            return None
+        if "no-store" in cacheControlLower or "private" in cacheControlLower:
+            return None
+
+        # Figure out if this asset is immutable.
+        isImmutable = "immutable" in cacheControlLower
+        if isImmutable is False and "no-cache" not in cacheControlLower:
+            maxAge = HttpAssetCache._GetMaxAgeSec(cacheControlLower)
+            if maxAge is not None and maxAge >= HttpAssetCache.c_ImmutableMinMaxAgeSec:
+                isImmutable = True
+        if isImmutable is False and "no-cache" not in cacheControlLower:
+            posOfQuestionMark = key.find('?')
+            pathOnly = key if posOfQuestionMark == -1 else key[:posOfQuestionMark]
+            if HttpAssetCache.c_HashedFileNameRegex.search(pathOnly[pathOnly.rfind('/') + 1:]) is not None:
+                isImmutable = True
+        if isImmutable:
+            return HttpAssetCache.c_ImmutableFreshSec
+        # If it's not immutable, we need a validator so we can revalidate it.
+        if hasValidator is False:
+            return None
+        return HttpAssetCache.c_FreshSec
+
+
+    # Returns the max-age value of the cache control header, or None if there isn't one.
+    @staticmethod
+    def _GetMaxAgeSec(cacheControlLower:str) -> int:
+        for part in cacheControlLower.split(","):
+            part = part.strip()
+            if part.startswith("max-age="):
+                try:
+                    return int(part[len("max-age="):].strip())
+                except Exception:
+                    return None
+        return None
+
+
+    # Reads the body and compresses it into a new entry. Returns None on failure.
+    def _CreateEntry(self, key:str, octoHttpResult:OctoHttpRequest.Result, shouldCompress:bool, freshSec:float):
+        buffer = octoHttpResult.FullBodyBuffer
+        if buffer is None:
+            octoHttpResult.ReadAllContentFromStreamResponse(self.Logger)
+            buffer = octoHttpResult.FullBodyBuffer
+        contentLength = int(octoHttpResult.Headers.get("content-length", -1))
+        if buffer is None or len(buffer) != contentLength:
+            self.Logger.warn(f"HttpAssetCache read a body of different size then the content length, it won't be cached. {key}")
+            return None
+
+        # Compress the body now, so it's ready to send on every hit.
+        ogSize = len(buffer)
+        compressionType = DataCompression.None_
+        if shouldCompress and ogSize >= Compression.MinSizeToCompress:
+            with CompressionContext(self.Logger) as compressionContext:
+                compressionContext.SetTotalCompressedSizeOfData(ogSize)
+                compressResult = Compression.Get().Compress(compressionContext, buffer)
+                buffer = compressResult.Bytes
+                compressionType = compressResult.CompressionType
+        buffer = bytes(buffer)
+
+        # Copy the headers, so the entry isn't effected by any changes to the result.
+        headers = CaseInsensitiveDict(octoHttpResult.Headers)
+        headers[HttpAssetCache.c_CacheHeaderName] = "1"
+        return HttpAssetCacheEntry(octoHttpResult.Url, headers, buffer, compressionType, ogSize, shouldCompress, freshSec)
+
+
+    def _AddEntry(self, key:str, entry, isNewStore:bool) -> None:
+        with self.Lock:
+            self._RemoveEntry(key)
+            self.Entries[key] = entry
+            self.TotalBytes += len(entry.Buffer)
+            if isNewStore:
+                self.Stores += 1
+            # Remove the least recently used entries until we are under the limit.
+            while self.TotalBytes > self.MaxMemoryBytes and len(self.Entries) > 0:
+                oldestKey = next(iter(self.Entries))
+                self._RemoveEntry(oldestKey)
+                self.Evictions += 1
+        if self.Logger.isEnabledFor(logging.DEBUG):
+            self.Logger.debug(f"HttpAssetCache stored [{entry.OriginalSize}->{len(entry.Buffer)}] fresh for {entry.FreshSec}s {key}")
+
+
+    # Must be called under the lock.
+    def _RemoveEntry(self, key:str) -> None:
+        entry = self.Entries.pop(key, None)
+        if entry is not None:
+            self.TotalBytes -= len(entry.Buffer)
+
+
+    # Starts a thread to revalidate the entry, if one isn't already running for the key.
+    def _StartRevalidation(self, key:str, entry) -> None:
+        with self.Lock:
+            if key in self.RevalidatingKeys:
+                return
+            self.RevalidatingKeys.add(key)
+        try:
+            th = threading.Thread(target=self._RevalidationThread, args=(key, entry))
+            th.daemon = True
+            th.start()
+        except Exception as e:
+            with self.Lock:
+                self.RevalidatingKeys.discard(key)
+            Sentry.Exception("HttpAssetCache failed to start revalidation thread.", e)
+
+
+    def _RevalidationThread(self, key:str, entry) -> None:
+        octoHttpResult = None
+        try:
+            with self.Lock:
+                self.Revalidations += 1
+
+            # Make a conditional request with the validators we have.
+            # Like Slipstream, the headers don't include the x-forwarded-for-host, but static assets don't depend on it.
+            headers = HeaderHelper.GatherRequestHeaders(self.Logger, None, BaseProtocol.Http)
+            etag = entry.Headers.get("etag", None)
+            if etag is not None:
+                headers["If-None-Match"] = etag
+            lastModified = entry.Headers.get("last-modified", None)
+            if lastModified is not None:
+                headers["If-Modified-Since"] = lastModified
+            octoHttpResult = OctoHttpRequest.MakeHttpCall(self.Logger, key, PathTypes.Relative, "GET", headers)
+
+            if octoHttpResult is not None and octoHttpResult.StatusCode == 304:
+                # It's still valid.
+                nowSec = time.time()
+                with self.Lock:
+                    self.RevalidationsNotModified += 1
+                    if self.Entries.get(key, None) is entry:
+                        entry.ValidatedSec = nowSec
+                store = HttpAssetDiskStore.Get()
+                if store is not None:
+                    store.SetValidated(key, nowSec)
+                return
+
+            # If we got a new version, try to replace the entry with it.
+            if octoHttpResult is not None and octoHttpResult.StatusCode == 200:
+                freshSec = self._GetFreshSecIfCacheable(key, octoHttpResult)
+                if freshSec is not None:
+                    newEntry = self._CreateEntry(key, octoHttpResult, entry.ShouldCompress, freshSec)
+                    if newEntry is not None:
+                        self._PersistEntry(key, newEntry)
+                        self._AddEntry(key, newEntry, True)
+                        with self.Lock:
+                            self.RevalidationsChanged += 1
+                        return
+
+            # Otherwise, the asset is gone or isn't cacheable anymore, so remove it.
+            statusCode = "None" if octoHttpResult is None else str(octoHttpResult.StatusCode)
+            self.Logger.info(f"HttpAssetCache revalidation failed with status {statusCode}, removing {key}")
+            with self.Lock:
+                self.RevalidationsFailed += 1
+                if self.Entries.get(key, None) is entry:
+                    self._RemoveEntry(key)
+            store = HttpAssetDiskStore.Get()
+            if store is not None:
+                store.Remove(key)
+        except Exception as e:
+            Sentry.Exception("HttpAssetCache revalidation failed.", e)
+            with self.Lock:
+                self.RevalidationsFailed += 1
+                if self.Entries.get(key, None) is entry:
+                    self._RemoveEntry(key)
+        finally:
+            if octoHttpResult is not None:
+                HttpAssetCache._CloseResult(octoHttpResult)
+            with self.Lock:
+                self.RevalidatingKeys.discard(key)
+
+
+    # The body has been fully read at this point, so this just releases the response.
+    @staticmethod
+    def _CloseResult(octoHttpResult:OctoHttpRequest.Result) -> None:
+        # The result supports the with keyword to close any response object it has.
+        with octoHttpResult:
+            pass
+
+
+    def GetStats(self) -> dict:
+        with self.Lock:
+            lookups = self.Hits + self.Misses
+            return {
+                "Entries": len(self.Entries),
+                "Bytes": self.TotalBytes,
+                "MaxBytes": self.MaxMemoryBytes,
+                "Hits": self.Hits,
+                "Misses": self.Misses,
+                "HitRatePercent": round((self.Hits / lookups) * 100.0, 1) if lookups > 0 else 0.0,
+                "Stores": self.Stores,
+                "Evictions": self.Evictions,
+                "Expirations": self.Expirations,
+                "DiskLoads": self.DiskLoads,
+                "Revalidations": self.Revalidations,
+                "RevalidationsNotModified": self.RevalidationsNotModified,
+                "RevalidationsChanged": self.RevalidationsChanged,
+                "RevalidationsFailed": self.RevalidationsFailed,
+            }
+
+
+# A cached response. The buffer and headers are never changed once the entry is created.
+class HttpAssetCacheEntry:
+
+    def __init__(self, url:str, headers, buffer:bytes, compressionType, originalSize:int, shouldCompress:bool, freshSec:float):
+        self.Url = url
+        self.Headers = headers
+        self.Buffer = buffer
+        self.CompressionType = compressionType
+        self.OriginalSize = originalSize
+        self.ShouldCompress = shouldCompress
+        self.FreshSec = freshSec
+        self.ValidatedSec = time.time()
+
+
+    # Creates a memory entry for an entry from the disk store, which uses the memory mapped body.
+    @staticmethod
+    def FromDiskEntry(diskEntry):
+        entry = HttpAssetCacheEntry(diskEntry.Url, CaseInsensitiveDict(diskEntry.Headers), diskEntry.Buffer, diskEntry.CompressionType, diskEntry.OriginalSize,
+                                    diskEntry.CompressionType != DataCompression.None_, diskEntry.FreshSec)
+        entry.ValidatedSec = diskEntry.ValidatedSec
+        return entry
+
+
+    # Returns a new result for this entry, that shares the body buffer.
+    def CreateResult(self) -> OctoHttpRequest.Result:
+        result = OctoHttpRequest.Result(200, self.Headers.copy(), self.Url, False)
+        result.SetFullBodyBuffer(self.Buffer, self.CompressionType, self.OriginalSize)
+        return result
@@ -0,0 +1,411 @@
+import os
+import json
+import mmap
+import time
+import zlib
+import hashlib
+import logging
+import threading
+
+from .sentry import Sentry
+from .relaymetrics import RelayMetrics
+from .zstandarddictionary import ZStandardDictionary
+from .Proto.DataCompression import DataCompression
+
+#
+# A persistent, content addressed store for pre-compressed http bodies, so the caches don't start cold after a restart.
+#
+# Each body is stored already compressed in the format the relay sends, in a file named by the sha256 of the data, so the same body
+# stored for different keys only exists once. An index file maps each key (the url) to its blob, the validator (ETag or Last-Modified)
+# the body is for, the response headers, and when it was last validated.
+#
+# Reads are memory mapped, so the body buffers handed out are backed by the page cache and large bundles are never copied into the
+# python heap. The first time a blob is read after startup, its hash is checked, so a corrupt or partially written file is never sent.
+#
+# The store is bounded by the total blob size, and the least recently used entries are removed first.
+# The store is optional, it's only setup if the host's relay options give it a size.
+#
+class HttpAssetDiskStore:
+
+    # The max size of all of the stored bodies, in MB. 0 means the store is disabled.
+    c_DefaultMaxSizeMb = 0
+    c_MinMaxSizeMb = 0
+    c_MaxMaxSizeMb = 1024
+
+    # Bump this if the index or blob format changes, old stores will be cleared.
+    c_FormatVersion = 1
+
+    c_StoreFolderName = "HttpAssetStore"
+    c_IndexFileName = "index.json"
+    c_BlobExtension = ".bin"
+
+    # How often the index is written when only the last used times have changed.
+    c_LazyIndexSaveIntervalSec = 5 * 60.0
+
+    # How long after a change the index is written, so a burst of changes only writes it once.
+    c_IndexSaveDelaySec = 5.0
+
+    _Instance = None
+
+
+    # If the max size is 0, the store is disabled and nothing is persisted.
+    @staticmethod
+    def Init(logger:logging.Logger, localStorageDir:str, maxSizeBytes:int):
+        if maxSizeBytes <= 0:
+            HttpAssetDiskStore._Instance = None
+            return
+        HttpAssetDiskStore._Instance = HttpAssetDiskStore(logger, localStorageDir, maxSizeBytes)
+
+
+    # Note this will be None if the host didn't init it or it's disabled, in which case nothing is persisted.
+    @staticmethod
+    def Get():
+        return HttpAssetDiskStore._Instance
+
+
+    def __init__(self, logger:logging.Logger, localStorageDir:str, maxSizeBytes:int):
+        self.Logger = logger
+        self.MaxSizeBytes = maxSizeBytes
+        self.Lock = threading.Lock()
+        self.SaveLock = threading.Lock()
+        self.StoreDir = os.path.join(localStorageDir, HttpAssetDiskStore.c_StoreFolderName)
+        self.IndexFilePath = os.path.join(self.StoreDir, HttpAssetDiskStore.c_IndexFileName)
+        self.Entries = {}
+        # The total size of all of the unique blobs.
+        self.TotalBytes = 0
+        # The blobs that have passed the integrity check since we started.
+        self.VerifiedBlobs = set()
+        self.IsIndexDirty = False
+        self.IsIndexSaveScheduled = False
+        self.LastIndexSaveSec = time.time()
+
+        # The compressed bodies are only valid for the compression dictionary they were made with, so it's part of the store format.
+        self.FormatId = f"{HttpAssetDiskStore.c_FormatVersion}-{zlib.crc32(ZStandardDictionary.c_Dict1.encode('utf-8'))}"
+
+        # Stats
+        self.Hits = 0
+        self.Misses = 0
+        self.Stores = 0
+        self.Evictions = 0
+        self.IntegrityFailures = 0
+
+        try:
+            os.makedirs(self.StoreDir, exist_ok=True)
+            self._LoadIndex()
+        except Exception as e:
+            Sentry.Exception("HttpAssetDiskStore failed to load, it will be cleared.", e)
+            self._Clear()
+
+        RelayMetrics.Get().RegisterStatsProvider("HttpAssetDiskStore", self.GetStats)
+
+
+    # Returns the entry for the key, or None if there isn't a valid one.
+    # If the validator is given, the entry must be for the same validator.
+    def GetEntry(self, key:str, validator:str = None):
+        with self.Lock:
+            info = self.Entries.get(key, None)
+            if info is None or (validator is not None and info["Validator"] != validator):
+                self.Misses += 1
+                return None
+            blobHash = info["Hash"]
+            info["LastUsedSec"] = time.time()
+            self.IsIndexDirty = True
+        buffer = self._MapBlob(blobHash, info["Size"])
+        if buffer is None:
+            # The blob is missing or corrupt, so remove every entry that uses it.
+            self.Logger.warn(f"HttpAssetDiskStore blob for {key} failed the integrity check, removing it.")
+            with self.Lock:
+                self.IntegrityFailures += 1
+                self.Misses += 1
+                for k in [k for k, v in self.Entries.items() if v["Hash"] == blobHash]:
+                    self._RemoveEntry(k)
+            self._ScheduleIndexSave()
+            return None
+        with self.Lock:
+            self.Hits += 1
+        self._SaveIndexIfDue()
+        return HttpAssetDiskStoreEntry(key, info, buffer)
+
+
+    # Returns all of the keys that start with the prefix.
+    def GetKeys(self, prefix:str = "") -> list:
+        with self.Lock:
+            return [k for k in self.Entries if k.startswith(prefix)]
+
+
+    # Stores the compressed body for the key, replacing any existing entry.
+    # On success, returns a memory mapped buffer of the stored body, so the caller can drop its own copy. Returns None on failure.
+    def Put(self, key:str, url:str, headers:dict, buffer, compressionType:int, originalSize:int, freshSec:float, validatedSec:float):
+        try:
+            size = len(buffer)
+            if size == 0 or size > self.MaxSizeBytes:
+                return None
+            blobHash = hashlib.sha256(buffer).hexdigest()
+            blobPath = self._GetBlobPath(blobHash)
+            # Since the blobs are content addressed, if it already exists, it should be the same data. It's still checked when it's first mapped.
+            wroteBlob = False
+            if os.path.exists(blobPath) is False or os.path.getsize(blobPath) != size:
+                wroteBlob = True
+                # Write to a temp file and move it into place, so a partially written blob never has a valid name.
+                tempPath = f"{blobPath}.{threading.get_ident()}.tmp"
+                with open(tempPath, "wb") as f:
+                    f.write(buffer)
+                os.replace(tempPath, blobPath)
+            info = {
+                "Hash": blobHash,
+                "Size": size,
+                "Url": url,
+                "Validator": HttpAssetDiskStore.GetValidator(headers),
+                "Headers": dict(headers),
+                "CompressionType": compressionType,
+                "OriginalSize": originalSize,
+                "FreshSec": freshSec,
+                "ValidatedSec": validatedSec,
+                "LastUsedSec": time.time(),
+            }
+            with self.Lock:
+                if self._IsBlobReferenced(blobHash) is False:
+                    self.TotalBytes += size
+                oldInfo = self.Entries.get(key, None)
+                self.Entries[key] = info
+                self.IsIndexDirty = True
+                # Add the new entry before the old one's blob is removed, so it's not deleted if it's the same blob.
+                if oldInfo is not None:
+                    self._DeleteBlobIfUnused(oldInfo)
+                # If we just wrote it, it doesn't need to be checked.
+                if wroteBlob:
+                    self.VerifiedBlobs.add(blobHash)
+                self.Stores += 1
+                self._EvictIfNeeded()
+                isStored = key in self.Entries
+            self._ScheduleIndexSave()
+            if isStored is False:
+                return None
+            return self._MapBlob(blobHash, size)
+        except Exception as e:
+            Sentry.Exception("HttpAssetDiskStore failed to store a body.", e)
+        return None
+
+
+    # Updates the validated time of the entry, when a revalidation says it's still good.
+    def SetValidated(self, key:str, validatedSec:float) -> None:
+        with self.Lock:
+            info = self.Entries.get(key, None)
+            if info is None:
+                return
+            info["ValidatedSec"] = validatedSec
+            self.IsIndexDirty = True
+        self._SaveIndexIfDue()
+
+
+    def Remove(self, key:str) -> None:
+        with self.Lock:
+            if key not in self.Entries:
+                return
+            self._RemoveEntry(key)
+        self._ScheduleIndexSave()
+
+
+    # Returns the ETag or Last-Modified value of the headers, which is what the body is keyed on along with the url.
+    @staticmethod
+    def GetValidator(headers:dict) -> str:
+        lastModified = None
+        for name, value in headers.items():
+            nameLower = name.lower()
+            if nameLower == "etag":
+                return value
+            if nameLower == "last-modified":
+                lastModified = value
+        return lastModified
+
+
+    def GetStats(self) -> dict:
+        with self.Lock:
+            lookups = self.Hits + self.Misses
+            return {
+                "Entries": len(self.Entries),
+                "Bytes": self.TotalBytes,
+                "MaxBytes": self.MaxSizeBytes,
+                "Hits": self.Hits,
+                "Misses": self.Misses,
+                "HitRatePercent": round((self.Hits / lookups) * 100.0, 1) if lookups > 0 else 0.0,
+                "Stores": self.Stores,
+                "Evictions": self.Evictions,
+                "IntegrityFailures": self.IntegrityFailures,
+            }
+
+
+    def _GetBlobPath(self, blobHash:str) -> str:
+        return os.path.join(self.StoreDir, blobHash + HttpAssetDiskStore.c_BlobExtension)
+
+
+    # Returns a read only memory mapped buffer of the blob, or None if it's missing or fails the integrity check.
+    def _MapBlob(self, blobHash:str, size:int):
+        try:
+            with open(self._GetBlobPath(blobHash), "rb") as f:
+                if os.fstat(f.fileno()).st_size != size:
+                    return None
+                # The mapping stays valid after the file is closed.
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            buffer = memoryview(m)
+            with self.Lock:
+                isVerified = blobHash in self.VerifiedBlobs
+            if isVerified is False:
+                if hashlib.sha256(buffer).hexdigest() != blobHash:
+                    return None
+                with self.Lock:
+                    self.VerifiedBlobs.add(blobHash)
+            return buffer
+        except Exception as e:
+            self.Logger.warn(f"HttpAssetDiskStore failed to map blob {blobHash}. {e}")
+        return None
+
+
+    # Must be called under the lock.
+    def _IsBlobReferenced(self, blobHash:str) -> bool:
+        for info in self.Entries.values():
+            if info["Hash"] == blobHash:
+                return True
+        return False
+
+
+    # Must be called under the lock. If no other entry uses the blob, it's deleted.
+    def _RemoveEntry(self, key:str) -> None:
+        info = self.Entries.pop(key, None)
+        if info is None:
+            return
+        self.IsIndexDirty = True
+        self._DeleteBlobIfUnused(info)
+
+
+    # Must be called under the lock, after the entry has been removed or replaced.
+    def _DeleteBlobIfUnused(self, info:dict) -> None:
+        if self._IsBlobReferenced(info["Hash"]):
+            return
+        self.TotalBytes -= info["Size"]
+        self.VerifiedBlobs.discard(info["Hash"])
+        try:
+            os.remove(self._GetBlobPath(info["Hash"]))
+        except Exception as e:
+            # On some platforms a mapped file can't be deleted, it will be cleaned up on the next start.
+            self.Logger.info(f"HttpAssetDiskStore failed to delete blob {info['Hash']}. {e}")
+
+
+    # Must be called under the lock. Removes the least recently used entries until we are under the size limit.
+    def _EvictIfNeeded(self) -> None:
+        while self.TotalBytes > self.MaxSizeBytes and len(self.Entries) > 0:
+            oldestKey = min(self.Entries, key=lambda k: self.Entries[k]["LastUsedSec"])
+            self._RemoveEntry(oldestKey)
+            self.Evictions += 1
+
+
+    def _SaveIndexIfDue(self) -> None:
+        if self.IsIndexDirty and time.time() - self.LastIndexSaveSec > HttpAssetDiskStore.c_LazyIndexSaveIntervalSec:
+            self._ScheduleIndexSave()
+
+
+    # Schedules the index to be written on a background thread after c_IndexSaveDelaySec.
+    # If a save is already scheduled, it will pick up this change, so nothing more is needed.
+    def _ScheduleIndexSave(self) -> None:
+        with self.Lock:
+            if self.IsIndexSaveScheduled:
+                return
+            self.IsIndexSaveScheduled = True
+        t = threading.Thread(target=self._IndexSaveThread, name="HttpAssetDiskStoreSave")
+        t.daemon = True
+        t.start()
+
+
+    def _IndexSaveThread(self) -> None:
+        time.sleep(HttpAssetDiskStore.c_IndexSaveDelaySec)
+        # Clear the flag before saving, so a change made during the save schedules another one.
+        with self.Lock:
+            self.IsIndexSaveScheduled = False
+        self._SaveIndex()
+
+
+    # Blocks to write the index. It's written to a temp file and moved into place, so it's never partially written.
+    def _SaveIndex(self) -> None:
+        try:
+            with self.SaveLock:
+                with self.Lock:
+                    data = {"FormatId": self.FormatId, "Entries": {k: dict(v) for k, v in self.Entries.items()}}
+                    self.IsIndexDirty = False
+                    self.LastIndexSaveSec = time.time()
+                tempPath = self.IndexFilePath + ".tmp"
+                with open(tempPath, "w", encoding="utf-8") as f:
+                    json.dump(data, f)
+                os.replace(tempPath, self.IndexFilePath)
+        except Exception as e:
+            self.Logger.error("HttpAssetDiskStore _SaveIndex failed "+str(e))
+
+
+    # Loads the index and removes anything that doesn't match it.
+    def _LoadIndex(self) -> None:
+        if os.path.exists(self.IndexFilePath) is False:
+            self._Clear()
+            return
+        with open(self.IndexFilePath, encoding="utf-8") as f:
+            data = json.load(f)
+        if data.get("FormatId", None) != self.FormatId:
+            self.Logger.info("HttpAssetDiskStore format changed, clearing the store.")
+            self._Clear()
+            return
+
+        # Only keep entries that have their blob, and compression we can still send.
+        blobSizes = {}
+        for key, info in data["Entries"].items():
+            blobHash = info["Hash"]
+            if blobHash not in blobSizes:
+                blobPath = self._GetBlobPath(blobHash)
+                blobSizes[blobHash] = os.path.getsize(blobPath) if os.path.exists(blobPath) else -1
+            if blobSizes[blobHash] != info["Size"] or info["CompressionType"] not in (DataCompression.None_, DataCompression.Zlib, DataCompression.ZStandard):
+                continue
+            self.Entries[key] = info
+
+        # Count the unique blobs and remove any files that aren't used.
+        usedBlobs = set(info["Hash"] for info in self.Entries.values())
+        self.TotalBytes = sum(blobSizes[h] for h in usedBlobs)
+        self._RemoveUnusedFiles(usedBlobs)
+        with self.Lock:
+            self._EvictIfNeeded()
+        self.Logger.info(f"HttpAssetDiskStore loaded. Entries: {len(self.Entries)}, Size: {self.TotalBytes}")
+
+
+    # Removes everything in the store.
+    def _Clear(self) -> None:
+        with self.Lock:
+            self.Entries = {}
+            self.TotalBytes = 0
+        self._RemoveUnusedFiles(set())
+        self._SaveIndex()
+
+
+    def _RemoveUnusedFiles(self, usedBlobs:set) -> None:
+        try:
+            for fileName in os.listdir(self.StoreDir):
+                if fileName == HttpAssetDiskStore.c_IndexFileName:
+                    continue
+                if fileName.endswith(HttpAssetDiskStore.c_BlobExtension) and fileName[:-len(HttpAssetDiskStore.c_BlobExtension)] in usedBlobs:
+                    continue
+                try:
+                    os.remove(os.path.join(self.StoreDir, fileName))
+                except Exception as e:
+                    self.Logger.info(f"HttpAssetDiskStore failed to remove unused file {fileName}. {e}")
+        except Exception as e:
+            self.Logger.warn(f"HttpAssetDiskStore failed to clean up unused files. {e}")
+
+
+# A stored body, the buffer is memory mapped and read only.
+class HttpAssetDiskStoreEntry:
+
+    def __init__(self, key:str, info:dict, buffer):
+        self.Key = key
+        self.Url = info["Url"]
+        self.Buffer = buffer
+        self.Validator = info["Validator"]
+        self.Headers = info["Headers"]
+        self.CompressionType = info["CompressionType"]
+        self.OriginalSize = info["OriginalSize"]
+        self.FreshSec = info["FreshSec"]
+        self.ValidatedSec = info["ValidatedSec"]
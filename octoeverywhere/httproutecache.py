@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import threading
+
+from .relaymetrics import RelayMetrics
+
+#
+# Learns which attempt of the OctoHttpRequest fallback chain works for a given path prefix.
+#
+# For relative paths, MakeHttpCall always tries OctoPrint first and then walks the fallback chain. For things like webcam
+# streams that are routed by haproxy, that means every request pays for a 404 hop (or more) before it gets to the attempt
+# that works. This cache remembers the attempt that worked for each path prefix, so later requests can go straight to it.
+#
+# Entries are only ever learned for fallback attempts, if the main URL works there's nothing to learn.
+# Entries expire after MaxRouteAgeSec, and they are removed as soon as a learned attempt fails, so the full chain will run
+# again and relearn the route. The cache also persists across restarts in the plugin data folder, the file is written
+# on a background thread a little after the routes change, so the request that learned the route isn't held up.
+#
+class HttpRouteCache:
+
+    # The attempt indexes, in the order the fallback chain tries them.
+    AttemptMain = 0
+    AttemptHttpProxy = 1
+    AttemptLocalIpHttpProxy = 2
+    AttemptLocalIpOctoPrint = 3
+    AttemptWebcamHardcode = 4
+
+    # How long a learned route is used before we make the full chain verify it again.
+    # Like the mDNS cache, this persists across restarts, so it's not too long.
+    MaxRouteAgeSec = 6 * 60.0 * 60.0
+
+    # The max number of routes we will track, the oldest are removed first.
+    c_MaxRoutes = 256
+
+    # How long after a route changes the cache file is written, so a burst of changes is only written once.
+    c_SaveDelaySec = 5.0
+
+    _Instance = None
+
+
+    @staticmethod
+    def Init(logger, pluginDataFolderPath):
+        HttpRouteCache._Instance = HttpRouteCache(logger, pluginDataFolderPath)
+
+
+    # Note this will be None if the host didn't init it, in which case the fallback chain runs like normal.
+    @staticmethod
+    def Get():
+        return HttpRouteCache._Instance
+
+
+    def __init__(self, logger, pluginDataFolderPath):
+        self.Logger = logger
+        self.Lock = threading.Lock()
+        self.SaveLock = threading.Lock()
+        self.IsSaveScheduled = False
+        self.CacheFilePath = os.path.join(pluginDataFolderPath, "HttpRouteCache.json")
+
+        # Stats
+        self.Hits = 0
+        self.Misses = 0
+        self.Learned = 0
+        self.Invalidations = 0
+
+        # Try to load past routes from the file. If we fail, just restart.
+        self.Routes = None
+        self._LoadCacheFile()
+        if self.Routes is None:
+            self._ResetCacheFile()
+
+        RelayMetrics.Get().RegisterStatsProvider("HttpRouteCache", self.GetStats)
+
+
+    # Returns the route key for a relative path. The key is the first two path segments, which is enough to tell apart
+    # the things proxies route on, without a key for every file. Root level paths like "/login" get their own key, so they don't all share "/".
+    # For example "/webcam/?action=stream" -> "/webcam", "/api/printer/tool" -> "/api/printer", and "/login" -> "/login"
+    # Returns None if the path can't be keyed.
+    @staticmethod
+    def GetRouteKey(path:str) -> str:
+        if path is None or len(path) == 0 or path[0] != "/":
+            return None
+        end = len(path)
+        for c in ("?", "#"):
+            i = path.find(c)
+            if i != -1 and i < end:
+                end = i
+        thirdSlash = -1
+        secondSlash = path.find("/", 1, end)
+        if secondSlash != -1:
+            thirdSlash = path.find("/", secondSlash + 1, end)
+        if thirdSlash != -1:
+            end = thirdSlash
+        # Trailing slashes are dropped, so "/webcam/" and "/webcam" share a key.
+        key = path[:end].rstrip("/").lower()
+        if len(key) == 0:
+            return "/"
+        return key
+
+
+    # Returns the learned attempt index for the route key, or None if there isn't a valid one.
+    # The config string is the local ports and protocol, if they have changed since the route was learned, it's no longer valid.
+    def GetLearnedAttempt(self, routeKey:str, config:str) -> int:
+        if routeKey is None:
+            return None
+        with self.Lock:
+            entry = self.Routes.get(routeKey, None)
+            if entry is not None:
+                try:
+                    if entry["Config"] == config and time.time() - float(entry["LearnedSec"]) < HttpRouteCache.MaxRouteAgeSec:
+                        return int(entry["Attempt"])
+                except Exception as e:
+                    self.Logger.warn(f"HttpRouteCache found a bad entry for {routeKey}, removing it. {e}")
+                # The entry is expired, for an old config, or bad, so remove it.
+                del self.Routes[routeKey]
+            self.Misses += 1
+        RelayMetrics.Get().IncrementCounter("Cache.Route.Misses")
+        return None
+
+
+    # Called when a learned attempt worked.
+    def ReportHit(self, routeKey:str) -> None:
+        with self.Lock:
+            self.Hits += 1
+        RelayMetrics.Get().IncrementCounter("Cache.Route.Hits")
+
+
+    # Called when a learned attempt failed. The route is removed, so the full chain runs and relearns it.
+    def ReportFailure(self, routeKey:str) -> None:
+        with self.Lock:
+            if self.Routes.pop(routeKey, None) is None:
+                return
+            self.Invalidations += 1
+        self.Logger.info(f"HttpRouteCache learned route for {routeKey} failed, the route was removed.")
+        RelayMetrics.Get().IncrementCounter("Cache.Route.Invalidations")
+        self._ScheduleSave()
+
+
+    # Called when the fallback chain found a working attempt.
+    def LearnRoute(self, routeKey:str, config:str, attempt:int) -> None:
+        if routeKey is None or attempt == HttpRouteCache.AttemptMain:
+            return
+        with self.Lock:
+            existing = self.Routes.get(routeKey, None)
+            if existing is not None and existing.get("Attempt", None) == attempt and existing.get("Config", None) == config:
+                return
+            self.Routes[routeKey] = {"Attempt": attempt, "Config": config, "LearnedSec": time.time()}
+            # Keep the size in check, remove the oldest routes first.
+            while len(self.Routes) > HttpRouteCache.c_MaxRoutes:
+                oldestKey = min(self.Routes, key=lambda k: self.Routes[k].get("LearnedSec", 0))
+                del self.Routes[oldestKey]
+            self.Learned += 1
+        self.Logger.info(f"HttpRouteCache learned fallback attempt {attempt} for {routeKey}")
+        RelayMetrics.Get().IncrementCounter("Cache.Route.Learned")
+        self._ScheduleSave()
+
+
+    def GetStats(self) -> dict:
+        with self.Lock:
+            return {
+                "Routes": {k: v.get("Attempt", None) for k, v in self.Routes.items()},
+                "Hits": self.Hits,
+                "Misses": self.Misses,
+                "Learned": self.Learned,
+                "Invalidations": self.Invalidations,
+            }
+
+
+    def _ResetCacheFile(self):
+        self.Logger.info("HttpRouteCache cache file reset")
+        self.Routes = {}
+
+
+    # Schedules the cache file to be written on a background thread after c_SaveDelaySec.
+    # If a save is already scheduled, it will pick up this change, so nothing more is needed.
+    def _ScheduleSave(self):
+        with self.Lock:
+            if self.IsSaveScheduled:
+                return
+            self.IsSaveScheduled = True
+        t = threading.Thread(target=self._SaveThread, name="HttpRouteCacheSave")
+        t.daemon = True
+        t.start()
+
+
+    def _SaveThread(self):
+        time.sleep(HttpRouteCache.c_SaveDelaySec)
+        # Clear the flag before saving, so a change made during the save schedules another one.
+        with self.Lock:
+            self.IsSaveScheduled = False
+        self._SaveCacheFile()
+
+
+    # Blocks to write the current routes to a file.
+    def _SaveCacheFile(self):
+        try:
+            with self.SaveLock:
+                with self.Lock:
+                    data = {"Routes": dict(self.Routes)}
+                with open(self.CacheFilePath, 'w', encoding="utf-8") as f:
+                    json.dump(data, f)
+        except Exception as e:
+            self.Logger.error("HttpRouteCache _SaveCacheFile failed "+str(e))
+
+
+    # Does a blocking call to load any routes from the file.
+    def _LoadCacheFile(self):
+        try:
+            if os.path.exists(self.CacheFilePath) is False:
+                self._ResetCacheFile()
+                return
+            with open(self.CacheFilePath, encoding="utf-8") as f:
+                data = json.load(f)
+            self.Routes = data["Routes"]
+            self.Logger.info("HttpRouteCache file loaded. Routes Found: "+str(len(self.Routes)))
+        except Exception as e:
+            self._ResetCacheFile()
+            self.Logger.error("HttpRouteCache _LoadCacheFile failed "+str(e))
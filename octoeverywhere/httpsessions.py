@@ -1,16 +1,46 @@
+import queue
 import logging
 import threading
+import time
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.poolmanager import PoolManager
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import EmptyPoolError
+
+from .relaymetrics import RelayMetrics
 
 # A common class to cache http sessions per host.
 # This makes the connections more efficient as we can reuse the connections and the session isn't created every time.
+#
+# Each session has a managed connection pool, so we can control how many connections are kept per host, how a request acts when
+# all of them are in use, and get stats on how well the connections are being reused. Sessions that haven't been used for a while
+# are evicted, so hosts that no longer exist (like old mDNS IPs) don't hold sockets forever.
 class HttpSessions:
 
+    # The default max number of connections we keep open per host.
+    # The requests default is 10, but a portal burst can easily have more web streams than that making calls to the same host,
+    # which means the extra connections are thrown away and reopened each time.
+    c_DefaultMaxConnectionsPerHost = 20
+    c_MinConnectionsPerHost = 1
+    c_MaxConnectionsPerHost = 256
+
+    # In blocking mode, this is the max time a request will wait for a free connection.
+    # If no connection is freed in time, an overflow connection is opened rather than failing the request, since
+    # things like webcam streams can hold a connection for hours.
+    c_MaxPoolWaitSec = 5.0
+
+    # How long a session can go without being used before it's evicted.
+    c_IdleSessionEvictSec = 10 * 60.0
+    # How often we check for idle sessions. The check is done when sessions are requested, so there's no extra thread.
+    c_IdleSessionCheckIntervalSec = 60.0
+
     _Instance = None
 
     @staticmethod
-    def Init(logger:logging.Logger):
-        HttpSessions._Instance = HttpSessions(logger)
+    def Init(logger:logging.Logger, maxConnectionsPerHost:int = c_DefaultMaxConnectionsPerHost, blockWhenPoolFull:bool = False):
+        HttpSessions._Instance = HttpSessions(logger, maxConnectionsPerHost, blockWhenPoolFull)
 
 
     @staticmethod
@@ -18,10 +48,34 @@ class HttpSessions:
         return HttpSessions._Instance
 
 
-    def __init__(self, logger:logging.Logger):
+    def __init__(self, logger:logging.Logger, maxConnectionsPerHost:int, blockWhenPoolFull:bool):
         self.Logger = logger
         self.Sessions = {}
         self.SessionsLock = threading.Lock()
+        self.MaxConnectionsPerHost = maxConnectionsPerHost
+        self.BlockWhenPoolFull = blockWhenPoolFull
+        self.LastIdleCheckSec = time.time()
+
+        # Stats
+        self.SessionsCreated = 0
+        self.SessionsEvicted = 0
+        # The stats of sessions that have been evicted, so the totals don't go backwards.
+        self.EvictedStats = HttpPoolStats()
+
+        RelayMetrics.Get().RegisterStatsProvider("HttpSessions", self.GetStats)
+
+
+    # Sets the pool options, this is used by the hosts after they have read their config.
+    # Any existing sessions are closed, so they are recreated with the new options.
+    def SetPoolOptions(self, maxConnectionsPerHost:int, blockWhenPoolFull:bool) -> None:
+        with self.SessionsLock:
+            if self.MaxConnectionsPerHost == maxConnectionsPerHost and self.BlockWhenPoolFull == blockWhenPoolFull:
+                return
+            self.Logger.info(f"HttpSessions pool options set. Max connections per host: {maxConnectionsPerHost}, Block when full: {blockWhenPoolFull}")
+            self.MaxConnectionsPerHost = maxConnectionsPerHost
+            self.BlockWhenPoolFull = blockWhenPoolFull
+            for host in list(self.Sessions.keys()):
+                self._RemoveSession(host)
 
 
     # Returns a Session given the url or host.
@@ -59,16 +113,23 @@ class HttpSessions:
                     hostEnd = len(hostOrUrl)
                 host = hostOrUrl[:hostEnd]
 
+        # Every so often, check for sessions that haven't been used in a while.
+        nowSec = time.time()
+        if nowSec - self.LastIdleCheckSec > HttpSessions.c_IdleSessionCheckIntervalSec:
+            self._EvictIdleSessions(nowSec)
+
         # If one exists, we don't need to lock.
-        s = self.Sessions.get(host, None)
-        if s is not None:
-            return s
+        m = self.Sessions.get(host, None)
+        if m is not None:
+            m.LastUsedSec = nowSec
+            return m.Session
 
         with self.SessionsLock:
             # Check again after locking
-            s = self.Sessions.get(host, None)
-            if s is not None:
-                return s
+            m = self.Sessions.get(host, None)
+            if m is not None:
+                m.LastUsedSec = nowSec
+                return m.Session
 
             # Create a new session.
             self.Logger.info(f"Creating new session for {host}")
@@ -79,6 +140,255 @@ class HttpSessions:
             # We don't need that, so we can just set it to False. Is saves about 20ms per request.
             s.trust_env = False
 
+            # Replace the default adapters with our managed ones, which share the stats for this host.
+            stats = HttpPoolStats()
+            adapter = ManagedHttpAdapter(stats, self.MaxConnectionsPerHost, self.BlockWhenPoolFull)
+            s.mount("http://", adapter)
+            s.mount("https://", adapter)
+
             # Set the session and return it!
-            self.Sessions[host] = s
+            self.Sessions[host] = ManagedSession(s, stats, nowSec)
+            self.SessionsCreated += 1
             return s
+
+
+    # Closes and removes any sessions that haven't been used in a while and have no connections in use.
+    # Note that a thread could have just gotten the session before it's closed, but that's fine, a closed session will still make
+    # new connections if it's used. It just won't be reused after that.
+    def _EvictIdleSessions(self, nowSec:float) -> None:
+        with self.SessionsLock:
+            # Check again under the lock, so only one thread does the check.
+            if nowSec - self.LastIdleCheckSec <= HttpSessions.c_IdleSessionCheckIntervalSec:
+                return
+            self.LastIdleCheckSec = nowSec
+            for host, m in list(self.Sessions.items()):
+                if nowSec - m.LastUsedSec < HttpSessions.c_IdleSessionEvictSec or m.Stats.GetCheckedOut() > 0:
+                    continue
+                self.Logger.info(f"HttpSessions evicting idle session for {host}")
+                self._RemoveSession(host)
+                self.SessionsEvicted += 1
+
+
+    # Must be called under the sessions lock.
+    def _RemoveSession(self, host:str) -> None:
+        m = self.Sessions.pop(host, None)
+        if m is None:
+            return
+        self.EvictedStats.Add(m.Stats)
+        try:
+            m.Session.close()
+        except Exception as e:
+            self.Logger.warn(f"HttpSessions failed to close session for {host}. {e}")
+
+
+    def GetStats(self) -> dict:
+        with self.SessionsLock:
+            sessions = list(self.Sessions.items())
+            totals = HttpPoolStats()
+            totals.Add(self.EvictedStats)
+            result = {
+                "MaxConnectionsPerHost": self.MaxConnectionsPerHost,
+                "BlockWhenPoolFull": self.BlockWhenPoolFull,
+                "ActiveSessions": len(sessions),
+                "SessionsCreated": self.SessionsCreated,
+                "SessionsEvicted": self.SessionsEvicted,
+            }
+        nowSec = time.time()
+        hosts = {}
+        for host, m in sessions:
+            totals.Add(m.Stats)
+            hostStats = m.Stats.GetStats()
+            hostStats["IdleSec"] = round(nowSec - m.LastUsedSec, 1)
+            hosts[host] = hostStats
+        result["Totals"] = totals.GetStats()
+        result["Hosts"] = hosts
+        return result
+
+
+# Holds a session and the info we need to manage it.
+class ManagedSession:
+
+    def __init__(self, session:requests.Session, stats, lastUsedSec:float):
+        self.Session = session
+        self.Stats = stats
+        self.LastUsedSec = lastUsedSec
+
+
+# The connection pool stats for a host. These are updated by the managed connection pools.
+class HttpPoolStats:
+
+    def __init__(self):
+        self.Lock = threading.Lock()
+        # The number of times a connection was taken from the pool, which is once per request.
+        self.Acquires = 0
+        # The number of new connections opened. Any acquire that didn't open a new connection reused one.
+        self.NewConnections = 0
+        # The number of connections closed because the pool was already full when they were released.
+        self.Discarded = 0
+        # The number of times an acquire found no free connections. In non-blocking mode these open an extra connection.
+        self.PoolEmpty = 0
+        # The number of times an acquire had to wait for a connection, and how long, in blocking mode.
+        self.PoolWaits = 0
+        self.PoolWaitTotalSec = 0.0
+        self.PoolWaitTimeouts = 0
+        # The number of connections currently taken from the pool.
+        self.CheckedOut = 0
+
+
+    def OnAcquire(self, wasEmpty:bool, isBlocking:bool, waitSec:float, timedOut:bool) -> None:
+        with self.Lock:
+            self.Acquires += 1
+            self.CheckedOut += 1
+            if wasEmpty:
+                self.PoolEmpty += 1
+                if isBlocking:
+                    self.PoolWaits += 1
+                    self.PoolWaitTotalSec += waitSec
+            if timedOut:
+                self.PoolWaitTimeouts += 1
+        if wasEmpty and isBlocking:
+            RelayMetrics.Get().RecordLatency("Http.PoolWait", waitSec)
+
+
+    def OnNewConnection(self) -> None:
+        with self.Lock:
+            self.NewConnections += 1
+
+
+    def OnRelease(self, discarded:bool) -> None:
+        with self.Lock:
+            self.CheckedOut = max(0, self.CheckedOut - 1)
+            if discarded:
+                self.Discarded += 1
+
+
+    def GetCheckedOut(self) -> int:
+        with self.Lock:
+            return self.CheckedOut
+
+
+    # Adds the counts of the other stats to this one.
+    def Add(self, other) -> None:
+        with other.Lock:
+            values = (other.Acquires, other.NewConnections, other.Discarded, other.PoolEmpty, other.PoolWaits, other.PoolWaitTotalSec, other.PoolWaitTimeouts, other.CheckedOut)
+        with self.Lock:
+            self.Acquires += values[0]
+            self.NewConnections += values[1]
+            self.Discarded += values[2]
+            self.PoolEmpty += values[3]
+            self.PoolWaits += values[4]
+            self.PoolWaitTotalSec += values[5]
+            self.PoolWaitTimeouts += values[6]
+            self.CheckedOut += values[7]
+
+
+    def GetStats(self) -> dict:
+        with self.Lock:
+            reused = max(0, self.Acquires - self.NewConnections)
+            return {
+                "Acquires": self.Acquires,
+                "NewConnections": self.NewConnections,
+                "ReusedConnections": reused,
+                "ReuseRatePercent": round((reused / self.Acquires) * 100.0, 1) if self.Acquires > 0 else 0.0,
+                # Churn is every connection we opened that was thrown away because the pool was full.
+                "Discarded": self.Discarded,
+                "PoolEmpty": self.PoolEmpty,
+                "PoolWaits": self.PoolWaits,
+                "PoolWaitAvgMs": round((self.PoolWaitTotalSec / self.PoolWaits) * 1000.0, 2) if self.PoolWaits > 0 else 0.0,
+                "PoolWaitTimeouts": self.PoolWaitTimeouts,
+                "CheckedOut": self.CheckedOut,
+            }
+
+
+# A requests adapter that uses our managed pool manager.
+class ManagedHttpAdapter(HTTPAdapter):
+
+    def __init__(self, stats:HttpPoolStats, maxConnections:int, blockWhenPoolFull:bool):
+        # This must be set before the base init, since it creates the pool manager.
+        self.ManagedStats = stats
+        super().__init__(pool_maxsize=maxConnections, pool_block=blockWhenPoolFull)
+
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        # Save these values for pickling, like the base class does.
+        #pylint: disable=attribute-defined-outside-init
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = ManagedPoolManager(self.ManagedStats, num_pools=connections, maxsize=maxsize, block=block, **pool_kwargs)
+
+
+# A urllib3 pool manager that creates our managed connection pools.
+class ManagedPoolManager(PoolManager):
+
+    def __init__(self, stats:HttpPoolStats, **kwargs):
+        super().__init__(**kwargs)
+        self.ManagedStats = stats
+        self.pool_classes_by_scheme = {"http": ManagedHTTPConnectionPool, "https": ManagedHTTPSConnectionPool}
+
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super()._new_pool(scheme, host, port, request_context)
+        pool.ManagedStats = self.ManagedStats
+        return pool
+
+
+# Wraps the urllib3 connection pool functions to track the stats and bound the blocking wait time.
+class ManagedPoolMixin:
+
+    ManagedStats = None
+
+    def _get_conn(self, timeout=None):
+        stats = self.ManagedStats
+        if stats is None:
+            return super()._get_conn(timeout)
+        # If there are no free connections in the pool, we will either wait for one or open a new one.
+        pool = self.pool
+        wasEmpty = pool is not None and pool.empty()
+        if self.block and (timeout is None or timeout > HttpSessions.c_MaxPoolWaitSec):
+            timeout = HttpSessions.c_MaxPoolWaitSec
+        startSec = time.time()
+        try:
+            conn = super()._get_conn(timeout)
+        except EmptyPoolError:
+            # We waited the max time and no connection was freed. Rather than failing the request, open an overflow connection,
+            # it will be discarded when it's released since the pool is full.
+            stats.OnAcquire(True, True, time.time() - startSec, True)
+            return self._new_conn()
+        stats.OnAcquire(wasEmpty, self.block, time.time() - startSec, False)
+        return conn
+
+
+    def _new_conn(self):
+        stats = self.ManagedStats
+        if stats is not None:
+            stats.OnNewConnection()
+        return super()._new_conn()
+
+
+    # This replaces the base function, so we can count discarded connections and never raise when the pool is full in blocking mode.
+    def _put_conn(self, conn):
+        stats = self.ManagedStats
+        if stats is None:
+            super()._put_conn(conn)
+            return
+        discarded = False
+        pool = self.pool
+        if pool is not None:
+            try:
+                pool.put(conn, block=False)
+                stats.OnRelease(False)
+                return
+            except queue.Full:
+                discarded = conn is not None
+        stats.OnRelease(discarded)
+        if conn:
+            conn.close()
+
+
+class ManagedHTTPConnectionPool(ManagedPoolMixin, HTTPConnectionPool):
+    pass
+
+
+class ManagedHTTPSConnectionPool(ManagedPoolMixin, HTTPSConnectionPool):
+    pass
@@ -0,0 +1,228 @@
+import threading
+import collections
+
+#
+# A bounded chunk pipe used to stream a request body to the local http server as it arrives.
+#
+# Without this, the whole upload is collected into one buffer before the local http request is made, so a large upload (like a 200MB gcode file)
+# is held in memory and the upload to the local server can't start until the upload from the service is done.
+# With the pipe, the http request is started when the stream opens. The web stream thread writes each incoming message's data into the pipe,
+# and the http lib reads it out as it sends the body. If the local server is slower than the service, the writer blocks once the pipe is full,
+# which pushes back on the web stream.
+#
+# The body can only be sent once, but the fallback chain might need to try more than one url. So the pipe keeps the data that has been read
+# up to a replay limit, and a new body can be created from the start as long as nothing beyond that limit has been read. That covers the common
+# fallback case, where the attempt fails to connect before any of the body is sent.
+#
+class HttpUploadPipe:
+
+    # The max size of the data that's been written but not read yet. Once the pipe is this full, writes block.
+    c_DefaultMaxBufferedBytes = 4 * 1024 * 1024
+
+    # The max size of the data that's kept after it's read, so the body can be sent again by a fallback attempt.
+    c_DefaultMaxReplayBytes = 4 * 1024 * 1024
+
+    # The max time a read or write will block. This matches the local http call timeout.
+    c_MaxBlockSec = 1800.0
+
+
+    # The known size is the full size of the body if it's known, otherwise None.
+    def __init__(self, knownSizeBytes:int = None, maxBufferedBytes:int = c_DefaultMaxBufferedBytes, maxReplayBytes:int = c_DefaultMaxReplayBytes):
+        self.KnownSizeBytes = knownSizeBytes
+        self.MaxBufferedBytes = maxBufferedBytes
+        self.MaxReplayBytes = maxReplayBytes
+        self.Condition = threading.Condition()
+
+        # The data that's been written but not read yet.
+        self.Chunks = collections.deque()
+        self.BufferedBytes = 0
+        # The data that's been read, kept so the body can be sent again.
+        self.ReplayChunks = []
+        self.ReplayBytes = 0
+        self.CanReplay = True
+
+        # The position in the current chunk.
+        self.ChunkOffset = 0
+        self.TotalWrittenBytes = 0
+        self.IsWriteDone = False
+        self.IsReadDone = False
+        self.IsAborted = False
+        self.HasCreatedBody = False
+
+        # Stats
+        self.WriteWaits = 0
+
+
+    # Adds data to the pipe, this blocks if the pipe is full.
+    # Returns false if the reader is done, in which case the data is dropped.
+    def Write(self, buffer) -> bool:
+        if buffer is None or len(buffer) == 0:
+            return not self.IsReadDone
+        with self.Condition:
+            if self.BufferedBytes >= self.MaxBufferedBytes and self.IsReadDone is False and self.IsAborted is False:
+                self.WriteWaits += 1
+                if self.Condition.wait_for(lambda: self.BufferedBytes < self.MaxBufferedBytes or self.IsReadDone or self.IsAborted, HttpUploadPipe.c_MaxBlockSec) is False:
+                    raise Exception("HttpUploadPipe timed out waiting for the reader.")
+            if self.IsAborted:
+                raise Exception("HttpUploadPipe write after the pipe was aborted.")
+            self.TotalWrittenBytes += len(buffer)
+            if self.IsReadDone:
+                return False
+            self.Chunks.append(buffer)
+            self.BufferedBytes += len(buffer)
+            self.Condition.notify_all()
+            return True
+
+
+    # Returns true if a write right now wouldn't block.
+    def CanWriteWithoutBlocking(self) -> bool:
+        with self.Condition:
+            return self.BufferedBytes < self.MaxBufferedBytes or self.IsReadDone or self.IsAborted
+
+
+    # Called when all of the data has been written.
+    def FinishWrite(self) -> None:
+        with self.Condition:
+            self.IsWriteDone = True
+            self.Condition.notify_all()
+
+
+    # Called when the http request is done, so any more writes are dropped rather than blocking forever.
+    def FinishRead(self) -> None:
+        with self.Condition:
+            self.IsReadDone = True
+            self.Chunks.clear()
+            self.BufferedBytes = 0
+            self.ReplayChunks = []
+            self.ReplayBytes = 0
+            self.Condition.notify_all()
+
+
+    # Called when the stream is closed, any blocked read or write will throw.
+    def Abort(self) -> None:
+        with self.Condition:
+            self.IsAborted = True
+            self.Condition.notify_all()
+
+
+    # Reads up to size bytes, or the rest of the current chunk if size is -1.
+    # Returns an empty buffer when all of the data has been read.
+    # If block is false and there's no data ready, None is returned.
+    def Read(self, size:int = -1, block:bool = True):
+        with self.Condition:
+            if len(self.Chunks) == 0 and self.IsWriteDone is False and self.IsAborted is False:
+                if block is False:
+                    return None
+                if self.Condition.wait_for(lambda: len(self.Chunks) > 0 or self.IsWriteDone or self.IsAborted, HttpUploadPipe.c_MaxBlockSec) is False:
+                    raise Exception("HttpUploadPipe timed out waiting for upload data.")
+            if self.IsAborted:
+                raise Exception("HttpUploadPipe read after the pipe was aborted.")
+            if len(self.Chunks) == 0:
+                return b""
+            chunk = self.Chunks[0]
+            available = len(chunk) - self.ChunkOffset
+            if size < 0 or size >= available:
+                size = available
+            data = bytes(chunk[self.ChunkOffset:self.ChunkOffset + size])
+            self.ChunkOffset += size
+            if self.ChunkOffset >= len(chunk):
+                self.Chunks.popleft()
+                self.ChunkOffset = 0
+                self.BufferedBytes -= len(chunk)
+                self._KeepForReplay(chunk)
+                self.Condition.notify_all()
+            return data
+
+
+    # Must be called under lock.
+    def _KeepForReplay(self, chunk) -> None:
+        if self.CanReplay is False:
+            return
+        if self.ReplayBytes + len(chunk) > self.MaxReplayBytes:
+            self.CanReplay = False
+            self.ReplayChunks = []
+            self.ReplayBytes = 0
+            return
+        self.ReplayChunks.append(chunk)
+        self.ReplayBytes += len(chunk)
+
+
+    # Resets the read position to the start of the body, so it can be sent again.
+    # Throws if too much of the body has been read to replay it.
+    def Rewind(self) -> None:
+        with self.Condition:
+            if self.IsAborted:
+                raise Exception("HttpUploadPipe rewind after the pipe was aborted.")
+            if self.CanReplay is False or self.IsReadDone:
+                raise Exception("HttpUploadPipe can't replay the body, too much of it has already been sent.")
+            if len(self.ReplayChunks) == 0 and self.ChunkOffset == 0:
+                return
+            # The replay chunks go back in front of the unread chunks.
+            self.ChunkOffset = 0
+            self.Chunks.extendleft(reversed(self.ReplayChunks))
+            self.BufferedBytes += self.ReplayBytes
+            self.ReplayChunks = []
+            self.ReplayBytes = 0
+
+
+    # Returns a new body for a http request attempt, which will send the body from the start.
+    # Throws if the body can't be sent again.
+    def CreateBody(self):
+        if self.HasCreatedBody:
+            self.Rewind()
+        self.HasCreatedBody = True
+        if self.KnownSizeBytes is not None:
+            return HttpUploadPipeReader(self)
+        return self._ReadChunks()
+
+
+    # Returns a new async body for a http request attempt, for the asyncio relay engine.
+    # Reads that would block are done on a blocking thread.
+    def CreateAsyncBody(self, engine):
+        if self.HasCreatedBody:
+            self.Rewind()
+        self.HasCreatedBody = True
+        return self._ReadChunksAsync(engine)
+
+
+    def _ReadChunks(self):
+        while True:
+            data = self.Read()
+            if len(data) == 0:
+                return
+            yield data
+
+
+    async def _ReadChunksAsync(self, engine):
+        while True:
+            data = self.Read(block=False)
+            if data is None:
+                data = await engine.RunBlocking(self.Read)
+            if len(data) == 0:
+                return
+            yield data
+
+
+    def GetStats(self) -> dict:
+        with self.Condition:
+            return {
+                "TotalWrittenBytes": self.TotalWrittenBytes,
+                "BufferedBytes": self.BufferedBytes,
+                "WriteWaits": self.WriteWaits,
+                "CanReplay": self.CanReplay,
+            }
+
+
+# A file like reader for a pipe with a known size. The size lets the http lib set the content length, rather than using a chunked body.
+class HttpUploadPipeReader:
+
+    def __init__(self, pipe:HttpUploadPipe):
+        self.Pipe = pipe
+
+
+    def __len__(self):
+        return self.Pipe.KnownSizeBytes
+
+
+    def read(self, size:int = -1):
+        return self.Pipe.Read(size)
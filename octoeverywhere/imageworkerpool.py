@@ -0,0 +1,306 @@
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+
+from .sentry import Sentry
+from .relaymetrics import RelayMetrics
+from .snapshotimageprocessor import SnapshotImageProcessor
+
+
+# An optional small pool of worker processes for the snapshot image work.
+#
+# The PIL decode, transform, and encode work for notification and Gadget snapshots can take hundreds of milliseconds on a Pi.
+# Done on the calling thread, it competes with the relay and the printer communication for the GIL and the CPU, which adds latency jitter.
+# With the pool enabled, the jobs are queued to worker processes instead, and the calling thread just waits for the result.
+#
+# Each worker has a shared memory buffer, so the frame and the result are handed off without being pickled through the pipe.
+# The workers are started on the first job and stop when they have been idle for a while, so the pool costs nothing when it's not used.
+# If a job takes too long, the worker process is killed and restarted, so a bad image can't hang the pool.
+class ImageWorkerPool:
+
+    # The worker count limits.
+    c_DefaultWorkerCount = 1
+    c_MinWorkerCount = 1
+    c_MaxWorkerCount = 4
+
+    # How many jobs can wait in the queue. If the queue is full, the job is done on the calling thread.
+    c_MaxQueuedJobs = 8
+
+    # How long a job can take, including the time it waits in the queue and the worker start time.
+    c_JobTimeoutSec = 20.0
+
+    # How long a worker process can be idle before it's stopped.
+    c_WorkerIdleTimeoutSec = 300.0
+
+    # The size of each worker's shared memory buffer. Larger frames and results are sent through the pipe.
+    c_SharedBufferBytes = 4 * 1024 * 1024
+
+    # The options, which are set by the host.
+    Enabled = False
+    WorkerCount = c_DefaultWorkerCount
+
+    _Instance = None
+
+
+    @staticmethod
+    def Init(logger:logging.Logger):
+        ImageWorkerPool._Instance = ImageWorkerPool(logger)
+
+
+    @staticmethod
+    def Get():
+        return ImageWorkerPool._Instance
+
+
+    @staticmethod
+    def SetOptions(enabled:bool, workerCount:int):
+        ImageWorkerPool.Enabled = enabled
+        ImageWorkerPool.WorkerCount = min(max(workerCount, ImageWorkerPool.c_MinWorkerCount), ImageWorkerPool.c_MaxWorkerCount)
+
+
+    def __init__(self, logger:logging.Logger):
+        self.Logger = logger
+        self.Lock = threading.Lock()
+        self.Jobs = queue.Queue(ImageWorkerPool.c_MaxQueuedJobs)
+        self.Workers = []
+        self.IsBroken = False
+
+
+    # Does the snapshot work in a worker process.
+    # Returns None if the pool isn't enabled or can't take the job, in which case the caller should do the work itself.
+    # Otherwise, returns the new snapshot, or the original snapshot if the job failed or timed out, like SnapshotImageProcessor does.
+    def TryProcessSnapshot(self, snapshot, flipH:bool, flipV:bool, rotation:int, snapshotResizeParams) -> bytes:
+        if ImageWorkerPool.Enabled is False or self.IsBroken:
+            return None
+        if self._EnsureWorkers() is False:
+            return None
+
+        job = ImageJob(snapshot, flipH, flipV, rotation, snapshotResizeParams)
+        try:
+            self.Jobs.put_nowait(job)
+        except queue.Full:
+            RelayMetrics.Get().IncrementCounter("ImageWorker.QueueFull")
+            self.Logger.warn("ImageWorkerPool job queue is full, the snapshot will be processed on the calling thread.")
+            return None
+        RelayMetrics.Get().IncrementCounter("ImageWorker.Jobs")
+
+        # The worker enforces the deadline, but don't wait forever if something goes wrong.
+        if job.Done.wait(ImageWorkerPool.c_JobTimeoutSec + 1.0) is False:
+            job.IsAbandoned = True
+            RelayMetrics.Get().IncrementCounter("ImageWorker.Timeouts")
+            self.Logger.warn("ImageWorkerPool timed out waiting for a snapshot job.")
+            return snapshot
+        RelayMetrics.Get().RecordLatency("ImageWorker.Job", time.time() - job.CreatedSec)
+        if job.Result is None:
+            return snapshot
+        return job.Result
+
+
+    # Starts the worker threads, if they haven't been. The worker processes are started by the threads when they get a job.
+    def _EnsureWorkers(self) -> bool:
+        with self.Lock:
+            if len(self.Workers) > 0:
+                return True
+            try:
+                context = ImageWorkerPool._GetContext()
+                for i in range(ImageWorkerPool.WorkerCount):
+                    self.Workers.append(ImageWorker(self.Logger, context, self.Jobs, i))
+                self.Logger.info(f"ImageWorkerPool started with {len(self.Workers)} workers.")
+                return True
+            except Exception as e:
+                # If this platform can't run worker processes, always do the work on the calling thread.
+                self.IsBroken = True
+                Sentry.Exception("ImageWorkerPool failed to start, the image work will be done in process.", e)
+                return False
+
+
+    @staticmethod
+    def _GetContext():
+        # The plugin process has many threads, so we don't want to fork it directly.
+        # The forkserver forks the workers from a clean single threaded process. If it's not supported, use spawn.
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            return multiprocessing.get_context("forkserver")
+        return multiprocessing.get_context("spawn")
+
+
+# A snapshot job, which is waited on by the caller.
+class ImageJob:
+
+    def __init__(self, snapshot, flipH:bool, flipV:bool, rotation:int, snapshotResizeParams):
+        self.Snapshot = snapshot
+        self.FlipH = flipH
+        self.FlipV = flipV
+        self.Rotation = rotation
+        self.SnapshotResizeParams = snapshotResizeParams
+        self.CreatedSec = time.time()
+        self.DeadlineSec = self.CreatedSec + ImageWorkerPool.c_JobTimeoutSec
+        self.Done = threading.Event()
+        self.IsAbandoned = False
+        # The new snapshot, or None if the job failed.
+        self.Result = None
+
+
+# Owns one worker process and the thread that hands it jobs from the queue.
+class ImageWorker:
+
+    def __init__(self, logger:logging.Logger, context, jobs:queue.Queue, index:int):
+        self.Logger = logger
+        self.Context = context
+        self.Jobs = jobs
+        self.Index = index
+        self.Process = None
+        self.Conn = None
+        # The shared buffer is created once and passed to each process this worker starts.
+        self.SharedBuffer = context.RawArray("B", ImageWorkerPool.c_SharedBufferBytes)
+        self.SharedView = memoryview(self.SharedBuffer).cast("B")
+        self.Thread = threading.Thread(target=self._WorkerThread, name=f"ImageWorker-{index}", daemon=True)
+        self.Thread.start()
+
+
+    def _WorkerThread(self):
+        while True:
+            try:
+                job = self.Jobs.get(timeout=ImageWorkerPool.c_WorkerIdleTimeoutSec)
+            except queue.Empty:
+                # Don't hold the process while there's nothing to do.
+                if self.Process is not None:
+                    if self.Logger.isEnabledFor(logging.DEBUG):
+                        self.Logger.debug(f"ImageWorker {self.Index} is idle, stopping the worker process.")
+                    self._StopProcess()
+                continue
+            try:
+                self._RunJob(job)
+            except Exception as e:
+                Sentry.Exception("ImageWorker failed to run a job.", e)
+                self._StopProcess()
+            finally:
+                job.Done.set()
+
+
+    def _RunJob(self, job:ImageJob):
+        # If the caller has given up, there's no reason to do the work.
+        if job.IsAbandoned or time.time() >= job.DeadlineSec:
+            return
+        self._EnsureProcess()
+
+        # Hand off the frame, using the shared buffer if it fits.
+        snapshotLen = len(job.Snapshot)
+        if snapshotLen <= len(self.SharedView):
+            self.SharedView[:snapshotLen] = job.Snapshot
+            payload = snapshotLen
+        else:
+            payload = bytes(job.Snapshot)
+        self.Conn.send((payload, job.FlipH, job.FlipV, job.Rotation, job.SnapshotResizeParams))
+
+        # Wait for the result, until the job's deadline.
+        if self.Conn.poll(max(0.0, job.DeadlineSec - time.time())) is False:
+            RelayMetrics.Get().IncrementCounter("ImageWorker.Timeouts")
+            self.Logger.warn(f"ImageWorker {self.Index} job timed out, restarting the worker process.")
+            self._StopProcess()
+            return
+        try:
+            (result, logs) = self.Conn.recv()
+        except EOFError:
+            # The process died, most likely from a bad image.
+            RelayMetrics.Get().IncrementCounter("ImageWorker.Failures")
+            self.Logger.warn(f"ImageWorker {self.Index} process exited while processing a job, restarting the worker process.")
+            self._StopProcess()
+            return
+
+        # Replay the worker's logs into our logger.
+        for level, msg in logs:
+            self.Logger.log(level, msg)
+
+        # The result is None if the snapshot wasn't changed, the length in the shared buffer, or the new snapshot buffer.
+        if result is None:
+            job.Result = job.Snapshot
+        elif isinstance(result, int):
+            job.Result = bytes(self.SharedView[:result])
+        else:
+            job.Result = result
+
+
+    def _EnsureProcess(self):
+        if self.Process is not None and self.Process.is_alive():
+            return
+        self._StopProcess()
+        parentConn, childConn = self.Context.Pipe()
+        self.Process = self.Context.Process(target=_ImageWorkerMain, args=(childConn, self.SharedBuffer), name=f"OctoEverywhere-ImageWorker-{self.Index}", daemon=True)
+        self.Process.start()
+        # The child has its own copy of its end of the pipe now.
+        childConn.close()
+        self.Conn = parentConn
+        RelayMetrics.Get().IncrementCounter("ImageWorker.ProcessStarts")
+
+
+    def _StopProcess(self):
+        conn = self.Conn
+        process = self.Process
+        self.Conn = None
+        self.Process = None
+        try:
+            if conn is not None:
+                conn.close()
+        except Exception:
+            pass
+        try:
+            if process is not None:
+                # Closing the pipe ends the worker loop, but if it's stuck on a job it needs to be killed.
+                process.join(0.5)
+                if process.is_alive():
+                    process.kill()
+                    process.join(1.0)
+        except Exception as e:
+            Sentry.Exception("ImageWorker failed to stop the worker process.", e)
+
+
+# Collects the worker's logs, so they can be sent back with the result and logged by the plugin process.
+class _LogCaptureHandler(logging.Handler):
+
+    def __init__(self):
+        super().__init__()
+        self.Records = []
+
+
+    def emit(self, record):
+        self.Records.append((record.levelno, self.format(record)))
+
+
+    def Pop(self) -> list:
+        records = self.Records
+        self.Records = []
+        return records
+
+
+# The main function of the worker processes.
+def _ImageWorkerMain(conn, sharedBuffer):
+    logger = logging.getLogger("ImageWorker")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    capture = _LogCaptureHandler()
+    logger.addHandler(capture)
+    Sentry.SetLogger(logger)
+    sharedView = memoryview(sharedBuffer).cast("B")
+    while True:
+        try:
+            (payload, flipH, flipV, rotation, snapshotResizeParams) = conn.recv()
+        except (EOFError, OSError):
+            # The plugin process closed the pipe, so we are done.
+            return
+        # Copy the frame out of the shared buffer, since the result might be written back into it.
+        snapshot = bytes(sharedView[:payload]) if isinstance(payload, int) else payload
+        out = SnapshotImageProcessor.ProcessSnapshot(logger, snapshot, flipH, flipV, rotation, snapshotResizeParams)
+        result = None
+        if out is not snapshot:
+            if len(out) <= len(sharedView):
+                sharedView[:len(out)] = out
+                result = len(out)
+            else:
+                result = out
+        try:
+            conn.send((result, capture.Pop()))
+        except (EOFError, OSError):
+            # The plugin process gave up on the job and closed the pipe.
+            return
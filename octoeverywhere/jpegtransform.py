@@ -0,0 +1,197 @@
+import math
+import shutil
+import logging
+import subprocess
+
+from .sentry import Sentry
+
+
+# Does lossless rotates and flips of jpegs, in the DCT domain, without decoding and re-encoding the image.
+#
+# A full decode, transpose, and re-encode costs hundreds of milliseconds of CPU on a Pi for a 1080p frame, and each pass loses quality.
+# Rotates and flips can be done by reordering and transposing the DCT blocks of the jpeg instead, which is much faster and is lossless.
+# We use jpegtran for that, which is part of libjpeg-turbo and is installed on most systems with it or can be installed by the installer.
+# If jpegtran isn't installed or it fails on the image, the caller falls back to the PIL path.
+#
+# When the PIL path is used to scale the image down, this also finds the reduced scale the jpeg decoder can decode at,
+# so the image is never decoded at a larger size than the resize needs, or than c_MaxDecodePixels.
+class JpegTransform:
+
+    # The max amount of time a transform can take, before we give up and fall back.
+    c_TimeoutSec = 5.0
+
+    # The max number of pixels we will decode for a snapshot, which bounds the decode time and memory.
+    # Larger jpegs are decoded at a reduced scale, and if even the smallest scale is too large, the image isn't decoded.
+    c_MaxDecodePixels = 3840 * 2160
+
+    # The reduced scales the jpeg decoder supports, from the smallest to the largest.
+    c_DraftScales = (8, 4, 2)
+
+    # The jpeg SOF markers, which hold the image size. C4, C8, and CC aren't SOF markers.
+    c_SofMarkers = (0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF)
+
+    # The path to jpegtran, found on the first use. An empty string means it's not installed.
+    _JpegTranPath = None
+
+
+    # Returns the path to jpegtran or None if it's not installed.
+    @staticmethod
+    def GetJpegTranPath() -> str:
+        if JpegTransform._JpegTranPath is None:
+            path = shutil.which("jpegtran")
+            JpegTransform._JpegTranPath = path if path is not None else ""
+        if len(JpegTransform._JpegTranPath) == 0:
+            return None
+        return JpegTransform._JpegTranPath
+
+
+    # Returns True if the image would change size with the given rotation, because the width and height are swapped.
+    @staticmethod
+    def IsRotationSizeSwapped(rotation:int) -> bool:
+        return rotation % 180 != 0
+
+
+    # Parses the jpeg headers to get the (width, height) of the image, without decoding it.
+    # Returns None if the buffer isn't a jpeg or the size can't be found.
+    @staticmethod
+    def GetJpegSize(buf) -> tuple:
+        if buf is None or len(buf) < 4 or buf[0] != 0xFF or buf[1] != 0xD8:
+            return None
+        i = 2
+        bufLen = len(buf)
+        while i + 4 <= bufLen:
+            if buf[i] != 0xFF:
+                return None
+            marker = buf[i+1]
+            # Fill bytes
+            if marker == 0xFF:
+                i += 1
+                continue
+            # Markers with no length.
+            if marker == 0x01 or (marker >= 0xD0 and marker <= 0xD8):
+                i += 2
+                continue
+            # If we hit the start of scan or the end of the image, there's no size.
+            if marker == 0xDA or marker == 0xD9:
+                return None
+            length = (buf[i+2] << 8) | buf[i+3]
+            if marker in JpegTransform.c_SofMarkers:
+                if i + 9 > bufLen:
+                    return None
+                height = (buf[i+5] << 8) | buf[i+6]
+                width = (buf[i+7] << 8) | buf[i+8]
+                return (width, height)
+            i += 2 + length
+        return None
+
+
+    # Returns the scale factor the resize params will scale the image by after it's rotated, or None if it won't be scaled.
+    # This matches the resize logic in NotificationsHandler.GetNotificationSnapshot
+    @staticmethod
+    def GetResizeScale(size:tuple, rotation:int, snapshotResizeParams) -> float:
+        if snapshotResizeParams is None:
+            return None
+        width, height = size
+        if JpegTransform.IsRotationSizeSwapped(rotation):
+            width, height = height, width
+        if snapshotResizeParams.CropSquareCenterNoPadding:
+            # The smallest side is scaled to the size, and the other side is cropped.
+            if height >= snapshotResizeParams.Size and width >= snapshotResizeParams.Size:
+                return float(snapshotResizeParams.Size) / float(min(width, height))
+            return None
+        if snapshotResizeParams.ResizeToHeight and height > snapshotResizeParams.Size:
+            return float(snapshotResizeParams.Size) / float(height)
+        if snapshotResizeParams.ResizeToWidth and width > snapshotResizeParams.Size:
+            return float(snapshotResizeParams.Size) / float(width)
+        return None
+
+
+    # Returns True if the image is too large to decode, even at the smallest reduced scale.
+    @staticmethod
+    def IsTooLargeToDecode(size:tuple) -> bool:
+        smallest = JpegTransform.c_DraftScales[0]
+        return (size[0] // smallest) * (size[1] // smallest) > JpegTransform.c_MaxDecodePixels
+
+
+    # Returns the size to pass to the PIL jpeg draft() function, which decodes the jpeg at 1/2, 1/4, or 1/8 scale, or None if a full decode is needed.
+    # The draft size is the smallest size that's still at least as large as the resize target, so the resize still does the final scale,
+    # and it's also small enough that no more than c_MaxDecodePixels are decoded.
+    @staticmethod
+    def GetDraftSize(size:tuple, rotation:int, snapshotResizeParams) -> tuple:
+        width, height = size
+        if width <= 0 or height <= 0:
+            return None
+        draftWidth = width
+        draftHeight = height
+
+        # If the image will be scaled down, the decoder only needs to produce the final size.
+        scale = JpegTransform.GetResizeScale(size, rotation, snapshotResizeParams)
+        if scale is not None:
+            draftWidth = math.ceil(width * scale)
+            draftHeight = math.ceil(height * scale)
+
+        # If the image is too large to decode, find the smallest reduced scale that fits.
+        # PIL picks the largest scale that's less than or equal to the source size divided by the draft size, so use the floor.
+        if width * height > JpegTransform.c_MaxDecodePixels:
+            for s in reversed(JpegTransform.c_DraftScales):
+                if (width // s) * (height // s) <= JpegTransform.c_MaxDecodePixels:
+                    draftWidth = min(draftWidth, width // s)
+                    draftHeight = min(draftHeight, height // s)
+                    break
+
+        # The decoder can only reduce by at least half, so don't bother if it's not going to do anything.
+        if draftWidth * 2 > width or draftHeight * 2 > height:
+            return None
+        return (max(1, draftWidth), max(1, draftHeight))
+
+
+    # Converts the flips and rotation into the single jpegtran transform that has the same result.
+    # The flips are applied first, then the clockwise rotation, which matches the order the PIL path uses.
+    # Returns the list of jpegtran args, an empty list if the image isn't changed.
+    @staticmethod
+    def GetJpegTranArgs(flipH:bool, flipV:bool, rotation:int) -> list:
+        rotation = rotation % 360
+        # A horizontal and vertical flip is the same as a 180 rotation, and a vertical flip is a horizontal flip with a 180 rotation.
+        if flipV:
+            rotation = (rotation + 180) % 360
+            flipH = not flipH
+        if flipH is False:
+            if rotation == 0:
+                return []
+            return ["-rotate", str(rotation)]
+        if rotation == 0:
+            return ["-flip", "horizontal"]
+        if rotation == 90:
+            return ["-transverse"]
+        if rotation == 180:
+            return ["-flip", "vertical"]
+        return ["-transpose"]
+
+
+    # Does a lossless rotate and flip of the jpeg buffer.
+    # Returns the new jpeg buffer, or None if jpegtran isn't installed or it failed, in which case the caller should fall back.
+    @staticmethod
+    def TryLosslessTransform(logger:logging.Logger, buf, flipH:bool, flipV:bool, rotation:int) -> bytes:
+        jpegTranPath = JpegTransform.GetJpegTranPath()
+        if jpegTranPath is None:
+            return None
+        transformArgs = JpegTransform.GetJpegTranArgs(flipH, flipV, rotation)
+        if len(transformArgs) == 0:
+            return buf
+        try:
+            # Trim drops any partial blocks on the edges that can't be transformed, which is at most 15 pixels, only when the image size isn't a multiple of the block size.
+            # We don't copy the markers, since an EXIF orientation would no longer be correct.
+            args = [jpegTranPath, "-copy", "none", "-trim"]
+            args.extend(transformArgs)
+            result = subprocess.run(args, input=bytes(buf), stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=JpegTransform.c_TimeoutSec, check=False)
+            # jpegtran returns 2 for warnings, like a truncated image, in which case we fall back so PIL can handle it.
+            out = result.stdout
+            if result.returncode != 0 or out is None or len(out) < 2 or out[0] != 0xFF or out[1] != 0xD8:
+                logger.info(f"JpegTransform jpegtran failed, falling back. Code: {result.returncode}, Error: {result.stderr.decode(errors='replace').strip()}")
+                return None
+            return out
+        except subprocess.TimeoutExpired:
+            logger.warn("JpegTransform jpegtran timed out, falling back.")
+        except Exception as e:
+            Sentry.Exception("JpegTransform failed to run jpegtran.", e)
+        return None
@@ -1,5 +1,8 @@
+import time
+import asyncio
 import platform
 import logging
+import threading
 
 import requests
 
@@ -7,7 +10,11 @@ from .mdns import MDns
 from .compat import Compat
 from .localip import LocalIpHelper
 from .httpsessions import HttpSessions
+from .relaymetrics import RelayMetrics
+from .httproutecache import HttpRouteCache
+from .httpuploadpipe import HttpUploadPipe
 from .octostreammsgbuilder import OctoStreamMsgBuilder
+from .asynchttpresponse import AsyncHttpResponse
 
 from .Proto.PathTypes import PathTypes
 from .Proto.DataCompression import DataCompression
@@ -19,6 +26,15 @@ class OctoHttpRequest:
     LocalOctoPrintPort = 5000
     LocalHostAddress = "127.0.0.1"
     DisableHttpRelay = False
+    EnableUrlRacing = False
+    EnableStreamingUploads = False
+    EnablePipelinedBodyRelay = False
+
+    # When url racing is enabled, this is how long we wait on an attempt before the next candidate url is started in parallel.
+    c_UrlRaceStaggerSec = 0.25
+
+    # The names of the attempts, indexed by the HttpRouteCache attempt index.
+    c_AttemptNames = ["Main request", "Http proxy fallback", "Local IP Http Proxy Fallback", "Local IP fallback", "Webcam hardcode fallback"]
 
     @staticmethod
     def SetLocalHttpProxyPort(port):
@@ -55,6 +71,31 @@ class OctoHttpRequest:
     def GetDisableHttpRelay() -> bool:
         return OctoHttpRequest.DisableHttpRelay
 
+    # When enabled, idempotent requests will start the next url in the fallback chain in parallel if the current attempt is slow,
+    # rather than waiting for it to fail. The first acceptable response wins.
+    @staticmethod
+    def SetEnableUrlRacing(enableUrlRacing:bool):
+        OctoHttpRequest.EnableUrlRacing = enableUrlRacing
+    @staticmethod
+    def GetEnableUrlRacing() -> bool:
+        return OctoHttpRequest.EnableUrlRacing
+
+    # When enabled, large request bodies are streamed to the local http server as they arrive, rather than being collected in memory first.
+    @staticmethod
+    def SetEnableStreamingUploads(enableStreamingUploads:bool):
+        OctoHttpRequest.EnableStreamingUploads = enableStreamingUploads
+    @staticmethod
+    def GetEnableStreamingUploads() -> bool:
+        return OctoHttpRequest.EnableStreamingUploads
+
+    # When enabled, large response bodies with a known length are relayed with the body read, compression, and send running at the same time.
+    @staticmethod
+    def SetEnablePipelinedBodyRelay(enablePipelinedBodyRelay:bool):
+        OctoHttpRequest.EnablePipelinedBodyRelay = enablePipelinedBodyRelay
+    @staticmethod
+    def GetEnablePipelinedBodyRelay() -> bool:
+        return OctoHttpRequest.EnablePipelinedBodyRelay
+
 
     # Based on the URL passed, this will return PathTypes.Relative or PathTypes.Absolute
     @staticmethod
@@ -234,12 +275,10 @@ class OctoHttpRequest:
         # Make the common call.
         return OctoHttpRequest.MakeHttpCall(logger, path, pathType, method, headers, data)
 
-    # allowRedirects should be false for all proxy calls. If it's true, then the content returned might be from a redirected URL and the actual URL will be incorrect.
-    # Instead, the system needs to handle the redirect 301 or 302 call as normal, sending it back to the caller, and allowing them to follow the redirect if needed.
-    # The X-Forwarded-Host header will tell the OctoPrint server the correct place to set the location redirect header.
-    # However, for calls that aren't proxy calls, things like local snapshot requests and such, we want to allow redirects to be more robust.
+    # Builds the main URL and the fallback URLs for a http call.
+    # Returns url, fallbackUrl, fallbackWebcamUrl, fallbackLocalIpOctoPrintPortSuffix, fallbackLocalIpHttpProxySuffix, httpProxyProtocol
     @staticmethod
-    def MakeHttpCall(logger, pathOrUrl, pathOrUrlType, method, headers, data=None, allowRedirects=False) -> Result:
+    def _BuildCallUrls(pathOrUrl, pathOrUrlType):
         # First of all, we need to figure out what the URL is. There are two options
         #
         # 1) Absolute URLs
@@ -348,11 +387,27 @@ class OctoHttpRequest:
         else:
             raise Exception("Http request got a message with an unknown path type. "+str(pathOrUrlType))
 
+        return url, fallbackUrl, fallbackWebcamUrl, fallbackLocalIpOctoPrintPortSuffix, fallbackLocalIpHttpProxySuffix, httpProxyProtocol
+
+
+    # Shared by the sync and async http call paths, this normalizes the data and headers before the request is made.
+    @staticmethod
+    def _PrepareCallDataAndHeaders(headers, data):
         # Ensure if there's no data we don't set it. Sometimes our json message parsing will leave an empty
         # bytearray where it should be None.
-        if data is not None and len(data) == 0:
+        if data is not None and isinstance(data, HttpUploadPipe) is False and len(data) == 0:
             data = None
 
+        # For upload pipes, the content length must match the body we send, so any length from the original request is replaced.
+        # If the size isn't known, there's no content length and the body is sent chunked.
+        if isinstance(data, HttpUploadPipe):
+            if headers is None:
+                headers = {}
+            for name in [name for name in headers.keys() if name.lower() == "content-length"]:
+                del headers[name]
+            if data.KnownSizeBytes is not None:
+                headers["Content-Length"] = str(data.KnownSizeBytes)
+
         # All of the users of MakeHttpCall don't handle compressed responses.
         # For OctoStream request, this header is already set in GatherRequestHeaders, but for things like webcam snapshot requests and such, it's not set.
         # Beyond nothing handling compressed responses, since the call is almost always over localhost, there's no point in doing compression, since it mainly just helps in transmit less data.
@@ -361,6 +416,39 @@ class OctoHttpRequest:
         if headers is None:
             headers = {}
         headers["Accept-Encoding"] = "identity"
+        return headers, data
+
+
+    # allowRedirects should be false for all proxy calls. If it's true, then the content returned might be from a redirected URL and the actual URL will be incorrect.
+    # Instead, the system needs to handle the redirect 301 or 302 call as normal, sending it back to the caller, and allowing them to follow the redirect if needed.
+    # The X-Forwarded-Host header will tell the OctoPrint server the correct place to set the location redirect header.
+    # However, for calls that aren't proxy calls, things like local snapshot requests and such, we want to allow redirects to be more robust.
+    @staticmethod
+    def MakeHttpCall(logger, pathOrUrl, pathOrUrlType, method, headers, data=None, allowRedirects=False) -> Result:
+        # Build the main URL and all of the fallbacks, see _BuildCallUrls for details.
+        url, fallbackUrl, fallbackWebcamUrl, fallbackLocalIpOctoPrintPortSuffix, fallbackLocalIpHttpProxySuffix, httpProxyProtocol = OctoHttpRequest._BuildCallUrls(pathOrUrl, pathOrUrlType)
+        headers, data = OctoHttpRequest._PrepareCallDataAndHeaders(headers, data)
+
+        # If the route cache is enabled and we have learned which attempt of the chain works for this path, go right to it.
+        # If the route cache is off, there's no route key and the full chain runs as normal.
+        routeKey, routeConfig = OctoHttpRequest._GetRouteKeyAndConfig(pathOrUrl, pathOrUrlType)
+        if routeKey is not None:
+            learnedAttempt = HttpRouteCache.Get().GetLearnedAttempt(routeKey, routeConfig)
+            if learnedAttempt is not None:
+                learnedUrl = OctoHttpRequest._GetAttemptUrl(learnedAttempt, url, fallbackUrl, fallbackWebcamUrl, fallbackLocalIpOctoPrintPortSuffix, fallbackLocalIpHttpProxySuffix, httpProxyProtocol)
+                if learnedUrl is not None:
+                    # Pass the main url as the next fallback, so if this fails the attempt doesn't end the chain and we run the full chain below.
+                    ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Learned route", method, learnedUrl, headers, data, None, True, url, allowRedirects)
+                    if ret.IsChainDone:
+                        HttpRouteCache.Get().ReportHit(routeKey)
+                        return ret.Result
+                    OctoHttpRequest._CloseUnusedResult(ret.Result, None)
+                HttpRouteCache.Get().ReportFailure(routeKey)
+
+        # If enabled, race the urls rather than walking the chain one at a time.
+        if OctoHttpRequest._ShouldRaceUrls(method, data):
+            urlArgs = (url, fallbackUrl, fallbackWebcamUrl, fallbackLocalIpOctoPrintPortSuffix, fallbackLocalIpHttpProxySuffix, httpProxyProtocol)
+            return OctoHttpRequest._MakeHttpCallRace(logger, method, headers, allowRedirects, urlArgs, routeKey, routeConfig)
 
         # First, try the main URL.
         # For the first main url, we set the main response to None and is fallback to False.
@@ -378,7 +466,7 @@ class OctoHttpRequest:
         # If the function reports the chain is done, the next fallback URL is invalid and we should always return
         # whatever is in the Response, even if it's None.
         if ret.IsChainDone:
-            return ret.Result
+            return OctoHttpRequest._LearnRouteIfSuccess(routeKey, routeConfig, HttpRouteCache.AttemptHttpProxy, ret.Result, mainResult)
 
         # Try to get the local IP of this device and try to use the same ports with it.
         # We build these full URLs after the failures so we don't try to get the local IP on every call.
@@ -391,7 +479,7 @@ class OctoHttpRequest:
         # If the function reports the chain is done, the next fallback URL is invalid and we should always return
         # whatever is in the Response, even if it's None.
         if ret.IsChainDone:
-            return ret.Result
+            return OctoHttpRequest._LearnRouteIfSuccess(routeKey, routeConfig, HttpRouteCache.AttemptLocalIpHttpProxy, ret.Result, mainResult)
 
         # Now try the OcotoPrint direct port with the local IP.
         localIpFallbackUrl = "http://" + localIp + fallbackLocalIpOctoPrintPortSuffix
@@ -399,14 +487,235 @@ class OctoHttpRequest:
         # If the function reports the chain is done, the next fallback URL is invalid and we should always return
         # whatever is in the Response, even if it's None.
         if ret.IsChainDone:
-            return ret.Result
+            return OctoHttpRequest._LearnRouteIfSuccess(routeKey, routeConfig, HttpRouteCache.AttemptLocalIpOctoPrint, ret.Result, mainResult)
 
         # If all others fail, try the hardcoded webcam URL.
         # Note this has to be last, because there commonly isn't a fallbackWebcamUrl, so it will stop the
         # chain of other attempts.
         ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Webcam hardcode fallback", method, fallbackWebcamUrl, headers, data, mainResult, True, None, allowRedirects)
         # No matter what, always return the result now.
-        return ret.Result
+        return OctoHttpRequest._LearnRouteIfSuccess(routeKey, routeConfig, HttpRouteCache.AttemptWebcamHardcode, ret.Result, mainResult)
+
+
+    # Returns the route cache key and config for the call, or None, None if the route cache can't be used.
+    # The route cache is only used for relative paths, since absolute URLs don't have the fallback chain.
+    # If the route cache option is off, the cache isn't setup and this always returns None, None.
+    @staticmethod
+    def _GetRouteKeyAndConfig(pathOrUrl, pathOrUrlType):
+        if pathOrUrlType != PathTypes.Relative or HttpRouteCache.Get() is None:
+            return None, None
+        routeKey = HttpRouteCache.GetRouteKey(pathOrUrl)
+        if routeKey is None:
+            return None, None
+        # If any of the local addresses or ports change, the learned routes are no longer valid.
+        config = f"{OctoHttpRequest.LocalHostAddress}|{OctoHttpRequest.LocalOctoPrintPort}|{OctoHttpRequest.LocalHttpProxyPort}|{OctoHttpRequest.LocalHttpProxyIsHttps}"
+        return routeKey, config
+
+
+    # Returns the URL for the given attempt index, or None if that attempt isn't possible for this call.
+    @staticmethod
+    def _GetAttemptUrl(attempt, url, fallbackUrl, fallbackWebcamUrl, fallbackLocalIpOctoPrintPortSuffix, fallbackLocalIpHttpProxySuffix, httpProxyProtocol):
+        if attempt == HttpRouteCache.AttemptMain:
+            return url
+        if attempt == HttpRouteCache.AttemptHttpProxy:
+            return fallbackUrl
+        if attempt == HttpRouteCache.AttemptWebcamHardcode:
+            return fallbackWebcamUrl
+        if attempt == HttpRouteCache.AttemptLocalIpHttpProxy and fallbackLocalIpHttpProxySuffix is not None:
+            return httpProxyProtocol + LocalIpHelper.TryToGetLocalIp() + fallbackLocalIpHttpProxySuffix
+        if attempt == HttpRouteCache.AttemptLocalIpOctoPrint and fallbackLocalIpOctoPrintPortSuffix is not None:
+            return "http://" + LocalIpHelper.TryToGetLocalIp() + fallbackLocalIpOctoPrintPortSuffix
+        return None
+
+
+    # If the result of the attempt is a success, and not the main result the chain fell back to, the route is learned.
+    # Always returns the result.
+    @staticmethod
+    def _LearnRouteIfSuccess(routeKey, routeConfig, attempt, result, mainResult):
+        if routeKey is not None and result is not None and result is not mainResult and result.StatusCode != 404:
+            HttpRouteCache.Get().LearnRoute(routeKey, routeConfig, attempt)
+        return result
+
+    #
+    # Url racing, aka "happy eyeballs" for the fallback chain.
+    #
+    # Rather than waiting for each attempt to fail before trying the next url, the next candidate is started in parallel if the
+    # current attempts haven't finished after c_UrlRaceStaggerSec. If an attempt fails, the next candidate is started right away.
+    # The first acceptable (non-404) response wins, and all of the other responses are closed.
+    # If no attempt wins, the result is the same as the chain: the main url response if there was one, otherwise any response we got.
+    #
+    # This is only used for idempotent requests with no body, since the request might be sent more than once.
+    #
+
+    @staticmethod
+    def _ShouldRaceUrls(method:str, data) -> bool:
+        if OctoHttpRequest.EnableUrlRacing is False or data is not None:
+            return False
+        methodUpper = method.upper()
+        return methodUpper == "GET" or methodUpper == "HEAD"
+
+
+    # Returns the next candidate as (url, attempt, nextAttempt), url will be None if there are no more candidates.
+    @staticmethod
+    def _GetNextRaceCandidate(nextAttempt:int, urlArgs):
+        while nextAttempt <= HttpRouteCache.AttemptWebcamHardcode:
+            attempt = nextAttempt
+            nextAttempt += 1
+            # The local ip fallbacks are only used if the http proxy fallback exists, like the chain does.
+            if attempt >= HttpRouteCache.AttemptLocalIpHttpProxy and urlArgs[1] is None:
+                return None, None, nextAttempt
+            url = OctoHttpRequest._GetAttemptUrl(attempt, *urlArgs)
+            if url is not None:
+                return url, attempt, nextAttempt
+        return None, None, nextAttempt
+
+
+    # Holds the shared state of a sync url race.
+    class UrlRaceContext():
+        def __init__(self):
+            self.Condition = threading.Condition()
+            self.Running = 0
+            self.Completions = 0
+            self.IsDone = False
+            self.WinnerAttempt = None
+            self.WinnerResult = None
+            self.MainResult = None
+            self.OtherResults = []
+
+
+    @staticmethod
+    def _MakeHttpCallRace(logger, method, headers, allowRedirects, urlArgs, routeKey, routeConfig) -> Result:
+        ctx = OctoHttpRequest.UrlRaceContext()
+        nextAttempt = HttpRouteCache.AttemptMain
+        metrics = RelayMetrics.Get()
+        while True:
+            # Start the next candidate, if there is one.
+            url, attempt, nextAttempt = OctoHttpRequest._GetNextRaceCandidate(nextAttempt, urlArgs)
+            if url is not None:
+                with ctx.Condition:
+                    if ctx.Running > 0:
+                        metrics.IncrementCounter("Http.UrlRace.ParallelStarts")
+                    ctx.Running += 1
+                t = threading.Thread(target=OctoHttpRequest._UrlRaceAttemptThread, args=(ctx, logger, attempt, url, method, headers, allowRedirects), name="UrlRaceAttempt")
+                t.daemon = True
+                t.start()
+            hasMoreCandidates = url is not None and nextAttempt <= HttpRouteCache.AttemptWebcamHardcode
+
+            with ctx.Condition:
+                # Wait until there's a winner, an attempt finishes, or the stagger time is up.
+                startCompletions = ctx.Completions
+                deadline = time.time() + OctoHttpRequest.c_UrlRaceStaggerSec
+                while ctx.WinnerResult is None and ctx.Running > 0 and ctx.Completions == startCompletions:
+                    if hasMoreCandidates is False:
+                        ctx.Condition.wait()
+                        continue
+                    remainingSec = deadline - time.time()
+                    if remainingSec <= 0:
+                        break
+                    ctx.Condition.wait(remainingSec)
+
+                # If we have a winner, or there's nothing left to wait on or start, we are done.
+                if ctx.WinnerResult is not None or (ctx.Running == 0 and hasMoreCandidates is False):
+                    ctx.IsDone = True
+                    if ctx.WinnerResult is not None:
+                        result = ctx.WinnerResult
+                        if ctx.WinnerAttempt != HttpRouteCache.AttemptMain:
+                            metrics.IncrementCounter("Http.UrlRace.FallbackWins")
+                            OctoHttpRequest._LearnRouteIfSuccess(routeKey, routeConfig, ctx.WinnerAttempt, result, ctx.MainResult)
+                    else:
+                        result = ctx.MainResult if ctx.MainResult is not None else (ctx.OtherResults[0] if len(ctx.OtherResults) > 0 else None)
+                    # Close everything we aren't returning, any attempts still running will close their own results.
+                    OctoHttpRequest._CloseUnusedResult(ctx.MainResult, result)
+                    for r in ctx.OtherResults:
+                        OctoHttpRequest._CloseUnusedResult(r, result)
+                    return result
+
+
+    @staticmethod
+    def _UrlRaceAttemptThread(ctx, logger, attempt, url, method, headers, allowRedirects):
+        ret = None
+        try:
+            # Pass the url as the next fallback, so failures don't end the chain and a valid response always means success.
+            ret = OctoHttpRequest.MakeHttpCallAttempt(logger, OctoHttpRequest.c_AttemptNames[attempt], method, url, headers, None, None, attempt != HttpRouteCache.AttemptMain, url, allowRedirects)
+        except Exception as e:
+            logger.info(f"Url race attempt {attempt} threw an exception: {e}")
+        with ctx.Condition:
+            ctx.Running -= 1
+            ctx.Completions += 1
+            result = ret.Result if ret is not None else None
+            if ctx.IsDone:
+                # The race is already over, so this result will never be used.
+                OctoHttpRequest._CloseUnusedResult(result, None)
+            elif ret is not None and ret.IsChainDone and ctx.WinnerResult is None:
+                ctx.WinnerAttempt = attempt
+                ctx.WinnerResult = result
+            elif result is not None:
+                if attempt == HttpRouteCache.AttemptMain:
+                    ctx.MainResult = result
+                else:
+                    ctx.OtherResults.append(result)
+            ctx.Condition.notify_all()
+
+
+    @staticmethod
+    async def _MakeHttpCallRaceAsync(logger, engine, method, headers, allowRedirects, urlArgs, routeKey, routeConfig) -> Result:
+        metrics = RelayMetrics.Get()
+        tasks = {}
+        mainResult = None
+        otherResults = []
+        result = None
+        nextAttempt = HttpRouteCache.AttemptMain
+        try:
+            while True:
+                # Start the next candidate, if there is one.
+                url, attempt, nextAttempt = OctoHttpRequest._GetNextRaceCandidate(nextAttempt, urlArgs)
+                if url is not None:
+                    if len(tasks) > 0:
+                        metrics.IncrementCounter("Http.UrlRace.ParallelStarts")
+                    coroutine = OctoHttpRequest.MakeHttpCallAttemptAsync(logger, engine, OctoHttpRequest.c_AttemptNames[attempt], method, url, headers, None, None, attempt != HttpRouteCache.AttemptMain, url, allowRedirects)
+                    tasks[asyncio.ensure_future(coroutine)] = attempt
+                hasMoreCandidates = url is not None and nextAttempt <= HttpRouteCache.AttemptWebcamHardcode
+
+                # If there's nothing left to wait on or start, we are done.
+                if len(tasks) == 0:
+                    if hasMoreCandidates:
+                        continue
+                    result = mainResult if mainResult is not None else (otherResults[0] if len(otherResults) > 0 else None)
+                    return result
+
+                # Wait until an attempt finishes, or the stagger time is up.
+                done, _ = await asyncio.wait(list(tasks.keys()), timeout=OctoHttpRequest.c_UrlRaceStaggerSec if hasMoreCandidates else None, return_when=asyncio.FIRST_COMPLETED)
+                for t in done:
+                    doneAttempt = tasks.pop(t)
+                    ret = None
+                    try:
+                        ret = t.result()
+                    except Exception as e:
+                        logger.info(f"Url race attempt {doneAttempt} threw an exception: {e}")
+                    doneResult = ret.Result if ret is not None else None
+                    if ret is not None and ret.IsChainDone and result is None:
+                        result = doneResult
+                        if doneAttempt != HttpRouteCache.AttemptMain:
+                            metrics.IncrementCounter("Http.UrlRace.FallbackWins")
+                            OctoHttpRequest._LearnRouteIfSuccess(routeKey, routeConfig, doneAttempt, result, mainResult)
+                    elif doneResult is not None:
+                        if doneAttempt == HttpRouteCache.AttemptMain:
+                            mainResult = doneResult
+                        else:
+                            otherResults.append(doneResult)
+                if result is not None:
+                    return result
+        finally:
+            # Cancel any attempts still running, and close all of the responses we aren't returning.
+            for t in tasks:
+                if t.done() and t.cancelled() is False and t.exception() is None and t.result() is not None:
+                    OctoHttpRequest._CloseUnusedResult(t.result().Result, result)
+                else:
+                    t.cancel()
+            OctoHttpRequest._CloseUnusedResult(mainResult, result)
+            for r in otherResults:
+                OctoHttpRequest._CloseUnusedResult(r, result)
+
 
     # Returned by a single http request attempt.
     # IsChainDone - indicates if the fallback chain is done and the response should be returned
@@ -427,6 +736,7 @@ class OctoHttpRequest:
     # This function should always return a AttemptResult object.
     @staticmethod
     def MakeHttpCallAttempt(logger, attemptName, method, url, headers, data, mainResult, isFallback, nextFallbackUrl, allowRedirects:bool = False):
+        attemptStartSec = time.time()
         response = None
         try:
             # Try to make the http call.
@@ -444,7 +754,7 @@ class OctoHttpRequest:
             # This means that response.content will not be valid and we will always use the iter_content. But it also means
             # iter_content will ready into memory on demand and throw when the stream is consumed. This is important, because
             # our logic relies on the exception when the stream is consumed to end the http response stream.
-            response = HttpSessions.GetSession(url).request(method, url, headers=headers, data=data, timeout=1800, allow_redirects=allowRedirects, stream=True, verify=False)
+            response = HttpSessions.GetSession(url).request(method, url, headers=headers, data=OctoHttpRequest._GetAttemptBody(data), timeout=1800, allow_redirects=allowRedirects, stream=True, verify=False)
         except Exception as e:
             logger.info(attemptName + " http URL threw an exception: "+str(e))
 
@@ -459,10 +769,12 @@ class OctoHttpRequest:
             else:
                 logger.warn(url + " http call returned no response on Windows. Trying again with no headers.")
             try:
-                response = HttpSessions.GetSession(url).request(method, url, headers={}, data=data, timeout=1800, allow_redirects=False, stream=True, verify=False)
+                response = HttpSessions.GetSession(url).request(method, url, headers=OctoHttpRequest._GetNoHeadersRetryHeaders(data), data=OctoHttpRequest._GetAttemptBody(data), timeout=1800, allow_redirects=False, stream=True, verify=False)
             except Exception as e:
                 logger.info(attemptName + " http NO HEADERS URL threw an exception: "+str(e))
 
+        OctoHttpRequest._RecordAttemptMetrics(attemptStartSec, isFallback)
+
         # Check if we got a valid response.
         if response is not None and response.status_code != 404:
             # We got a valid response, we are done.
@@ -491,8 +803,213 @@ class OctoHttpRequest:
             return OctoHttpRequest.AttemptResult(True, None)
 
 
+    # Returns the body to send for an attempt. Upload pipes can only be read once, so each attempt gets a new body that starts from the beginning.
+    # If the pipe can't be sent again this throws, which fails the attempt.
+    @staticmethod
+    def _GetAttemptBody(data, engine = None):
+        if isinstance(data, HttpUploadPipe):
+            if engine is not None:
+                return data.CreateAsyncBody(engine)
+            return data.CreateBody()
+        return data
+
+
+    # The 431 retry sends no headers, but an upload pipe with a known size still needs the content length.
+    @staticmethod
+    def _GetNoHeadersRetryHeaders(data) -> dict:
+        if isinstance(data, HttpUploadPipe) and data.KnownSizeBytes is not None:
+            return {"Content-Length": str(data.KnownSizeBytes)}
+        return {}
+
+
+    # Records the time of each attempt, and how many times we had to move down the fallback chain.
+    @staticmethod
+    def _RecordAttemptMetrics(attemptStartSec:float, isFallback:bool):
+        metrics = RelayMetrics.Get()
+        metrics.RecordLatency(RelayMetrics.HttpCallAttempt, time.time() - attemptStartSec)
+        if isFallback:
+            metrics.IncrementCounter(RelayMetrics.HttpFallbackHops)
+
+
     @staticmethod
     def _buildHttRequestResultFromResponse(response:requests.Response, url:str, isFallback:bool) -> Result:
         if response is None:
             return None
         return OctoHttpRequest.Result(response.status_code, response.headers, url, isFallback, requestLibResponseObj=response)
+
+
+    #
+    # Async http calls, used by the asyncio relay engine.
+    #
+
+    # When the asyncio relay engine makes a call and the body is known to be this size or smaller, it's read fully on the loop.
+    # That means the response can be processed on the loop without needing a blocking thread for the body reads.
+    c_AsyncFullBodyReadMaxSizeBytes = 512 * 1024
+
+    # The async version of MakeHttpCallOctoStreamHelper, this must be called on the asyncio relay engine loop.
+    @staticmethod
+    async def MakeHttpCallOctoStreamHelperAsync(logger, engine, httpInitialContext, method, headers, data=None):
+        # Get the vars we need from the octostream initial context.
+        path = OctoStreamMsgBuilder.BytesToString(httpInitialContext.Path())
+        if path is None:
+            raise Exception("Http request has no path field in open message.")
+        pathType = httpInitialContext.PathType()
+
+        # Make the common call.
+        return await OctoHttpRequest.MakeHttpCallAsync(logger, engine, path, pathType, method, headers, data)
+
+
+    # The async version of MakeHttpCall, this must be called on the asyncio relay engine loop.
+    # This uses the exact same URL and fallback logic as MakeHttpCall, see it for details.
+    @staticmethod
+    async def MakeHttpCallAsync(logger, engine, pathOrUrl, pathOrUrlType, method, headers, data=None, allowRedirects=False) -> Result:
+        # For absolute URLs, the URL building might need to do a mDNS lookup, so we do it on a blocking thread.
+        if pathOrUrlType == PathTypes.Absolute:
+            urls = await engine.RunBlocking(OctoHttpRequest._BuildCallUrls, pathOrUrl, pathOrUrlType)
+        else:
+            urls = OctoHttpRequest._BuildCallUrls(pathOrUrl, pathOrUrlType)
+        url, fallbackUrl, fallbackWebcamUrl, fallbackLocalIpOctoPrintPortSuffix, fallbackLocalIpHttpProxySuffix, httpProxyProtocol = urls
+        headers, data = OctoHttpRequest._PrepareCallDataAndHeaders(headers, data)
+
+        # Run the same fallback chain as MakeHttpCall.
+        routeKey, routeConfig = OctoHttpRequest._GetRouteKeyAndConfig(pathOrUrl, pathOrUrlType)
+        result = await OctoHttpRequest._MakeHttpCallChainAsync(logger, engine, method, headers, data, allowRedirects, url, fallbackUrl, fallbackWebcamUrl, fallbackLocalIpOctoPrintPortSuffix, fallbackLocalIpHttpProxySuffix, httpProxyProtocol, routeKey, routeConfig)
+
+        # If the body is small, read it now, so it can be processed on the loop.
+        if result is not None:
+            await OctoHttpRequest._ReadSmallAsyncBodyIfPossible(result, method)
+        return result
+
+
+    @staticmethod
+    async def _MakeHttpCallChainAsync(logger, engine, method, headers, data, allowRedirects, url, fallbackUrl, fallbackWebcamUrl, fallbackLocalIpOctoPrintPortSuffix, fallbackLocalIpHttpProxySuffix, httpProxyProtocol, routeKey, routeConfig) -> Result:
+        # Unlike the requests lib, async responses hold a pooled connection until they are closed, so any response we don't return must be closed.
+        # If we have learned which attempt of the chain works for this path, go right to it.
+        if routeKey is not None:
+            learnedAttempt = HttpRouteCache.Get().GetLearnedAttempt(routeKey, routeConfig)
+            if learnedAttempt is not None:
+                learnedUrl = OctoHttpRequest._GetAttemptUrl(learnedAttempt, url, fallbackUrl, fallbackWebcamUrl, fallbackLocalIpOctoPrintPortSuffix, fallbackLocalIpHttpProxySuffix, httpProxyProtocol)
+                if learnedUrl is not None:
+                    ret = await OctoHttpRequest.MakeHttpCallAttemptAsync(logger, engine, "Learned route", method, learnedUrl, headers, data, None, True, url, allowRedirects)
+                    if ret.IsChainDone:
+                        HttpRouteCache.Get().ReportHit(routeKey)
+                        return ret.Result
+                    OctoHttpRequest._CloseUnusedResult(ret.Result, None)
+                HttpRouteCache.Get().ReportFailure(routeKey)
+
+        # If enabled, race the urls rather than walking the chain one at a time.
+        if OctoHttpRequest._ShouldRaceUrls(method, data):
+            urlArgs = (url, fallbackUrl, fallbackWebcamUrl, fallbackLocalIpOctoPrintPortSuffix, fallbackLocalIpHttpProxySuffix, httpProxyProtocol)
+            return await OctoHttpRequest._MakeHttpCallRaceAsync(logger, engine, method, headers, allowRedirects, urlArgs, routeKey, routeConfig)
+
+        ret = await OctoHttpRequest.MakeHttpCallAttemptAsync(logger, engine, "Main request", method, url, headers, data, None, False, fallbackUrl, allowRedirects)
+        if ret.IsChainDone:
+            return ret.Result
+        mainResult = ret.Result
+
+        ret = await OctoHttpRequest.MakeHttpCallAttemptAsync(logger, engine, "Http proxy fallback", method, fallbackUrl, headers, data, mainResult, True, fallbackLocalIpHttpProxySuffix, allowRedirects)
+        if ret.IsChainDone:
+            return OctoHttpRequest._CloseUnusedResult(mainResult, OctoHttpRequest._LearnRouteIfSuccess(routeKey, routeConfig, HttpRouteCache.AttemptHttpProxy, ret.Result, mainResult))
+        OctoHttpRequest._CloseUnusedResult(ret.Result, mainResult)
+
+        localIp = LocalIpHelper.TryToGetLocalIp()
+        localIpFallbackUrl = httpProxyProtocol + localIp + fallbackLocalIpHttpProxySuffix
+        ret = await OctoHttpRequest.MakeHttpCallAttemptAsync(logger, engine, "Local IP Http Proxy Fallback", method, localIpFallbackUrl, headers, data, mainResult, True, fallbackLocalIpOctoPrintPortSuffix, allowRedirects)
+        if ret.IsChainDone:
+            return OctoHttpRequest._CloseUnusedResult(mainResult, OctoHttpRequest._LearnRouteIfSuccess(routeKey, routeConfig, HttpRouteCache.AttemptLocalIpHttpProxy, ret.Result, mainResult))
+        OctoHttpRequest._CloseUnusedResult(ret.Result, mainResult)
+
+        localIpFallbackUrl = "http://" + localIp + fallbackLocalIpOctoPrintPortSuffix
+        ret = await OctoHttpRequest.MakeHttpCallAttemptAsync(logger, engine, "Local IP fallback", method, localIpFallbackUrl, headers, data, mainResult, True, fallbackWebcamUrl, allowRedirects)
+        if ret.IsChainDone:
+            return OctoHttpRequest._CloseUnusedResult(mainResult, OctoHttpRequest._LearnRouteIfSuccess(routeKey, routeConfig, HttpRouteCache.AttemptLocalIpOctoPrint, ret.Result, mainResult))
+        OctoHttpRequest._CloseUnusedResult(ret.Result, mainResult)
+
+        ret = await OctoHttpRequest.MakeHttpCallAttemptAsync(logger, engine, "Webcam hardcode fallback", method, fallbackWebcamUrl, headers, data, mainResult, True, None, allowRedirects)
+        return OctoHttpRequest._CloseUnusedResult(mainResult, OctoHttpRequest._LearnRouteIfSuccess(routeKey, routeConfig, HttpRouteCache.AttemptWebcamHardcode, ret.Result, mainResult))
+
+
+    # Closes the result's response if it's not the result being used. Always returns the used result.
+    @staticmethod
+    def _CloseUnusedResult(result, usedResult):
+        if result is not None and result is not usedResult and result.ResponseForBodyRead is not None:
+            result.ResponseForBodyRead.close()
+        return usedResult
+
+
+    # The async version of MakeHttpCallAttempt, this should always return a AttemptResult object.
+    @staticmethod
+    async def MakeHttpCallAttemptAsync(logger, engine, attemptName, method, url, headers, data, mainResult, isFallback, nextFallbackUrl, allowRedirects:bool = False):
+        attemptStartSec = time.time()
+        client = engine.GetHttpClient()
+        response = None
+        try:
+            # See MakeHttpCallAttempt for the details of these options, the timeout and verify flags are set on the client.
+            response = await client.send(client.build_request(method, url, headers=headers, content=OctoHttpRequest._GetAttemptBody(data, engine)), stream=True, follow_redirects=allowRedirects)
+        except Exception as e:
+            logger.info(attemptName + " http URL threw an exception: "+str(e))
+
+        # Handle the 431 case, see MakeHttpCallAttempt for details.
+        if response is not None and response.status_code == 431 or (platform.system() == "Windows" and response is None):
+            if response is not None and response.status_code == 431:
+                logger.info(url + " http call returned 431, too many headers. Trying again with no headers.")
+                await response.aclose()
+            else:
+                logger.warn(url + " http call returned no response on Windows. Trying again with no headers.")
+            response = None
+            try:
+                response = await client.send(client.build_request(method, url, headers=OctoHttpRequest._GetNoHeadersRetryHeaders(data), content=OctoHttpRequest._GetAttemptBody(data, engine)), stream=True, follow_redirects=False)
+            except Exception as e:
+                logger.info(attemptName + " http NO HEADERS URL threw an exception: "+str(e))
+
+        OctoHttpRequest._RecordAttemptMetrics(attemptStartSec, isFallback)
+
+        # Check if we got a valid response.
+        if response is not None and response.status_code != 404:
+            return OctoHttpRequest.AttemptResult(True, OctoHttpRequest._buildHttpRequestResultFromAsyncResponse(logger, engine, response, url, isFallback))
+
+        # Check if we have another fallback URL to try.
+        if nextFallbackUrl is not None:
+            return OctoHttpRequest.AttemptResult(False, OctoHttpRequest._buildHttpRequestResultFromAsyncResponse(logger, engine, response, url, isFallback))
+
+        # We don't have another fallback, so we need to end this.
+        if mainResult is not None:
+            logger.info(attemptName + " failed and we have no more fallbacks. Returning the main URL response.")
+            if response is not None:
+                await response.aclose()
+            return OctoHttpRequest.AttemptResult(True, mainResult)
+        else:
+            logger.error(attemptName + " failed and we have no more fallbacks. We DON'T have a main response.")
+            return OctoHttpRequest.AttemptResult(True, OctoHttpRequest._buildHttpRequestResultFromAsyncResponse(logger, engine, response, url, isFallback))
+
+
+    @staticmethod
+    def _buildHttpRequestResultFromAsyncResponse(logger, engine, response, url:str, isFallback:bool) -> Result:
+        if response is None:
+            return None
+        asyncResponse = AsyncHttpResponse(logger, engine, response)
+        return OctoHttpRequest.Result(asyncResponse.status_code, asyncResponse.headers, url, isFallback, requestLibResponseObj=asyncResponse)
+
+
+    # If the response has a known small body, this reads it fully into the full body buffer and closes the response.
+    @staticmethod
+    async def _ReadSmallAsyncBodyIfPossible(result:Result, method:str) -> None:
+        asyncResponse = result.ResponseForBodyRead
+        if asyncResponse is None or method.upper() == "HEAD" or result.StatusCode == 204 or result.StatusCode == 304:
+            return
+        contentLengthStr = result.Headers.get("content-length", None)
+        if contentLengthStr is None:
+            return
+        # Multipart streams are never fully read.
+        contentType = result.Headers.get("content-type", None)
+        if contentType is not None and contentType.lower().startswith("multipart"):
+            return
+        try:
+            contentLength = int(contentLengthStr)
+        except Exception:
+            return
+        if contentLength <= 0 or contentLength > OctoHttpRequest.c_AsyncFullBodyReadMaxSizeBytes:
+            return
+        buffer = await asyncResponse.ReadAsync(contentLength)
+        await asyncResponse.CloseAsync()
+        result.SetFullBodyBuffer(buffer)
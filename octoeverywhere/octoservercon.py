@@ -4,6 +4,10 @@ from datetime import datetime
 
 from .sentry import Sentry
 from .websocketimpl import Client
+from .asyncwebsocketimpl import AsyncClient
+from .asyncrelayengine import AsyncRelayEngine
+from .sendscheduler import SendScheduler
+from .relaymetrics import RelayMetrics
 from .octosessionimpl import OctoSession
 from .repeattimer import RepeatTimer
 from .octopingpong import OctoPingPong
@@ -87,6 +91,8 @@ class OctoServerCon:
         # This callback wil only fire on the very first time the plugin is ran.
         if self.IsPrimaryConnection:
             OctoPingPong.Get().RegisterPluginFirstRunLatencyCompleteCallback(self.OnFirstRunLatencyDataComplete)
+            # Also expose the uplink queue stats in the metrics command.
+            RelayMetrics.Get().RegisterStatsProvider("Uplink", self.GetUplinkStats)
 
         # Note! Will be None for secondary connections!
         self.StatusChangeHandler = statusChangeHandler
@@ -337,7 +343,13 @@ class OctoServerCon:
 
                     # Connect to the service.
                     # When this returns, make sure it's fully closed.
-                    self.Ws = Client(endpoint, self.OnOpened, self.OnMsg, None, self.OnClosed, self.OnError)
+                    # If the asyncio relay engine is enabled, the websocket runs on the engine's loop, but this thread still blocks until it's closed.
+                    # The OctoStream connection often has many small messages queued at once, so we coalesce the writes.
+                    if AsyncRelayEngine.Get() is not None:
+                        # The session message handling can block, so it's dispatched off the loop.
+                        self.Ws = AsyncClient(endpoint, self.OnOpened, self.OnMsg, None, self.OnClosed, self.OnError, coalesceWrites=True, dispatchOffLoop=True)
+                    else:
+                        self.Ws = Client(endpoint, self.OnOpened, self.OnMsg, None, self.OnClosed, self.OnError, coalesceWrites=True)
                     with self.Ws:
                         self.Logger.info("Attempting to talk to OctoEverywhere, server con "+self.GetConnectionString() + " wsId:"+self.GetWsId(self.Ws))
                         self.Ws.RunUntilClosed()
@@ -385,10 +397,48 @@ class OctoServerCon:
                 runForTimeChecker.Stop()
 
 
-    def SendMsg(self, buffer:bytearray, msgStartOffsetBytes:int, msgSize:int):
+    def SendMsg(self, buffer:bytearray, msgStartOffsetBytes:int, msgSize:int, streamId:int = SendScheduler.c_NonStreamId, priority:int = None):
         # When we send any message, consider it user activity.
         self.LastUserActivityTime = datetime.now()
-        self.Ws.Send(buffer, msgStartOffsetBytes, msgSize, True)
+        self.Ws.Send(buffer, msgStartOffsetBytes, msgSize, True, streamId, priority)
+
+
+    # Blocks until the stream is within the uplink byte budget. Returns false if the wait timed out.
+    def WaitForUplinkBudget(self, streamId:int, timeoutSec:float) -> bool:
+        ws = self.Ws
+        if ws is None:
+            return True
+        return ws.WaitForSendBudget(streamId, timeoutSec)
+
+
+    # The same as WaitForUplinkBudget, but for producers that run on the asyncio relay engine loop.
+    async def WaitForUplinkBudgetAsync(self, streamId:int, timeoutSec:float) -> bool:
+        ws = self.Ws
+        if ws is None:
+            return True
+        return await ws.WaitForSendBudgetAsync(streamId, timeoutSec)
+
+
+    # Returns the bytes queued for the stream and the age of it's oldest queued message.
+    def GetUplinkQueueState(self, streamId:int):
+        ws = self.Ws
+        if ws is None:
+            return (0, 0.0)
+        return ws.GetStreamSendQueueState(streamId)
+
+
+    # Returns the send queue, budget, and write stats of the current websocket, and the priority stats of the current session.
+    def GetUplinkStats(self) -> dict:
+        stats = {}
+        ws = self.Ws
+        if ws is not None:
+            stats["SendQueue"] = ws.GetSendQueueStats()
+            stats["SendBudget"] = ws.GetSendBudgetStats()
+            stats["SendWrites"] = ws.GetSendWriteStats()
+        session = self.OctoSession
+        if session is not None:
+            stats["PriorityArbiter"] = session.PriorityArbiter.GetStats()
+        return stats
 
 
     def GetWsId(self, ws):
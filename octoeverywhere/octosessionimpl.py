@@ -10,6 +10,7 @@ import logging
 #
 
 from .WebStream import octowebstream
+from .WebStream.octowebstreampriorityarbiter import OctoWebStreamPriorityArbiter
 from .octohttprequest import OctoHttpRequest
 from .localip import LocalIpHelper
 from .octostreammsgbuilder import OctoStreamMsgBuilder
@@ -19,6 +20,7 @@ from .ostypeidentifier import OsTypeIdentifier
 from .threaddebug import ThreadDebug
 from .compression import Compression
 from .deviceid import DeviceId
+from .sendscheduler import SendScheduler
 
 from .Proto import OctoStreamMessage
 from .Proto import HandshakeAck
@@ -50,15 +52,34 @@ class OctoSession:
         # Create our server auth helper.
         self.ServerAuth = ServerAuthHelper(self.Logger)
 
+        # Shared by all of the web streams in this session, so low pri streams can defer to high pri streams.
+        self.PriorityArbiter = OctoWebStreamPriorityArbiter(self.Logger)
+
 
     def OnSessionError(self, backoffModifierSec):
         # Just forward
         self.OctoStream.OnSessionError(self.SessionId, backoffModifierSec)
 
 
-    def Send(self, buffer:bytearray, msgStartOffsetBytes:int, msgSize:int):
+    # The stream id and priority are used by the send scheduler to interleave streams fairly, see SendScheduler.
+    def Send(self, buffer:bytearray, msgStartOffsetBytes:int, msgSize:int, streamId:int = SendScheduler.c_NonStreamId, priority:int = None):
         # The message is already encoded, pass it along to the socket.
-        self.OctoStream.SendMsg(buffer, msgStartOffsetBytes, msgSize)
+        self.OctoStream.SendMsg(buffer, msgStartOffsetBytes, msgSize, streamId, priority)
+
+
+    # Blocks until the stream is within the uplink byte budget. Returns false if the wait timed out.
+    def WaitForUplinkBudget(self, streamId:int, timeoutSec:float) -> bool:
+        return self.OctoStream.WaitForUplinkBudget(streamId, timeoutSec)
+
+
+    # The same as WaitForUplinkBudget, but for producers that run on the asyncio relay engine loop.
+    async def WaitForUplinkBudgetAsync(self, streamId:int, timeoutSec:float) -> bool:
+        return await self.OctoStream.WaitForUplinkBudgetAsync(streamId, timeoutSec)
+
+
+    # Returns the bytes queued for the stream and the age of it's oldest queued message.
+    def GetUplinkQueueState(self, streamId:int):
+        return self.OctoStream.GetUplinkQueueState(streamId)
 
 
     def HandleSummonRequest(self, msg):
@@ -197,8 +218,8 @@ class OctoSession:
                 localStream = octowebstream.OctoWebStream(args=(self.Logger, streamId, self,))
                 # Set it in the map
                 self.ActiveWebStreams[streamId] = localStream
-                # Start it's main worker thread
-                localStream.start()
+                # Start it's main worker thread, or in the worker pool mode, get it ready to be scheduled.
+                localStream.StartProcessing()
 
         # If we get here, we know we must have a localStream
         localStream.OnIncomingServerMessage(webStreamMsg)
@@ -0,0 +1,32 @@
+import logging
+
+from .asyncrelayengine import AsyncRelayEngine
+from .WebStream.octowebstreamworkerpool import OctoWebStreamWorkerPool
+
+#
+# The relay can run in a few different execution modes, this is used by the hosts to pick the mode from their config at startup.
+#
+#   thread      - The default, every web stream gets it's own thread and every websocket has it's own threads.
+#   worker_pool - Web streams run on a bounded pool of worker threads.
+#   asyncio     - The server websocket, local websockets, web streams, and local http calls run on a single asyncio event loop.
+#                 Only work that must block is handed off to a bounded thread pool.
+#
+class RelayExecutionMode:
+
+    Thread = "thread"
+    WorkerPool = "worker_pool"
+    Asyncio = "asyncio"
+    All = [Thread, WorkerPool, Asyncio]
+
+
+    # Sets up the execution mode, this must be called before the relay is started.
+    # maxThreads is the max number of worker threads in the worker_pool mode, and the max number of blocking threads in the asyncio mode.
+    @staticmethod
+    def Setup(logger:logging.Logger, mode:str, maxThreads:int):
+        mode = str(mode).lower()
+        if mode == RelayExecutionMode.WorkerPool:
+            OctoWebStreamWorkerPool.Init(logger, maxThreads)
+        elif mode == RelayExecutionMode.Asyncio:
+            AsyncRelayEngine.Init(logger, maxThreads)
+        elif mode != RelayExecutionMode.Thread:
+            logger.warning(f"Unknown relay execution mode '{mode}', using the default thread mode.")
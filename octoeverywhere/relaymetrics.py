@@ -0,0 +1,198 @@
+import bisect
+import logging
+import threading
+import time
+
+#
+# An in process metrics registry for the relay hot paths.
+#
+# The relay already measures things like body read, compression, and uplink send times, but those values only make it into a
+# debug log line. This registry keeps counters, gauges, and bucketed latency histograms for the whole process, so they can be
+# read with the "metrics" command on production printers without turning on debug logging.
+#
+# Recording is cheap, it's a dict lookup and a few adds under a lock, so it's safe to call on every chunk in the hot path.
+# Other components that already keep their own stats (like the send scheduler) can register a stats provider, which is only
+# called when the metrics are read.
+#
+# Metric names are dotted PascalCase strings, like "Http.BodyRead". All latency values are in seconds.
+#
+class RelayMetrics:
+
+    # The upper bounds of the latency histogram buckets, in milliseconds. Anything larger goes into the last overflow bucket.
+    c_LatencyBucketBoundsMs = [1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000]
+
+    # Common metric names, so the producers and anyone reading the output agree.
+    HttpRequestExecution = "Http.RequestExecution"
+    HttpResponseSend = "Http.ResponseSend"
+    HttpBodyRead = "Http.BodyRead"
+    HttpCompression = "Http.Compression"
+    HttpUplinkSend = "Http.UplinkSend"
+    HttpCallAttempt = "Http.CallAttempt"
+    HttpFallbackHops = "Http.FallbackHops"
+    HttpRequests = "Http.Requests"
+    SlipstreamCacheHits = "Cache.Slipstream.Hits"
+    SlipstreamCacheMisses = "Cache.Slipstream.Misses"
+    NotModifiedConversions = "Cache.NotModified.Conversions"
+
+    _Instance = None
+    _InstanceLock = threading.Lock()
+
+
+    @staticmethod
+    def Init(logger:logging.Logger):
+        with RelayMetrics._InstanceLock:
+            old = RelayMetrics._Instance
+            RelayMetrics._Instance = RelayMetrics(logger)
+            # Keep any stats providers that were registered before we were inited.
+            if old is not None:
+                with old.Lock:
+                    RelayMetrics._Instance.StatsProviders.update(old.StatsProviders)
+
+
+    # Unlike most of our singletons, this is created on demand if it wasn't inited, since it's used in a lot of shared code
+    # and the metrics should never be the reason something fails.
+    @staticmethod
+    def Get():
+        if RelayMetrics._Instance is None:
+            with RelayMetrics._InstanceLock:
+                if RelayMetrics._Instance is None:
+                    RelayMetrics._Instance = RelayMetrics(logging.getLogger("octoeverywhere"))
+        return RelayMetrics._Instance
+
+
+    def __init__(self, logger:logging.Logger):
+        self.Logger = logger
+        self.Lock = threading.Lock()
+        self.StartTimeSec = time.time()
+        self.Counters = {}
+        self.Gauges = {}
+        self.Histograms = {}
+        self.StatsProviders = {}
+
+
+    # Adds the value to a counter.
+    def IncrementCounter(self, name:str, value:int = 1) -> None:
+        with self.Lock:
+            self.Counters[name] = self.Counters.get(name, 0) + value
+
+
+    # Sets a gauge to the current value.
+    def SetGauge(self, name:str, value) -> None:
+        with self.Lock:
+            self.Gauges[name] = value
+
+
+    # Records a latency sample, in seconds.
+    def RecordLatency(self, name:str, valueSec:float) -> None:
+        with self.Lock:
+            h = self.Histograms.get(name, None)
+            if h is None:
+                h = LatencyHistogram()
+                self.Histograms[name] = h
+            h.Record(valueSec)
+
+
+    # Registers a function that returns a dict of stats, it's called each time the metrics are read.
+    # Registering with the same name replaces the old provider.
+    def RegisterStatsProvider(self, name:str, provider) -> None:
+        with self.Lock:
+            self.StatsProviders[name] = provider
+
+
+    def UnregisterStatsProvider(self, name:str, provider = None) -> None:
+        with self.Lock:
+            # If the provider is given, only remove it if it's still the registered one.
+            if provider is not None and self.StatsProviders.get(name, None) is not provider:
+                return
+            self.StatsProviders.pop(name, None)
+
+
+    # Clears all counters, gauges, and histograms. The stats providers stay registered.
+    def Reset(self) -> None:
+        with self.Lock:
+            self.StartTimeSec = time.time()
+            self.Counters = {}
+            self.Gauges = {}
+            self.Histograms = {}
+
+
+    # Returns a json serializable dict of all of the metrics.
+    def GetSnapshot(self) -> dict:
+        with self.Lock:
+            result = {
+                "UptimeSec": round(time.time() - self.StartTimeSec, 3),
+                "Counters": dict(self.Counters),
+                "Gauges": dict(self.Gauges),
+                "Histograms": {name: h.GetStats() for name, h in self.Histograms.items()},
+            }
+            providers = list(self.StatsProviders.items())
+        # Call the providers outside of our lock, since they take their own locks.
+        providerStats = {}
+        for name, provider in providers:
+            try:
+                providerStats[name] = provider()
+            except Exception as e:
+                self.Logger.warn(f"RelayMetrics stats provider {name} failed: {e}")
+                providerStats[name] = {"Error": str(e)}
+        result["Providers"] = providerStats
+        return result
+
+
+# A fixed bucket latency histogram. This must be used under the RelayMetrics lock.
+class LatencyHistogram:
+
+    def __init__(self):
+        self.Buckets = [0] * (len(RelayMetrics.c_LatencyBucketBoundsMs) + 1)
+        self.Count = 0
+        self.TotalSec = 0.0
+        self.MinSec = None
+        self.MaxSec = 0.0
+
+
+    def Record(self, valueSec:float) -> None:
+        if valueSec < 0:
+            valueSec = 0.0
+        self.Buckets[bisect.bisect_left(RelayMetrics.c_LatencyBucketBoundsMs, valueSec * 1000.0)] += 1
+        self.Count += 1
+        self.TotalSec += valueSec
+        if self.MinSec is None or valueSec < self.MinSec:
+            self.MinSec = valueSec
+        if valueSec > self.MaxSec:
+            self.MaxSec = valueSec
+
+
+    # Returns the upper bound of the bucket the percentile falls into, in ms, capped by the max value seen.
+    def GetPercentileMs(self, percent:float) -> float:
+        if self.Count == 0:
+            return 0.0
+        target = max(1, int(self.Count * percent / 100.0 + 0.5))
+        seen = 0
+        maxMs = self.MaxSec * 1000.0
+        for i, count in enumerate(self.Buckets):
+            seen += count
+            if seen >= target:
+                if i >= len(RelayMetrics.c_LatencyBucketBoundsMs):
+                    return round(maxMs, 2)
+                return round(min(float(RelayMetrics.c_LatencyBucketBoundsMs[i]), maxMs), 2)
+        return round(maxMs, 2)
+
+
+    def GetStats(self) -> dict:
+        buckets = {}
+        for i, count in enumerate(self.Buckets):
+            if count == 0:
+                continue
+            if i < len(RelayMetrics.c_LatencyBucketBoundsMs):
+                buckets["le" + str(RelayMetrics.c_LatencyBucketBoundsMs[i]) + "ms"] = count
+            else:
+                buckets["inf"] = count
+        return {
+            "Count": self.Count,
+            "AvgMs": round((self.TotalSec / self.Count) * 1000.0, 2) if self.Count > 0 else 0.0,
+            "MinMs": round((self.MinSec or 0.0) * 1000.0, 2),
+            "MaxMs": round(self.MaxSec * 1000.0, 2),
+            "P50Ms": self.GetPercentileMs(50),
+            "P90Ms": self.GetPercentileMs(90),
+            "P99Ms": self.GetPercentileMs(99),
+            "Buckets": buckets,
+        }
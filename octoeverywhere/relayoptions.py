@@ -0,0 +1,157 @@
+import logging
+
+from .httpsessions import HttpSessions
+from .httproutecache import HttpRouteCache
+from .httpassetdiskstore import HttpAssetDiskStore
+from .httpassetcache import HttpAssetCache
+from .imageworkerpool import ImageWorkerPool
+from .octohttprequest import OctoHttpRequest
+from .relayexecutionmode import RelayExecutionMode
+from .WebStream.octowebstreamworkerpool import OctoWebStreamWorkerPool
+from .Webcam.mjpegfanout import MjpegFanOutManager
+from .Webcam.quickcamcapturegovernor import QuickCamCaptureGovernor
+from .Webcam.webcamframeregistry import WebcamFrameRegistry
+from .Webcam.webcamsnapshotcache import WebcamSnapshotCache
+from .Webcam.webcamstreamgovernor import WebcamStreamGovernor
+
+
+# Defines one relay option, how the hosts find it in their settings, and what values are valid.
+class RelayOption:
+
+    def __init__(self, name:str, configKey:str, default, minValue:int = None, maxValue:int = None, acceptableValues:list = None):
+        # The name is the OctoPrint setting name and the name used to get the value from RelayOptions.
+        self.Name = name
+        # The key in the relay section of the linux host config file, this must match the key in linux_host/config.py.
+        self.ConfigKey = configKey
+        self.Default = default
+        # For int options, the inclusive range of valid values.
+        self.MinValue = minValue
+        self.MaxValue = maxValue
+        # For string options, the list of valid values.
+        self.AcceptableValues = acceptableValues
+
+
+#
+# The user settable options of the relay.
+#
+# All of the hosts read these the same way, so they are defined once here. A host loads the options from it's own settings,
+# which fills in the defaults and range checks the values, and then applies them all at once before the relay is started.
+#
+class RelayOptions:
+
+    c_Options = [
+        RelayOption("WebStreamExecutionMode", "web_stream_execution_mode", RelayExecutionMode.Thread, acceptableValues=RelayExecutionMode.All),
+        RelayOption("WorkerPoolMaxThreads", "worker_pool_max_threads", OctoWebStreamWorkerPool.c_DefaultMaxWorkerThreads, OctoWebStreamWorkerPool.c_MinWorkerThreads, OctoWebStreamWorkerPool.c_MaxWorkerThreads),
+        RelayOption("OriginUrlRacing", "origin_url_racing", False),
+        RelayOption("HttpRouteCache", "http_route_cache", False),
+        RelayOption("AssetCacheMaxMb", "asset_cache_max_mb", HttpAssetCache.c_DefaultMaxMemoryMb, HttpAssetCache.c_MinMaxMemoryMb, HttpAssetCache.c_MaxMaxMemoryMb),
+        RelayOption("AssetDiskStoreMaxMb", "asset_disk_store_max_mb", HttpAssetDiskStore.c_DefaultMaxSizeMb, HttpAssetDiskStore.c_MinMaxSizeMb, HttpAssetDiskStore.c_MaxMaxSizeMb),
+        RelayOption("LocalHttpMaxConnectionsPerHost", "local_http_max_connections_per_host", HttpSessions.c_DefaultMaxConnectionsPerHost, HttpSessions.c_MinConnectionsPerHost, HttpSessions.c_MaxConnectionsPerHost),
+        RelayOption("LocalHttpPoolBlocking", "local_http_pool_blocking", False),
+        RelayOption("StreamingUploads", "streaming_uploads", False),
+        RelayOption("PipelinedBodyRelay", "pipelined_body_relay", False),
+        RelayOption("WebcamLatestFrameMode", "webcam_latest_frame_mode", False),
+        RelayOption("WebcamMaxFps", "webcam_max_fps", WebcamStreamGovernor.c_DefaultMaxFps, WebcamStreamGovernor.c_MinMaxFps, WebcamStreamGovernor.c_MaxMaxFps),
+        RelayOption("WebcamTargetLatencyMs", "webcam_target_latency_ms", WebcamStreamGovernor.c_DefaultTargetLatencyMs, WebcamStreamGovernor.c_MinTargetLatencyMs, WebcamStreamGovernor.c_MaxTargetLatencyMs),
+        RelayOption("WebcamStreamFanOut", "webcam_stream_fan_out", False),
+        RelayOption("WebcamSnapshotFreshnessMs", "webcam_snapshot_freshness_ms", WebcamSnapshotCache.c_DefaultFreshnessWindowMs, WebcamSnapshotCache.c_MinFreshnessWindowMs, WebcamSnapshotCache.c_MaxFreshnessWindowMs),
+        RelayOption("WebcamStreamFrameMaxAgeMs", "webcam_stream_frame_max_age_ms", WebcamFrameRegistry.c_DefaultMaxFrameAgeMs, WebcamFrameRegistry.c_MinMaxFrameAgeMs, WebcamFrameRegistry.c_MaxMaxFrameAgeMs),
+        RelayOption("ImageWorkerPool", "image_worker_pool", False),
+        RelayOption("ImageWorkerCount", "image_worker_count", ImageWorkerPool.c_DefaultWorkerCount, ImageWorkerPool.c_MinWorkerCount, ImageWorkerPool.c_MaxWorkerCount),
+        RelayOption("QuickCamAdaptiveCapture", "quickcam_adaptive_capture", False),
+        RelayOption("QuickCamSnapshotFps", "quickcam_snapshot_fps", QuickCamCaptureGovernor.c_DefaultSnapshotFps, QuickCamCaptureGovernor.c_MinSnapshotFps, QuickCamCaptureGovernor.c_MaxSnapshotFps),
+    ]
+
+
+    def __init__(self):
+        # Start with the defaults, so the options are always valid.
+        self.Values = {}
+        for option in RelayOptions.c_Options:
+            self.Values[option.Name] = option.Default
+
+
+    # Returns the value of the option with the given name.
+    def Get(self, name:str):
+        return self.Values[name]
+
+
+    # Loads the options from the relay section of the linux host config.
+    # The config fills in any missing values with the defaults and resets any invalid values, so the user can see them in the config file.
+    @staticmethod
+    def LoadFromConfig(config, section:str) -> "RelayOptions":
+        options = RelayOptions()
+        for option in RelayOptions.c_Options:
+            if isinstance(option.Default, bool):
+                value = config.GetBool(section, option.ConfigKey, option.Default)
+            elif isinstance(option.Default, int):
+                value = config.GetIntIfInRange(section, option.ConfigKey, option.Default, option.MinValue, option.MaxValue)
+            else:
+                value = config.GetStrIfInAcceptableList(section, option.ConfigKey, option.Default, option.AcceptableValues)
+            options.Values[option.Name] = value
+        return options
+
+
+    # Loads the options from the OctoPrint plugin settings.
+    # getFromSettings is a function that takes the setting name and default value, and returns the setting value or the default if it's not set.
+    @staticmethod
+    def LoadFromSettings(logger:logging.Logger, getFromSettings) -> "RelayOptions":
+        options = RelayOptions()
+        for option in RelayOptions.c_Options:
+            value = getFromSettings(option.Name, option.Default)
+            try:
+                if isinstance(option.Default, bool):
+                    value = value is True
+                elif isinstance(option.Default, int):
+                    value = min(max(int(value), option.MinValue), option.MaxValue)
+                else:
+                    value = str(value).lower()
+                    if value not in option.AcceptableValues:
+                        raise Exception(f"It must be one of {option.AcceptableValues}")
+            except Exception as e:
+                logger.warning(f"The relay setting {option.Name} has an invalid value '{value}', the default will be used. {e}")
+                value = option.Default
+            options.Values[option.Name] = value
+        return options
+
+
+    # Applies the options, this must be called before the relay is started.
+    # HttpSessions and Compression must already be setup. The plugin data folder is where the optional caches keep their files.
+    def Apply(self, logger:logging.Logger, pluginDataFolderPath:str):
+        # Setup the web stream execution mode.
+        RelayExecutionMode.Setup(logger, self.Get("WebStreamExecutionMode"), self.Get("WorkerPoolMaxThreads"))
+
+        # Setup the optional http route cache, so requests that need the fallback chain can go right to the attempt that works.
+        # If it's not setup, every request walks the full fallback chain.
+        if self.Get("HttpRouteCache"):
+            HttpRouteCache.Init(logger, pluginDataFolderPath)
+
+        # Setup the optional disk store for pre-compressed static assets, so they survive restarts. If the size is 0, it's disabled.
+        HttpAssetDiskStore.Init(logger, pluginDataFolderPath, self.Get("AssetDiskStoreMaxMb") * 1024 * 1024)
+
+        # Setup the optional in memory cache for static assets, like the frontend's js, css, and fonts. If the size is 0, it's disabled.
+        # This must be after the disk store, since the cache uses it if it's setup.
+        HttpAssetCache.Init(logger, self.Get("AssetCacheMaxMb") * 1024 * 1024)
+
+        # Setup the optional url racing, streaming uploads, and pipelined body relay for the local http calls.
+        OctoHttpRequest.SetEnableUrlRacing(self.Get("OriginUrlRacing"))
+        OctoHttpRequest.SetEnableStreamingUploads(self.Get("StreamingUploads"))
+        OctoHttpRequest.SetEnablePipelinedBodyRelay(self.Get("PipelinedBodyRelay"))
+
+        # Setup the optional latest frame mode for relayed webcam streams.
+        WebcamStreamGovernor.SetOptions(self.Get("WebcamLatestFrameMode"), self.Get("WebcamMaxFps"), self.Get("WebcamTargetLatencyMs"))
+
+        # Setup the optional sharing of http mjpeg webcam streams.
+        MjpegFanOutManager.SetEnabled(self.Get("WebcamStreamFanOut"))
+
+        # Setup how long webcam snapshots can be reused, and how old a live stream frame can be and still be used for a snapshot.
+        WebcamSnapshotCache.SetFreshnessWindowMs(self.Get("WebcamSnapshotFreshnessMs"))
+        WebcamFrameRegistry.SetMaxFrameAgeMs(self.Get("WebcamStreamFrameMaxAgeMs"))
+
+        # Setup the optional image worker pool for snapshot image work.
+        ImageWorkerPool.SetOptions(self.Get("ImageWorkerPool"), self.Get("ImageWorkerCount"))
+
+        # Setup the optional demand adaptive capture for RTSP webcams.
+        QuickCamCaptureGovernor.SetOptions(self.Get("QuickCamAdaptiveCapture"), self.Get("QuickCamSnapshotFps"))
+
+        # Setup the local http connection pool options.
+        HttpSessions.Get().SetPoolOptions(self.Get("LocalHttpMaxConnectionsPerHost"), self.Get("LocalHttpPoolBlocking"))
@@ -0,0 +1,408 @@
+import time
+import asyncio
+import threading
+import collections
+
+from .Proto.MessagePriority import MessagePriority
+
+#
+# The send scheduler replaces the FIFO send queue used by the websocket clients.
+#
+# With a FIFO, a large download or timelapse body that's queued in front of small API responses or webcam frames from other streams
+# will block them until it's all sent, which makes the portal feel frozen. Instead, the scheduler keeps a queue per priority class and
+# per stream, and picks what to send next using deficit round-robin at both levels.
+#   - Each priority class gets a quantum of bytes per round that's weighted by the priority, so higher priority classes get more
+#     of the uplink, but lower priority classes are never fully starved.
+#   - When a class becomes active, it's put ahead of the lower priority classes that are waiting in the current round.
+#     The weights only set the bandwidth share, so without this a small API or control message would wait for a full quantum
+#     from every lower class that was active before it.
+#   - Within a class, each stream gets a fixed quantum per round, so large bodies are interleaved with other streams in bounded slices.
+#
+# Messages are never split, since each one is a complete OctoStream message, but the order of messages within a stream is always kept.
+#
+# The scheduler also tracks the bytes queued per stream and in total, so producers can be held back when the uplink is slow.
+# Without this, a fast local source like a webcam stream or a large download will queue messages until the device runs out of memory.
+# The budget is only enforced for producers that call WaitForBudget, Put never blocks, so messages like the handshake are never held.
+# Producers that run on an asyncio loop, which must never block, use WaitForBudgetAsync instead.
+#
+class SendScheduler:
+
+    # The bytes each stream is allowed to send per round within a class.
+    c_StreamQuantumBytes = 64 * 1024
+
+    # The priority classes, ordered from highest to lowest, and the weight of their quantum.
+    # Any message priority value that's less than or equal to the class priority is put in that class.
+    c_Classes = [
+        (MessagePriority.Critical, "Critical", 16),
+        (MessagePriority.High, "High", 8),
+        (MessagePriority.Normal, "Normal", 4),
+        (MessagePriority.Low, "Low", 2),
+        (MessagePriority.Background, "Background", 1),
+    ]
+
+    # Messages that aren't part of a web stream, like the handshake, use stream id 0 and are always critical.
+    c_NonStreamId = 0
+
+    # The default max bytes that can be queued in total and for a single stream before producers are held back.
+    c_DefaultGlobalBudgetBytes = 24 * 1024 * 1024
+    c_DefaultStreamBudgetBytes = 4 * 1024 * 1024
+
+
+    def __init__(self, globalBudgetBytes:int = c_DefaultGlobalBudgetBytes, streamBudgetBytes:int = c_DefaultStreamBudgetBytes):
+        self.Lock = threading.Lock()
+        self.ItemAvailable = threading.Condition(self.Lock)
+        self.BudgetAvailable = threading.Condition(self.Lock)
+        self.Classes = []
+        for priority, name, weight in SendScheduler.c_Classes:
+            self.Classes.append(SendSchedulerClass(priority, name, SendScheduler.c_StreamQuantumBytes * weight))
+        # The classes that have queued messages, in round-robin order.
+        self.ActiveClasses = collections.deque()
+        self.IsClosed = False
+
+        # Byte budget tracking
+        self.GlobalBudgetBytes = globalBudgetBytes
+        self.StreamBudgetBytes = streamBudgetBytes
+        self.TotalQueuedBytes = 0
+        # A map of stream id to the bytes that stream has queued.
+        self.StreamQueuedBytes = {}
+        self.BudgetWaiters = 0
+        # The asyncio waiters, which are woken on their own loop when budget frees.
+        self.AsyncBudgetWaiters = []
+
+        # Budget stats
+        self.TotalQueuedBytesHighWaterMark = 0
+        self.StreamQueuedBytesHighWaterMark = 0
+        self.BudgetWaits = 0
+        self.BudgetWaitTimeouts = 0
+        self.BudgetWaitTimeTotalSec = 0.0
+        self.BudgetWaitTimeHighWaterMarkSec = 0.0
+
+
+    # Adds a context to the queue, this can be called from any thread.
+    # The context must have a Buffer, MsgSize, StreamId, and Priority.
+    def Put(self, context) -> None:
+        schedulerClass = self._GetClass(context.Priority)
+        sizeBytes = context.GetSendSizeBytes()
+        nowSec = time.time()
+        with self.Lock:
+            if self.IsClosed:
+                return
+            stream = schedulerClass.Streams.get(context.StreamId, None)
+            if stream is None:
+                stream = SendSchedulerStream(context.StreamId)
+                schedulerClass.Streams[context.StreamId] = stream
+                schedulerClass.ActiveStreams.append(stream)
+                if len(schedulerClass.ActiveStreams) == 1:
+                    self._ActivateClassUnderLock(schedulerClass)
+            stream.Queue.append((context, sizeBytes, nowSec))
+
+            # Update the stats
+            schedulerClass.QueuedMessages += 1
+            schedulerClass.QueuedBytes += sizeBytes
+            schedulerClass.PeakQueuedMessages = max(schedulerClass.PeakQueuedMessages, schedulerClass.QueuedMessages)
+            schedulerClass.PeakQueuedBytes = max(schedulerClass.PeakQueuedBytes, schedulerClass.QueuedBytes)
+            self.TotalQueuedBytes += sizeBytes
+            self.TotalQueuedBytesHighWaterMark = max(self.TotalQueuedBytesHighWaterMark, self.TotalQueuedBytes)
+            streamQueuedBytes = self.StreamQueuedBytes.get(context.StreamId, 0) + sizeBytes
+            self.StreamQueuedBytes[context.StreamId] = streamQueuedBytes
+            self.StreamQueuedBytesHighWaterMark = max(self.StreamQueuedBytesHighWaterMark, streamQueuedBytes)
+            self.ItemAvailable.notify()
+
+
+    # Blocks until there's something to send, and returns it.
+    # Returns None if the scheduler is closed.
+    def Get(self):
+        with self.Lock:
+            while True:
+                if self.IsClosed:
+                    return None
+                if len(self.ActiveClasses) > 0:
+                    return self._PopUnderLock()
+                self.ItemAvailable.wait()
+
+
+    # Returns the next context to send or None if there's nothing queued or the scheduler is closed.
+    def TryGet(self):
+        with self.Lock:
+            if self.IsClosed or len(self.ActiveClasses) == 0:
+                return None
+            return self._PopUnderLock()
+
+
+    # Blocks until the stream is within it's byte budget and the total queued bytes are within the global budget, or the timeout expires.
+    # Returns true if there's budget available, or false if the wait timed out and the caller should shed load.
+    # If the scheduler is closed, this returns true, since the connection is going down and the queued messages have been dropped.
+    def WaitForBudget(self, streamId:int, timeoutSec:float) -> bool:
+        with self.Lock:
+            if self._HasBudgetUnderLock(streamId):
+                return True
+            start = time.time()
+            self.BudgetWaiters += 1
+            try:
+                while True:
+                    remainingSec = timeoutSec - (time.time() - start)
+                    if remainingSec <= 0:
+                        self.BudgetWaitTimeouts += 1
+                        return False
+                    self.BudgetAvailable.wait(remainingSec)
+                    if self._HasBudgetUnderLock(streamId):
+                        return True
+            finally:
+                self.BudgetWaiters -= 1
+                waitSec = time.time() - start
+                self.BudgetWaits += 1
+                self.BudgetWaitTimeTotalSec += waitSec
+                self.BudgetWaitTimeHighWaterMarkSec = max(self.BudgetWaitTimeHighWaterMarkSec, waitSec)
+
+
+    # The same as WaitForBudget, but for producers that run on an asyncio loop.
+    # The wait doesn't block the loop, the waiter's event is set on it's loop when budget frees.
+    async def WaitForBudgetAsync(self, streamId:int, timeoutSec:float) -> bool:
+        waiter = AsyncBudgetWaiter(asyncio.get_running_loop())
+        with self.Lock:
+            if self._HasBudgetUnderLock(streamId):
+                return True
+            start = time.time()
+            self.AsyncBudgetWaiters.append(waiter)
+        try:
+            while True:
+                remainingSec = timeoutSec - (time.time() - start)
+                if remainingSec <= 0:
+                    with self.Lock:
+                        self.BudgetWaitTimeouts += 1
+                    return False
+                try:
+                    await asyncio.wait_for(waiter.Event.wait(), remainingSec)
+                except asyncio.TimeoutError:
+                    pass
+                # Clear the event under the lock before checking, so a notify after the check will always wake us.
+                with self.Lock:
+                    waiter.Event.clear()
+                    waiter.IsNotified = False
+                    if self._HasBudgetUnderLock(streamId):
+                        return True
+        finally:
+            with self.Lock:
+                if waiter in self.AsyncBudgetWaiters:
+                    self.AsyncBudgetWaiters.remove(waiter)
+                waitSec = time.time() - start
+                self.BudgetWaits += 1
+                self.BudgetWaitTimeTotalSec += waitSec
+                self.BudgetWaitTimeHighWaterMarkSec = max(self.BudgetWaitTimeHighWaterMarkSec, waitSec)
+
+
+    # Returns a tuple of the bytes queued for the stream and how long the oldest queued message for the stream has been waiting.
+    # This is used by producers that would rather skip data than queue it, like webcam streams, to tell if the uplink is keeping up.
+    def GetStreamQueueState(self, streamId:int):
+        with self.Lock:
+            queuedBytes = self.StreamQueuedBytes.get(streamId, 0)
+            if queuedBytes == 0:
+                return (0, 0.0)
+            oldestAgeSec = 0.0
+            for c in self.Classes:
+                stream = c.Streams.get(streamId, None)
+                if stream is not None and len(stream.Queue) > 0:
+                    oldestAgeSec = max(oldestAgeSec, time.time() - stream.Queue[0][2])
+            return (queuedBytes, oldestAgeSec)
+
+
+    # Closes the scheduler, any queued messages are dropped and any blocked Get calls will return None.
+    def Close(self):
+        with self.Lock:
+            self.IsClosed = True
+            self.ActiveClasses.clear()
+            for c in self.Classes:
+                c.Streams.clear()
+                c.ActiveStreams.clear()
+                c.QueuedMessages = 0
+                c.QueuedBytes = 0
+            self.TotalQueuedBytes = 0
+            self.StreamQueuedBytes.clear()
+            self.ItemAvailable.notify_all()
+            self.BudgetAvailable.notify_all()
+            self._NotifyAsyncBudgetWaitersUnderLock()
+
+
+    # Returns a dict of the byte budget stats.
+    def GetBudgetStats(self) -> dict:
+        with self.Lock:
+            return {
+                "GlobalBudgetBytes": self.GlobalBudgetBytes,
+                "StreamBudgetBytes": self.StreamBudgetBytes,
+                "TotalQueuedBytes": self.TotalQueuedBytes,
+                "TotalQueuedBytesHighWaterMark": self.TotalQueuedBytesHighWaterMark,
+                "StreamQueuedBytesHighWaterMark": self.StreamQueuedBytesHighWaterMark,
+                "BudgetWaits": self.BudgetWaits,
+                "BudgetWaitTimeouts": self.BudgetWaitTimeouts,
+                "BudgetWaitTimeTotalSec": round(self.BudgetWaitTimeTotalSec, 3),
+                "BudgetWaitTimeHighWaterMarkSec": round(self.BudgetWaitTimeHighWaterMarkSec, 3),
+            }
+
+
+    # Returns a dict of the per class queue depth and wait time stats.
+    def GetStats(self) -> dict:
+        stats = {}
+        with self.Lock:
+            for c in self.Classes:
+                avgWaitMs = 0.0
+                if c.SentMessages > 0:
+                    avgWaitMs = (c.WaitTimeTotalSec / c.SentMessages) * 1000.0
+                stats[c.Name] = {
+                    "QueuedMessages": c.QueuedMessages,
+                    "QueuedBytes": c.QueuedBytes,
+                    "PeakQueuedMessages": c.PeakQueuedMessages,
+                    "PeakQueuedBytes": c.PeakQueuedBytes,
+                    "ActiveStreams": len(c.ActiveStreams),
+                    "SentMessages": c.SentMessages,
+                    "SentBytes": c.SentBytes,
+                    "AvgWaitMs": round(avgWaitMs, 2),
+                    "WaitHighWaterMarkMs": round(c.WaitTimeHighWaterMarkSec * 1000.0, 2),
+                }
+        return stats
+
+
+    def _HasBudgetUnderLock(self, streamId:int) -> bool:
+        if self.IsClosed:
+            return True
+        if self.TotalQueuedBytes >= self.GlobalBudgetBytes:
+            return False
+        return self.StreamQueuedBytes.get(streamId, 0) < self.StreamBudgetBytes
+
+
+    # Adds a class that just became active to the round, ahead of the first lower priority class.
+    # It's given it's quantum now, so it's served as soon as it reaches the front rather than being credited and sent to the back.
+    # Must be called under lock.
+    def _ActivateClassUnderLock(self, schedulerClass):
+        schedulerClass.Deficit = schedulerClass.Quantum
+        for i, activeClass in enumerate(self.ActiveClasses):
+            if activeClass.Priority > schedulerClass.Priority:
+                self.ActiveClasses.insert(i, schedulerClass)
+                return
+        self.ActiveClasses.append(schedulerClass)
+
+
+    def _GetClass(self, priority:int):
+        if priority is None:
+            return self.Classes[0]
+        for c in self.Classes:
+            if priority <= c.Priority:
+                return c
+        return self.Classes[-1]
+
+
+    # Must be called under lock and there must be at least one active class.
+    def _PopUnderLock(self):
+        while True:
+            schedulerClass = self.ActiveClasses[0]
+            stream = schedulerClass.PeekNextStream()
+            context, sizeBytes, queuedSec = stream.Queue[0]
+
+            # If the class can't afford the message this round, give it more credit and move on to the next class.
+            if sizeBytes > schedulerClass.Deficit:
+                schedulerClass.Deficit += schedulerClass.Quantum
+                self.ActiveClasses.rotate(-1)
+                continue
+
+            # Take the message.
+            stream.Queue.popleft()
+            stream.Deficit -= sizeBytes
+            schedulerClass.Deficit -= sizeBytes
+
+            # If the stream is empty, it's no longer active. Since it was picked, it's always at the front.
+            if len(stream.Queue) == 0:
+                schedulerClass.ActiveStreams.popleft()
+                del schedulerClass.Streams[stream.StreamId]
+                # If the class is empty, it's no longer active and it's deficit is reset, as DRR requires.
+                if len(schedulerClass.ActiveStreams) == 0:
+                    self.ActiveClasses.popleft()
+                    schedulerClass.Deficit = 0
+
+            # Update the stats.
+            waitSec = time.time() - queuedSec
+            schedulerClass.QueuedMessages -= 1
+            schedulerClass.QueuedBytes -= sizeBytes
+            schedulerClass.SentMessages += 1
+            schedulerClass.SentBytes += sizeBytes
+            schedulerClass.WaitTimeTotalSec += waitSec
+            schedulerClass.WaitTimeHighWaterMarkSec = max(schedulerClass.WaitTimeHighWaterMarkSec, waitSec)
+
+            # Release the message's bytes from the budget, once the message is taken it's being written to the socket.
+            self.TotalQueuedBytes -= sizeBytes
+            streamQueuedBytes = self.StreamQueuedBytes.get(stream.StreamId, 0) - sizeBytes
+            if streamQueuedBytes <= 0:
+                self.StreamQueuedBytes.pop(stream.StreamId, None)
+            else:
+                self.StreamQueuedBytes[stream.StreamId] = streamQueuedBytes
+            if self.BudgetWaiters > 0:
+                self.BudgetAvailable.notify_all()
+            if len(self.AsyncBudgetWaiters) > 0:
+                self._NotifyAsyncBudgetWaitersUnderLock()
+            return context
+
+
+    # Wakes the asyncio budget waiters. Each waiter is only woken once until it checks the budget again, so the loop isn't flooded.
+    # Must be called under lock.
+    def _NotifyAsyncBudgetWaitersUnderLock(self):
+        for waiter in self.AsyncBudgetWaiters:
+            if waiter.IsNotified:
+                continue
+            waiter.IsNotified = True
+            try:
+                waiter.Loop.call_soon_threadsafe(waiter.Event.set)
+            except RuntimeError:
+                # The loop is closed, so there's no one to wake.
+                pass
+
+
+# An asyncio task waiting for budget, see SendScheduler.WaitForBudgetAsync.
+class AsyncBudgetWaiter:
+
+    def __init__(self, loop):
+        self.Loop = loop
+        # The event must be created on the loop it's waited on.
+        self.Event = asyncio.Event()
+        self.IsNotified = False
+
+
+# The state for one priority class.
+class SendSchedulerClass:
+
+    def __init__(self, priority:int, name:str, quantum:int):
+        self.Priority = priority
+        self.Name = name
+        self.Quantum = quantum
+        self.Deficit = 0
+        # A map of stream id to stream, and the streams that have queued messages, in round-robin order.
+        self.Streams = {}
+        self.ActiveStreams = collections.deque()
+
+        # Stats
+        self.QueuedMessages = 0
+        self.QueuedBytes = 0
+        self.PeakQueuedMessages = 0
+        self.PeakQueuedBytes = 0
+        self.SentMessages = 0
+        self.SentBytes = 0
+        self.WaitTimeTotalSec = 0.0
+        self.WaitTimeHighWaterMarkSec = 0.0
+
+
+    # Returns the stream that should send next, using deficit round-robin.
+    # The stream that's returned will always be at the front of the active streams.
+    def PeekNextStream(self):
+        while True:
+            stream = self.ActiveStreams[0]
+            if stream.Queue[0][1] <= stream.Deficit:
+                return stream
+            stream.Deficit += SendScheduler.c_StreamQuantumBytes
+            self.ActiveStreams.rotate(-1)
+
+
+# The state for one stream within a priority class.
+class SendSchedulerStream:
+
+    def __init__(self, streamId:int):
+        self.StreamId = streamId
+        self.Deficit = 0
+        # A queue of tuples, (context, sizeBytes, queuedTimeSec)
+        self.Queue = collections.deque()
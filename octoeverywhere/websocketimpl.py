@@ -1,15 +1,21 @@
-import queue
 import threading
 import certifi
 import octowebsocket
-from octowebsocket import WebSocketApp
+from octowebsocket import WebSocketApp, ABNF
 
 from .sentry import Sentry
+from .sendscheduler import SendScheduler
 
 # This class gives a bit of an abstraction over the normal ws
 class Client:
 
-    def __init__(self, url, onWsOpen = None, onWsMsg = None, onWsData = None, onWsClose = None, onWsError = None, headers:dict = None, subProtocolList:list = None):
+    # When coalescing writes, this is the max number of bytes that will be gathered into one socket write.
+    # Any single message larger than this is sent on it's own, since the copy would cost more than the extra write.
+    c_CoalesceMaxWriteBytes = 64 * 1024
+
+    # If coalesceWrites is set, the send thread will drain everything that's queued and write the frames to the socket in as few writes as possible.
+    # This is a big win for the OctoStream connection, where many small messages are often queued at once, since each write is a TLS record and a syscall.
+    def __init__(self, url, onWsOpen = None, onWsMsg = None, onWsData = None, onWsClose = None, onWsError = None, headers:dict = None, subProtocolList:list = None, coalesceWrites:bool = False):
 
         # Set the default timeout for the socket. There's no other way to do this than this global var, and it will be shared by all websockets.
         # This is used when the system is writing or receiving, but not when it's waiting to receive, as that's a select()
@@ -25,8 +31,11 @@ class Client:
 
         # We use a send queue thread because it allows us to process downloads about 2x faster.
         # This is because the downstream work of the WS can be made faster if it's done in parallel
-        self.SendQueue = queue.Queue()
+        # The send queue is a scheduler, so large messages from one stream don't block small messages from other streams or higher priorities.
+        self.SendQueue = SendScheduler()
         self.SendThread:threading.Thread = None
+        self.CoalesceWrites = coalesceWrites
+        self.WriteStats = SendWriteStats()
 
         # Used to log more details about what's going on with the websocket.
         # websocket.enableTrace(True)
@@ -149,8 +158,8 @@ class Client:
 
         # Always ensure we close the send queue.
         try:
-            # Push an empty buffer to the send queue, which will close it.
-            self.SendQueue.put(SendQueueContext(None))
+            # Closing the send queue will wake the send thread, which will then exit.
+            self.SendQueue.Close()
         except Exception as e:
             Sentry.Exception("Exception while trying to close the send queue.", e)
 
@@ -189,22 +198,23 @@ class Client:
         self._Close()
 
 
-    def Send(self, buffer:bytearray, msgStartOffsetBytes:int = None, msgSize:int = None, isData:bool = True):
+    # The stream id and priority are used by the send scheduler, see SendScheduler. Messages that aren't part of a stream should use the defaults.
+    def Send(self, buffer:bytearray, msgStartOffsetBytes:int = None, msgSize:int = None, isData:bool = True, streamId:int = SendScheduler.c_NonStreamId, priority:int = None):
         if isData:
-            self.SendWithOptCode(buffer, msgStartOffsetBytes, msgSize, octowebsocket.ABNF.OPCODE_BINARY)
+            self.SendWithOptCode(buffer, msgStartOffsetBytes, msgSize, octowebsocket.ABNF.OPCODE_BINARY, streamId, priority)
         else:
-            self.SendWithOptCode(buffer, msgStartOffsetBytes, msgSize, octowebsocket.ABNF.OPCODE_TEXT)
+            self.SendWithOptCode(buffer, msgStartOffsetBytes, msgSize, octowebsocket.ABNF.OPCODE_TEXT, streamId, priority)
 
 
     # Sends a buffer, with an optional message start offset and size.
     # If the message start offset and size are not provided, it's assumed the buffer starts at 0 and the size is the full buffer.
     # Providing a bytearray with room in the front allows the system to avoid copying the buffer.
-    def SendWithOptCode(self, buffer:bytearray, msgStartOffsetBytes:int = None, msgSize:int = None, optCode = octowebsocket.ABNF.OPCODE_BINARY):
+    def SendWithOptCode(self, buffer:bytearray, msgStartOffsetBytes:int = None, msgSize:int = None, optCode = octowebsocket.ABNF.OPCODE_BINARY, streamId:int = SendScheduler.c_NonStreamId, priority:int = None):
         try:
             # Make sure we have a buffer, this is invalid and it will also shutdown our send thread.
             if buffer is None:
                 raise Exception("We tired to send a message to the websocket with a None buffer.")
-            self.SendQueue.put(SendQueueContext(buffer, msgStartOffsetBytes, msgSize, optCode))
+            self.SendQueue.Put(SendQueueContext(buffer, msgStartOffsetBytes, msgSize, optCode, streamId, priority))
         except Exception as e:
             # If any exception happens during sending, we want to report the error
             # and shutdown the entire websocket.
@@ -215,15 +225,19 @@ class Client:
         try:
             while self.isClosed is False:
                 # Wait on something to send.
-                context = self.SendQueue.get()
+                context = self.SendQueue.Get()
                 # If it's None, that means we are shutting down.
                 if context is None or context.Buffer is None:
                     return
+                if self.CoalesceWrites:
+                    self._SendCoalesced(context)
+                    continue
                 # Send it!
                 # Important! We don't want to use the frame mask because it adds about 30% CPU usage on low end devices.
                 # The frame masking was only need back when websockets were used over the internet without SSL.
                 # Our server, OctoPrint, and Moonraker all accept unmasked frames, so its safe to do this for all WS.
                 self.Ws.send(context.Buffer, context.OptCode, False, context.MsgStartOffsetBytes, context.MsgSize)
+                self.WriteStats.OnWrite(1, context.GetSendSizeBytes())
         except Exception as e:
             # If any exception happens during sending, we want to report the error
             # and shutdown the entire websocket.
@@ -235,6 +249,83 @@ class Client:
 
 
 
+    # Sends the context and anything else that's queued, gathering the frames into as few socket writes as possible.
+    # Each message is still it's own websocket frame, the frames are just written back to back.
+    def _SendCoalesced(self, context):
+        batch = bytearray()
+        batchFrames = 0
+        while context is not None and context.Buffer is not None:
+            # Format the frame, this adds the websocket header in front of the data, without a copy if there's room in the buffer.
+            # Like the normal send, we don't use the frame mask.
+            frameData = ABNF.create_frame(context.Buffer, context.OptCode, use_frame_mask=False, data_start_offset_bytes=context.MsgStartOffsetBytes, data_msg_length_bytes=context.MsgSize).format()
+            # If this frame would overflow the batch, flush what we have first.
+            if batchFrames > 0 and len(batch) + len(frameData) > Client.c_CoalesceMaxWriteBytes:
+                self._WriteRaw(batch, batchFrames)
+                batch = bytearray()
+                batchFrames = 0
+            # Large frames are written directly, to avoid the copy.
+            if len(frameData) >= Client.c_CoalesceMaxWriteBytes:
+                self._WriteRaw(frameData, 1)
+            else:
+                batch += frameData
+                batchFrames += 1
+            # Grab anything else that's ready to send, without blocking.
+            context = self.SendQueue.TryGet()
+        if batchFrames > 0:
+            self._WriteRaw(batch, batchFrames)
+
+
+    # Writes the already formatted frame data to the socket.
+    # This uses the same lock and send function as the websocket lib's send_frame, so it's safe with the lib's ping and close frames.
+    def _WriteRaw(self, data, frameCount:int):
+        sock = self.Ws.sock
+        if sock is None or sock.sock is None:
+            raise octowebsocket.WebSocketConnectionClosedException("Connection is already closed.")
+        data = memoryview(data)
+        length = len(data)
+        syscalls = 0
+        with sock.lock:
+            while len(data) > 0:
+                #pylint: disable=protected-access
+                sent = sock._send(data)
+                syscalls += 1
+                if sent == 0:
+                    raise octowebsocket.WebSocketConnectionClosedException("Connection is already closed.")
+                data = data[sent:]
+        self.WriteStats.OnWrite(frameCount, length, syscalls)
+
+
+    # Returns the frames per write and bytes per syscall stats.
+    def GetSendWriteStats(self) -> dict:
+        return self.WriteStats.GetStats()
+
+
+    # Returns the per priority class send queue stats.
+    def GetSendQueueStats(self) -> dict:
+        return self.SendQueue.GetStats()
+
+
+    # Blocks until the stream is within the send queue byte budget, see SendScheduler.WaitForBudget.
+    def WaitForSendBudget(self, streamId:int, timeoutSec:float) -> bool:
+        return self.SendQueue.WaitForBudget(streamId, timeoutSec)
+
+
+    # Waits without blocking until the stream is within the send queue byte budget, see SendScheduler.WaitForBudgetAsync.
+    # This is used by producers that run on the asyncio relay engine loop.
+    async def WaitForSendBudgetAsync(self, streamId:int, timeoutSec:float) -> bool:
+        return await self.SendQueue.WaitForBudgetAsync(streamId, timeoutSec)
+
+
+    # Returns the send queue byte budget stats.
+    def GetSendBudgetStats(self) -> dict:
+        return self.SendQueue.GetBudgetStats()
+
+
+    # Returns the bytes queued for the stream and the age of it's oldest queued message, see SendScheduler.GetStreamQueueState.
+    def GetStreamSendQueueState(self, streamId:int):
+        return self.SendQueue.GetStreamQueueState(streamId)
+
+
     # Support using with:
     def __enter__(self):
         return self
@@ -290,8 +381,58 @@ class Client:
 
 
 class SendQueueContext():
-    def __init__(self, buffer:bytearray, msgStartOffsetBytes:int = None, msgSize:int = None, optCode = octowebsocket.ABNF.OPCODE_BINARY) -> None:
+    def __init__(self, buffer:bytearray, msgStartOffsetBytes:int = None, msgSize:int = None, optCode = octowebsocket.ABNF.OPCODE_BINARY, streamId:int = SendScheduler.c_NonStreamId, priority:int = None) -> None:
         self.Buffer = buffer
         self.MsgStartOffsetBytes = msgStartOffsetBytes
         self.MsgSize = msgSize
         self.OptCode = optCode
+        self.StreamId = streamId
+        self.Priority = priority
+
+    # Returns the number of bytes that will be sent for this context.
+    def GetSendSizeBytes(self) -> int:
+        if self.MsgSize is not None:
+            return self.MsgSize
+        if self.Buffer is None:
+            return 0
+        if self.MsgStartOffsetBytes is not None:
+            return len(self.Buffer) - self.MsgStartOffsetBytes
+        return len(self.Buffer)
+
+
+# Tracks how many frames and bytes each socket write sends, for tuning the coalesced write mode.
+class SendWriteStats():
+    def __init__(self) -> None:
+        self.Lock = threading.Lock()
+        self.Writes = 0
+        self.Frames = 0
+        self.Bytes = 0
+        self.Syscalls = 0
+        self.FramesPerWriteHighWaterMark = 0
+
+
+    # A syscall count of None means it's unknown, like when the write is buffered by the asyncio transport.
+    def OnWrite(self, frames:int, sizeBytes:int, syscalls:int = None) -> None:
+        with self.Lock:
+            self.Writes += 1
+            self.Frames += frames
+            self.Bytes += sizeBytes
+            if syscalls is not None:
+                self.Syscalls += syscalls
+            self.FramesPerWriteHighWaterMark = max(self.FramesPerWriteHighWaterMark, frames)
+
+
+    def GetStats(self) -> dict:
+        with self.Lock:
+            stats = {
+                "Writes": self.Writes,
+                "Frames": self.Frames,
+                "Bytes": self.Bytes,
+                "FramesPerWrite": round(self.Frames / self.Writes, 2) if self.Writes > 0 else 0.0,
+                "FramesPerWriteHighWaterMark": self.FramesPerWriteHighWaterMark,
+                "BytesPerWrite": int(self.Bytes / self.Writes) if self.Writes > 0 else 0,
+            }
+            if self.Syscalls > 0:
+                stats["Syscalls"] = self.Syscalls
+                stats["BytesPerSyscall"] = int(self.Bytes / self.Syscalls)
+            return stats
@@ -15,6 +15,7 @@ from octoeverywhere.octohttprequest import OctoHttpRequest
 from octoeverywhere.notificationshandler import NotificationsHandler
 from octoeverywhere.octopingpong import OctoPingPong
 from octoeverywhere.httpsessions import HttpSessions
+from octoeverywhere.relaymetrics import RelayMetrics
 from octoeverywhere.compression import Compression
 from octoeverywhere.telemetry import Telemetry
 from octoeverywhere.deviceid import DeviceId
@@ -25,6 +26,7 @@ from octoeverywhere.Proto.ServerHost import ServerHost
 from octoeverywhere.commandhandler import CommandHandler
 from octoeverywhere.printinfo import PrintInfoManager
 from octoeverywhere.compat import Compat
+from octoeverywhere.relayoptions import RelayOptions
 
 
 from .printerstateobject import PrinterStateObject
@@ -157,6 +159,8 @@ class OctoeverywherePlugin(octoprint.plugin.StartupPlugin,
 
         # Setup the HttpSession cache early, so it can be used whenever
         HttpSessions.Init(self._logger)
+        # Setup the relay metrics early as well, so all of the hot paths can record to it.
+        RelayMetrics.Init(self._logger)
 
         # Setup Sentry to capture issues.
         # We can't enable tracing or profiling in OctoPrint, because it picks up a lot of OctoPrint functions.
@@ -184,6 +188,10 @@ class OctoeverywherePlugin(octoprint.plugin.StartupPlugin,
         # Setup compression
         Compression.Init(self._logger, self.get_plugin_data_folder())
 
+        # Setup the relay options, like the web stream execution mode, the optional caches, and the local http and webcam options.
+        # This is done here rather than in the main thread, since Slipstream uses the optional caches when it starts.
+        RelayOptions.LoadFromSettings(self._logger, self.GetFromSettings).Apply(self._logger, self.get_plugin_data_folder())
+
         # Init the static local auth helper
         LocalAuth.Init(self._logger, self._user_manager)
 
@@ -10,7 +10,9 @@ from octoeverywhere.octohttprequest import OctoHttpRequest
 from octoeverywhere.commandhandler import CommandHandler
 from octoeverywhere.octopingpong import OctoPingPong
 from octoeverywhere.httpsessions import HttpSessions
+from octoeverywhere.relaymetrics import RelayMetrics
 from octoeverywhere.compression import Compression
+from octoeverywhere.relayoptions import RelayOptions
 from octoeverywhere.telemetry import Telemetry
 from octoeverywhere.deviceid import DeviceId
 from octoeverywhere.sentry import Sentry
@@ -173,6 +175,8 @@ if __name__ == '__main__':
 
     # Setup the HttpSession cache early, so it can be used whenever
     HttpSessions.Init(logger)
+    # Setup the relay metrics early as well, so all of the hot paths can record to it.
+    RelayMetrics.Init(logger)
 
     # Init Sentry, but it won't report since we are in dev mode.
     Sentry.SetLogger(logger)
@@ -184,6 +188,9 @@ if __name__ == '__main__':
     # Setup compression
     Compression.Init(logger, PluginFilePathRoot)
 
+    # Setup the relay options, the dev runner always uses the defaults.
+    RelayOptions().Apply(logger, PluginFilePathRoot)
+
     # Init the mdns client
     MDns.Init(logger, PluginFilePathRoot)
     #MDns.Get().Test()
@@ -1,6 +1,8 @@
 import threading
 import time
 
+from requests.structures import CaseInsensitiveDict
+
 from octoeverywhere.sentry import Sentry
 from octoeverywhere.compat import Compat
 from octoeverywhere.octohttprequest import OctoHttpRequest
@@ -9,6 +11,7 @@ from octoeverywhere.WebStream.octoheaderimpl import HeaderHelper
 from octoeverywhere.WebStream.octoheaderimpl import BaseProtocol
 from octoeverywhere.octostreammsgbuilder import OctoStreamMsgBuilder
 from octoeverywhere.compression import Compression, CompressionContext
+from octoeverywhere.httpassetdiskstore import HttpAssetDiskStore
 
 from .localauth import LocalAuth
 
@@ -25,6 +28,10 @@ from .localauth import LocalAuth
 # We also pre-compress the response, so we can use a better compression quality and we don't have to compress it in realtime.
 #
 # This class has also been expanded to cache static resources required by the index that are large.
+#
+# If the HttpAssetDiskStore is enabled, the static resources are also written to it, so after a restart they can be served right away, before the index is
+# fetched again. Since the static resource paths include a version query string, a path that's already cached never needs to be fetched again.
+# The index itself isn't persisted, since it changes between boots.
 class Slipstream:
     # A const that defines the common cache path for the index.
     # This is a special case for the index, since we ignore query parameters and anchors for the cache lookup logic.
@@ -63,6 +70,9 @@ class Slipstream:
     ]
 
 
+    # The prefix of our keys in the disk store.
+    DiskStoreKeyPrefix = "slipstream|"
+
     # Logic for a static singleton
     _Instance = None
 
@@ -86,6 +96,9 @@ class Slipstream:
         self.IsRefreshing = False
         self.Cache = {}
 
+        # Load anything we cached before the last restart, so it's ready right away.
+        self._LoadFromDiskStore()
+
         # Kick off a thread to grab the initial index, no delay we build the cache ASAP.
         # Note on server boot this index cache call can take a long time (25-30s)
         self.UpdateCache(0)
@@ -139,15 +152,19 @@ class Slipstream:
 
         # We have our path, check if it's in the map
         with self.Lock:
-            if path in self.Cache:
-                # Note that this object can be updated!
-                # There's only once case right now, there's logic that will compare the cache header and convert the
-                # Object into a 304 response, which will strip some headers and the body buffer.
-                self.Logger.debug("Slipstream returning cached content for "+path)
-                return self.Cache[path]
-
-        # Otherwise return cache miss.
-        return None
+            cachedResult = self.Cache.get(path, None)
+        if cachedResult is None:
+            # Otherwise return cache miss.
+            return None
+
+        # Note that the returned object can be updated!
+        # There's only once case right now, there's logic that will compare the cache header and convert the
+        # Object into a 304 response, which will strip some headers and the body buffer.
+        # So we return a copy that shares the body buffer, so the cached object never changes.
+        self.Logger.debug("Slipstream returning cached content for "+path)
+        result = OctoHttpRequest.Result(cachedResult.StatusCode, cachedResult.Headers.copy(), cachedResult.Url, cachedResult.DidFallback)
+        result.SetFullBodyBuffer(cachedResult.FullBodyBuffer, cachedResult.BodyBufferCompressionType, cachedResult.BodyBufferPreCompressSize)
+        return result
 
 
     # Starts a async thread to update the index cache.
@@ -223,6 +240,7 @@ class Slipstream:
         # Now process the index to see if there's more we should cache.
         # We explicitly look for known files in the index should reference that are large.
         # If we don't find them, no big deal.
+        foundPaths = set()
         for subPath in Slipstream.OptionalPartialCachePaths:
             # This function will try to find the full url or path in the index body, including the query string.
             fullPath = self.TryToFindFullUrl(indexBodyStr, subPath)
@@ -230,16 +248,28 @@ class Slipstream:
             # No big deal if it can't be found.
             if fullPath is None:
                 continue
+            foundPaths.add(fullPath)
+
+            # If the path has a version query string and we already have it, there's no need to get it again.
+            with self.Lock:
+                if fullPath.find('?') != -1 and fullPath in self.Cache:
+                    continue
 
             # If we find it, try to cache it.
             result = self._GetCacheReadyOctoHttpResult(fullPath)
             if result is None:
                 continue
 
+            # Write it to the disk store, so it's ready after a restart.
+            self._SaveToDiskStore(fullPath, result)
+
             # Add it to our cache.
             with self.Lock:
                 self.Cache[fullPath] = result
 
+        # Remove anything that the index no longer uses.
+        self._RemoveUnusedPaths(foundPaths)
+
         self.Logger.info("Slipstream took "+str(time.time()-start)+" to fully update the cache")
 
 
@@ -338,6 +368,50 @@ class Slipstream:
         return None
 
 
+    # Loads any static resources we stored in the disk store before the last restart.
+    def _LoadFromDiskStore(self):
+        store = HttpAssetDiskStore.Get()
+        if store is None:
+            return
+        try:
+            for key in store.GetKeys(Slipstream.DiskStoreKeyPrefix):
+                entry = store.GetEntry(key)
+                if entry is None:
+                    continue
+                result = OctoHttpRequest.Result(200, CaseInsensitiveDict(entry.Headers), entry.Url, False)
+                result.SetFullBodyBuffer(entry.Buffer, entry.CompressionType, entry.OriginalSize)
+                with self.Lock:
+                    self.Cache[key[len(Slipstream.DiskStoreKeyPrefix):]] = result
+            self.Logger.info(f"Slipstream loaded {len(self.Cache)} cached items from the disk store.")
+        except Exception as e:
+            Sentry.Exception("Slipstream failed to load from the disk store.", e)
+
+
+    # Writes the result to the disk store. On success, the result's body is swapped to the memory mapped one from the store.
+    def _SaveToDiskStore(self, path, result:OctoHttpRequest.Result):
+        store = HttpAssetDiskStore.Get()
+        if store is None:
+            return
+        # The paths are versioned, so the fresh time isn't used.
+        mappedBuffer = store.Put(Slipstream.DiskStoreKeyPrefix + path, result.Url, result.Headers, result.FullBodyBuffer, result.BodyBufferCompressionType, result.BodyBufferPreCompressSize, 0, time.time())
+        if mappedBuffer is not None:
+            result.SetFullBodyBuffer(mappedBuffer, result.BodyBufferCompressionType, result.BodyBufferPreCompressSize)
+
+
+    # Removes any static resources from the memory cache and disk store that aren't in the found paths.
+    def _RemoveUnusedPaths(self, foundPaths:set):
+        with self.Lock:
+            for path in list(self.Cache.keys()):
+                if path != Slipstream.IndexCachePath and path not in foundPaths:
+                    del self.Cache[path]
+        store = HttpAssetDiskStore.Get()
+        if store is None:
+            return
+        for key in store.GetKeys(Slipstream.DiskStoreKeyPrefix):
+            if key[len(Slipstream.DiskStoreKeyPrefix):] not in foundPaths:
+                store.Remove(key)
+
+
     def RemoveCacheIfExists(self, url):
         with self.Lock:
             if url in self.Cache:
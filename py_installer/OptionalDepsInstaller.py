@@ -72,6 +72,9 @@ class OptionalDepsInstaller:
         # Try to install ffmpeg, this is required for RTSP streaming.
         OptionalDepsInstaller._DoFfmpegInstall(context)
 
+        # Try to install jpegtran, this is optional but allows snapshots to be rotated and flipped without re-encoding them.
+        OptionalDepsInstaller._DoJpegTranInstall(context)
+
 
     @staticmethod
     def _InstallZStandard(context:Context) -> None:
@@ -123,3 +126,22 @@ class OptionalDepsInstaller:
             OptionalDepsInstaller._ThreadStatus = "Ffmpeg install complete"
         except Exception as e:
             Logger.Debug(f"Error installing ffmpeg. {str(e)}")
+
+
+    @staticmethod
+    def _DoJpegTranInstall(context:Context) -> None:
+        try:
+            # We don't even try installing on K1 or SonicPad, we know it fail.
+            if context.OsType == OsTypes.K1 or context.OsType == OsTypes.SonicPad:
+                return
+
+            # jpegtran is part of the libjpeg-turbo tools.
+            Logger.Debug("Installing jpegtran, this might take a moment...")
+            OptionalDepsInstaller._ThreadStatus = "Installing jpegtran system libs..."
+            startSec = time.time()
+            (returnCode, stdOut, stdError) = Util.RunShellCommand("sudo apt-get install libjpeg-turbo-progs -y", False)
+            # Report the status to the installer log.
+            Logger.Debug(f"jpegtran install result. Code: {returnCode}, StdOut: {stdOut}, StdErr: {stdError}, Time: {time.time()-startSec}")
+            OptionalDepsInstaller._ThreadStatus = "jpegtran install complete"
+        except Exception as e:
+            Logger.Debug(f"Error installing jpegtran. {str(e)}")